@@ -1,16 +1,18 @@
+import hmac
 import os
-import types
+import time
 import logging
+from datetime import datetime, timezone
 from pymongo import UpdateOne
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 from config import (
     BOGOTA_TZ, cors_origins, allow_credentials,
@@ -31,78 +33,49 @@ scheduler = AsyncIOScheduler()
 @asynccontextmanager
 async def lifespan(app):
     # === STARTUP ===
+    from utils import loop_monitor
+    from utils.http_metrics import start_flushing
+    start_flushing()
+    loop_monitor.start()
     try:
         logger.info("Starting application initialization...")
 
+        # Per-phase startup timings, logged once startup completes.
+        timings = {}
+        phase_started = time.perf_counter()
+
+        def mark(phase):
+            nonlocal phase_started
+            now = time.perf_counter()
+            timings[phase] = round((now - phase_started) * 1000)
+            phase_started = now
+
         await db.command('ping')
         logger.info("MongoDB connection successful")
+        mark("ping")
 
         try:
             from create_indexes import create_indexes
             await create_indexes(db)
-            logger.info("Índices MongoDB verificados/creados exitosamente")
         except Exception as e:
             logger.warning(f"No se pudieron crear índices automáticamente: {e}")
+        mark("indexes")
 
-        try:
-            await db.rate_limits.create_index("expires_at", expireAfterSeconds=0, name="rate_limits_ttl")
-        except Exception as idx_err:
-            logger.warning(f"rate_limits_ttl index could not be created: {idx_err}")
-        try:
-            await db.rate_limits.create_index(
-                [("key", 1), ("timestamp", -1)], name="rate_limits_key_timestamp"
-            )
-        except Exception as idx_err:
-            # If there is an IndexKeySpecsConflict (code 86), the old index was created
-            # with a different sort direction. Drop and recreate it — this is safe because
-            # rate_limits is a performance-only index with no unique data; no documents
-            # are deleted when dropping an index.
-            if "IndexKeySpecsConflict" in str(idx_err) or getattr(idx_err, "code", None) == 86:
-                try:
-                    await db.rate_limits.drop_index("rate_limits_key_timestamp")
-                    await db.rate_limits.create_index(
-                        [("key", 1), ("timestamp", -1)], name="rate_limits_key_timestamp"
-                    )
-                    logger.info("rate_limits_key_timestamp index recreated with correct sort direction")
-                except Exception as recreate_err:
-                    logger.warning(f"rate_limits_key_timestamp index could not be recreated: {recreate_err}")
-            else:
-                logger.warning(f"rate_limits_key_timestamp index could not be created: {idx_err}")
-        try:
-            await db.scheduler_locks.create_index("expires_at", expireAfterSeconds=0, name="scheduler_locks_ttl")
-        except Exception as idx_err:
-            logger.debug(f"scheduler_locks_ttl index already exists or could not be created: {idx_err}")
-        try:
-            await db.scheduler_locks.create_index("lock_name", unique=True, name="scheduler_locks_unique")
-        except Exception as idx_err:
-            logger.debug(f"scheduler_locks_unique index already exists or could not be created: {idx_err}")
-        try:
-            await db.grade_changes.create_index(
-                [("student_id", 1), ("changed_at", -1)],
-                name="grade_changes_student_date"
-            )
-        except Exception as idx_err:
-            logger.debug(f"grade_changes_student_date index already exists or could not be created: {idx_err}")
-        try:
-            await db.refresh_tokens.create_index("expires_at", expireAfterSeconds=0, name="refresh_tokens_ttl")
-        except Exception as idx_err:
-            logger.debug(f"refresh_tokens_ttl index already exists or could not be created: {idx_err}")
-        try:
-            await db.refresh_tokens.create_index("token", unique=True, name="refresh_tokens_token_unique")
-        except Exception as idx_err:
-            logger.debug(f"refresh_tokens_token_unique index already exists or could not be created: {idx_err}")
-        try:
-            await db.refresh_tokens.create_index("user_id", name="refresh_tokens_user_id")
-        except Exception as idx_err:
-            logger.debug(f"refresh_tokens_user_id index already exists or could not be created: {idx_err}")
+        from migrations.runner import ensure_migrated
+        await ensure_migrated()
+        mark("migrations")
 
         await create_initial_data()
+        mark("initial_data")
 
         worker_id = os.environ.get("WORKER_ID")
         should_start_scheduler = worker_id is None or worker_id == "0"
         if should_start_scheduler:
             from routes.admin import check_and_close_modules
-            from scheduler.cleanup import cleanup_expired_data
+            from scheduler.cleanup import cleanup_expired_data, reconcile_stats_counters
+            from scheduler.rollups import rollup_daily_analytics
+            from scheduler.course_sweeper import sweep_course_deletions
+            from scheduler.orphan_collector import collect_orphans
 
             scheduler.add_job(
                 check_and_close_modules,
@@ -118,6 +91,46 @@ async def lifespan(app):
                 name='Cleanup Expired Tokens and Rate Limits',
                 replace_existing=True
             )
+            scheduler.add_job(
+                rollup_daily_analytics,
+                CronTrigger(hour=23, minute=50, timezone=BOGOTA_TZ),
+                id='rollup_daily_analytics',
+                name='Daily Analytics Rollups',
+                replace_existing=True
+            )
+            scheduler.add_job(
+                reconcile_stats_counters,
+                IntervalTrigger(minutes=30),
+                id='reconcile_stats_counters',
+                name='Reconcile /stats Counters',
+                next_run_time=datetime.now(timezone.utc),
+                replace_existing=True
+            )
+            # Recounts requested by bulk jobs whose background run found the lock taken.
+            scheduler.add_job(
+                reconcile_stats_counters,
+                IntervalTrigger(minutes=1),
+                kwargs={"only_if_requested": True},
+                id='reconcile_requested_stats_counters',
+                name='Serve Requested /stats Recounts',
+                replace_existing=True
+            )
+            # Also kicked right after each DELETE /courses/{id}; this run picks up
+            # deletions interrupted by a restart or a failed batch.
+            scheduler.add_job(
+                sweep_course_deletions,
+                IntervalTrigger(minutes=2),
+                id='sweep_course_deletions',
+                name='Sweep Deleted Courses',
+                replace_existing=True
+            )
+            scheduler.add_job(
+                collect_orphans,
+                IntervalTrigger(minutes=15),
+                id='collect_orphans',
+                name='Collect Orphaned Course Data',
+                replace_existing=True
+            )
             scheduler.start()
             logger.info("Automatic module closure scheduler started (runs daily at 02:00 AM Bogotá time / UTC-5)")
         else:
@@ -130,7 +143,12 @@ async def lifespan(app):
             except Exception as e:
                 logger.error(f"❌ AWS S3 bucket verification failed: {e}. PDF uploads will fail!")
 
-        logger.info("Application startup completed successfully")
+        mark("scheduler_and_storage")
+        logger.info(
+            "Application startup completed successfully ("
+            + ", ".join(f"{phase} {ms} ms" for phase, ms in timings.items())
+            + f", total {sum(timings.values())} ms)"
+        )
     except Exception as e:
         logger.error(f"Startup failed: {e}", exc_info=True)
         if "auth" in str(e).lower() or "connection" in str(e).lower() or "ServerSelectionTimeoutError" in type(e).__name__:
@@ -151,6 +169,14 @@ async def lifespan(app):
         logger.info("APScheduler shut down gracefully")
     except Exception as e:
         logger.warning(f"Error shutting down scheduler: {e}")
+    from utils import loop_monitor
+    from utils.http_metrics import stop_flushing
+    from utils.images import shutdown_image_pool
+    from utils.storage import close_backends
+    loop_monitor.stop()
+    stop_flushing()
+    shutdown_image_pool()
+    close_backends()
     client.close()
 
 
@@ -165,37 +191,85 @@ app.add_middleware(
 )
 
 
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        response = await call_next(request)
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-XSS-Protection"] = "1; mode=block"
-        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-        response.headers["Permissions-Policy"] = "camera=(), microphone=(), geolocation=()"
-        content_type = response.headers.get("content-type", "")
-        if "text/html" in content_type:
-            csp_directives = [
-                "default-src 'self'",
-                "script-src 'self'",
-                "style-src 'self' 'unsafe-inline'",
-                "img-src 'self' data: blob: https://*.amazonaws.com",
-                "font-src 'self' data:",
-                "connect-src 'self' https://*.onrender.com",
-                "frame-ancestors 'none'",
-                "base-uri 'self'",
-                "form-action 'self'",
-            ]
-            response.headers["Content-Security-Policy"] = "; ".join(csp_directives)
-        if request.url.scheme == "https":
-            response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
-        if request.url.path.startswith("/api/auth/"):
-            response.headers["Cache-Control"] = "no-store"
-        return response
+# Security headers, encoded once at import. Names are lowercase bytes as in ASGI messages.
+_SECURITY_HEADERS = [
+    (b"x-content-type-options", b"nosniff"),
+    (b"x-frame-options", b"DENY"),
+    (b"x-xss-protection", b"1; mode=block"),
+    (b"referrer-policy", b"strict-origin-when-cross-origin"),
+    (b"permissions-policy", b"camera=(), microphone=(), geolocation=()"),
+]
+_SECURITY_HEADER_NAMES = frozenset(name for name, _ in _SECURITY_HEADERS)
+_CSP_HEADER = (b"content-security-policy", "; ".join([
+    "default-src 'self'",
+    "script-src 'self'",
+    "style-src 'self' 'unsafe-inline'",
+    "img-src 'self' data: blob: https://*.amazonaws.com",
+    "font-src 'self' data:",
+    "connect-src 'self' https://*.onrender.com",
+    "frame-ancestors 'none'",
+    "base-uri 'self'",
+    "form-action 'self'",
+]).encode())
+_HSTS_HEADER = (b"strict-transport-security", b"max-age=31536000; includeSubDomains")
+_NO_STORE_HEADER = (b"cache-control", b"no-store")
+
+
+class SecurityHeadersMiddleware:
+    """Pure ASGI middleware adding the security headers on http.response.start.
+
+    Unlike BaseHTTPMiddleware it does not run the endpoint in a separate task or pipe the
+    body through a memory stream, so StreamingResponse bodies pass through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        https = scope.get("scheme") == "https"
+        auth_path = scope["path"].startswith("/api/auth/")
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                headers = []
+                html = has_cache_control = False
+                for name, value in message.get("headers", ()):
+                    name = name.lower()
+                    if name in _SECURITY_HEADER_NAMES:
+                        continue
+                    if name == b"content-type":
+                        html = b"text/html" in value
+                    elif name == b"cache-control":
+                        has_cache_control = True
+                    headers.append((name, value))
+                headers.extend(_SECURITY_HEADERS)
+                if html:
+                    headers = [h for h in headers if h[0] != b"content-security-policy"]
+                    headers.append(_CSP_HEADER)
+                if https:
+                    headers = [h for h in headers if h[0] != b"strict-transport-security"]
+                    headers.append(_HSTS_HEADER)
+                # Routes that opt into conditional GET (e.g. /api/auth/me) set their own
+                # "private, no-cache" policy; everything else under /api/auth/ stays no-store.
+                if auth_path and not has_cache_control:
+                    headers.append(_NO_STORE_HEADER)
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
 
 
 app.add_middleware(SecurityHeadersMiddleware)
 
+from utils.http_metrics import HttpMetricsMiddleware  # noqa: E402
+from utils.query_metrics import QueryMetricsMiddleware  # noqa: E402
+# Added last so it wraps HttpMetricsMiddleware, which reads the request's database time.
+app.add_middleware(HttpMetricsMiddleware)
+app.add_middleware(QueryMetricsMiddleware)
+
 
 @app.get("/api/health")
 async def health_check():
@@ -211,6 +285,24 @@ async def health_check():
         )
 
 
+@app.get("/api/metrics")
+async def metrics(request: Request):
+    """Per-route request metrics of every worker, in Prometheus text format.
+
+    Readable with "Authorization: Bearer <METRICS_TOKEN>" (for the scraper) or with an
+    admin session token, like the /admin metrics endpoints; never anonymously.
+    """
+    from config import METRICS_TOKEN
+    from utils.http_metrics import render_prometheus
+    from utils.security import get_current_user
+    auth = request.headers.get("authorization", "")
+    if not (METRICS_TOKEN and hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode())):
+        user = await get_current_user(auth or None)
+        if user["role"] != "admin":
+            return JSONResponse(status_code=403, content={"detail": "Solo admin"})
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled exception: {exc}", exc_info=True)
@@ -243,7 +335,10 @@ async def app_root():
 
 
 async def create_initial_data():
-    """Crea los usuarios y datos iniciales si no existen"""
+    """Crea los usuarios y datos iniciales si no existen.
+
+    Las correcciones de datos de una sola vez viven en migrations/versions.py.
+    """
     import uuid
     from datetime import datetime, timezone
     from pymongo import UpdateOne
@@ -355,18 +450,9 @@ async def create_initial_data():
                     {"$setOnInsert": subject_data},
                     upsert=True
                 ))
+    subjects_created = 0
     if subject_ops:
-        await db.subjects.bulk_write(subject_ops, ordered=False)
-
-    legacy_id_map = {
-        "user-editor-1": str(uuid.uuid5(uuid.NAMESPACE_OID, "user-editor-1")),
-        "user-prof-1":   str(uuid.uuid5(uuid.NAMESPACE_OID, "user-prof-1")),
-        "user-prof-2":   str(uuid.uuid5(uuid.NAMESPACE_OID, "user-prof-2")),
-    }
-    for old_id, new_id in legacy_id_map.items():
-        result = await db.users.update_one({"id": old_id}, {"$set": {"id": new_id}})
-        if result.modified_count > 0:
-            logger.info(f"Migrated legacy user ID: {old_id} -> {new_id}")
+        subjects_created = (await db.subjects.bulk_write(subject_ops, ordered=False)).upserted_count
 
     reset_users = os.environ.get('RESET_USERS', 'false').lower() == 'true'
     if reset_users:
@@ -381,6 +467,7 @@ async def create_initial_data():
         logger.info("Base de datos vacía. Creando usuarios iniciales...")
 
     create_seed_users = os.environ.get('CREATE_SEED_USERS', 'false').lower() == 'true'
+    users_created = 0
 
     if not create_seed_users:
         logger.info("CREATE_SEED_USERS=false: Omitiendo creación de usuarios semilla (modo producción)")
@@ -437,6 +524,7 @@ async def create_initial_data():
             result = await db.users.bulk_write(ops, ordered=False)
             created_count = result.upserted_count
 
+        users_created += created_count
         if created_count > 0:
             logger.info(f"Creados {created_count} usuarios semilla nuevos")
         else:
@@ -463,187 +551,15 @@ async def create_initial_data():
             "estado": "activo"
         }
         await db.users.insert_one(editor2_data)
+        users_created += 1
         logger.info(f"Editor user created: {editor2_email}")
     else:
         logger.info(f"Editor user already exists: {editor2_email}")
 
     logger.info(f"Total usuarios en sistema: {await db.users.count_documents({})}")
 
-    logger.info("Checking and fixing course subject_ids field...")
-    courses_to_fix = await db.courses.find(
-        {"$or": [
-            {"subject_ids": {"$exists": False}},
-            {"subject_ids": None},
-            {"subject_ids": []}
-        ]},
-        {"_id": 0}
-    ).to_list(1000)
-
-    fixed_count = 0
-    for course in courses_to_fix:
-        if course.get("subject_id") and (not course.get("subject_ids") or len(course.get("subject_ids", [])) == 0):
-            await db.courses.update_one(
-                {"id": course["id"]},
-                {"$set": {"subject_ids": [course["subject_id"]]}}
-            )
-            fixed_count += 1
-
-    if fixed_count > 0:
-        logger.info(f"Fixed {fixed_count} courses with missing subject_ids field")
-
-    logger.info("Checking and fixing user subject_ids field...")
-    users_to_fix = await db.users.find(
-        {"$or": [
-            {"subject_ids": {"$exists": False}},
-            {"subject_ids": None}
-        ]},
-        {"_id": 0}
-    ).to_list(1000)
-
-    fixed_user_count = 0
-    for user in users_to_fix:
-        await db.users.update_one(
-            {"id": user["id"]},
-            {"$set": {"subject_ids": []}}
-        )
-        fixed_user_count += 1
-
-    if fixed_user_count > 0:
-        logger.info(f"Fixed {fixed_user_count} users with missing subject_ids field")
-
-    logger.info("Checking and migrating student program_statuses field...")
-    students_to_migrate = await db.users.find(
-        {"role": "estudiante", "program_statuses": {"$exists": False}},
-        {"_id": 0, "id": 1, "program_ids": 1, "program_id": 1, "estado": 1}
-    ).to_list(5000)
-
-    migrated_count = 0
-    for student in students_to_migrate:
-        program_ids_list = student.get("program_ids") or []
-        if not program_ids_list and student.get("program_id"):
-            program_ids_list = [student["program_id"]]
-        if not program_ids_list:
-            continue
-        global_estado = student.get("estado", "activo") or "activo"
-        program_statuses = {pid: global_estado for pid in program_ids_list}
-        await db.users.update_one(
-            {"id": student["id"]},
-            {"$set": {"program_statuses": program_statuses}}
-        )
-        migrated_count += 1
-
-    if migrated_count > 0:
-        logger.info(f"Migrated {migrated_count} students: initialized program_statuses field")
-
-    logger.info("Migrating submissions without course_id field...")
-    # Build a lookup map of activity_id -> course_id to avoid N+1 queries
-    all_activities_for_migration = await db.activities.find(
-        {}, {"_id": 0, "id": 1, "course_id": 1}
-    ).to_list(50000)
-    activity_course_map = {
-        a["id"]: a["course_id"] for a in all_activities_for_migration if a.get("course_id")
-    }
-
-    migrated_submissions = 0
-    batch_size = 1000
-    skip = 0
-    while True:
-        batch = await db.submissions.find(
-            {"course_id": {"$exists": False}},
-            {"_id": 0, "id": 1, "activity_id": 1}
-        ).skip(skip).limit(batch_size).to_list(batch_size)
-        if not batch:
-            break
-        bulk_ops = []
-        for sub in batch:
-            course_id = activity_course_map.get(sub.get("activity_id"))
-            if course_id:
-                bulk_ops.append(UpdateOne({"id": sub["id"]}, {"$set": {"course_id": course_id}}))
-        if bulk_ops:
-            result = await db.submissions.bulk_write(bulk_ops, ordered=False)
-            migrated_submissions += result.modified_count
-        if len(batch) < batch_size:
-            break
-        skip += batch_size
-
-    if migrated_submissions > 0:
-        logger.info(f"Migrated {migrated_submissions} submissions: added course_id field")
-
-    logger.info("Checking for orphaned group/course data...")
-    existing_course_ids = [c["id"] for c in await db.courses.find({}, {"_id": 0, "id": 1}).to_list(None)]
-    total_submissions = await db.submissions.count_documents({})
-    # If submissions exist but only 1 course was loaded, the DB connection likely returned
-    # a partial result — skip the purge to prevent accidental data loss.
-    MIN_COURSES_FOR_PURGE = 2
-
-    if not existing_course_ids:
-        logger.warning(
-            "Orphan purge skipped: no courses found in DB. "
-            "This is safe on first startup. If courses exist and this warning persists, "
-            "check MongoDB connectivity."
-        )
-    elif total_submissions > 0 and len(existing_course_ids) < MIN_COURSES_FOR_PURGE:
-        logger.warning(
-            f"Orphan purge skipped: only {len(existing_course_ids)} course(s) found but "
-            f"{total_submissions} submission(s) exist. This may indicate a DB connection issue. "
-            "Skipping purge to prevent data loss."
-        )
-    else:
-        # Purge activities and course-level records orphaned from deleted courses
-        course_orphan_filter = {"course_id": {"$nin": existing_course_ids}}
-        orphan_activities = await db.activities.delete_many(course_orphan_filter)
-        orphan_recovery = await db.recovery_enabled.delete_many(course_orphan_filter)
-        orphan_failed = await db.failed_subjects.delete_many(course_orphan_filter)
-
-        # Purge grades orphaned from deleted courses (grades DO have course_id)
-        orphan_grades = await db.grades.delete_many(course_orphan_filter)
-
-        # Purge videos orphaned from deleted courses
-        orphan_videos = await db.class_videos.delete_many(course_orphan_filter)
-
-        # Recalculate activity IDs after purging orphan activities
-        # (some activities may have just been deleted above)
-        remaining_activity_ids = [a["id"] for a in await db.activities.find({}, {"_id": 0, "id": 1}).to_list(None)]
-
-        # Purge submissions orphaned from deleted activities
-        # IMPORTANT: submissions do NOT have course_id — they must be filtered by activity_id
-        if remaining_activity_ids:
-            orphan_count_preview = await db.submissions.count_documents(
-                {"activity_id": {"$nin": remaining_activity_ids}}
-            )
-            if orphan_count_preview > 0:
-                logger.info(f"About to purge {orphan_count_preview} orphaned submissions...")
-            orphan_submissions = await db.submissions.delete_many(
-                {"activity_id": {"$nin": remaining_activity_ids}}
-            )
-            if orphan_submissions.deleted_count != orphan_count_preview:
-                logger.warning(
-                    f"Submission purge mismatch: previewed {orphan_count_preview} "
-                    f"but deleted {orphan_submissions.deleted_count}."
-                )
-        else:
-            # No activities exist — skip submission purge to avoid wiping everything
-            # (this can happen on first startup or if DB is temporarily unavailable)
-            orphan_submissions = types.SimpleNamespace(deleted_count=0)
-            logger.warning(
-                "Submission orphan purge skipped: no activities found. "
-                "This protects submissions from accidental deletion on startup issues."
-            )
-
-        total_purged = (orphan_activities.deleted_count + orphan_grades.deleted_count +
-                        orphan_submissions.deleted_count + orphan_videos.deleted_count +
-                        orphan_recovery.deleted_count + orphan_failed.deleted_count)
-        if total_purged > 0:
-            logger.info(
-                f"Purged {total_purged} orphaned records: "
-                f"{orphan_activities.deleted_count} activities, "
-                f"{orphan_grades.deleted_count} grades, "
-                f"{orphan_submissions.deleted_count} submissions (by activity_id), "
-                f"{orphan_videos.deleted_count} videos, "
-                f"{orphan_recovery.deleted_count} recovery_enabled, "
-                f"{orphan_failed.deleted_count} failed_subjects"
-            )
-        else:
-            logger.info("No orphaned group/course data found")
+    if programs_created or subjects_created or users_created:
+        from utils.http_cache import bump_versions
+        await bump_versions("programs", "subjects", "courses", "students")
 
     logger.info("Datos iniciales verificados/creados exitosamente")
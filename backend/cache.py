@@ -1,26 +1,45 @@
 import time
 import logging
+from collections import OrderedDict
 from typing import Optional, Any
 
+from utils.http_cache import bump_versions, dashboard_version_keys
+
 logger = logging.getLogger(__name__)
 
 class TTLCache:
-    """Simple in-memory TTL cache for data that changes rarely."""
+    """Simple in-memory TTL cache for data that changes rarely.
+
+    With max_entries, a set that overflows the cache first drops the expired entries and
+    then the least recently used ones, so keys that are never read again do not pile up.
+    """
     
-    def __init__(self, ttl_seconds: int = 300):
-        self._cache: dict[str, tuple[float, Any]] = {}
+    def __init__(self, ttl_seconds: int = 300, max_entries: Optional[int] = None):
+        self._cache: OrderedDict[str, tuple[float, Any]] = OrderedDict()
         self._ttl = ttl_seconds
+        self._max_entries = max_entries
     
     def get(self, key: str) -> Optional[Any]:
         if key in self._cache:
             timestamp, value = self._cache[key]
             if time.time() - timestamp < self._ttl:
+                if self._max_entries:
+                    self._cache.move_to_end(key)
                 return value
             del self._cache[key]
         return None
     
     def set(self, key: str, value: Any):
-        self._cache[key] = (time.time(), value)
+        now = time.time()
+        self._cache[key] = (now, value)
+        if self._max_entries:
+            self._cache.move_to_end(key)
+            if len(self._cache) > self._max_entries:
+                # Entries are in last-use order, so the expired ones are not necessarily first.
+                for k in [k for k, (ts, _) in self._cache.items() if now - ts >= self._ttl]:
+                    del self._cache[k]
+                while len(self._cache) > self._max_entries:
+                    self._cache.popitem(last=False)
     
     def invalidate(self, key: str = None):
         if key:
@@ -28,7 +47,26 @@ class TTLCache:
         else:
             self._cache.clear()
 
+    def invalidate_prefix(self, prefix: str):
+        for key in [k for k in self._cache if k.startswith(prefix)]:
+            del self._cache[key]
+
 # Cache instances
 programs_cache = TTLCache(ttl_seconds=300)   # 5 minutes
 subjects_cache = TTLCache(ttl_seconds=300)   # 5 minutes
 recovery_panel_cache = TTLCache(ttl_seconds=45)  # 45 seconds — invalidated on any approval/rejection
+# Keyed "{course_id}:{student_id}:{subject_id}"; each entry keeps the stamps of the
+# dashboard entries of response_versions it was built under (see
+# utils.http_cache.dashboard_version_keys). Those are shared by every gunicorn worker, so
+# a write handled by one of them makes the entries cached by the others stale at once.
+student_dashboard_cache = TTLCache(ttl_seconds=120, max_entries=5000)
+
+
+async def invalidate_student_dashboard(course_id: str, student_id: str = None):
+    """Drop cached student dashboards for a whole course, or for one student in it."""
+    if not course_id:
+        return
+    course_key, student_key = dashboard_version_keys(course_id, student_id)
+    await bump_versions(student_key if student_id else course_key)
+    prefix = f"{course_id}:{student_id}:" if student_id else f"{course_id}:"
+    student_dashboard_cache.invalidate_prefix(prefix)
@@ -66,6 +66,45 @@ AUTO_RECOVERY_ENABLED_AT = os.environ.get('AUTO_RECOVERY_ENABLED_AT')
 # File upload
 UPLOAD_DIR = ROOT_DIR / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
+# When set (e.g. "/_protected_uploads/"), GET /files authorizes the request and hands the
+# file to nginx with X-Accel-Redirect instead of streaming it through Python. Must match
+# an `internal` location aliased to UPLOAD_DIR (see nginx.single-container.conf).
+FILES_ACCEL_REDIRECT_PREFIX = os.environ.get('FILES_ACCEL_REDIRECT_PREFIX') or None
+# Resumable upload sessions (POST /uploads/sessions): received chunks are written into one
+# file per session here and assembled into a normal upload on finalize.
+UPLOAD_SESSION_DIR = ROOT_DIR / "upload_sessions"
+UPLOAD_SESSION_DIR.mkdir(exist_ok=True)
+UPLOAD_SESSION_CHUNK_SIZE = int(os.environ.get('UPLOAD_SESSION_CHUNK_SIZE', str(1024 * 1024)))
+UPLOAD_SESSION_TTL_HOURS = int(os.environ.get('UPLOAD_SESSION_TTL_HOURS', '24'))
+
+# Image compression runs in a per-worker process pool so Pillow never blocks the event loop.
+IMAGE_POOL_WORKERS = int(os.environ.get('IMAGE_POOL_WORKERS', '1'))
+# Jobs running + waiting per gunicorn worker; beyond this, new jobs wait for a free slot
+# (up to IMAGE_POOL_QUEUE_WAIT seconds in a request, IMAGE_BACKGROUND_QUEUE_WAIT in
+# background processing, where uploads that found the pool full are queued).
+IMAGE_POOL_MAX_PENDING = int(os.environ.get('IMAGE_POOL_MAX_PENDING', '4'))
+IMAGE_POOL_QUEUE_WAIT = float(os.environ.get('IMAGE_POOL_QUEUE_WAIT', '10'))
+IMAGE_BACKGROUND_QUEUE_WAIT = float(os.environ.get('IMAGE_BACKGROUND_QUEUE_WAIT', '300'))
+IMAGE_JOB_TIMEOUT = float(os.environ.get('IMAGE_JOB_TIMEOUT', '15'))
+
+# MongoDB commands slower than this are logged with the route that issued them.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+
+# Per-route request metrics (utils/http_metrics.py). Each gunicorn worker writes its totals
+# to a file in METRICS_DIR every METRICS_FLUSH_SECONDS and GET /api/metrics merges them.
+# Without a usable directory /api/metrics only reports the worker that answers it.
+METRICS_DIR = os.environ.get('METRICS_DIR') or ('/dev/shm/webapp-metrics' if os.path.isdir('/dev/shm') else None)
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', '5'))
+# GET /api/metrics is never public: it accepts "Authorization: Bearer <METRICS_TOKEN>"
+# (set this for the Prometheus scraper) or an admin session token. Leave it unset to
+# restrict the endpoint to admins.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+
+# Event-loop lag watchdog (utils/loop_monitor.py): off unless LOOP_MONITOR=true. Stalls
+# longer than LOOP_LAG_THRESHOLD_MS are logged with the blocking call's stack.
+LOOP_MONITOR_ENABLED = os.environ.get('LOOP_MONITOR', 'false').lower() == 'true'
+LOOP_MONITOR_INTERVAL_MS = float(os.environ.get('LOOP_MONITOR_INTERVAL_MS', '250'))
+LOOP_LAG_THRESHOLD_MS = float(os.environ.get('LOOP_LAG_THRESHOLD_MS', '300'))
 
 # Cloudinary
 CLOUDINARY_CLOUD_NAME = os.environ.get('CLOUDINARY_CLOUD_NAME')
@@ -100,21 +139,36 @@ AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 AWS_S3_BUCKET_NAME = os.environ.get('AWS_S3_BUCKET_NAME')
 AWS_S3_REGION = os.environ.get('AWS_S3_REGION', 'us-east-1')
+# Optional S3-compatible endpoint (MinIO, LocalStack) for local development and tests.
+AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL') or None
 USE_S3 = bool(AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY and AWS_S3_BUCKET_NAME)
 
+# Threads per storage backend for blocking SDK / disk calls (see utils/storage.py).
+# The S3 client keeps the same number of pooled HTTP connections so workers never wait
+# on a connection.
+STORAGE_POOL_WORKERS = int(os.environ.get('STORAGE_POOL_WORKERS', '8'))
+
 s3_client = None
 if USE_S3:
     import boto3
+    from botocore.config import Config as _BotoConfig
     s3_client = boto3.client(
         's3',
         aws_access_key_id=AWS_ACCESS_KEY_ID,
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=AWS_S3_REGION
+        region_name=AWS_S3_REGION,
+        endpoint_url=AWS_S3_ENDPOINT_URL,
+        config=_BotoConfig(max_pool_connections=STORAGE_POOL_WORKERS, retries={"mode": "standard"}),
     )
     logger.info("AWS S3 configured – PDFs will use persistent S3 storage.")
 else:
     logger.warning("AWS S3 not configured – PDFs stored on ephemeral local disk.")
 
+# Lifetime of a presigned direct-upload URL (POST /uploads/presign). Uploads never
+# completed within PRESIGNED_UPLOAD_GRACE after expiry are deleted by cleanup_expired_data.
+PRESIGNED_UPLOAD_EXPIRES = int(os.environ.get('PRESIGNED_UPLOAD_EXPIRES', '900'))
+PRESIGNED_UPLOAD_GRACE = 3600
+
 # Production detection
 IS_PRODUCTION = any(os.environ.get(env) for env in ['RENDER', 'RAILWAY_ENVIRONMENT', 'DYNO'])
 
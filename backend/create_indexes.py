@@ -3,141 +3,295 @@ Script para crear índices en MongoDB.
 Ejecutar una vez antes de ir a producción:
     python create_indexes.py
 
-También se llama automáticamente al iniciar la aplicación.
+También se llama automáticamente al iniciar la aplicación; allí se omite por completo
+mientras la huella de INDEXES guardada en Mongo coincida (ver create_indexes()).
 """
 import asyncio
+import hashlib
+import json
 import logging
 import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Same list as utils.recovery_state.OPEN_STATES; repeated here so this script runs
+# without importing the app's database module.
+_OPEN_RECOVERY_STATES = ["pending", "approved", "completed_ok", "completed_rejected"]
+
+# Document in `index_state` holding the fingerprint of the last fully applied INDEXES.
+FINGERPRINT_DOC_ID = "indexes"
+# Document in `index_state` used as a lock so only one process compares and (re)creates
+# indexes. It lives here rather than in scheduler_locks because it has to work before
+# that collection's unique index exists: uniqueness of _id is what makes it exclusive.
+LOCK_DOC_ID = "lock"
+LOCK_TTL_SECONDS = 600
+
+# (collection, keys, options). Every entry needs a "name": that is what gets compared
+# against list_indexes() to decide what is missing.
+INDEXES = [
+    # users — email uniqueness only applies to non-null values (partialFilterExpression
+    # excludes documents where email is missing or null from the unique constraint,
+    # allowing multiple users such as students who have no email address).
+    ("users", [("email", 1)], {"unique": True, "partialFilterExpression": {"email": {"$type": "string"}}, "name": "users_email_unique"}),
+    ("users", [("cedula", 1)], {"sparse": True, "name": "users_cedula"}),
+    ("users", [("role", 1)], {"name": "users_role"}),
+    ("users", [("estado", 1)], {"name": "users_estado"}),
+    ("users", [("role", 1), ("estado", 1)], {"name": "users_role_estado"}),
+    ("users", [("name", 1)], {"name": "users_name"}),
+    # courses
+    ("courses", [("teacher_id", 1)], {"name": "courses_teacher_id"}),
+    ("courses", [("program_id", 1)], {"name": "courses_program_id"}),
+    # enrollments — one row per (course, student); see utils/enrollments.py
+    ("enrollments", [("course_id", 1), ("student_id", 1)], {"unique": True, "name": "enrollments_course_student_unique"}),
+    ("enrollments", [("course_id", 1), ("status", 1)], {"name": "enrollments_course_status"}),
+    ("enrollments", [("student_id", 1), ("status", 1)], {"name": "enrollments_student_status"}),
+    # enrollment conflict check: same program, other group
+    ("enrollments", [("program_id", 1), ("student_id", 1), ("status", 1)], {"name": "enrollments_program_student_status"}),
+    # grades
+    ("grades", [("student_id", 1)], {"name": "grades_student_id"}),
+    ("grades", [("course_id", 1)], {"name": "grades_course_id"}),
+    ("grades", [("activity_id", 1)], {"name": "grades_activity_id"}),
+    ("grades", [("student_id", 1), ("course_id", 1)], {"name": "grades_student_course"}),
+    ("grades", [("student_id", 1), ("course_id", 1), ("activity_id", 1)], {"name": "grades_student_course_activity"}),
+    ("grades", [("course_id", 1), ("subject_id", 1)], {"name": "grades_course_subject"}),
+    ("grades", [("student_id", 1), ("course_id", 1), ("subject_id", 1)], {"name": "grades_student_course_subject"}),
+    # submissions
+    ("submissions", [("student_id", 1)], {"name": "submissions_student_id"}),
+    ("submissions", [("course_id", 1)], {"name": "submissions_course_id"}),
+    ("submissions", [("activity_id", 1)], {"name": "submissions_activity_id"}),
+    ("submissions", [("activity_id", 1), ("student_id", 1)], {"unique": True, "name": "submissions_activity_student_unique"}),
+    ("submissions", [("activity_id", 1), ("submitted_at", -1)], {"name": "submissions_activity_submitted"}),
+    ("submissions", [("student_id", 1), ("activity_id", 1)], {"name": "submissions_student_activity"}),
+    # activities
+    ("activities", [("course_id", 1)], {"name": "activities_course_id"}),
+    ("activities", [("course_id", 1), ("subject_id", 1)], {"name": "activities_course_subject"}),
+    ("activities", [("due_date", 1)], {"name": "activities_due_date"}),
+    # compound for overdue-submissions query (auto-recovery feature)
+    ("activities", [("course_id", 1), ("subject_id", 1), ("due_date", 1), ("is_recovery", 1)], {"name": "activities_overdue_lookup"}),
+    # compound for start_date filtering (scheduled activities hidden from students)
+    ("activities", [("course_id", 1), ("subject_id", 1), ("start_date", 1)], {"name": "activities_course_subject_start"}),
+    # programs
+    ("programs", [("active", 1)], {"name": "programs_active"}),
+    # subjects
+    ("subjects", [("id", 1)], {"unique": True, "name": "subjects_id_unique"}),
+    ("subjects", [("program_id", 1)], {"name": "subjects_program_id"}),
+    ("subjects", [("program_id", 1), ("module_number", 1)], {"name": "subjects_program_module"}),
+    # module_closures
+    ("module_closures", [("program_id", 1), ("module_number", 1)], {"name": "module_closures_program_module"}),
+    # recovery_enabled
+    ("recovery_enabled", [("student_id", 1), ("course_id", 1)], {"name": "recovery_enabled_student_course"}),
+    # failed_subjects — queries filter on the `state` enum (utils/recovery_state.py).
+    # The partial indexes only hold open records, which is all recovery_close and the
+    # admin approval paths ever look at; processed history stays out of them.
+    ("failed_subjects", [("student_id", 1)], {"name": "failed_subjects_student_id"}),
+    ("failed_subjects", [("student_id", 1), ("course_id", 1), ("state", 1)], {"name": "failed_subjects_student_course_state"}),
+    ("failed_subjects", [("course_id", 1), ("state", 1), ("student_id", 1)], {"name": "failed_subjects_course_state_student"}),
+    ("failed_subjects", [("state", 1), ("course_id", 1)], {"name": "failed_subjects_state_course"}),
+    ("failed_subjects", [("course_id", 1), ("module_number", 1), ("state", 1)],
+     {"name": "failed_subjects_course_module_open", "partialFilterExpression": {"state": {"$in": _OPEN_RECOVERY_STATES}}}),
+    ("failed_subjects", [("program_id", 1), ("module_number", 1), ("state", 1)],
+     {"name": "failed_subjects_program_module_open", "partialFilterExpression": {"state": {"$in": _OPEN_RECOVERY_STATES}}}),
+    ("failed_subjects", [("student_id", 1), ("program_id", 1), ("module_number", 1), ("state", 1)],
+     {"name": "failed_subjects_student_program_module_open", "partialFilterExpression": {"state": {"$in": _OPEN_RECOVERY_STATES}}}),
+    # Additional indexes for scheduler performance
+    ("users", [("id", 1)], {"unique": True, "name": "users_id_unique"}),
+    ("grades", [("course_id", 1), ("student_id", 1), ("value", 1)], {"name": "grades_course_student_value"}),
+    ("courses", [("id", 1)], {"unique": True, "name": "courses_id_unique"}),
+    # response_versions — ETag stamps for conditional GET
+    ("response_versions", [("key", 1)], {"unique": True, "name": "response_versions_key_unique"}),
+    # analytics_rollups — one snapshot per day/program/module
+    ("analytics_rollups", [("date", 1), ("program_id", 1), ("module_number", 1)],
+     {"unique": True, "name": "analytics_rollups_date_program_module"}),
+    ("analytics_rollups", [("program_id", 1), ("module_number", 1), ("date", 1)],
+     {"name": "analytics_rollups_program_module_date"}),
+    # file_blobs — content-addressed uploads with reference counts
+    ("file_blobs", [("storage", 1), ("sha256", 1), ("ext", 1)], {"unique": True, "name": "file_blobs_content_unique"}),
+    ("file_blobs", [("storage", 1), ("stored_name", 1)], {"name": "file_blobs_stored_name"}),
+    # upload_sessions — resumable uploads (POST /uploads/sessions)
+    ("upload_sessions", [("id", 1)], {"unique": True, "name": "upload_sessions_id_unique"}),
+    ("upload_sessions", [("expires_at", 1)], {"name": "upload_sessions_expires_at"}),
+    # course_deletions — tombstones swept by scheduler/course_sweeper.py
+    ("course_deletions", [("course_id", 1)], {"unique": True, "name": "course_deletions_course_id_unique"}),
+    ("course_deletions", [("status", 1), ("requested_at", -1)], {"name": "course_deletions_status_requested"}),
+    # upload_intents — pending presigned uploads (POST /uploads/presign)
+    ("upload_intents", [("id", 1)], {"unique": True, "name": "upload_intents_id_unique"}),
+    ("upload_intents", [("expires_at", 1)], {"name": "upload_intents_expires_at"}),
+    # refresh_tokens
+    ("refresh_tokens", [("token", 1)], {"unique": True, "name": "refresh_tokens_token_unique"}),
+    ("refresh_tokens", [("user_id", 1)], {"name": "refresh_tokens_user_id"}),
+    # rate_limits — TTL index to auto-expire documents + compound for query performance
+    ("rate_limits", [("expires_at", 1)], {"expireAfterSeconds": 0, "name": "rate_limits_ttl"}),
+    ("rate_limits", [("key", 1), ("timestamp", -1)], {"name": "rate_limits_key_timestamp"}),
+    # audit_logs — TTL index (90-day retention) + query performance indexes
+    ("audit_logs", [("expires_at", 1)], {"expireAfterSeconds": 0, "name": "audit_logs_ttl"}),
+    ("audit_logs", [("timestamp", -1)], {"name": "audit_logs_timestamp"}),
+    ("audit_logs", [("user_id", 1), ("action", 1)], {"name": "audit_logs_user_action"}),
+    # grade_changes — query index + TTL index (1-year retention)
+    ("grade_changes", [("grade_id", 1)], {"name": "grade_changes_grade_id"}),
+    ("grade_changes", [("changed_at", 1)], {"expireAfterSeconds": 365 * 24 * 3600, "name": "grade_changes_ttl"}),
+    # module_closures — compound index for scheduler lookup query
+    ("module_closures", [("program_id", 1), ("module_number", 1), ("closed_date", 1)], {"name": "module_closures_lookup", "unique": True}),
+    # class_videos
+    ("class_videos", [("course_id", 1)], {"name": "class_videos_course_id"}),
+    ("class_videos", [("course_id", 1), ("subject_id", 1)], {"name": "class_videos_course_subject"}),
+    ("class_videos", [("created_by", 1)], {"name": "class_videos_created_by"}),
+    ("class_videos", [("video_group_id", 1)], {"sparse": True, "name": "class_videos_group_id"}),
+    # activity groups
+    ("activities", [("activity_group_id", 1)], {"sparse": True, "name": "activities_group_id"}),
+    # scheduler_locks — distributed locks for scheduler jobs and migrations
+    ("scheduler_locks", [("lock_name", 1)], {"unique": True, "name": "scheduler_locks_unique"}),
+    ("scheduler_locks", [("expires_at", 1)], {"expireAfterSeconds": 0, "name": "scheduler_locks_ttl"}),
+    ("grade_changes", [("student_id", 1), ("changed_at", -1)], {"name": "grade_changes_student_date"}),
+    ("refresh_tokens", [("expires_at", 1)], {"expireAfterSeconds": 0, "name": "refresh_tokens_ttl"}),
+]
+
+# Opciones que se comparan con el índice existente; si difieren, se recrea.
+_COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def index_fingerprint() -> str:
+    """Hash de la especificación completa: cambia con cualquier índice nuevo o modificado."""
+    return hashlib.sha256(json.dumps(INDEXES, sort_keys=True).encode()).hexdigest()
+
 
-async def create_indexes(db):
-    """Crea todos los índices necesarios para rendimiento óptimo."""
-    indexes = [
-        # users — email uniqueness only applies to non-null values (partialFilterExpression
-        # excludes documents where email is missing or null from the unique constraint,
-        # allowing multiple users such as students who have no email address).
-        ("users", [("email", 1)], {"unique": True, "partialFilterExpression": {"email": {"$type": "string"}}, "name": "users_email_unique"}),
-        ("users", [("cedula", 1)], {"sparse": True, "name": "users_cedula"}),
-        ("users", [("role", 1)], {"name": "users_role"}),
-        ("users", [("estado", 1)], {"name": "users_estado"}),
-        ("users", [("role", 1), ("estado", 1)], {"name": "users_role_estado"}),
-        ("users", [("name", 1)], {"name": "users_name"}),
-        # courses
-        ("courses", [("teacher_id", 1)], {"name": "courses_teacher_id"}),
-        ("courses", [("program_id", 1)], {"name": "courses_program_id"}),
-        ("courses", [("student_ids", 1)], {"name": "courses_student_ids"}),
-        # compound for enrollment conflict check (was missing, caused slow scans)
-        ("courses", [("program_id", 1), ("student_ids", 1)], {"name": "courses_program_students"}),
-        # grades
-        ("grades", [("student_id", 1)], {"name": "grades_student_id"}),
-        ("grades", [("course_id", 1)], {"name": "grades_course_id"}),
-        ("grades", [("activity_id", 1)], {"name": "grades_activity_id"}),
-        ("grades", [("student_id", 1), ("course_id", 1)], {"name": "grades_student_course"}),
-        ("grades", [("student_id", 1), ("course_id", 1), ("activity_id", 1)], {"name": "grades_student_course_activity"}),
-        ("grades", [("course_id", 1), ("subject_id", 1)], {"name": "grades_course_subject"}),
-        ("grades", [("student_id", 1), ("course_id", 1), ("subject_id", 1)], {"name": "grades_student_course_subject"}),
-        # submissions
-        ("submissions", [("student_id", 1)], {"name": "submissions_student_id"}),
-        ("submissions", [("course_id", 1)], {"name": "submissions_course_id"}),
-        ("submissions", [("activity_id", 1)], {"name": "submissions_activity_id"}),
-        ("submissions", [("activity_id", 1), ("student_id", 1)], {"unique": True, "name": "submissions_activity_student_unique"}),
-        ("submissions", [("activity_id", 1), ("submitted_at", -1)], {"name": "submissions_activity_submitted"}),
-        ("submissions", [("student_id", 1), ("activity_id", 1)], {"name": "submissions_student_activity"}),
-        # activities
-        ("activities", [("course_id", 1)], {"name": "activities_course_id"}),
-        ("activities", [("course_id", 1), ("subject_id", 1)], {"name": "activities_course_subject"}),
-        ("activities", [("due_date", 1)], {"name": "activities_due_date"}),
-        # compound for overdue-submissions query (auto-recovery feature)
-        ("activities", [("course_id", 1), ("subject_id", 1), ("due_date", 1), ("is_recovery", 1)], {"name": "activities_overdue_lookup"}),
-        # compound for start_date filtering (scheduled activities hidden from students)
-        ("activities", [("course_id", 1), ("subject_id", 1), ("start_date", 1)], {"name": "activities_course_subject_start"}),
-        # programs
-        ("programs", [("active", 1)], {"name": "programs_active"}),
-        # subjects
-        ("subjects", [("id", 1)], {"unique": True, "name": "subjects_id_unique"}),
-        ("subjects", [("program_id", 1)], {"name": "subjects_program_id"}),
-        ("subjects", [("program_id", 1), ("module_number", 1)], {"name": "subjects_program_module"}),
-        # module_closures
-        ("module_closures", [("program_id", 1), ("module_number", 1)], {"name": "module_closures_program_module"}),
-        # recovery_enabled
-        ("recovery_enabled", [("student_id", 1), ("course_id", 1)], {"name": "recovery_enabled_student_course"}),
-        # failed_subjects
-        ("failed_subjects", [("student_id", 1)], {"name": "failed_subjects_student_id"}),
-        ("failed_subjects", [("course_id", 1), ("recovery_processed", 1), ("student_id", 1)], {"name": "failed_subjects_course_processed_student"}),
-        ("failed_subjects", [("student_id", 1), ("course_id", 1)], {"name": "failed_subjects_student_course"}),
-        ("failed_subjects", [("course_id", 1), ("module_number", 1), ("recovery_processed", 1)], {"name": "failed_subjects_course_module_processed"}),
-        ("failed_subjects", [("course_id", 1), ("module_number", 1), ("recovery_processed", 1), ("recovery_expired", 1)],
-         {"name": "failed_subjects_course_module_recovery"}),
-        ("failed_subjects", [("recovery_approved", 1), ("recovery_completed", 1), ("recovery_processed", 1), ("recovery_rejected", 1)], {"name": "failed_subjects_recovery_state"}),
-        # Additional indexes for scheduler performance
-        ("users", [("id", 1)], {"unique": True, "name": "users_id_unique"}),
-        ("failed_subjects", [("student_id", 1), ("recovery_processed", 1), ("recovery_expired", 1)], {"name": "failed_subjects_student_processed_expired"}),
-        ("grades", [("course_id", 1), ("student_id", 1), ("value", 1)], {"name": "grades_course_student_value"}),
-        ("courses", [("id", 1)], {"unique": True, "name": "courses_id_unique"}),
-        # refresh_tokens
-        ("refresh_tokens", [("token", 1)], {"unique": True, "name": "refresh_tokens_token_unique"}),
-        ("refresh_tokens", [("user_id", 1)], {"name": "refresh_tokens_user_id"}),
-        # rate_limits — TTL index to auto-expire documents + compound for query performance
-        ("rate_limits", [("expires_at", 1)], {"expireAfterSeconds": 0, "name": "rate_limits_ttl"}),
-        ("rate_limits", [("key", 1), ("timestamp", -1)], {"name": "rate_limits_key_timestamp"}),
-        # audit_logs — TTL index (90-day retention) + query performance indexes
-        ("audit_logs", [("expires_at", 1)], {"expireAfterSeconds": 0, "name": "audit_logs_ttl"}),
-        ("audit_logs", [("timestamp", -1)], {"name": "audit_logs_timestamp"}),
-        ("audit_logs", [("user_id", 1), ("action", 1)], {"name": "audit_logs_user_action"}),
-        # grade_changes — query index + TTL index (1-year retention)
-        ("grade_changes", [("grade_id", 1)], {"name": "grade_changes_grade_id"}),
-        ("grade_changes", [("changed_at", 1)], {"expireAfterSeconds": 365 * 24 * 3600, "name": "grade_changes_ttl"}),
-        # module_closures — compound index for scheduler lookup query
-        ("module_closures", [("program_id", 1), ("module_number", 1), ("closed_date", 1)], {"name": "module_closures_lookup", "unique": True}),
-        # class_videos
-        ("class_videos", [("course_id", 1)], {"name": "class_videos_course_id"}),
-        ("class_videos", [("course_id", 1), ("subject_id", 1)], {"name": "class_videos_course_subject"}),
-        ("class_videos", [("created_by", 1)], {"name": "class_videos_created_by"}),
-        ("class_videos", [("video_group_id", 1)], {"sparse": True, "name": "class_videos_group_id"}),
-        # activity groups
-        ("activities", [("activity_group_id", 1)], {"sparse": True, "name": "activities_group_id"}),
-    ]
-
-    created = 0
-    skipped = 0
-    errors = 0
-
-    for collection_name, keys, options in indexes:
+def _matches(existing: dict, keys: list, options: dict) -> bool:
+    if [(k, v) for k, v in existing["key"].items()] != [tuple(k) for k in keys]:
+        return False
+    return all(existing.get(opt) == options.get(opt) for opt in _COMPARED_OPTIONS)
+
+
+async def _sync_collection(db, collection_name: str, specs: list) -> dict:
+    """Crea, en una sola llamada, los índices que faltan en una colección y recrea los que
+    existen con otra definición. Eliminar un índice no borra documentos."""
+    result = {"created": [], "recreated": [], "existing": 0, "errors": []}
+    try:
+        existing = {ix["name"]: ix async for ix in db[collection_name].list_indexes()}
+    except Exception:
+        existing = {}  # la colección aún no existe
+
+    missing = []
+    for keys, options in specs:
+        current = existing.get(options["name"])
+        if current is None:
+            missing.append((keys, options))
+        elif _matches(current, keys, options):
+            result["existing"] += 1
+        else:
+            try:
+                await db[collection_name].drop_index(options["name"])
+                await db[collection_name].create_index(keys, **options)
+                result["recreated"].append(options["name"])
+            except Exception as e:
+                result["errors"].append(f"{collection_name}.{options['name']}: {e}")
+
+    if missing:
         try:
-            background_options = {**options, "background": True}
-            await db[collection_name].create_index(keys, **background_options)
-            logger.info(f"Índice creado/verificado: {collection_name}.{options.get('name', str(keys))}")
-            created += 1
-        except Exception as e:
-            if "IndexOptionsConflict" in type(e).__name__ or "IndexOptionsConflict" in str(e) \
-                    or "IndexKeySpecsConflict" in str(e) or getattr(e, "code", None) == 86:
-                # Index exists with different options or key specs — drop and recreate so the
-                # new definition takes effect. Dropping an index does NOT delete any documents;
-                # only the index metadata changes. Data is fully preserved.
-                index_name = options.get("name")
+            await db[collection_name].create_indexes([IndexModel(keys, **options) for keys, options in missing])
+            result["created"].extend(options["name"] for _, options in missing)
+        except Exception:
+            # Alguno falló (p. ej. las mismas claves con otro nombre): se crean uno a uno
+            # para no perder los demás y reportar el que falla.
+            for keys, options in missing:
                 try:
-                    if index_name:
-                        await db[collection_name].drop_index(index_name)
-                    background_options = {**options, "background": True}
-                    await db[collection_name].create_index(keys, **background_options)
-                    logger.info(f"Índice recreado con nuevas opciones: {collection_name}.{index_name}")
-                    created += 1
-                except Exception as recreate_e:
-                    logger.error(f"Error recreando índice en {collection_name}.{index_name}: {recreate_e}")
-                    errors += 1
-            elif "already exists" in str(e).lower():
-                skipped += 1
-            else:
-                logger.error(f"Error creando índice en {collection_name}: {e}")
-                errors += 1
-
-    logger.info(f"Índices: {created} creados/verificados, {skipped} ya existían, {errors} errores")
-    return {"created": created, "skipped": skipped, "errors": errors}
+                    await db[collection_name].create_index(keys, **options)
+                    result["created"].append(options["name"])
+                except Exception as e:
+                    result["errors"].append(f"{collection_name}.{options['name']}: {e}")
+    return result
+
+
+def _lock_owner() -> str:
+    return f"worker-{os.environ.get('WORKER_ID', 'unknown')}-{os.getpid()}"
+
+
+async def _acquire_lock(db) -> bool:
+    """Toma el lock de índices; False si otro proceso lo tiene y no ha expirado."""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.index_state.update_one(
+            {"_id": LOCK_DOC_ID, "expires_at": {"$lt": now}},
+            {"$set": {"locked_by": _lock_owner(), "expires_at": now + timedelta(seconds=LOCK_TTL_SECONDS)}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+async def _release_lock(db):
+    await db.index_state.delete_one({"_id": LOCK_DOC_ID, "locked_by": _lock_owner()})
+
+
+async def create_indexes(db, force: bool = False) -> dict:
+    """Asegura todos los índices de INDEXES y devuelve un reporte.
+
+    Si la huella guardada en `index_state` coincide con la especificación actual no se
+    hace nada más (una sola lectura). Si no, se compara list_indexes() de cada colección
+    con la especificación y solo se crean los que faltan, todas las colecciones en
+    paralelo. La huella se guarda únicamente si no hubo errores.
+
+    La comparación y creación se hacen con un lock: con varios workers arrancando a la
+    vez, solo uno toca los índices y los demás lo omiten (reporte con "locked": True).
+    """
+    started = time.perf_counter()
+    fingerprint = index_fingerprint()
+    if not force:
+        stored = await db.index_state.find_one({"_id": FINGERPRINT_DOC_ID})
+        if stored and stored.get("fingerprint") == fingerprint:
+            report = {"skipped": True, "duration_ms": round((time.perf_counter() - started) * 1000)}
+            logger.info(f"Índices al día (huella {fingerprint[:12]}): {report['duration_ms']} ms")
+            return report
+
+    if not await _acquire_lock(db):
+        report = {"skipped": True, "locked": True, "duration_ms": round((time.perf_counter() - started) * 1000)}
+        logger.info("Otro proceso está actualizando los índices; se omite")
+        return report
+    try:
+        report = await _sync_all(db, fingerprint)
+    finally:
+        await _release_lock(db)
+    report["duration_ms"] = round((time.perf_counter() - started) * 1000)
+    logger.info(
+        f"Índices: {len(report['created'])} creados, {len(report['recreated'])} recreados, "
+        f"{report['existing']} ya existían, {len(report['errors'])} errores en {report['duration_ms']} ms"
+    )
+    for error in report["errors"]:
+        logger.error(f"Error creando índice {error}")
+    return report
+
+
+async def _sync_all(db, fingerprint: str) -> dict:
+    by_collection: dict = {}
+    for collection_name, keys, options in INDEXES:
+        by_collection.setdefault(collection_name, []).append((keys, options))
+    results = await asyncio.gather(*(
+        _sync_collection(db, name, specs) for name, specs in by_collection.items()
+    ))
+
+    report = {
+        "skipped": False,
+        "created": [n for r in results for n in r["created"]],
+        "recreated": [n for r in results for n in r["recreated"]],
+        "existing": sum(r["existing"] for r in results),
+        "errors": [e for r in results for e in r["errors"]],
+    }
+    if not report["errors"]:
+        await db.index_state.replace_one(
+            {"_id": FINGERPRINT_DOC_ID},
+            {"fingerprint": fingerprint, "applied_at": datetime.now(timezone.utc).isoformat(),
+             "created": report["created"], "recreated": report["recreated"]},
+            upsert=True,
+        )
+    return report
 
 
 async def main():
@@ -146,7 +300,8 @@ async def main():
     client = AsyncIOMotorClient(mongo_url)
     db = client[db_name]
     print(f"Conectando a MongoDB: {db_name}")
-    result = await create_indexes(db)
+    # Ejecutado a mano, siempre compara contra list_indexes() aunque la huella coincida.
+    result = await create_indexes(db, force="--check-fingerprint" not in sys.argv)
     print(f"Resultado: {result}")
     client.close()
 
@@ -2,6 +2,7 @@ import os
 import logging
 from motor.motor_asyncio import AsyncIOMotorClient
 from config import redact_mongo_url
+from utils.query_metrics import QueryMetricsListener
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +17,7 @@ try:
         maxIdleTimeMS=30000,
         connectTimeoutMS=5000,
         serverSelectionTimeoutMS=5000,
+        event_listeners=[QueryMetricsListener()],
     )
     db = client[os.environ.get('DB_NAME', 'WebApp')]
     logger.info(f"MongoDB client initialized for database: {os.environ.get('DB_NAME', 'WebApp')}")
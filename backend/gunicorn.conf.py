@@ -22,6 +22,16 @@ def post_fork(server, worker):
     os.environ["WORKER_ID"] = str(_worker_counter)
     _worker_counter += 1
 
+def on_starting(server):
+    """Start /api/metrics from zero: drop files left by a previous run."""
+    from utils.http_metrics import clear_directory
+    clear_directory()
+
+def child_exit(server, worker):
+    """Keep an exited worker's request counters (max_requests restarts, crashes)."""
+    from utils.http_metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+
 # Clase de worker: uvicorn para FastAPI async
 worker_class = "uvicorn.workers.UvicornWorker"
 
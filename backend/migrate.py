@@ -0,0 +1,57 @@
+"""
+Script para aplicar las migraciones de datos pendientes (migrations/versions.py).
+Uso:
+    python migrate.py           # aplica las pendientes
+    python migrate.py status    # muestra aplicadas y pendientes
+
+Los workers también las aplican al iniciar si la versión registrada está atrasada;
+ejecutarlo antes de un despliegue evita que ese trabajo caiga en el arranque.
+"""
+import asyncio
+import logging
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database import client  # noqa: E402
+from migrations.runner import applied_migrations, current_version, run_pending  # noqa: E402
+from migrations.versions import MIGRATIONS  # noqa: E402
+
+
+async def status():
+    applied = await applied_migrations()
+    print(f"Versión registrada: {await current_version()}")
+    for migration in MIGRATIONS:
+        record = applied.get(migration.number)
+        mark = f"aplicada {record['applied_at']} ({record.get('duration_ms', '?')} ms)" if record else "PENDIENTE"
+        print(f"  {migration.number:03d} {migration.name:<32} {mark}")
+
+
+async def up() -> int:
+    applied = await run_pending()
+    if applied is None:
+        print("Otro proceso está aplicando migraciones; inténtelo más tarde.")
+        return 1
+    print(f"Migraciones aplicadas: {', '.join(applied) if applied else 'ninguna (al día)'}")
+    return 0
+
+
+async def main(argv: list) -> int:
+    command = argv[0] if argv else "up"
+    try:
+        if command == "status":
+            await status()
+            return 0
+        if command == "up":
+            return await up()
+        print(__doc__)
+        return 2
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sys.exit(asyncio.run(main(sys.argv[1:])))
@@ -0,0 +1,110 @@
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from database import db
+from migrations.versions import MIGRATIONS
+from scheduler.cleanup import acquire_scheduler_lock, extend_scheduler_lock, release_scheduler_lock
+
+logger = logging.getLogger(__name__)
+
+# `schema_migrations` holds one document per applied migration ({_id: number, name,
+# applied_at, duration_ms}) plus a "head" document with the highest number reached.
+# Worker startup only reads "head"; the lock and the per-migration documents are
+# touched only when something is pending.
+HEAD_ID = "head"
+LOCK_NAME = "schema_migrations"
+LOCK_TTL_SECONDS = 600
+
+# Migrations seen as applied by this process; once applied they stay applied.
+_applied_seen: set = set()
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1].number if MIGRATIONS else 0
+
+
+async def current_version() -> int:
+    head = await db.schema_migrations.find_one({"_id": HEAD_ID}, {"version": 1})
+    return (head or {}).get("version", 0)
+
+
+async def applied_migrations() -> dict:
+    """{number: record} for every migration recorded as applied."""
+    records = await db.schema_migrations.find({"_id": {"$ne": HEAD_ID}}).to_list(None)
+    return {r["_id"]: r for r in records}
+
+
+async def is_applied(number: int) -> bool:
+    """Whether migration `number` is recorded as applied.
+
+    A worker can serve requests while another process still holds the migration lock,
+    or after a migration failed, so read paths that rely on a backfill check this and
+    keep their old query until it returns True.
+    """
+    if number in _applied_seen:
+        return True
+    if await db.schema_migrations.find_one({"_id": number}, {"_id": 1}) is None:
+        return False
+    _applied_seen.add(number)
+    return True
+
+
+async def pending_migrations() -> list:
+    applied = await applied_migrations()
+    return [m for m in MIGRATIONS if m.number not in applied]
+
+
+async def run_pending() -> Optional[list]:
+    """Apply every pending migration in order under the migration lock.
+
+    Returns the names applied, or None if another process holds the lock. Stops at the
+    first failure (which propagates); the failed migration stays pending and is retried
+    on the next run.
+    """
+    if not await acquire_scheduler_lock(LOCK_NAME, ttl_seconds=LOCK_TTL_SECONDS):
+        return None
+    applied = []
+    try:
+        for migration in await pending_migrations():
+            if not await extend_scheduler_lock(LOCK_NAME, LOCK_TTL_SECONDS):
+                raise RuntimeError("migration lock lost")
+            logger.info(f"Applying migration {migration.number:03d} {migration.name}...")
+            started = time.perf_counter()
+            await migration.run()
+            duration_ms = round((time.perf_counter() - started) * 1000)
+            await db.schema_migrations.replace_one(
+                {"_id": migration.number},
+                {"name": migration.name, "applied_at": datetime.now(timezone.utc).isoformat(),
+                 "duration_ms": duration_ms},
+                upsert=True,
+            )
+            applied.append(migration.name)
+            logger.info(f"Migration {migration.number:03d} {migration.name} applied in {duration_ms} ms")
+        await db.schema_migrations.update_one(
+            {"_id": HEAD_ID}, {"$max": {"version": latest_version()}}, upsert=True
+        )
+    finally:
+        await release_scheduler_lock(LOCK_NAME)
+    if applied:
+        # Migrations write programs, subjects, users and courses directly.
+        from utils.http_cache import bump_versions
+        await bump_versions("programs", "subjects", "courses", "students")
+    return applied
+
+
+async def ensure_migrated():
+    """Worker startup: a single read when the schema is current, otherwise migrate (or
+    leave it to whichever process holds the lock)."""
+    if await current_version() >= latest_version():
+        return
+    try:
+        applied = await run_pending()
+    except Exception as e:
+        logger.error(f"Schema migration failed: {e}", exc_info=True)
+        return
+    if applied is None:
+        logger.info("Schema migrations are being applied by another process")
+    elif applied:
+        logger.info(f"Applied {len(applied)} schema migration(s): {', '.join(applied)}")
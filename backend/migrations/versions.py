@@ -0,0 +1,119 @@
+import logging
+import uuid
+from typing import NamedTuple, Callable, Awaitable
+
+from pymongo import UpdateOne
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# One-time data fixes, applied in order by migrations/runner.py and recorded in
+# `schema_migrations`. Never renumber or edit a released migration: add a new one.
+# Each must be safe to re-run, since a crash mid-way leaves it unrecorded.
+
+BATCH_SIZE = 1000
+
+
+class Migration(NamedTuple):
+    number: int
+    name: str
+    run: Callable[[], Awaitable[None]]
+
+
+async def legacy_user_ids():
+    """Seed users used to have fixed ids; they now use uuid5 of the old id."""
+    for old_id in ("user-editor-1", "user-prof-1", "user-prof-2"):
+        new_id = str(uuid.uuid5(uuid.NAMESPACE_OID, old_id))
+        result = await db.users.update_one({"id": old_id}, {"$set": {"id": new_id}})
+        if result.modified_count > 0:
+            logger.info(f"Migrated legacy user ID: {old_id} -> {new_id}")
+
+
+async def course_subject_ids():
+    """Courses created with a single subject_id get the subject_ids list."""
+    fixed = 0
+    async for course in db.courses.find(
+        {"$or": [{"subject_ids": {"$exists": False}}, {"subject_ids": None}, {"subject_ids": []}],
+         "subject_id": {"$nin": [None, ""]}},
+        {"_id": 0, "id": 1, "subject_id": 1},
+    ):
+        await db.courses.update_one({"id": course["id"]}, {"$set": {"subject_ids": [course["subject_id"]]}})
+        fixed += 1
+    if fixed:
+        logger.info(f"Fixed {fixed} courses with missing subject_ids field")
+
+
+async def user_subject_ids():
+    result = await db.users.update_many(
+        {"$or": [{"subject_ids": {"$exists": False}}, {"subject_ids": None}]},
+        {"$set": {"subject_ids": []}},
+    )
+    if result.modified_count:
+        logger.info(f"Fixed {result.modified_count} users with missing subject_ids field")
+
+
+async def student_status():
+    from utils.helpers import backfill_student_status
+    await backfill_student_status(BATCH_SIZE)
+
+
+async def submission_course_ids():
+    """Copy course_id onto submissions from their activity, one batch at a time instead
+    of loading every activity up front."""
+    migrated = 0
+    last_id = None
+    while True:
+        query = {"course_id": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await db.submissions.find(query, {"_id": 1, "activity_id": 1}).sort("_id", 1).limit(BATCH_SIZE).to_list(BATCH_SIZE)
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+        activity_ids = list({s["activity_id"] for s in batch if s.get("activity_id")})
+        course_by_activity = {
+            a["id"]: a["course_id"]
+            for a in await db.activities.find(
+                {"id": {"$in": activity_ids}}, {"_id": 0, "id": 1, "course_id": 1}
+            ).to_list(len(activity_ids))
+            if a.get("course_id")
+        }
+        ops = [
+            UpdateOne({"_id": s["_id"]}, {"$set": {"course_id": course_by_activity[s["activity_id"]]}})
+            for s in batch if s.get("activity_id") in course_by_activity
+        ]
+        if ops:
+            result = await db.submissions.bulk_write(ops, ordered=False)
+            migrated += result.modified_count
+    if migrated:
+        logger.info(f"Migrated {migrated} submissions: added course_id field")
+
+
+async def enrollments_collection():
+    from utils.enrollments import migrate_course_arrays
+    await migrate_course_arrays()
+
+
+async def recovery_states():
+    from utils.recovery_state import backfill_states
+    await backfill_states(BATCH_SIZE)
+
+
+async def purge_orphaned_course_data():
+    """Kept as a recorded no-op. It used to load every course and activity id and delete
+    with $nin; data left behind by old course deletions is now removed in batches by the
+    orphan collector (scheduler/orphan_collector.py), which runs on a schedule."""
+    logger.info("purge_orphaned_course_data: orphaned data is left to the orphan collector")
+
+
+MIGRATIONS = [
+    Migration(1, "legacy_user_ids", legacy_user_ids),
+    Migration(2, "course_subject_ids", course_subject_ids),
+    Migration(3, "user_subject_ids", user_subject_ids),
+    Migration(4, "student_status", student_status),
+    Migration(5, "submission_course_ids", submission_course_ids),
+    Migration(6, "enrollments_collection", enrollments_collection),
+    Migration(7, "recovery_states", recovery_states),
+    Migration(8, "purge_orphaned_course_data", purge_orphaned_course_data),
+]
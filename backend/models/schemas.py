@@ -210,6 +210,9 @@ class CourseUpdate(BaseModel):
     subject_ids: Optional[List[str]] = None
     teacher_id: Optional[str] = None
     student_ids: Optional[List[str]] = None
+    # Incremental alternative to student_ids (the whole roster) for one-off changes.
+    add_student_ids: Optional[List[str]] = None
+    remove_student_ids: Optional[List[str]] = None
     active: Optional[bool] = None
     start_date: Optional[str] = None
     end_date: Optional[str] = None
@@ -310,3 +313,17 @@ class RecoveryEnableRequest(BaseModel):
 class ModuleCloseDateUpdate(BaseModel):
     module1_close_date: Optional[str] = None
     module2_close_date: Optional[str] = None
+
+
+class PresignUploadRequest(BaseModel):
+    filename: str = Field(..., min_length=1, max_length=255)
+    size: int = Field(..., gt=0)
+
+
+class CompleteUploadRequest(BaseModel):
+    upload_id: str
+
+
+class UploadSessionCreate(BaseModel):
+    filename: str = Field(..., min_length=1, max_length=255)
+    size: int = Field(..., gt=0)
@@ -1,16 +1,27 @@
 import asyncio
+import csv
+import io
+import re
+import unicodedata
 import uuid
 import logging
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+from urllib.parse import quote
 from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from database import db
+from cache import invalidate_student_dashboard
 from utils.security import get_current_user, safe_object_id
 from utils.audit import log_audit, log_security_event
+from utils.counters import incr_counters
+from utils.blobs import add_file_references
+from utils.storage import get_backend, storage_name_for_file
+from utils.zipstream import ZipStreamWriter
+from utils import recovery_state
 from models.schemas import ActivityCreate, ActivityUpdate
-from config import MAX_LIMIT, MAX_ACTIVITIES_PER_WEEK_PER_SUBJECT
+from config import MAX_LIMIT, MAX_ACTIVITIES_PER_WEEK_PER_SUBJECT, BOGOTA_TZ
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -40,13 +51,9 @@ async def get_activities(course_id: Optional[str] = None, subject_id: Optional[s
     )
 
     if user["role"] == "estudiante" and course_id:
-        approved_records = await db.failed_subjects.find({
-            "student_id": user["id"],
-            "course_id": course_id,
-            "recovery_approved": True,
-            "recovery_processed": {"$ne": True},
-            "recovery_rejected": {"$ne": True},
-        }, {"_id": 0, "subject_id": 1}).to_list(100)
+        approved_records = await db.failed_subjects.find(await recovery_state.in_states(
+            {"student_id": user["id"], "course_id": course_id}, recovery_state.IN_RECOVERY_STATES
+        ), {"_id": 0, "subject_id": 1}).to_list(100)
         approved_subject_ids = {r.get("subject_id") for r in approved_records if r.get("subject_id")}
         has_course_level_approval = any(not r.get("subject_id") for r in approved_records)
 
@@ -168,6 +175,10 @@ async def create_activity(req: ActivityCreate, user=Depends(get_current_user)):
         await db.activities.insert_one(activity)
         del activity["_id"]
         created_activities.append(activity)
+        await invalidate_student_dashboard(cid)
+    await incr_counters(activities=len(created_activities))
+    # The upload counted one reference per file; every extra course holds another.
+    await add_file_references(req.files, len(created_activities) - 1)
 
     await log_audit("activity_created", user["id"], user["role"], {
         "activity_ids": [a["id"] for a in created_activities],
@@ -208,6 +219,8 @@ async def update_activity_group(group_id: str, req: ActivityUpdate, user=Depends
                 except ValueError:
                     pass
         await db.activities.update_many({"activity_group_id": group_id}, {"$set": update_data})
+        for a in activities_in_group:
+            await invalidate_student_dashboard(a.get("course_id"))
     await log_audit("activity_group_updated", user["id"], user["role"], {
         "group_id": group_id, "course_count": len(activities_in_group)
     })
@@ -221,16 +234,19 @@ async def delete_activity_group(group_id: str, user=Depends(get_current_user)):
     if user["role"] not in ["profesor", "admin"]:
         raise HTTPException(status_code=403, detail="Solo profesores o admin")
     activities_in_group = await db.activities.find(
-        {"activity_group_id": group_id}, {"_id": 0, "id": 1}
+        {"activity_group_id": group_id}, {"_id": 0, "id": 1, "course_id": 1}
     ).to_list(500)
     if not activities_in_group:
         raise HTTPException(status_code=404, detail="Grupo de actividades no encontrado")
     activity_ids = [a["id"] for a in activities_in_group]
-    await asyncio.gather(
+    _, _, activities_deleted = await asyncio.gather(
         db.grades.delete_many({"activity_id": {"$in": activity_ids}}),
         db.submissions.delete_many({"activity_id": {"$in": activity_ids}}),
         db.activities.delete_many({"activity_group_id": group_id}),
     )
+    await incr_counters(activities=-activities_deleted.deleted_count)
+    for a in activities_in_group:
+        await invalidate_student_dashboard(a.get("course_id"))
     await log_audit("activity_group_deleted", user["id"], user["role"], {
         "group_id": group_id, "deleted_count": len(activity_ids)
     })
@@ -278,6 +294,7 @@ async def update_activity(activity_id: str, req: ActivityUpdate, user=Depends(ge
     result = await db.activities.update_one({"id": activity_id}, {"$set": update_data})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Actividad no encontrada")
+    await invalidate_student_dashboard(activity.get("course_id"))
     updated = await db.activities.find_one({"id": activity_id}, {"_id": 0})
     return updated
 
@@ -288,16 +305,130 @@ async def delete_activity(activity_id: str, user=Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Solo profesores o admin")
 
     if user["role"] == "profesor":
-        await _verify_professor_course_ownership(activity_id, user)
+        activity = await _verify_professor_course_ownership(activity_id, user)
     else:
         activity = await db.activities.find_one({"id": activity_id}, {"_id": 0})
         if not activity:
             raise HTTPException(status_code=404, detail="Actividad no encontrada")
 
-    await asyncio.gather(
+    _, _, activity_deleted = await asyncio.gather(
         db.grades.delete_many({"activity_id": activity_id}),
         db.submissions.delete_many({"activity_id": activity_id}),
         db.activities.delete_one({"id": activity_id}),
     )
+    await incr_counters(activities=-activity_deleted.deleted_count)
+    await invalidate_student_dashboard(activity.get("course_id"))
     await log_audit("activity_deleted", user["id"], user["role"], {"activity_id": activity_id})
     return {"message": "Actividad eliminada con sus notas y entregas"}
+
+
+_ZIP_NAME_RE = re.compile(r'[^\w\-. ]+')
+
+
+def _zip_safe(value: str, fallback: str) -> str:
+    cleaned = _ZIP_NAME_RE.sub("_", value or "").strip(" ._")[:100]
+    return cleaned or fallback
+
+
+def _attachment_disposition(filename: str) -> str:
+    """Content-Disposition for a name that may not be ASCII: headers are latin-1 encoded,
+    so the plain filename gets an accent-stripped copy and RFC 5987 filename* the real one."""
+    ascii_name = "".join(
+        c if c.isascii() and c != '"' else "_"
+        for c in unicodedata.normalize("NFKD", filename) if not unicodedata.combining(c)
+    )
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def _parse_submitted_at(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(BOGOTA_TZ) if value else None
+    except (ValueError, AttributeError):
+        return None
+
+
+@router.get("/activities/{activity_id}/submissions.zip")
+async def download_activity_submissions(activity_id: str, user=Depends(get_current_user)):
+    """All submission files of an activity as one ZIP, one folder per student, plus a
+    manifest.csv with submission times and the status of every file.
+
+    The archive is built while it is sent: each file is streamed from its storage
+    backend into the ZIP, so memory use does not grow with the class size.
+    """
+    if user["role"] not in ["profesor", "admin"]:
+        raise HTTPException(status_code=403, detail="Solo profesores o admin")
+    if user["role"] == "profesor":
+        activity = await _verify_professor_course_ownership(activity_id, user)
+    else:
+        activity = await db.activities.find_one({"id": activity_id}, {"_id": 0})
+        if not activity:
+            raise HTTPException(status_code=404, detail="Actividad no encontrada")
+
+    submissions = await db.submissions.find(
+        {"activity_id": activity_id},
+        {"_id": 0, "student_id": 1, "submitted_at": 1, "edited": 1, "files": 1},
+    ).sort("submitted_at", 1).to_list(5000)
+    student_ids = list({s["student_id"] for s in submissions if s.get("student_id")})
+    students = await db.users.find(
+        {"id": {"$in": student_ids}}, {"_id": 0, "id": 1, "name": 1, "cedula": 1}
+    ).to_list(len(student_ids) or 1)
+    students_by_id = {s["id"]: s for s in students}
+
+    async def generate():
+        writer = ZipStreamWriter()
+        manifest = io.StringIO()
+        csv_writer = csv.writer(manifest)
+        csv_writer.writerow(["estudiante", "cedula", "student_id", "entregado", "editado", "archivo", "ruta_zip", "estado"])
+        used_names: set = set()
+        for sub in submissions:
+            student = students_by_id.get(sub.get("student_id"), {})
+            name, cedula = student.get("name") or "", student.get("cedula") or ""
+            folder = _zip_safe(f"{name}_{cedula}" if cedula else name, sub.get("student_id", "estudiante")[:8])
+            submitted_at = _parse_submitted_at(sub.get("submitted_at"))
+            row = [name, cedula, sub.get("student_id"), sub.get("submitted_at") or "", "si" if sub.get("edited") else "no"]
+            files = [f for f in (sub.get("files") or []) if isinstance(f, dict) and f.get("stored_name")]
+            if not files:
+                csv_writer.writerow(row + ["", "", "sin archivos"])
+                continue
+            for f in files:
+                filename = _zip_safe(f.get("filename") or "", "archivo")
+                entry_name = f"{folder}/{filename}"
+                counter = 1
+                while entry_name in used_names:
+                    counter += 1
+                    stem, dot, ext = filename.rpartition(".")
+                    entry_name = f"{folder}/{stem}_{counter}.{ext}" if dot else f"{folder}/{filename}_{counter}"
+                backend = get_backend(storage_name_for_file(f))
+                if backend is None:
+                    csv_writer.writerow(row + [f.get("filename") or "", "", "almacenamiento no disponible"])
+                    continue
+                try:
+                    found = await backend.exists(f["stored_name"])
+                except Exception:
+                    found = True  # let the read below report the actual error
+                if not found:
+                    csv_writer.writerow(row + [f.get("filename") or "", "", "archivo no encontrado"])
+                    continue
+                used_names.add(entry_name)
+                status = "incluido"
+                try:
+                    async for piece in writer.add_stream(entry_name, backend.get_stream(f["stored_name"]), submitted_at):
+                        yield piece
+                except Exception as e:
+                    # The entry is closed where the read stopped; the manifest says so.
+                    logger.warning(f"ZIP export: could not read {f['stored_name']}: {e}")
+                    status = "error al leer el archivo"
+                csv_writer.writerow(row + [f.get("filename") or "", entry_name, status])
+        # UTF-8 BOM so Excel opens accented names correctly.
+        yield writer.add_bytes("manifest.csv", ("\ufeff" + manifest.getvalue()).encode("utf-8"))
+        yield writer.close()
+
+    zip_name = _zip_safe(f"actividad_{activity.get('activity_number') or ''}_{activity.get('title') or ''}", "actividad")
+    await log_audit("submissions_exported", user["id"], user["role"], {
+        "activity_id": activity_id, "submissions": len(submissions),
+    })
+    return StreamingResponse(
+        generate(),
+        media_type="application/zip",
+        headers={"Content-Disposition": _attachment_disposition(f"{zip_name}_entregas.zip")},
+    )
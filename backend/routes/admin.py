@@ -22,10 +22,13 @@ except ImportError:
 from database import db
 from utils.security import get_current_user, hash_password
 from utils.audit import log_audit, _make_audit_record
-from utils.helpers import derive_estado_from_program_statuses
+from utils.helpers import derive_estado_from_program_statuses, with_student_status
 from config import BOGOTA_TZ, MAX_OVERDUE_BEFORE_RECOVERY, AUTO_RECOVERY_ENABLED_AT
-from scheduler.cleanup import acquire_scheduler_lock, release_scheduler_lock
-from cache import recovery_panel_cache
+from scheduler.cleanup import acquire_scheduler_lock, release_scheduler_lock, request_stats_reconcile
+from cache import recovery_panel_cache, invalidate_student_dashboard
+from utils.http_cache import bump_versions
+from utils.counters import count_student_status_change, incr_counters
+from utils import enrollments, recovery_state
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -114,6 +117,7 @@ async def check_and_close_modules():
                 await asyncio.sleep(0)
             module_dates = course.get("module_dates") or {}
             prog_id_for_course = course.get("program_id", "")
+            course_student_ids = await enrollments.enrolled_ids(course["id"])
 
             # --- Causa 1: fallback module_dates from program when course has none ---
             if not module_dates and prog_id_for_course:
@@ -224,12 +228,9 @@ async def check_and_close_modules():
 
                 # Find ALL failed_subjects for this course/module that haven't been processed yet.
                 # Ceiling of 5000: a single course cannot realistically have more students.
-                all_records = await db.failed_subjects.find({
-                    "course_id": course["id"],
-                    "module_number": int(module_key),
-                    "recovery_expired": {"$ne": True},
-                    "recovery_processed": {"$ne": True}
-                }, {"_id": 0}).to_list(5000)
+                all_records = await db.failed_subjects.find(await recovery_state.in_states(
+                    {"course_id": course["id"], "module_number": int(module_key)}, recovery_state.OPEN_STATES
+                ), {"_id": 0}).to_list(5000)
                 
                 prog_id = course.get("program_id", "")
 
@@ -242,7 +243,7 @@ async def check_and_close_modules():
                 # Skip only when there are no recovery records AND no enrolled students.
                 # We still need to process courses with no recovery records if they have
                 # direct-pass students whose promotion was deferred to recovery_close.
-                if not all_records and not course.get("student_ids"):
+                if not all_records and not course_student_ids:
                     continue
 
                 # Filter course subjects to those belonging to this module_key.
@@ -307,19 +308,13 @@ async def check_and_close_modules():
                         )
                         removed_count += 1
                         for record in records:
-                            fs_bulk_ops.append(UpdateOne(
-                                {"id": record["id"]},
-                                {"$set": {"recovery_processed": True, "processed_at": now.isoformat()}}
+                            fs_bulk_ops.append(recovery_state.transition_op(
+                                record["id"], recovery_state.PROCESSED, processed_at=now.isoformat()
                             ))
                         continue
 
                     # A student passes only if ALL their records are approved by admin AND completed AND approved by teacher
-                    all_passed = all(
-                        r.get("recovery_approved") is True and
-                        r.get("recovery_completed") is True and
-                        r.get("teacher_graded_status") == "approved"
-                        for r in records
-                    )
+                    all_passed = all(recovery_state.is_passed(r) for r in records)
 
                     # Bug-2 fix: even when all *existing* records show "passed", also verify that
                     # every failing subject in this course/module has a corresponding record.
@@ -420,9 +415,8 @@ async def check_and_close_modules():
                     
                     # Mark all records for this student in this course/module as processed
                     for record in records:
-                        fs_bulk_ops.append(UpdateOne(
-                            {"id": record["id"]},
-                            {"$set": {"recovery_processed": True, "processed_at": now.isoformat()}}
+                        fs_bulk_ops.append(recovery_state.transition_op(
+                            record["id"], recovery_state.PROCESSED, processed_at=now.isoformat()
                         ))
 
                 if user_bulk_ops:
@@ -436,20 +430,8 @@ async def check_and_close_modules():
                         logger.error(f"Failed to batch write recovery audit logs: {_audit_exc}")
                 # Batch unenroll for students_records loop: one course update instead of N
                 if _records_unenroll_ids:
-                    await db.courses.update_one(
-                        {"id": course["id"]},
-                        {
-                            "$pull": {"student_ids": {"$in": _records_unenroll_ids}},
-                            "$addToSet": {"removed_student_ids": {"$each": _records_unenroll_ids}}
-                        }
-                    )
-                    _still_enrolled_docs = await db.courses.find(
-                        {"student_ids": {"$in": _records_unenroll_ids}},
-                        {"_id": 0, "student_ids": 1}
-                    ).to_list(1000)
-                    _still_enrolled_set: set = set()
-                    for _c in _still_enrolled_docs:
-                        _still_enrolled_set.update(_c.get("student_ids") or [])
+                    await enrollments.mark_removed(course["id"], _records_unenroll_ids)
+                    _still_enrolled_set = await enrollments.still_enrolled(_records_unenroll_ids)
                     for _sid in _records_unenroll_ids:
                         if _sid not in _still_enrolled_set:
                             await db.users.update_one(
@@ -460,7 +442,7 @@ async def check_and_close_modules():
                 # Also promote students who passed the module directly (no failed subjects),
                 # whose promotion was deferred to recovery_close by close_module_internal.
                 # Pre-load student docs and reuse prog_doc for direct_pass loop
-                _direct_ids = [sid for sid in course.get("student_ids", []) if sid not in students_records]
+                _direct_ids = [sid for sid in course_student_ids if sid not in students_records]
                 if _direct_ids:
                     _direct_docs = await db.users.find(
                         {"id": {"$in": _direct_ids}},
@@ -468,13 +450,11 @@ async def check_and_close_modules():
                     ).to_list(5000)
                     direct_students_map = {s["id"]: s for s in _direct_docs}
                     # Pre-fetch all pending failed_subjects for direct-pass students in one query
-                    _direct_pending_list = await db.failed_subjects.find({
+                    _direct_pending_list = await db.failed_subjects.find(await recovery_state.in_states({
                         "student_id": {"$in": _direct_ids},
                         "program_id": prog_id,
                         "module_number": int(module_key),
-                        "recovery_processed": {"$ne": True},
-                        "recovery_expired": {"$ne": True},
-                    }, {"_id": 0, "student_id": 1}).to_list(5000)
+                    }, recovery_state.OPEN_STATES), {"_id": 0, "student_id": 1}).to_list(5000)
                     _direct_pending_set = {rec["student_id"] for rec in _direct_pending_list}
                 else:
                     direct_students_map = {}
@@ -483,7 +463,7 @@ async def check_and_close_modules():
                 _direct_unenroll_ids: list = []
                 _direct_audit_log_batch: list = []
 
-                for student_id in course.get("student_ids", []):
+                for student_id in course_student_ids:
                     if student_id in students_records:
                         continue  # Already handled above as a recovery student
                     direct_student = direct_students_map.get(student_id)
@@ -623,20 +603,8 @@ async def check_and_close_modules():
                         logger.error(f"Failed to batch write direct_pass audit logs: {_audit_exc}")
                 # Batch unenroll for direct_pass loop: one course update instead of N
                 if _direct_unenroll_ids:
-                    await db.courses.update_one(
-                        {"id": course["id"]},
-                        {
-                            "$pull": {"student_ids": {"$in": _direct_unenroll_ids}},
-                            "$addToSet": {"removed_student_ids": {"$each": _direct_unenroll_ids}}
-                        }
-                    )
-                    _still_enrolled_docs = await db.courses.find(
-                        {"student_ids": {"$in": _direct_unenroll_ids}},
-                        {"_id": 0, "student_ids": 1}
-                    ).to_list(1000)
-                    _still_enrolled_set = set()
-                    for _c in _still_enrolled_docs:
-                        _still_enrolled_set.update(_c.get("student_ids") or [])
+                    await enrollments.mark_removed(course["id"], _direct_unenroll_ids)
+                    _still_enrolled_set = await enrollments.still_enrolled(_direct_unenroll_ids)
                     for _sid in _direct_unenroll_ids:
                         if _sid not in _still_enrolled_set:
                             await db.users.update_one(
@@ -648,8 +616,8 @@ async def check_and_close_modules():
                 # in this course/module and did not fully pass recovery records, remove them.
                 # This covers edge cases where failed_subjects records are missing/stale.
                 # Pre-load current course doc and all student docs in 2 queries (instead of 2 per student)
-                current_course_doc = await db.courses.find_one({"id": course["id"]}, {"_id": 0, "student_ids": 1})
-                _fallback_ids = list(course.get("student_ids", []))
+                current_enrolled_ids = set(await enrollments.enrolled_ids(course["id"]))
+                _fallback_ids = list(course_student_ids)
                 if _fallback_ids:
                     _fb_docs = await db.users.find(
                         {"id": {"$in": _fallback_ids}},
@@ -665,13 +633,11 @@ async def check_and_close_modules():
                 # Pre-load ALL failed_subjects for all fallback students in ONE query
                 # instead of one query per student inside the loop (N queries → 1 query)
                 if _fallback_ids:
-                    _fallback_fs_docs = await db.failed_subjects.find({
+                    _fallback_fs_docs = await db.failed_subjects.find(await recovery_state.in_states({
                         "student_id": {"$in": _fallback_ids},
                         "course_id": course["id"],
                         "module_number": int(module_key),
-                        "recovery_processed": {"$ne": True},
-                        "recovery_expired": {"$ne": True},
-                    }, {"_id": 0}).to_list(5000)
+                    }, recovery_state.OPEN_STATES), {"_id": 0}).to_list(5000)
                     _fallback_fs_by_student: dict = {}
                     for _fsr in _fallback_fs_docs:
                         _fsid = _fsr.get("student_id")
@@ -682,7 +648,7 @@ async def check_and_close_modules():
 
                 for student_id in _fallback_ids:
                     # Skip if already unenrolled in previous steps
-                    if not current_course_doc or student_id not in (current_course_doc.get("student_ids") or []):
+                    if student_id not in current_enrolled_ids:
                         continue
 
                     # Only enforce for students still in the module being closed
@@ -721,12 +687,7 @@ async def check_and_close_modules():
                     unresolved_records = _fallback_fs_by_student.get(student_id, [])
 
                     # If all unresolved records are fully approved+graded, let normal pass flow apply
-                    if unresolved_records and all(
-                        r.get("recovery_approved") is True and
-                        r.get("recovery_completed") is True and
-                        r.get("teacher_graded_status") == "approved"
-                        for r in unresolved_records
-                    ):
+                    if unresolved_records and all(recovery_state.is_passed(r) for r in unresolved_records):
                         continue
 
                     _fallback_unenroll_ids.append(student_id)
@@ -743,9 +704,8 @@ async def check_and_close_modules():
 
                     if unresolved_records:
                         for rec in unresolved_records:
-                            fallback_fs_bulk_ops.append(UpdateOne(
-                                {"id": rec["id"]},
-                                {"$set": {"recovery_processed": True, "processed_at": now.isoformat()}}
+                            fallback_fs_bulk_ops.append(recovery_state.transition_op(
+                                rec["id"], recovery_state.PROCESSED, processed_at=now.isoformat()
                             ))
 
                     await log_audit(
@@ -760,20 +720,8 @@ async def check_and_close_modules():
                     await db.failed_subjects.bulk_write(fallback_fs_bulk_ops, ordered=False)
                 # Batch unenroll for fallback loop: one course update instead of N
                 if _fallback_unenroll_ids:
-                    await db.courses.update_one(
-                        {"id": course["id"]},
-                        {
-                            "$pull": {"student_ids": {"$in": _fallback_unenroll_ids}},
-                            "$addToSet": {"removed_student_ids": {"$each": _fallback_unenroll_ids}}
-                        }
-                    )
-                    _still_enrolled_docs = await db.courses.find(
-                        {"student_ids": {"$in": _fallback_unenroll_ids}},
-                        {"_id": 0, "student_ids": 1}
-                    ).to_list(1000)
-                    _still_enrolled_set = set()
-                    for _c in _still_enrolled_docs:
-                        _still_enrolled_set.update(_c.get("student_ids") or [])
+                    await enrollments.mark_removed(course["id"], _fallback_unenroll_ids)
+                    _still_enrolled_set = await enrollments.still_enrolled(_fallback_unenroll_ids)
                     for _sid in _fallback_unenroll_ids:
                         if _sid not in _still_enrolled_set:
                             await db.users.update_one(
@@ -810,7 +758,14 @@ async def check_and_close_modules():
     except Exception as e:
         logger.error(f"Error in automatic module closure check: {e}", exc_info=True)
     finally:
-        await release_scheduler_lock("auto_close_modules")
+        try:
+            # Closure rewrites enrollments and student statuses across many courses; bump the
+            # collection-level stamps once instead of tracking every touched document.
+            await bump_versions("courses", "students")
+            # Closure changes many student statuses through bulk writes; recount rather than $inc.
+            await request_stats_reconcile()
+        finally:
+            await release_scheduler_lock("auto_close_modules")
 
 
 async def check_overdue_auto_recovery(dry_run: bool = False) -> int:
@@ -836,11 +791,9 @@ async def check_overdue_auto_recovery(dry_run: bool = False) -> int:
     subject_info = {s["id"]: s for s in all_subjects}
 
     # Process course by course to keep memory bounded
-    async for course in db.courses.find(
-        {"student_ids": {"$exists": True, "$not": {"$size": 0}}}, {"_id": 0}
-    ):
+    async for course in db.courses.find({"student_count": {"$gt": 0}}, {"_id": 0}):
         course_id = course["id"]
-        enrolled_ids = course.get("student_ids") or []
+        enrolled_ids = await enrollments.enrolled_ids(course_id)
         if not enrolled_ids:
             continue
 
@@ -888,7 +841,7 @@ async def check_overdue_auto_recovery(dry_run: bool = False) -> int:
 
         # Bulk-load existing open recovery records for this course to avoid find_one per student
         existing_recoveries = await db.failed_subjects.find(
-            {"course_id": course_id, "recovery_processed": {"$ne": True}, "recovery_rejected": {"$ne": True}},
+            await recovery_state.in_states({"course_id": course_id}, recovery_state.UNREJECTED_STATES),
             {"_id": 0, "student_id": 1, "subject_id": 1}
         ).to_list(5000)
         existing_recovery_set = {(r["student_id"], r.get("subject_id")) for r in existing_recoveries}
@@ -940,7 +893,7 @@ async def check_overdue_auto_recovery(dry_run: bool = False) -> int:
                 if dry_run:
                     candidates.append(record)
                 else:
-                    await db.failed_subjects.insert_one(record)
+                    await db.failed_subjects.insert_one(recovery_state.new_record(record))
                     del record["_id"]
                     # Update student program_statuses to pendiente_recuperacion
                     if program_id:
@@ -964,6 +917,9 @@ async def check_overdue_auto_recovery(dry_run: bool = False) -> int:
 
     if dry_run:
         return candidates  # type: ignore[return-value]
+    if created_count:
+        await bump_versions("students")
+        await request_stats_reconcile()
     return created_count
 
 
@@ -987,12 +943,7 @@ async def revert_stale_auto_recoveries() -> int:
 
     # Find all pending auto-recovery records
     pending = await db.failed_subjects.find(
-        {
-            "recovery_reason": "overdue_submissions",
-            "recovery_approved": False,
-            "recovery_processed": {"$ne": True},
-            "recovery_rejected": {"$ne": True},
-        },
+        await recovery_state.in_states({"recovery_reason": "overdue_submissions"}, recovery_state.PENDING),
         {"_id": 0}
     ).to_list(5000)
 
@@ -1060,6 +1011,7 @@ async def revert_stale_auto_recoveries() -> int:
 
     if reverted:
         logger.info(f"revert_stale_auto_recoveries: reverted {reverted} records that no longer qualify")
+        await request_stats_reconcile()
     return reverted
 
 
@@ -1074,13 +1026,9 @@ async def _revert_single_auto_recovery(record: dict):
     if program_id:
         # Only restore if the student is still in pendiente_recuperacion for this program
         # (they might have other reasons to be in recovery — don't blindly overwrite)
-        other_open = await db.failed_subjects.find_one({
-            "student_id": student_id,
-            "program_id": program_id,
-            "recovery_approved": False,
-            "recovery_processed": {"$ne": True},
-            "recovery_rejected": {"$ne": True},
-        })
+        other_open = await db.failed_subjects.find_one(await recovery_state.in_states(
+            {"student_id": student_id, "program_id": program_id}, recovery_state.PENDING
+        ))
         if not other_open:
             await db.users.update_one(
                 {"id": student_id},
@@ -1089,6 +1037,7 @@ async def _revert_single_auto_recovery(record: dict):
                     "estado": prev_status,
                 }}
             )
+    await bump_versions("students")
     logger.info(
         f"Reverted auto-recovery: student={student_id} subject={record.get('subject_id')} "
         f"course={record.get('course_id')} restored_status={prev_status}"
@@ -1141,6 +1090,9 @@ async def close_module_internal(module_number: int, program_id: Optional[str] =
     # Get courses/groups — filter by program_id when known to reduce data loaded
     courses_query = {"program_id": program_id} if program_id else {}
     courses = await db.courses.find(courses_query, {"_id": 0}).to_list(5000)
+    courses_by_id = {c["id"]: c for c in courses}
+    # Active enrollments of every candidate student, from one indexed query
+    student_course_ids = await enrollments.course_ids_by_student(s["id"] for s in students)
     
     # Load subjects for per-subject grade calculations
     all_subjects = await db.subjects.find({}, {"_id": 0, "id": 1, "name": 1, "module_number": 1}).to_list(1000)
@@ -1202,7 +1154,10 @@ async def close_module_internal(module_number: int, program_id: Optional[str] =
             continue  # Student not in this module
         
         # Get all courses for this student in the specified programs
-        student_courses = [c for c in courses if student_id in c.get("student_ids", []) and c["program_id"] in programs_in_module]
+        student_courses = [
+            courses_by_id[cid] for cid in student_course_ids.get(student_id, [])
+            if cid in courses_by_id and courses_by_id[cid]["program_id"] in programs_in_module
+        ]
         
         # Skip students with no grades in any of their module courses — teacher may have
         # forgotten to grade them. Count and log them instead of processing with 0.0 averages.
@@ -1360,7 +1315,11 @@ async def close_module_internal(module_number: int, program_id: Optional[str] =
 
     # Bulk insert failed subjects records
     if failed_subjects_records:
-        await db.failed_subjects.insert_many(failed_subjects_records)
+        await db.failed_subjects.insert_many([recovery_state.new_record(r) for r in failed_subjects_records])
+
+    if promotion_pending_ops or user_bulk_ops:
+        await bump_versions("students")
+        await request_stats_reconcile()
     
     if skipped_no_grades > 0:
         logger.warning(
@@ -1390,6 +1349,7 @@ async def set_all_students_module_1(user=Depends(get_current_user)):
         {"role": "estudiante"},
         {"$set": {"module": 1}}
     )
+    await bump_versions("students")
     
     return {
         "message": f"Se actualizaron {result.modified_count} estudiantes al Módulo 1",
@@ -1513,11 +1473,12 @@ async def get_recovery_panel(user=Depends(get_current_user)):
         failed_records,
     ) = await asyncio.gather(
         db.courses.find({}, {"_id": 0, "id": 1, "name": 1, "program_id": 1,
-                             "subject_ids": 1, "subject_id": 1, "module_dates": 1,
-                             "student_ids": 1, "removed_student_ids": 1}).to_list(1000),
+                             "subject_ids": 1, "subject_id": 1, "module_dates": 1}).to_list(1000),
         db.subjects.find({}, {"_id": 0, "id": 1, "name": 1, "module_number": 1}).to_list(1000),
         db.programs.find({}, {"_id": 0}).to_list(100),
-        db.failed_subjects.find({"recovery_processed": {"$ne": True}}, {"_id": 0}).to_list(1000),
+        db.failed_subjects.find(
+            await recovery_state.in_states({}, recovery_state.UNPROCESSED_STATES), {"_id": 0}
+        ).to_list(1000),
     )
 
     course_map = {c["id"]: c for c in all_courses}
@@ -1594,7 +1555,7 @@ async def get_recovery_panel(user=Depends(get_current_user)):
 
     # Fetch only records still in-process for admin action.
     failed_records = await db.failed_subjects.find(
-        {"recovery_processed": {"$ne": True}},
+        await recovery_state.in_states({}, recovery_state.UNPROCESSED_STATES),
         {"_id": 0}
     ).to_list(1000)
     
@@ -1682,6 +1643,7 @@ async def get_recovery_panel(user=Depends(get_current_user)):
             "recovery_approved": record["recovery_approved"],
             "recovery_completed": record["recovery_completed"],
             "recovery_processed": record.get("recovery_processed", False),
+            "state": recovery_state.state_of(record),
             "processed_at": record.get("processed_at"),
             "recovery_close": recovery_close,
             "next_module_start": next_module_start,
@@ -1758,10 +1720,10 @@ async def get_recovery_panel(user=Depends(get_current_user)):
             autodetect_graded_ids.setdefault(_cid, set()).add(_sid)
 
         # Collect all candidate student IDs across all relevant courses
+        autodetect_rosters = await enrollments.rosters_for(autodetect_course_ids)
         all_candidate_ids: set = set()
         for course, _, _ in autodetect_work:
-            enrolled = set(course.get("student_ids") or [])
-            removed = set(course.get("removed_student_ids") or [])
+            enrolled, removed = map(set, autodetect_rosters[course["id"]])
             graded = autodetect_graded_ids.get(course["id"], set())
             all_candidate_ids.update((enrolled | graded) - removed)
 
@@ -1785,8 +1747,7 @@ async def get_recovery_panel(user=Depends(get_current_user)):
 
         # --- Pass 3: process each (course, module) using pre-loaded data ---
         for course, module_number, recovery_close in autodetect_work:
-            enrolled_ids = set(course.get("student_ids") or [])
-            removed_ids = set(course.get("removed_student_ids") or [])
+            enrolled_ids, removed_ids = map(set, autodetect_rosters[course["id"]])
             graded_ids = autodetect_graded_ids.get(course["id"], set())
             candidate_student_ids = list((enrolled_ids | graded_ids) - removed_ids)
             if not candidate_student_ids:
@@ -1964,7 +1925,7 @@ async def approve_recovery_for_subject(failed_subject_id: str, approve: bool, us
                 subject_doc = await db.subjects.find_one({"id": subject_id}, {"_id": 0, "name": 1})
                 rejection_record["subject_id"] = subject_id
                 rejection_record["subject_name"] = subject_doc.get("name", "Desconocido") if subject_doc else "Desconocido"
-            await db.failed_subjects.insert_one(rejection_record)
+            await db.failed_subjects.insert_one(recovery_state.new_record(rejection_record))
             logger.info(
                 f"Admin {user['id']} rejected recovery for student {student_id} "
                 f"in course {course_id} (auto-detected entry); deferred to recovery_close"
@@ -2009,13 +1970,11 @@ async def approve_recovery_for_subject(failed_subject_id: str, approve: bool, us
             new_record["subject_name"] = subject_doc.get("name", "Desconocido") if subject_doc else "Desconocido"
         # Deduplication: check if a matching unprocessed/unrejected record already exists
         # (prevents duplicate records when admin clicks approve multiple times on the same entry)
-        dup_filter: dict = {
+        dup_filter: dict = await recovery_state.in_states({
             "student_id": student_id,
             "course_id": course_id,
             "module_number": module_number,
-            "recovery_processed": {"$ne": True},
-            "recovery_rejected": {"$ne": True},
-        }
+        }, [recovery_state.PENDING] + recovery_state.IN_RECOVERY_STATES)
         if subject_id:
             dup_filter["subject_id"] = subject_id
         else:
@@ -2024,13 +1983,13 @@ async def approve_recovery_for_subject(failed_subject_id: str, approve: bool, us
         if existing_dup:
             # Record already exists; ensure it is marked as approved (idempotent)
             if not existing_dup.get("recovery_approved"):
-                await db.failed_subjects.update_one(
-                    {"id": existing_dup["id"]},
-                    {"$set": {"recovery_approved": True, "approved_by": user["id"], "approved_at": now.isoformat()}}
+                await recovery_state.transition(
+                    {"id": existing_dup["id"]}, recovery_state.APPROVED,
+                    approved_by=user["id"], approved_at=now.isoformat(),
                 )
             new_record["id"] = existing_dup["id"]
         else:
-            await db.failed_subjects.insert_one(new_record)
+            await db.failed_subjects.insert_one(recovery_state.new_record(new_record))
 
         # Enable recovery activities for this student/course
         existing = await db.recovery_enabled.find_one({"student_id": student_id, "course_id": course_id, "subject_id": subject_id})
@@ -2051,7 +2010,7 @@ async def approve_recovery_for_subject(failed_subject_id: str, approve: bool, us
             )
         # Update program_statuses per-program and derive global estado
         prog_id = course.get("program_id", "")
-        student_doc = await db.users.find_one({"id": student_id}, {"_id": 0, "program_statuses": 1})
+        student_doc = await db.users.find_one({"id": student_id}, {"_id": 0, "program_statuses": 1, "estado": 1})
         student_program_statuses = (student_doc or {}).get("program_statuses") or {}
         if prog_id:
             student_program_statuses[prog_id] = "pendiente_recuperacion"
@@ -2060,8 +2019,12 @@ async def approve_recovery_for_subject(failed_subject_id: str, approve: bool, us
         if prog_id:
             update_fields["program_statuses"] = student_program_statuses
         await db.users.update_one({"id": student_id}, {"$set": update_fields})
+        if student_doc:
+            await count_student_status_change(student_doc.get("estado"), new_estado)
 
         recovery_panel_cache.invalidate("panel")
+        await invalidate_student_dashboard(course_id, student_id)
+        await bump_versions("students")
         return {"message": "Recuperación aprobada exitosamente"}
 
     # Find the failed subject record
@@ -2077,16 +2040,13 @@ async def approve_recovery_for_subject(failed_subject_id: str, approve: bool, us
         rej_course_id = failed_record["course_id"]
         rej_prog_id = failed_record.get("program_id", "")
         # Mark this record as rejected, keeping it unprocessed for the scheduler
-        await db.failed_subjects.update_one(
-            {"id": failed_subject_id},
-            {"$set": {
-                "recovery_approved": False,
-                "recovery_rejected": True,
-                "recovery_processed": False,
-                "rejected_by": user["id"],
-                "rejected_at": now.isoformat(),
-            }}
-        )
+        try:
+            await recovery_state.transition(
+                {"id": failed_subject_id}, recovery_state.COMPLETED_REJECTED,
+                recovery_approved=False, rejected_by=user["id"], rejected_at=now.isoformat(),
+            )
+        except recovery_state.InvalidRecoveryTransition:
+            raise HTTPException(status_code=400, detail="La recuperación ya fue procesada")
         logger.info(
             f"Admin {user['id']} rejected recovery for student {rej_student_id} "
             f"in course {rej_course_id} (record {failed_subject_id}); deferred to recovery_close"
@@ -2115,15 +2075,13 @@ async def approve_recovery_for_subject(failed_subject_id: str, approve: bool, us
                 )
     
     # Update approval status
-    await db.failed_subjects.update_one(
-        {"id": failed_subject_id},
-        {"$set": {
-            "recovery_approved": True,
-            "recovery_rejected": False,
-            "approved_by": user["id"],
-            "approved_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
+    try:
+        await recovery_state.transition(
+            {"id": failed_subject_id}, recovery_state.APPROVED,
+            approved_by=user["id"], approved_at=datetime.now(timezone.utc).isoformat(),
+        )
+    except recovery_state.InvalidRecoveryTransition:
+        raise HTTPException(status_code=400, detail="La recuperación ya fue calificada o procesada")
     
     # Enable recovery in the recovery_enabled collection
     recovery = {
@@ -2151,7 +2109,7 @@ async def approve_recovery_for_subject(failed_subject_id: str, approve: bool, us
         )
     # Update program_statuses per-program and derive global estado
     prog_id = failed_record.get("program_id", "")
-    student_doc = await db.users.find_one({"id": failed_record["student_id"]}, {"_id": 0, "program_statuses": 1})
+    student_doc = await db.users.find_one({"id": failed_record["student_id"]}, {"_id": 0, "program_statuses": 1, "estado": 1})
     student_program_statuses = (student_doc or {}).get("program_statuses") or {}
     if prog_id:
         student_program_statuses[prog_id] = "pendiente_recuperacion"
@@ -2160,6 +2118,10 @@ async def approve_recovery_for_subject(failed_subject_id: str, approve: bool, us
     if prog_id:
         update_fields["program_statuses"] = student_program_statuses
     await db.users.update_one({"id": failed_record["student_id"]}, {"$set": update_fields})
+    if student_doc:
+        await count_student_status_change(student_doc.get("estado"), new_estado)
+    await invalidate_student_dashboard(failed_record["course_id"], failed_record["student_id"])
+    await bump_versions("students")
     await log_audit("recovery_approved", user["id"], user["role"], {"student_id": failed_record["student_id"], "failed_subject_id": failed_subject_id, "subject_name": failed_record.get("subject_name", ""), "course_id": failed_record.get("course_id", "")})
     return {"message": "Recuperación aprobada exitosamente"}
 
@@ -2177,6 +2139,35 @@ async def get_graduated_students_count(user=Depends(get_current_user)):
         "count": count
     }
 
+@router.get("/admin/orphan-collector")
+async def get_orphan_collector_status(user=Depends(get_current_user)):
+    """Progress and totals of the background orphan collector (scheduler/orphan_collector.py)."""
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Solo admin")
+    from scheduler.orphan_collector import collector_status
+    return {"collections": await collector_status()}
+
+@router.get("/admin/loop-monitor")
+async def get_loop_monitor(user=Depends(get_current_user)):
+    """Event-loop lag and the stacks of recent stalls, for the worker answering this
+    request (utils/loop_monitor.py, enabled with LOOP_MONITOR=true)."""
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Solo admin")
+    from utils import loop_monitor
+    return loop_monitor.status()
+
+@router.get("/admin/query-metrics")
+async def get_query_metrics(top: int = 50, reset: bool = False, user=Depends(get_current_user)):
+    """MongoDB commands issued per route, as seen by the worker answering this request
+    (utils/query_metrics.py). reset=true clears that worker's totals after reading them."""
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Solo admin")
+    from utils import query_metrics
+    result = query_metrics.snapshot(top=max(1, min(top, 200)))
+    if reset:
+        query_metrics.reset()
+    return result
+
 @router.post("/admin/reset-users")
 async def reset_users(confirm_token: str = None):
     """
@@ -2312,7 +2303,9 @@ async def reset_users(confirm_token: str = None):
         }
     ]
     
-    await db.users.insert_many(default_users)
+    await db.users.insert_many([with_student_status(u) if u["role"] == "estudiante" else u for u in default_users])
+    await bump_versions("courses", "students")
+    await request_stats_reconcile()
     
     return {
         "message": "Usuarios reiniciados exitosamente",
@@ -2552,7 +2545,9 @@ async def seed_data():
             "created_at": datetime.now(timezone.utc).isoformat()
         }
     ]
-    await db.users.insert_many(users)
+    await db.users.insert_many([with_student_status(u) if u["role"] == "estudiante" else u for u in users])
+    await bump_versions("programs", "subjects", "courses", "students")
+    await request_stats_reconcile()
     
     return {
         "message": "Datos iniciales creados exitosamente",
@@ -2575,6 +2570,8 @@ async def purge_all_group_data(user=Depends(get_current_user)):
     videos_deleted = await db.class_videos.delete_many({})
     recovery_deleted = await db.recovery_enabled.delete_many({})
     failed_deleted = await db.failed_subjects.delete_many({})
+    await bump_versions("courses", "students")
+    await incr_counters(courses=-courses_deleted.deleted_count, activities=-activities_deleted.deleted_count)
 
     await log_audit(
         "purge_group_data",
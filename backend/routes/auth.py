@@ -12,6 +12,7 @@ from utils.security import (
 )
 from utils.audit import log_audit, log_security_event
 from models.schemas import LoginRequest
+from utils.http_cache import CACHE_CONTROL_ME, compute_etag, etag_matches, json_with_etag, not_modified
 from config import LOGIN_ATTEMPT_WINDOW
 
 logger = logging.getLogger(__name__)
@@ -183,9 +184,13 @@ async def logout(request: Request, user=Depends(get_current_user)):
 
 
 @router.get("/auth/me")
-async def get_me(user=Depends(get_current_user)):
+async def get_me(request: Request, user=Depends(get_current_user)):
     user_data = {k: v for k, v in user.items() if k != "password_hash"}
-    return user_data
+    # The user document is already loaded by get_current_user, so hashing it is free.
+    etag = compute_etag(user_data)
+    if etag_matches(request, etag):
+        return not_modified(etag, CACHE_CONTROL_ME)
+    return json_with_etag(user_data, etag, CACHE_CONTROL_ME)
 
 
 @router.get("/me/subjects")
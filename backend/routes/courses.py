@@ -1,13 +1,20 @@
 import uuid
 import logging
 from datetime import datetime, timezone
-from pathlib import Path
 from typing import Optional
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 
 from database import db
+from cache import invalidate_student_dashboard
 from utils.security import get_current_user, safe_object_id
 from utils.audit import log_audit
+from utils.counters import count_student_status_change, count_students_deleted, incr_counters
+from utils.images import run_in_background
+from utils import enrollments
+from utils.http_cache import (
+    CACHE_CONTROL_COURSE, bump_versions, course_version_keys,
+    etag_matches, json_with_etag, not_modified, versioned_etag,
+)
 from utils.helpers import (
     derive_estado_from_program_statuses,
     validate_module_dates_order,
@@ -17,10 +24,8 @@ from utils.helpers import (
     can_enroll_in_module,
 )
 from models.schemas import CourseCreate, CourseUpdate
-from config import (
-    MAX_LIMIT, USE_CLOUDINARY, USE_S3, UPLOAD_DIR,
-    _ERR_ENROLL_EGRESADO, _ERR_ENROLL_PENDIENTE
-)
+from scheduler.course_sweeper import sweep_course_deletions, tombstone_course
+from config import MAX_LIMIT, _ERR_ENROLL_EGRESADO, _ERR_ENROLL_PENDIENTE
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -45,7 +50,8 @@ async def get_courses(teacher_id: Optional[str] = None, student_id: Optional[str
             conditions.append({"teacher_id": safe_teacher_id})
 
     if student_id:
-        conditions.append({"student_ids": safe_object_id(student_id, "student_id")})
+        student_course_ids = await enrollments.course_ids_for_student(safe_object_id(student_id, "student_id"))
+        conditions.append({"id": {"$in": student_course_ids}})
 
     if len(conditions) == 0:
         query = {}
@@ -57,45 +63,42 @@ async def get_courses(teacher_id: Optional[str] = None, student_id: Optional[str
     limit = max(1, min(limit, MAX_LIMIT))
     skip = max(0, skip)
 
-    if fields == "summary":
-        # Use aggregation to compute student_count without returning the full student_ids array
-        pipeline = [
-            {"$match": query},
-            {"$skip": skip},
-            {"$limit": limit},
-            {"$addFields": {
-                "student_count": {"$size": {"$ifNull": ["$student_ids", []]}}
-            }},
-            {"$project": {"_id": 0, "student_ids": 0, "removed_student_ids": 0}},
-        ]
-        courses = await db.courses.aggregate(pipeline).to_list(limit)
-    else:
-        courses = await db.courses.find(query, {"_id": 0}).skip(skip).limit(limit).to_list(limit)
+    # Rosters live in `enrollments`; list reads only carry the maintained student_count.
+    # fields=summary is kept for existing clients and returns the same documents.
+    courses = await db.courses.find(query, {"_id": 0}).skip(skip).limit(limit).to_list(limit)
     return courses
 
 
 @router.get("/courses/{course_id}")
-async def get_course(course_id: str, user=Depends(get_current_user)):
+async def get_course(course_id: str, request: Request, user=Depends(get_current_user)):
+    etag, _ = await versioned_etag(*course_version_keys(course_id))
+    # Checked before the ETag: a deleted course must answer 404, not 304.
     course = await db.courses.find_one({"id": course_id}, {"_id": 0})
     if not course:
         raise HTTPException(status_code=404, detail="Curso no encontrado")
-    return course
+    if etag_matches(request, etag):
+        return not_modified(etag, CACHE_CONTROL_COURSE)
+    return json_with_etag(await enrollments.with_roster(course), etag, CACHE_CONTROL_COURSE)
 
 
 @router.get("/courses/{course_id}/students")
-async def get_course_students(course_id: str, include_removed: bool = False, user=Depends(get_current_user)):
+async def get_course_students(course_id: str, request: Request, include_removed: bool = False, user=Depends(get_current_user)):
     """Return students enrolled in a specific course."""
     if user["role"] not in ["admin", "profesor"]:
         raise HTTPException(status_code=403, detail="No autorizado")
-    course = await db.courses.find_one({"id": course_id}, {"_id": 0})
+    # Roster depends on the course document and on the student profiles it lists.
+    etag, _ = await versioned_etag(*course_version_keys(course_id), "students", variant=str(include_removed))
+    # Checked before the ETag: a deleted course must answer 404, not 304.
+    course = await db.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
     if not course:
         raise HTTPException(status_code=404, detail="Curso no encontrado")
-    student_ids = course.get("student_ids") or []
-    removed_ids = course.get("removed_student_ids") or []
+    if etag_matches(request, etag):
+        return not_modified(etag, CACHE_CONTROL_COURSE)
+    student_ids, removed_ids = await enrollments.course_roster(course_id)
 
     all_ids_to_fetch = list(set(student_ids + (removed_ids if include_removed else [])))
     if not all_ids_to_fetch:
-        return []
+        return json_with_etag([], etag, CACHE_CONTROL_COURSE)
     students = await db.users.find(
         {"id": {"$in": all_ids_to_fetch}, "role": "estudiante"},
         {"_id": 0, "password_hash": 0}
@@ -106,7 +109,7 @@ async def get_course_students(course_id: str, include_removed: bool = False, use
         for s in students:
             if s["id"] in removed_set:
                 s["_removed_from_group"] = True
-    return students
+    return json_with_etag(students, etag, CACHE_CONTROL_COURSE)
 
 
 @router.post("/courses")
@@ -190,10 +193,10 @@ async def create_course(req: CourseCreate, user=Depends(get_current_user)):
                     raise HTTPException(status_code=400, detail=_ERR_ENROLL_PENDIENTE)
 
     if student_ids_to_add and req.program_id:
+        conflicting_ids = await enrollments.conflicting_course_ids(req.program_id, student_ids_to_add)
         conflicting_groups = await db.courses.find(
-            {"program_id": req.program_id, "student_ids": {"$in": student_ids_to_add}},
-            {"_id": 0, "name": 1, "student_ids": 1}
-        ).to_list(1000)
+            {"id": {"$in": conflicting_ids}}, {"_id": 0, "name": 1}
+        ).to_list(1000) if conflicting_ids else []
         if conflicting_groups:
             conflict_names = [g["name"] for g in conflicting_groups]
             raise HTTPException(
@@ -215,7 +218,7 @@ async def create_course(req: CourseCreate, user=Depends(get_current_user)):
         "subject_ids": subject_ids if subject_ids else [],
         "teacher_id": req.teacher_id,
         "year": req.year,
-        "student_ids": student_ids_to_add,
+        "student_count": 0,
         "start_date": req.start_date,
         "end_date": req.end_date,
         "grupo": req.grupo,
@@ -224,12 +227,16 @@ async def create_course(req: CourseCreate, user=Depends(get_current_user)):
         "created_at": datetime.now(timezone.utc).isoformat()
     }
 
-    logger.info(f"Creating course: id={course['id']}, name={course['name']}, subject_ids={course['subject_ids']}, student_ids={len(course['student_ids'])} students")
+    logger.info(f"Creating course: id={course['id']}, name={course['name']}, subject_ids={course['subject_ids']}, student_ids={len(student_ids_to_add)} students")
 
     await db.courses.insert_one(course)
     del course["_id"]
+    await enrollments.enroll(course["id"], course["program_id"], student_ids_to_add)
+    course["student_count"] = len(set(student_ids_to_add))
+    course["student_ids"] = list(dict.fromkeys(student_ids_to_add))
+    course["removed_student_ids"] = []
 
-    if course["student_ids"]:
+    if student_ids_to_add:
         program_id = course["program_id"]
         module_number = get_open_enrollment_module(course["module_dates"]) or get_current_module_from_dates(course["module_dates"])
         if module_number is None and course["subject_ids"]:
@@ -242,7 +249,7 @@ async def create_course(req: CourseCreate, user=Depends(get_current_user)):
         if module_number is not None:
             await db.users.update_many(
                 {
-                    "id": {"$in": course["student_ids"]},
+                    "id": {"$in": student_ids_to_add},
                     "role": "estudiante",
                     "$or": [
                         {f"program_modules.{program_id}": {"$exists": False}},
@@ -257,8 +264,8 @@ async def create_course(req: CourseCreate, user=Depends(get_current_user)):
             )
         if program_id:
             enrolled_docs = await db.users.find(
-                {"id": {"$in": course["student_ids"]}, "role": "estudiante"},
-                {"_id": 0, "id": 1, "program_statuses": 1}
+                {"id": {"$in": student_ids_to_add}, "role": "estudiante"},
+                {"_id": 0, "id": 1, "program_statuses": 1, "estado": 1}
             ).to_list(5000)
             for s in enrolled_docs:
                 ps = s.get("program_statuses") or {}
@@ -269,7 +276,10 @@ async def create_course(req: CourseCreate, user=Depends(get_current_user)):
                         {"id": s["id"]},
                         {"$set": {"program_statuses": ps, "estado": new_estado}}
                     )
+                    await count_student_status_change(s.get("estado"), new_estado)
 
+    await incr_counters(courses=1)
+    await bump_versions("courses", f"course:{course['id']}", "students")
     await log_audit("course_created", user["id"], user["role"], {"course_id": course["id"], "course_name": course.get("name", "")})
     return course
 
@@ -297,14 +307,26 @@ async def update_course(course_id: str, req: CourseUpdate, user=Depends(get_curr
         if "subject_ids" not in update_data:
             update_data["subject_ids"] = [update_data["subject_id"]]
 
+    # The roster is not a course field: it is applied to `enrollments` after the update.
+    for roster_field in ("student_ids", "add_student_ids", "remove_student_ids"):
+        update_data.pop(roster_field, None)
+    requested_student_ids = req.student_ids
+    if requested_student_ids is None and (req.add_student_ids is not None or req.remove_student_ids is not None):
+        # Incremental form: resolve to the full roster so the checks below apply unchanged.
+        current_enrolled = await enrollments.enrolled_ids(course_id)
+        removing = set(req.remove_student_ids or [])
+        requested_student_ids = [
+            sid for sid in dict.fromkeys(current_enrolled + list(req.add_student_ids or []))
+            if sid not in removing
+        ]
+
     newly_added_ids = []
-    pre_update_student_ids: set = set()
-    if req.student_ids is not None and user["role"] == "admin":
-        current_course = await db.courses.find_one({"id": course_id}, {"_id": 0, "program_id": 1, "student_ids": 1, "module_dates": 1, "removed_student_ids": 1})
+    if requested_student_ids is not None and user["role"] == "admin":
+        current_course = await db.courses.find_one({"id": course_id}, {"_id": 0, "program_id": 1, "module_dates": 1})
         if current_course:
-            current_student_ids = set(current_course.get("student_ids") or [])
-            pre_update_student_ids = current_student_ids
-            newly_added_ids = list(set(req.student_ids) - current_student_ids)
+            current_enrolled, current_removed = await enrollments.course_roster(course_id)
+            current_student_ids = set(current_enrolled)
+            newly_added_ids = list(set(requested_student_ids) - current_student_ids)
             course_module_dates = (req.module_dates if req.module_dates is not None else current_course.get("module_dates")) or {}
             course_current_module = get_open_enrollment_module(course_module_dates) or get_current_module_from_dates(course_module_dates) or 1
             if newly_added_ids and not can_enroll_in_module(course_module_dates, course_current_module):
@@ -340,11 +362,13 @@ async def update_course(course_id: str, req: CourseUpdate, user=Depends(get_curr
                     )
 
             program_id = current_course.get("program_id")
-            if program_id and req.student_ids:
+            if program_id and requested_student_ids:
+                conflicting_ids = await enrollments.conflicting_course_ids(
+                    program_id, requested_student_ids, exclude_course_id=course_id
+                )
                 conflicting_groups = await db.courses.find(
-                    {"program_id": program_id, "id": {"$ne": course_id}, "student_ids": {"$in": req.student_ids}},
-                    {"_id": 0, "name": 1, "student_ids": 1}
-                ).to_list(1000)
+                    {"id": {"$in": conflicting_ids}}, {"_id": 0, "name": 1}
+                ).to_list(1000) if conflicting_ids else []
                 if conflicting_groups:
                     conflict_names = [g["name"] for g in conflicting_groups]
                     raise HTTPException(
@@ -352,7 +376,7 @@ async def update_course(course_id: str, req: CourseUpdate, user=Depends(get_curr
                         detail=f"Uno o más estudiantes ya están inscritos en otro grupo del mismo programa: {', '.join(conflict_names)}"
                     )
 
-            removed_ids = set(current_course.get("removed_student_ids") or [])
+            removed_ids = set(current_removed)
             if removed_ids and newly_added_ids:
                 blocked = [sid for sid in newly_added_ids if sid in removed_ids]
                 if blocked:
@@ -390,14 +414,22 @@ async def update_course(course_id: str, req: CourseUpdate, user=Depends(get_curr
                     if student_prog_status == "pendiente_recuperacion":
                         raise HTTPException(status_code=400, detail=_ERR_ENROLL_PENDIENTE)
 
-    result = await db.courses.update_one({"id": course_id}, {"$set": update_data})
-    if result.matched_count == 0:
+    if update_data:
+        result = await db.courses.update_one({"id": course_id}, {"$set": update_data})
+        found = result.matched_count > 0
+    else:
+        found = await db.courses.count_documents({"id": course_id}, limit=1) > 0
+    if not found:
         raise HTTPException(status_code=404, detail="Curso no encontrado")
+    await invalidate_student_dashboard(course_id)
     updated = await db.courses.find_one({"id": course_id}, {"_id": 0})
 
-    if updated and req.student_ids is not None:
+    if updated and requested_student_ids is not None:
         program_id = updated.get("program_id", "")
-        student_ids = updated.get("student_ids") or []
+        student_ids = list(dict.fromkeys(requested_student_ids))
+        current_ids = set(await enrollments.enrolled_ids(course_id))
+        await enrollments.unenroll(course_id, current_ids - set(student_ids))
+        await enrollments.enroll(course_id, program_id, [sid for sid in student_ids if sid not in current_ids])
         if student_ids:
             module_number = get_open_enrollment_module(updated.get("module_dates") or {}) or get_current_module_from_dates(updated.get("module_dates") or {})
             if module_number is None:
@@ -426,21 +458,12 @@ async def update_course(course_id: str, req: CourseUpdate, user=Depends(get_curr
                     }}
                 )
 
-    if req.student_ids is not None and pre_update_student_ids:
-        program_id_for_removed = updated.get("program_id", "") if updated else ""
-        manually_removed = pre_update_student_ids - set(req.student_ids)
-        if manually_removed:
-            await db.courses.update_one(
-                {"id": course_id},
-                {"$addToSet": {"removed_student_ids": {"$each": list(manually_removed)}}}
-            )
-
     if newly_added_ids:
         program_id_for_new = updated.get("program_id", "") if updated else ""
         if program_id_for_new:
             added_student_docs = await db.users.find(
                 {"id": {"$in": newly_added_ids}, "role": "estudiante"},
-                {"_id": 0, "id": 1, "program_statuses": 1}
+                {"_id": 0, "id": 1, "program_statuses": 1, "estado": 1}
             ).to_list(5000)
             for s in added_student_docs:
                 ps = s.get("program_statuses") or {}
@@ -451,15 +474,20 @@ async def update_course(course_id: str, req: CourseUpdate, user=Depends(get_curr
                         {"id": s["id"]},
                         {"$set": {"program_statuses": ps, "estado": new_estado}}
                     )
+                    await count_student_status_change(s.get("estado"), new_estado)
+
+    await bump_versions("courses", f"course:{course_id}", "students")
 
     if module_dates_updated:
         from routes.admin import check_and_close_modules
         await check_and_close_modules()
 
+    if updated:
+        updated = await enrollments.with_roster(await db.courses.find_one({"id": course_id}, {"_id": 0}) or updated)
     return updated
 
 
-@router.delete("/courses/{course_id}")
+@router.delete("/courses/{course_id}", status_code=202)
 async def delete_course(course_id: str, force: bool = False, delete_students: bool = False, user=Depends(get_current_user)):
     if user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Solo admin")
@@ -469,7 +497,7 @@ async def delete_course(course_id: str, force: bool = False, delete_students: bo
         raise HTTPException(status_code=404, detail="Curso no encontrado")
 
     program_id = course.get("program_id", "")
-    student_ids_in_course = course.get("student_ids", [])
+    student_ids_in_course = await enrollments.enrolled_ids(course_id)
 
     if student_ids_in_course:
         students = await db.users.find(
@@ -503,10 +531,8 @@ async def delete_course(course_id: str, force: bool = False, delete_students: bo
                 deleted_students_result = await db.users.delete_many(
                     {"id": {"$in": all_student_ids}, "role": "estudiante"}
                 )
-                await db.courses.update_many(
-                    {"student_ids": {"$in": all_student_ids}},
-                    {"$pullAll": {"student_ids": all_student_ids}}
-                )
+                await count_students_deleted([s.get("estado") for s in students])
+                await enrollments.drop_students(all_student_ids)
                 logger.info(
                     f"Deleted {deleted_students_result.deleted_count} student account(s) "
                     f"along with course {course_id}"
@@ -524,81 +550,38 @@ async def delete_course(course_id: str, force: bool = False, delete_students: bo
                 f"Force-deleted course {course_id}: unenrolled {len(blocking_students)} active student(s)"
             )
 
-    activities_for_files = await db.activities.find(
-        {"course_id": course_id}, {"_id": 0, "id": 1, "files": 1}
-    ).to_list(10000)
-    activity_ids = [a["id"] for a in activities_for_files if a.get("id")]
-    if activity_ids:
-        submissions_for_files = await db.submissions.find(
-            {"activity_id": {"$in": activity_ids}}, {"_id": 0, "files": 1}
-        ).to_list(50000)
-    else:
-        submissions_for_files = []
-
-    await db.courses.delete_one({"id": course_id})
+    # The course disappears from every read now; activities, submissions, grades and
+    # stored files go in batches in the background (scheduler/course_sweeper.py).
+    deletion = await tombstone_course(course, user)
+    await invalidate_student_dashboard(course_id)
+    # delete_students pulls ids from every other course too, so the collection stamp covers them.
+    await bump_versions("courses", f"course:{course_id}", "students")
+    run_in_background(sweep_course_deletions())
 
-    activities_deleted = await db.activities.delete_many({"course_id": course_id})
-    grades_deleted = await db.grades.delete_many({"course_id": course_id})
-    if activity_ids:
-        submissions_deleted = await db.submissions.delete_many({"activity_id": {"$in": activity_ids}})
-    else:
-        submissions_deleted = type("_DeleteResult", (), {"deleted_count": 0})()
-    failed_subjects_deleted = await db.failed_subjects.delete_many({"course_id": course_id})
-    recovery_enabled_deleted = await db.recovery_enabled.delete_many({"course_id": course_id})
-    videos_deleted = await db.class_videos.delete_many({"course_id": course_id})
-
-    cloudinary_deleted_count = 0
-    for doc in activities_for_files + submissions_for_files:
-        for f in (doc.get("files") or []):
-            stored_name = f.get("stored_name") if isinstance(f, dict) else None
-            if not stored_name:
-                continue
-            storage = f.get("storage") if isinstance(f, dict) else None
-            is_cloudinary_file = (
-                USE_CLOUDINARY and (
-                    storage == "cloudinary" or
-                    (isinstance(stored_name, str) and stored_name.startswith("educando/"))
-                )
-            )
-            if is_cloudinary_file:
-                try:
-                    import cloudinary.uploader
-                    _rt = f.get("resource_type") if isinstance(f, dict) else None
-                    if not _rt:
-                        _fext = Path(stored_name).suffix.lower().lstrip(".")
-                        if _fext in {"jpg", "jpeg", "png", "gif", "webp", "bmp", "svg"}:
-                            _rt = "image"
-                        elif _fext in {"mp4", "avi", "mov", "mkv", "webm"}:
-                            _rt = "video"
-                        else:
-                            _rt = "raw"
-                    cloudinary.uploader.destroy(stored_name, resource_type=_rt)
-                    cloudinary_deleted_count += 1
-                except Exception as e:
-                    logger.warning(f"Failed to delete Cloudinary file {stored_name}: {e}")
-            else:
-                file_path = UPLOAD_DIR / stored_name
-                if file_path.exists():
-                    try:
-                        file_path.unlink()
-                    except Exception as e:
-                        logger.warning(f"Failed to delete file {stored_name}: {e}")
-
-    logger.info(
-        f"Course {course_id} deleted: "
-        f"{activities_deleted.deleted_count} activities, {grades_deleted.deleted_count} grades, "
-        f"{submissions_deleted.deleted_count} submissions"
-    )
+    logger.info(f"Course {course_id} tombstoned; dependents queued for sweeping")
     await log_audit("course_deleted", user["id"], user["role"], {"course_id": course_id, "course_name": course.get("name", "")})
 
     return {
-        "message": "Grupo eliminado con todos sus datos asociados",
-        "deleted": {
-            "activities": activities_deleted.deleted_count,
-            "grades": grades_deleted.deleted_count,
-            "submissions": submissions_deleted.deleted_count,
-            "failed_subjects": failed_subjects_deleted.deleted_count,
-            "recovery_enabled": recovery_enabled_deleted.deleted_count,
-            "videos": videos_deleted.deleted_count
-        }
+        "message": "Grupo eliminado; sus datos asociados se eliminan en segundo plano",
+        "deletion": deletion,
     }
+
+
+@router.get("/course-deletions")
+async def list_course_deletions(status: Optional[str] = None, limit: int = 50, user=Depends(get_current_user)):
+    """Recent course deletions with their sweep progress (admin)."""
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Solo admin")
+    limit = max(1, min(limit, MAX_LIMIT))
+    query = {"status": status} if status else {}
+    return await db.course_deletions.find(query, {"_id": 0}).sort("requested_at", -1).to_list(limit)
+
+
+@router.get("/course-deletions/{course_id}")
+async def get_course_deletion(course_id: str, user=Depends(get_current_user)):
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Solo admin")
+    deletion = await db.course_deletions.find_one({"course_id": course_id}, {"_id": 0})
+    if not deletion:
+        raise HTTPException(status_code=404, detail="Eliminación no encontrada")
+    return deletion
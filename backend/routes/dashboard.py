@@ -3,9 +3,10 @@ import logging
 import io
 import csv
 import re
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from typing import Optional
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse, StreamingResponse
 
 try:
@@ -17,52 +18,49 @@ except ImportError:
     OPENPYXL_AVAILABLE = False
 
 from database import db
+from cache import student_dashboard_cache
 from utils.security import get_current_user
+from utils.http_cache import compute_etag, dashboard_version_keys, etag_matches, get_versions, not_modified
+from utils.counters import get_counters
+from utils import enrollments, recovery_state
+from config import BOGOTA_TZ
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-@router.get("/student/dashboard/{course_id}")
-async def get_student_dashboard(
-    course_id: str,
-    subject_id: Optional[str] = None,
-    user=Depends(get_current_user)
-):
-    """Consolidated endpoint that returns all data needed for the student course dashboard
-    in a single request, reducing 4-5 API calls to 1."""
-    if user["role"] != "estudiante":
-        raise HTTPException(status_code=403, detail="Solo estudiantes")
+_STUDENT_DASHBOARD_CACHE_CONTROL = "private, no-cache"
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 
-    student_id = user["id"]
 
-    # Build all queries
-    course = await db.courses.find_one({"id": course_id}, {"_id": 0})
-    if not course or student_id not in (course.get("student_ids") or []):
-        raise HTTPException(status_code=404, detail="Curso no encontrado o no inscrito")
+def _split_by_release(docs: list, field: str, now_iso: str) -> tuple:
+    """Split docs into those already released (field empty or <= now) and the earliest
+    future release timestamp, which bounds how long a cached dashboard stays valid."""
+    visible = []
+    next_release = None
+    for d in docs:
+        released_at = d.get(field)
+        if not released_at or released_at <= now_iso:
+            visible.append(d)
+        elif next_release is None or released_at < next_release:
+            next_release = released_at
+    return visible, next_release
+
 
-    # Activities query — students only see activities whose start_date has passed
+async def _load_student_dashboard(course: dict, student_id: str, subject_id: Optional[str]) -> tuple:
+    """Run the dashboard queries and return (payload, valid_until)."""
+    course_id = course["id"]
     now_iso = datetime.now(timezone.utc).isoformat()
+
+    # Scheduled activities/videos are filtered here rather than in the query so the
+    # earliest hidden release date is known and the cached payload can expire at it.
     activities_query = {"course_id": course_id}
     if subject_id:
         activities_query["subject_id"] = subject_id
-    activities_query["$or"] = [
-        {"start_date": {"$exists": False}},
-        {"start_date": None},
-        {"start_date": ""},
-        {"start_date": {"$lte": now_iso}},
-    ]
 
-    # Videos query (with available_from filter for students)
     videos_query = {"course_id": course_id}
     if subject_id:
         videos_query["subject_id"] = subject_id
-    videos_query["$or"] = [
-        {"available_from": {"$exists": False}},
-        {"available_from": None},
-        {"available_from": ""},
-        {"available_from": {"$lte": now_iso}}
-    ]
 
     # Grades query
     grades_query = {"student_id": student_id, "course_id": course_id}
@@ -75,17 +73,17 @@ async def get_student_dashboard(
         db.class_videos.find(videos_query, {"_id": 0}).to_list(500),
         db.grades.find(grades_query, {"_id": 0}).to_list(2000)
     )
+    activities, next_activity = _split_by_release(activities, "start_date", now_iso)
+    videos, next_video = _split_by_release(videos, "available_from", now_iso)
+    valid_until = min(filter(None, [next_activity, next_video]), default=None)
 
     # Filter recovery activities for students, and fetch subject info — both independent.
     async def _get_approved_records():
         if activities:
-            return await db.failed_subjects.find({
-                "student_id": student_id,
-                "course_id": course_id,
-                "recovery_approved": True,
-                "recovery_processed": {"$ne": True},
-                "recovery_expired": {"$ne": True}
-            }, {"_id": 0, "subject_id": 1}).to_list(100)
+            return await db.failed_subjects.find(await recovery_state.in_states(
+                {"student_id": student_id, "course_id": course_id, "recovery_approved": True},
+                recovery_state.GRADED_OR_APPROVED_STATES,
+            ), {"_id": 0, "subject_id": 1}).to_list(100)
         return []
 
     async def _get_subject():
@@ -101,13 +99,65 @@ async def get_student_dashboard(
         if not a.get("is_recovery") or a.get("subject_id") in approved_subject_ids
     ]
 
-    return {
+    payload = {
         "course": course,
         "activities": activities,
         "videos": videos,
         "grades": grades,
         "subject": subject
     }
+    return payload, valid_until
+
+
+@router.get("/student/dashboard/{course_id}")
+async def get_student_dashboard(
+    course_id: str,
+    request: Request,
+    subject_id: Optional[str] = None,
+    user=Depends(get_current_user)
+):
+    """Consolidated endpoint that returns all data needed for the student course dashboard
+    in a single request, reducing 4-5 API calls to 1.
+
+    Payloads are cached per (course, student, subject) under the dashboard version stamps,
+    which the writes that affect them bump (see cache.invalidate_student_dashboard).
+    Responses carry a strong ETag; a matching If-None-Match gets an empty 304."""
+    if user["role"] != "estudiante":
+        raise HTTPException(status_code=403, detail="Solo estudiantes")
+
+    student_id = user["id"]
+    version_keys = dashboard_version_keys(course_id, student_id)
+    versions = await get_versions(*version_keys)
+    stamp = ".".join(versions[k] for k in version_keys)
+    cache_key = f"{course_id}:{student_id}:{subject_id or ''}"
+    cached = student_dashboard_cache.get(cache_key)
+    now_iso = datetime.now(timezone.utc).isoformat()
+
+    if (cached is not None and cached["stamp"] == stamp
+            and (cached["valid_until"] is None or now_iso < cached["valid_until"])):
+        # Enrollment can change through many admin paths; re-check it with one indexed
+        # point query instead of trusting the cached course document.
+        if not await enrollments.is_enrolled(course_id, student_id):
+            student_dashboard_cache.invalidate(cache_key)
+            raise HTTPException(status_code=404, detail="Curso no encontrado o no inscrito")
+        etag, payload = cached["etag"], cached["payload"]
+    else:
+        course = await db.courses.find_one({"id": course_id}, {"_id": 0})
+        if not course or not await enrollments.is_enrolled(course_id, student_id):
+            raise HTTPException(status_code=404, detail="Curso no encontrado o no inscrito")
+        payload, valid_until = await _load_student_dashboard(course, student_id, subject_id)
+        payload = jsonable_encoder(payload)
+        etag = compute_etag({"versions": stamp, "payload": payload})
+        student_dashboard_cache.set(
+            cache_key, {"stamp": stamp, "etag": etag, "payload": payload, "valid_until": valid_until}
+        )
+
+    if etag_matches(request, etag):
+        return not_modified(etag, _STUDENT_DASHBOARD_CACHE_CONTROL)
+    return JSONResponse(
+        content=payload,
+        headers={"ETag": etag, "Cache-Control": _STUDENT_DASHBOARD_CACHE_CONTROL}
+    )
 
 
 @router.get("/teacher/dashboard/{course_id}")
@@ -156,14 +206,95 @@ async def get_teacher_dashboard(
     }
 
 
+async def _build_grades_matrix(students: list, activities: list, grades_cursor) -> dict:
+    """Pivot a projected grades cursor into parallel student/activity arrays plus a
+    dense values matrix (rows = students, columns = activities, None = no grade).
+
+    Recovery verdicts are sparse, so they travel as [row, col, status] triplets instead
+    of a second dense matrix.
+    """
+    student_index = {s["id"]: i for i, s in enumerate(students)}
+    activity_index = {a["id"]: j for j, a in enumerate(activities)}
+    values = [[None] * len(activities) for _ in students]
+    recovery_status = []
+    async for g in grades_cursor:
+        i = student_index.get(g.get("student_id"))
+        j = activity_index.get(g.get("activity_id"))
+        if i is None or j is None:
+            continue
+        values[i][j] = g.get("value")
+        if g.get("recovery_status"):
+            recovery_status.append([i, j, g["recovery_status"]])
+    return {
+        "student_ids": [s["id"] for s in students],
+        "student_names": [s.get("name", "") for s in students],
+        "activity_ids": [a["id"] for a in activities],
+        "activity_titles": [a.get("title", "") for a in activities],
+        "values": values,
+        "recovery_status": recovery_status,
+    }
+
+
+async def _get_teacher_grades_matrix(course: dict, subject_id: Optional[str], fs_query: dict) -> dict:
+    """Compact gradebook for format=matrix: every query is projected to the fields the
+    matrix needs and grades are consumed from a cursor instead of a 10000-doc list."""
+    course_id = course["id"]
+    activities_query = {"course_id": course_id}
+    grades_query = {"course_id": course_id}
+    if subject_id:
+        activities_query["subject_id"] = subject_id
+        grades_query["subject_id"] = subject_id
+
+    enrolled, removed = await enrollments.course_roster(course_id)
+    removed_set = set(removed) - set(enrolled)
+    student_ids = list(set(enrolled) | removed_set)
+
+    async def _empty_list():
+        return []
+
+    activities, students, recovery_records = await asyncio.gather(
+        db.activities.find(
+            activities_query,
+            {"_id": 0, "id": 1, "title": 1, "subject_id": 1, "activity_number": 1, "is_recovery": 1}
+        ).sort([("subject_id", 1), ("activity_number", 1)]).to_list(500),
+        db.users.find(
+            {"id": {"$in": student_ids}, "role": "estudiante"},
+            {"_id": 0, "id": 1, "name": 1}
+        ).sort("name", 1).to_list(5000) if student_ids else _empty_list(),
+        db.failed_subjects.find(fs_query, {"_id": 0, "student_id": 1, "subject_id": 1}).to_list(1000),
+    )
+
+    matrix = await _build_grades_matrix(
+        students,
+        activities,
+        db.grades.find(
+            grades_query,
+            {"_id": 0, "student_id": 1, "activity_id": 1, "value": 1, "recovery_status": 1}
+        ),
+    )
+    matrix.update({
+        "course_id": course_id,
+        "course_name": course.get("name", ""),
+        "student_removed": [s["id"] in removed_set for s in students],
+        "activity_subject_ids": [a.get("subject_id") for a in activities],
+        "activity_is_recovery": [bool(a.get("is_recovery")) for a in activities],
+        "recovery_enabled": sorted({
+            (r.get("student_id"), r.get("subject_id")) for r in recovery_records
+        }, key=lambda k: (k[0] or "", k[1] or "")),
+    })
+    return matrix
+
+
 @router.get("/teacher/grades-data/{course_id}")
 async def get_teacher_grades_data(
     course_id: str,
     subject_id: Optional[str] = None,
+    format: Optional[str] = None,
     user=Depends(get_current_user)
 ):
     """Consolidated endpoint that returns all data needed for the teacher grades page
-    in a single request, reducing 5 API calls to 1."""
+    in a single request, reducing 5 API calls to 1.
+    When format=matrix, returns the gradebook already pivoted into parallel arrays."""
     if user["role"] not in ["profesor", "admin"]:
         raise HTTPException(status_code=403, detail="Solo profesores o admin")
 
@@ -171,6 +302,12 @@ async def get_teacher_grades_data(
     if not course:
         raise HTTPException(status_code=404, detail="Curso no encontrado")
 
+    # Recovery enabled query
+    fs_query = await recovery_state.in_states({"course_id": course_id}, recovery_state.APPROVED)
+
+    if format and format.lower() == "matrix":
+        return await _get_teacher_grades_matrix(course, subject_id, fs_query)
+
     # Build queries
     activities_query = {"course_id": course_id}
     if subject_id:
@@ -181,19 +318,8 @@ async def get_teacher_grades_data(
         grades_query["subject_id"] = subject_id
 
     # All student IDs (enrolled + removed)
-    student_ids = list(set(
-        (course.get("student_ids") or []) +
-        (course.get("removed_student_ids") or [])
-    ))
-
-    # Recovery enabled query
-    fs_query = {
-        "recovery_approved": True,
-        "recovery_completed": {"$ne": True},
-        "recovery_processed": {"$ne": True},
-        "recovery_rejected": {"$ne": True},
-        "course_id": course_id,
-    }
+    enrolled, removed = await enrollments.course_roster(course_id)
+    student_ids = list(set(enrolled + removed))
 
     # Build futures before gather
     activities_fut = db.activities.find(activities_query, {"_id": 0}).to_list(500)
@@ -220,7 +346,7 @@ async def get_teacher_grades_data(
     recovery_records = results[3]
 
     # Mark removed students
-    removed_set = set(course.get("removed_student_ids") or []) - set(course.get("student_ids") or [])
+    removed_set = set(removed) - set(enrolled)
     for s in students_docs:
         if s["id"] in removed_set:
             s["_removed_from_group"] = True
@@ -274,7 +400,7 @@ async def get_course_results_report(course_id: str, subject_id: Optional[str] =
     subject_map = {s["id"]: s["name"] for s in all_subjects}
     
     # Load enrolled students
-    student_ids = course.get("student_ids") or []
+    student_ids = await enrollments.enrolled_ids(course_id)
     students = await db.users.find(
         {"id": {"$in": student_ids}, "role": "estudiante"},
         {"_id": 0, "id": 1, "name": 1, "cedula": 1}
@@ -304,7 +430,7 @@ async def get_course_results_report(course_id: str, subject_id: Optional[str] =
 
     # Pre-load all active recovery records for this course in one query (avoids N+1)
     _recovery_docs = await db.failed_subjects.find(
-        {"course_id": course_id, "recovery_processed": {"$ne": True}},
+        await recovery_state.in_states({"course_id": course_id}, recovery_state.UNPROCESSED_STATES),
         {"_id": 0, "student_id": 1}
     ).to_list(10000)
     # Use a set: we only need to know whether a student has any active recovery record
@@ -476,7 +602,7 @@ async def get_recovery_results_report(format: Optional[str] = None, user=Depends
     # tens of thousands of documents into memory at once.
     all_failed = []
     async for doc in db.failed_subjects.find(
-        {"recovery_processed": {"$ne": True}},
+        await recovery_state.in_states({}, recovery_state.UNPROCESSED_STATES),
         {"_id": 0}
     ):
         all_failed.append(doc)
@@ -608,40 +734,54 @@ async def get_stats(user=Depends(get_current_user)):
     if user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Solo admin")
 
-    # Conteo de estudiantes por estado en una sola aggregation query
-    student_status_agg = await db.users.aggregate([
-        {"$match": {"role": "estudiante"}},
-        {"$group": {
-            "_id": {"$ifNull": ["$estado", "activo"]},
-            "count": {"$sum": 1}
-        }}
-    ]).to_list(20)
-
-    students_by_status = {doc["_id"]: doc["count"] for doc in student_status_agg}
-    total_students = sum(students_by_status.values())
-
-    teachers, programs_count, courses_count, existing_courses = await asyncio.gather(
-        db.users.count_documents({"role": "profesor"}),
-        db.programs.count_documents({}),
-        db.courses.count_documents({}),
-        db.courses.find({}, {"_id": 0, "id": 1}).to_list(5000),
-    )
-    existing_course_ids = [c["id"] for c in existing_courses]
-    activities = await db.activities.count_documents({"course_id": {"$in": existing_course_ids}}) if existing_course_ids else 0
-
+    # Counters are maintained with $inc on every write path and reconciled periodically
+    # by the scheduler, so this is a single point read.
+    counters = await get_counters()
     return {
-        "students": total_students,
-        "teachers": teachers,
-        "programs": programs_count,
-        "courses": courses_count,
-        "activities": activities,
-        "students_activo": students_by_status.get("activo", 0),
-        "students_pendiente_recuperacion": students_by_status.get("pendiente_recuperacion", 0),
-        "students_egresado": students_by_status.get("egresado", 0),
-        "students_retirado": students_by_status.get("retirado", 0),
-        "students_reprobado": students_by_status.get("reprobado", 0),
+        "students": counters.get("students", 0),
+        "teachers": counters.get("teachers", 0),
+        "programs": counters.get("programs", 0),
+        "courses": counters.get("courses", 0),
+        "activities": counters.get("activities", 0),
+        "students_activo": counters.get("students_activo", 0),
+        "students_pendiente_recuperacion": counters.get("students_pendiente_recuperacion", 0),
+        "students_egresado": counters.get("students_egresado", 0),
+        "students_retirado": counters.get("students_retirado", 0),
+        "students_reprobado": counters.get("students_reprobado", 0),
     }
 
+@router.get("/stats/trends")
+async def get_stats_trends(
+    program_id: Optional[str] = None,
+    module_number: Optional[int] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    user=Depends(get_current_user),
+):
+    """Daily per-program/per-module snapshots written by the nightly rollup job.
+
+    Defaults to the last 90 days. Reads only the small analytics_rollups documents,
+    never the raw grades or failed_subjects collections.
+    """
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Solo admin")
+    today = datetime.now(BOGOTA_TZ).date()
+    date_to = date_to or today.isoformat()
+    date_from = date_from or (today - timedelta(days=90)).isoformat()
+    if not (_DATE_RE.match(date_from) and _DATE_RE.match(date_to)):
+        raise HTTPException(status_code=400, detail="Formato de fecha inválido (use AAAA-MM-DD)")
+
+    query: dict = {"date": {"$gte": date_from, "$lte": date_to}}
+    if program_id:
+        query["program_id"] = program_id
+    if module_number is not None:
+        query["module_number"] = module_number
+    snapshots = await db.analytics_rollups.find(
+        query, {"_id": 0, "created_at": 0}
+    ).sort([("date", 1), ("program_id", 1), ("module_number", 1)]).to_list(5000)
+    return {"date_from": date_from, "date_to": date_to, "snapshots": snapshots}
+
+
 @router.get("/health")
 async def health_check():
     """Health check endpoint for monitoring and Railway deployment"""
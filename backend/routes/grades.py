@@ -7,8 +7,10 @@ from fastapi import APIRouter, HTTPException, Depends, Request
 from fastapi.responses import JSONResponse
 
 from database import db
+from cache import invalidate_student_dashboard
 from utils.security import get_current_user, safe_object_id
 from utils.audit import log_audit, log_security_event
+from utils import recovery_state
 from utils.helpers import (
     _check_and_update_recovery_completion,
     _check_and_update_recovery_rejection,
@@ -149,13 +151,9 @@ async def create_grade(req: GradeCreate, user=Depends(get_current_user)):
         if req.recovery_status not in ("approved", "rejected", None):
             raise HTTPException(status_code=400, detail="Estado de recuperación inválido")
         rec_subject_id = req.subject_id or activity_doc.get("subject_id")
-        failed_filter = {
-            "student_id": req.student_id,
-            "course_id": req.course_id,
-            "recovery_approved": True,
-            "recovery_processed": {"$ne": True},
-            "recovery_rejected": {"$ne": True},
-        }
+        failed_filter = await recovery_state.in_states(
+            {"student_id": req.student_id, "course_id": req.course_id}, recovery_state.IN_RECOVERY_STATES
+        )
         if rec_subject_id:
             failed_filter["subject_id"] = rec_subject_id
         failed_record = await db.failed_subjects.find_one(failed_filter)
@@ -174,9 +172,7 @@ async def create_grade(req: GradeCreate, user=Depends(get_current_user)):
         fs_filter = {
             "student_id": req.student_id,
             "course_id": req.course_id,
-            "recovery_approved": True,
-            "recovery_processed": {"$ne": True},
-            "recovery_rejected": {"$ne": True},
+            "state": {"$in": recovery_state.IN_RECOVERY_STATES},
         }
         if rec_subject_id:
             fs_filter["subject_id"] = rec_subject_id
@@ -207,24 +203,23 @@ async def create_grade(req: GradeCreate, user=Depends(get_current_user)):
                 f"for student {req.student_id}, course {req.course_id}, subject {rec_subject_id}"
             )
 
-            await db.failed_subjects.update_one(
-                fs_filter,
-                {"$set": {
-                    "recovery_completed": True,
-                    "teacher_graded_status": "approved",
-                    "completed_at": datetime.now(timezone.utc).isoformat()
-                }}
-            )
+            try:
+                await recovery_state.transition(
+                    fs_filter, recovery_state.COMPLETED_OK,
+                    completed_at=datetime.now(timezone.utc).isoformat(),
+                )
+            except recovery_state.InvalidRecoveryTransition:
+                logger.warning(f"No open recovery to complete for student {req.student_id}, course {req.course_id}")
             await _check_and_update_recovery_completion(req.student_id, req.course_id)
         else:
-            await db.failed_subjects.update_one(
-                fs_filter,
-                {"$set": {
-                    "recovery_completed": True,
-                    "teacher_graded_status": "rejected",
-                    "completed_at": datetime.now(timezone.utc).isoformat()
-                }}
-            )
+            try:
+                await recovery_state.transition(
+                    fs_filter, recovery_state.COMPLETED_REJECTED,
+                    recovery_completed=True, teacher_graded_status="rejected",
+                    completed_at=datetime.now(timezone.utc).isoformat(),
+                )
+            except recovery_state.InvalidRecoveryTransition:
+                logger.warning(f"No open recovery to reject for student {req.student_id}, course {req.course_id}")
             await _check_and_update_recovery_rejection(req.student_id, req.course_id)
 
             if existing:
@@ -233,6 +228,7 @@ async def create_grade(req: GradeCreate, user=Depends(get_current_user)):
                     {"$set": {"recovery_status": req.recovery_status, "updated_at": datetime.now(timezone.utc).isoformat()}}
                 )
                 updated = await db.grades.find_one({"id": existing["id"]}, {"_id": 0})
+                await invalidate_student_dashboard(req.course_id, req.student_id)
                 await log_audit("recovery_graded", user["id"], user["role"], {"student_id": req.student_id, "course_id": req.course_id, "subject_id": req.subject_id, "result": "rejected"})
                 return updated
             grade = {
@@ -249,6 +245,7 @@ async def create_grade(req: GradeCreate, user=Depends(get_current_user)):
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }
             await db.grades.insert_one(grade)
+            await invalidate_student_dashboard(req.course_id, req.student_id)
             await log_audit("recovery_graded", user["id"], user["role"], {"student_id": req.student_id, "course_id": req.course_id, "subject_id": req.subject_id, "result": "rejected"})
             grade.pop("_id", None)
             return grade
@@ -282,6 +279,7 @@ async def create_grade(req: GradeCreate, user=Depends(get_current_user)):
             {"id": existing["id"]},
             {"$set": update_data}
         )
+        await invalidate_student_dashboard(req.course_id, req.student_id)
         updated = await db.grades.find_one({"id": existing["id"]}, {"_id": 0})
         return updated
 
@@ -300,6 +298,7 @@ async def create_grade(req: GradeCreate, user=Depends(get_current_user)):
     }
     await db.grades.insert_one(grade)
     del grade["_id"]
+    await invalidate_student_dashboard(req.course_id, req.student_id)
     if req.recovery_status == "approved":
         await log_audit("recovery_graded", user["id"], user["role"], {"student_id": req.student_id, "course_id": req.course_id, "subject_id": req.subject_id, "result": "approved"})
     else:
@@ -317,7 +316,7 @@ async def update_grade(grade_id: str, req: GradeUpdate, user=Depends(get_current
             detail="La nota debe estar entre 0.0 y 5.0"
         )
     # Verify the professor owns the course this grade belongs to (IDOR prevention).
-    grade_doc = await db.grades.find_one({"id": grade_id}, {"_id": 0, "course_id": 1})
+    grade_doc = await db.grades.find_one({"id": grade_id}, {"_id": 0, "course_id": 1, "student_id": 1})
     if not grade_doc:
         raise HTTPException(status_code=404, detail="Nota no encontrada")
     course = await db.courses.find_one({"id": grade_doc["course_id"]}, {"_id": 0})
@@ -336,5 +335,6 @@ async def update_grade(grade_id: str, req: GradeUpdate, user=Depends(get_current
     result = await db.grades.update_one({"id": grade_id}, {"$set": update_data})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Nota no encontrada")
+    await invalidate_student_dashboard(grade_doc["course_id"], grade_doc.get("student_id"))
     updated = await db.grades.find_one({"id": grade_id}, {"_id": 0})
     return updated
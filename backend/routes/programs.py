@@ -2,13 +2,17 @@ import uuid
 import logging
 from datetime import datetime, timezone
 from typing import Optional
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 
 from database import db
 from utils.security import get_current_user
 from utils.audit import log_audit
 from models.schemas import ProgramCreate, ProgramUpdate
 from cache import programs_cache
+from utils.counters import incr_counters
+from utils import recovery_state
+from scheduler.cleanup import request_stats_reconcile
+from utils.http_cache import CACHE_CONTROL_CATALOGUE, bump_versions, etag_matches, json_with_etag, not_modified, versioned_etag
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -25,13 +29,9 @@ async def _revert_module_recoveries(program_id: str, module_number: int):
     today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
     pending = await db.failed_subjects.find(
-        {
-            "program_id": program_id,
-            "module_number": module_number,
-            "recovery_approved": False,
-            "recovery_processed": {"$ne": True},
-            "recovery_rejected": {"$ne": True},
-        },
+        await recovery_state.in_states(
+            {"program_id": program_id, "module_number": module_number}, recovery_state.PENDING
+        ),
         {"_id": 0}
     ).to_list(5000)
 
@@ -46,13 +46,9 @@ async def _revert_module_recoveries(program_id: str, module_number: int):
         await db.failed_subjects.delete_one({"id": record["id"]})
 
         # Only restore status if the student has no other open recovery records for this program
-        other_open = await db.failed_subjects.find_one({
-            "student_id": student_id,
-            "program_id": program_id,
-            "recovery_approved": False,
-            "recovery_processed": {"$ne": True},
-            "recovery_rejected": {"$ne": True},
-        })
+        other_open = await db.failed_subjects.find_one(await recovery_state.in_states(
+            {"student_id": student_id, "program_id": program_id}, recovery_state.PENDING
+        ))
         if not other_open:
             await db.users.update_one(
                 {"id": student_id},
@@ -67,6 +63,8 @@ async def _revert_module_recoveries(program_id: str, module_number: int):
             f"program={program_id} module={module_number} restored_status={prev_status}"
         )
 
+    await bump_versions("students")
+    await request_stats_reconcile()
     logger.info(
         f"_revert_module_recoveries: program={program_id} module={module_number} "
         f"reverted={reverted} records (close date moved to future)"
@@ -75,13 +73,19 @@ async def _revert_module_recoveries(program_id: str, module_number: int):
 
 
 @router.get("/programs")
-async def get_programs(user=Depends(get_current_user)):
+async def get_programs(request: Request, user=Depends(get_current_user)):
+    # The version stamp is read before the payload so a write landing in between can only
+    # make the ETag older than the body, never the other way round.
+    etag, versions = await versioned_etag("programs")
+    if etag_matches(request, etag):
+        return not_modified(etag, CACHE_CONTROL_CATALOGUE)
     cached = programs_cache.get("all")
-    if cached is not None:
-        return cached
-    programs = await db.programs.find({}, {"_id": 0}).to_list(100)
-    programs_cache.set("all", programs)
-    return programs
+    if cached is not None and cached[0] == versions["programs"]:
+        programs = cached[1]
+    else:
+        programs = await db.programs.find({}, {"_id": 0}).to_list(100)
+        programs_cache.set("all", (versions["programs"], programs))
+    return json_with_etag(programs, etag, CACHE_CONTROL_CATALOGUE)
 
 
 @router.post("/programs")
@@ -100,6 +104,8 @@ async def create_program(req: ProgramCreate, user=Depends(get_current_user)):
     await db.programs.insert_one(program)
     del program["_id"]
     programs_cache.invalidate()
+    await bump_versions("programs")
+    await incr_counters(programs=1)
     await log_audit("program_created", user["id"], user["role"], {"program_id": program["id"], "program_name": req.name})
     return program
 
@@ -121,6 +127,7 @@ async def update_program(program_id: str, req: ProgramUpdate, user=Depends(get_c
         raise HTTPException(status_code=404, detail="Programa no encontrado")
 
     programs_cache.invalidate()
+    await bump_versions("programs")
     updated = await db.programs.find_one({"id": program_id}, {"_id": 0})
 
     # Detect if any module close date was moved to the future.
@@ -152,8 +159,10 @@ async def update_program(program_id: str, req: ProgramUpdate, user=Depends(get_c
 async def delete_program(program_id: str, user=Depends(get_current_user)):
     if user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Solo admin")
-    await db.programs.delete_one({"id": program_id})
+    result = await db.programs.delete_one({"id": program_id})
+    await incr_counters(programs=-result.deleted_count)
     programs_cache.invalidate()
+    await bump_versions("programs")
     await log_audit("program_deleted", user["id"], user["role"], {"program_id": program_id})
     return {"message": "Programa eliminado"}
 
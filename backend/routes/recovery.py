@@ -9,6 +9,7 @@ from database import db
 from utils.security import get_current_user
 from utils.audit import log_audit
 from utils.helpers import derive_estado_from_program_statuses
+from utils import recovery_state
 from models.schemas import RecoveryEnableRequest
 
 logger = logging.getLogger(__name__)
@@ -51,12 +52,7 @@ async def enable_recovery(req: RecoveryEnableRequest, user=Depends(get_current_u
 @router.get("/recovery/enabled")
 async def get_recovery_enabled(student_id: Optional[str] = None, course_id: Optional[str] = None, user=Depends(get_current_user)):
     """Get list of students with recovery enabled"""
-    fs_query = {
-        "recovery_approved": True,
-        "recovery_completed": {"$ne": True},
-        "recovery_processed": {"$ne": True},
-        "recovery_rejected": {"$ne": True},
-    }
+    fs_query = await recovery_state.in_states({}, recovery_state.APPROVED)
     if student_id:
         fs_query["student_id"] = student_id
     if course_id:
@@ -101,7 +97,7 @@ async def get_student_recoveries(user=Depends(get_current_user)):
     # all three are independent of each other.
     failed_subjects, all_subject_docs, programs = await asyncio.gather(
         db.failed_subjects.find(
-            {"student_id": student_id, "recovery_processed": {"$ne": True}},
+            await recovery_state.in_states({"student_id": student_id}, recovery_state.UNPROCESSED_STATES),
             {"_id": 0}
         ).to_list(100),
         db.subjects.find({}, {"_id": 0, "id": 1, "module_number": 1}).to_list(1000),
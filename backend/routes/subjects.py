@@ -2,19 +2,20 @@ import uuid
 import logging
 from datetime import datetime, timezone
 from typing import Optional
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 
 from database import db
 from utils.security import get_current_user
 from models.schemas import SubjectCreate, SubjectUpdate
 from cache import subjects_cache
+from utils.http_cache import CACHE_CONTROL_CATALOGUE, bump_versions, etag_matches, json_with_etag, not_modified, versioned_etag
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
 @router.get("/subjects")
-async def get_subjects(program_id: Optional[str] = None, teacher_id: Optional[str] = None, user=Depends(get_current_user)):
+async def get_subjects(request: Request, program_id: Optional[str] = None, teacher_id: Optional[str] = None, user=Depends(get_current_user)):
     query = {}
     if program_id:
         query["program_id"] = program_id
@@ -25,15 +26,19 @@ async def get_subjects(program_id: Optional[str] = None, teacher_id: Optional[st
         else:
             return []
 
-    # Use cache for common queries (no teacher_id filter)
+    # Use cache and conditional GET for common queries (no teacher_id filter)
     if not teacher_id:
+        etag, versions = await versioned_etag("subjects", variant=program_id or "")
+        if etag_matches(request, etag):
+            return not_modified(etag, CACHE_CONTROL_CATALOGUE)
         cache_key = f"program:{program_id}" if program_id else "all"
         cached = subjects_cache.get(cache_key)
-        if cached is not None:
-            return cached
-        subjects = await db.subjects.find(query, {"_id": 0}).to_list(500)
-        subjects_cache.set(cache_key, subjects)
-        return subjects
+        if cached is not None and cached[0] == versions["subjects"]:
+            subjects = cached[1]
+        else:
+            subjects = await db.subjects.find(query, {"_id": 0}).to_list(500)
+            subjects_cache.set(cache_key, (versions["subjects"], subjects))
+        return json_with_etag(subjects, etag, CACHE_CONTROL_CATALOGUE)
 
     subjects = await db.subjects.find(query, {"_id": 0}).to_list(500)
     return subjects
@@ -69,6 +74,7 @@ async def create_subject(req: SubjectCreate, user=Depends(get_current_user)):
     await db.subjects.insert_one(subject)
     del subject["_id"]
     subjects_cache.invalidate()
+    await bump_versions("subjects")
     return subject
 
 
@@ -89,6 +95,7 @@ async def update_subject(subject_id: str, req: SubjectUpdate, user=Depends(get_c
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Materia no encontrada")
     subjects_cache.invalidate()
+    await bump_versions("subjects")
     updated = await db.subjects.find_one({"id": subject_id}, {"_id": 0})
     return updated
 
@@ -99,4 +106,5 @@ async def delete_subject(subject_id: str, user=Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Solo admin")
     await db.subjects.delete_one({"id": subject_id})
     subjects_cache.invalidate()
+    await bump_versions("subjects")
     return {"message": "Materia eliminada"}
@@ -8,6 +8,7 @@ from fastapi.responses import JSONResponse
 
 from database import db
 from utils.security import get_current_user
+from utils import enrollments, recovery_state
 from models.schemas import SubmissionCreate
 
 logger = logging.getLogger(__name__)
@@ -45,20 +46,16 @@ async def create_submission(req: SubmissionCreate, user=Depends(get_current_user
     if not activity:
         raise HTTPException(status_code=404, detail="Actividad no encontrada")
 
-    course = await db.courses.find_one({"id": activity["course_id"]}, {"_id": 0, "student_ids": 1, "program_id": 1})
-    if not course or user["id"] not in (course.get("student_ids") or []):
+    enrollment = await enrollments.active_enrollment(activity["course_id"], user["id"])
+    if not enrollment:
         raise HTTPException(status_code=403, detail="No estás inscrito en este curso")
 
     now = datetime.now(timezone.utc)
 
     if activity.get("is_recovery"):
-        failed_filter = {
-            "student_id": user["id"],
-            "course_id": activity["course_id"],
-            "recovery_approved": True,
-            "recovery_processed": {"$ne": True},
-            "recovery_rejected": {"$ne": True},
-        }
+        failed_filter = await recovery_state.in_states(
+            {"student_id": user["id"], "course_id": activity["course_id"]}, recovery_state.IN_RECOVERY_STATES
+        )
         if activity.get("subject_id"):
             failed_filter["subject_id"] = activity["subject_id"]
         failed_record = await db.failed_subjects.find_one(failed_filter)
@@ -84,8 +81,8 @@ async def create_submission(req: SubmissionCreate, user=Depends(get_current_user
         subject = await db.subjects.find_one({"id": activity["subject_id"]}, {"_id": 0, "module_number": 1})
         if subject and subject.get("module_number") is not None:
             subject_module = subject["module_number"]
-            if course and course.get("program_id"):
-                program_id = course["program_id"]
+            if enrollment.get("program_id"):
+                program_id = enrollment["program_id"]
                 student_module = (user.get("program_modules") or {}).get(program_id)
                 if student_module is None:
                     student_module = user.get("module")
@@ -1,19 +1,33 @@
-import uuid
 import re
+import uuid
 import logging
 import os
+import stat
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 from typing import Optional
 from fastapi import APIRouter, HTTPException, Depends, File, UploadFile, Request
-from starlette.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, Response
+from pymongo import ReturnDocument
 
 from database import db
 from utils.security import get_current_user
+from utils.http_cache import etag_matches, not_modified
+from utils.images import (
+    DERIVATIVE_WIDTHS, IMAGE_EXTENSIONS, ImagePoolBusy, compress_or_original, derivative_name,
+    derivative_sizes, derivatives_or_empty, run_in_background,
+)
+from utils.storage import get_backend, get_default_backend
+from utils.blobs import (
+    BlobBeingDeleted, compression_finished, compression_pending, register_blob, response_from_blob, reuse_blob,
+    sha256_bytes, sha256_fileobj,
+)
+from scheduler.cleanup import upload_session_path
+from models.schemas import PresignUploadRequest, CompleteUploadRequest, UploadSessionCreate
 from config import (
-    USE_CLOUDINARY, USE_S3, UPLOAD_DIR,
-    AWS_S3_BUCKET_NAME, AWS_S3_REGION, s3_client,
-    MAX_UPLOADS_PER_MINUTE, UPLOAD_WINDOW
+    UPLOAD_DIR, FILES_ACCEL_REDIRECT_PREFIX, MAX_UPLOADS_PER_MINUTE, UPLOAD_WINDOW, PRESIGNED_UPLOAD_EXPIRES,
+    UPLOAD_SESSION_CHUNK_SIZE, UPLOAD_SESSION_TTL_HOURS, IMAGE_BACKGROUND_QUEUE_WAIT,
 )
 
 logger = logging.getLogger(__name__)
@@ -60,213 +74,582 @@ def _validate_file_content(file_content: bytes, declared_ext: str) -> bool:
     return True
 
 
-_IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "gif"}
-_MAX_IMAGE_DIMENSION = 1920
-_JPEG_QUALITY = 80
+_CONTENT_TYPES = {
+    "pdf": "application/pdf",
+    "doc": "application/msword",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "xls": "application/vnd.ms-excel",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "ppt": "application/vnd.ms-powerpoint",
+    "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "txt": "text/plain",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "webp": "image/webp",
+}
 
+ALLOWED_EXTENSIONS = {"pdf", "doc", "docx", "xls", "xlsx", "ppt", "pptx", "txt", "jpg", "jpeg", "png", "gif", "webp"}
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+# Enough for every signature in _MAGIC_BYTES plus the RIFF/WEBP check at bytes 8-12.
+_HEADER_BYTES = 12
 
-def compress_image(file_content: bytes, filename: str) -> tuple:
-    """Compress and optionally resize an image file."""
-    from PIL import Image
-    import io as _io
 
-    ext = Path(filename).suffix.lower().lstrip(".")
-    if ext not in _IMAGE_EXTENSIONS:
-        return file_content, filename
+def _spooled_size(fileobj) -> int:
+    """Size of an already-received upload, measured by seeking its spool file."""
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return size
 
-    original_size = len(file_content)
-    img = Image.open(_io.BytesIO(file_content))
-    w, h = img.size
-    if w > _MAX_IMAGE_DIMENSION or h > _MAX_IMAGE_DIMENSION:
-        img.thumbnail((_MAX_IMAGE_DIMENSION, _MAX_IMAGE_DIMENSION), Image.LANCZOS)
 
-    output = _io.BytesIO()
-    stem = Path(filename).stem
+def _safe_basename_for(filename: str) -> str:
+    return re.sub(r'[^\w\-]', '_', Path(filename).stem)[:100]
 
-    if ext == "png":
-        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
-            if img.mode == "P":
-                img = img.convert("RGBA")
-            img.save(output, format="PNG", optimize=True)
-            new_filename = f"{stem}.png"
-        else:
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            img.save(output, format="JPEG", quality=_JPEG_QUALITY, optimize=True)
-            new_filename = f"{stem}.jpg"
-    else:
-        if img.mode != "RGB":
-            img = img.convert("RGB")
-        img.save(output, format="JPEG", quality=_JPEG_QUALITY, optimize=True)
-        new_filename = f"{stem}.jpg"
 
-    compressed_bytes = output.getvalue()
-    compressed_size = len(compressed_bytes)
-    savings = round((1 - compressed_size / original_size) * 100, 1) if original_size else 0
-    logger.info(f"Image compressed: {original_size} -> {compressed_size} ({savings}% reduction)")
-    return compressed_bytes, new_filename
+async def _consume_upload_quota(user_id: str):
+    """Count one upload against the user's per-minute limit, or raise 429."""
+    upload_key = f"upload:{user_id}"
+    now = datetime.now(timezone.utc)
+    window_start = now - timedelta(seconds=UPLOAD_WINDOW)
+    upload_count = await db.rate_limits.count_documents({
+        "key": upload_key,
+        "timestamp": {"$gte": window_start}
+    })
+    if upload_count >= MAX_UPLOADS_PER_MINUTE:
+        raise HTTPException(status_code=429, detail="Demasiadas subidas. Intente de nuevo en un minuto.")
+    await db.rate_limits.insert_one({
+        "key": upload_key,
+        "timestamp": now,
+        "expires_at": now + timedelta(seconds=UPLOAD_WINDOW)
+    })
+
+
+async def _store_derivatives(derivatives: dict, stored_name: str, store, url_for) -> dict:
+    """Store each derivative next to the original and return the metadata recorded on
+    the file entry. A derivative that fails to store is left out (previews then fall
+    back to the original)."""
+    recorded = {}
+    for size, (content, width, height) in derivatives.items():
+        name = derivative_name(stored_name, size)
+        try:
+            await store(name, content)
+        except Exception as e:
+            logger.warning(f"Failed to store {size} derivative for {stored_name}: {e}")
+            continue
+        recorded[size] = {"stored_name": name, "url": url_for(name, size), "width": width, "height": height, "size": len(content)}
+    return recorded
+
+
+async def _process_image_in_background(file_content: bytes, filename: str, stored_name: str, storage: str,
+                                       store_original, store, url_for, compress: bool = True):
+    """Background mode: compress the stored original in place, then build derivatives
+    from the compressed version. The original is kept when compression does not shrink it.
+    Jobs here wait up to IMAGE_BACKGROUND_QUEUE_WAIT for a pool slot."""
+    try:
+        if compress:
+            try:
+                compressed, _ = await compress_or_original(
+                    file_content, filename, keep_format=True, queue_wait=IMAGE_BACKGROUND_QUEUE_WAIT
+                )
+                if len(compressed) < len(file_content):
+                    await store_original(compressed)
+                    file_content = compressed
+            finally:
+                await compression_finished(storage, stored_name)
+        derivatives = await derivatives_or_empty(file_content, filename, queue_wait=IMAGE_BACKGROUND_QUEUE_WAIT)
+        await _store_derivatives(derivatives, stored_name, store, url_for)
+    except Exception as e:
+        logger.error(f"Background image processing failed for {filename}: {e}")
+
+
+async def _finish_image(response: dict, file_content: Optional[bytes], filename: str, stored_name: str,
+                        storage: str, compress_later: bool, store_original, store, url_for):
+    """Attach derivatives to an image upload response (building them now, or scheduling
+    compression and derivatives for background mode). Derivatives that cannot get a pool
+    slot in time are queued in the background too instead of being skipped."""
+    if file_content is None:
+        return
+    sizes = derivative_sizes(filename)
+    if not sizes:
+        return
+    if not compress_later:
+        try:
+            derivatives = await derivatives_or_empty(file_content, filename, raise_if_busy=True)
+            response["derivatives"] = await _store_derivatives(derivatives, stored_name, store, url_for)
+            return
+        except ImagePoolBusy:
+            logger.warning(f"Image pool busy, queueing derivatives for {filename}")
+    else:
+        response["compression"] = "pending"
+    response["derivatives"] = {
+        size: {"stored_name": derivative_name(stored_name, size),
+               "url": url_for(derivative_name(stored_name, size), size), "pending": True}
+        for size in sizes
+    }
+    run_in_background(_process_image_in_background(
+        file_content, filename, stored_name, storage, store_original, store, url_for, compress=compress_later
+    ))
 
 
 @router.post("/upload")
-async def upload_file(request: Request, file: UploadFile = File(...), user=Depends(get_current_user)):
+async def upload_file(
+    request: Request,
+    file: UploadFile = File(...),
+    background_compression: bool = False,
+    user=Depends(get_current_user),
+):
+    """Store an uploaded file.
+
+    Images are compressed in the image process pool. With background_compression=true
+    (local and S3 storage) the original is stored and returned immediately, and the
+    compressed version replaces it under the same name once the pool finishes.
+
+    Files are stored under the SHA-256 of the uploaded bytes; re-uploading content that
+    is already stored returns the existing file (see utils/blobs.py).
+    """
     if user["role"] not in ["profesor", "admin", "estudiante"]:
         raise HTTPException(status_code=403, detail="No autorizado")
 
     original_name = file.filename
-    MAX_FILE_SIZE = 10 * 1024 * 1024
 
     content_length = request.headers.get("content-length")
     if content_length:
         try:
-            if int(content_length) > MAX_FILE_SIZE + 1024:
+            if int(content_length) > MAX_UPLOAD_SIZE + 1024:
                 raise HTTPException(status_code=413, detail="El archivo excede el tamaño máximo permitido (10MB)")
         except ValueError:
             pass
 
-    chunks = []
-    total_size = 0
-    while True:
-        chunk = await file.read(64 * 1024)
-        if not chunk:
-            break
-        total_size += len(chunk)
-        if total_size > MAX_FILE_SIZE:
-            raise HTTPException(status_code=413, detail="El archivo excede el tamaño máximo permitido (10MB)")
-        chunks.append(chunk)
-    file_content = b"".join(chunks)
-    file_size = total_size
-
     _ext = Path(original_name).suffix.lower().lstrip(".")
 
-    ALLOWED_EXTENSIONS = {"pdf", "doc", "docx", "xls", "xlsx", "ppt", "pptx", "txt", "jpg", "jpeg", "png", "gif", "webp"}
     if _ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(status_code=400, detail=f"Tipo de archivo no permitido: .{_ext}")
 
-    if not _validate_file_content(file_content, _ext):
+    # Starlette has already spooled the multipart body (in memory up to 1MB, on disk
+    # beyond that), so the size is known without reading it back into Python.
+    file_size = file.size if file.size is not None else await run_in_threadpool(_spooled_size, file.file)
+    if file_size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="El archivo excede el tamaño máximo permitido (10MB)")
+
+    # Magic-byte validation only needs the first chunk.
+    header = await file.read(_HEADER_BYTES)
+    await file.seek(0)
+    if not _validate_file_content(header, _ext):
         raise HTTPException(
             status_code=400,
             detail=f"El contenido del archivo no coincide con la extensión .{_ext}"
         )
 
-    _safe_basename = re.sub(r'[^\w\-]', '_', Path(original_name).stem)[:100]
+    await _consume_upload_quota(user["id"])
+    return await _store_upload(file.file, original_name, file_size, background_compression)
 
-    file_content, original_name = compress_image(file_content, original_name)
-    _ext = Path(original_name).suffix.lower().lstrip(".")
-    file_size = len(file_content)
-
-    _user_id = user["id"]
-    _upload_key = f"upload:{_user_id}"
-    _now = datetime.now(timezone.utc)
-    _window_start = _now - timedelta(seconds=UPLOAD_WINDOW)
-    _upload_count = await db.rate_limits.count_documents({
-        "key": _upload_key,
-        "timestamp": {"$gte": _window_start}
-    })
-    if _upload_count >= MAX_UPLOADS_PER_MINUTE:
-        raise HTTPException(status_code=429, detail="Demasiadas subidas. Intente de nuevo en un minuto.")
-    await db.rate_limits.insert_one({
-        "key": _upload_key,
-        "timestamp": _now,
-        "expires_at": _now + timedelta(seconds=UPLOAD_WINDOW)
-    })
 
-    _unique_suffix = str(uuid.uuid4())[:8]
-
-    if USE_S3:
-        _content_type_map = {
-            "pdf": "application/pdf",
-            "doc": "application/msword",
-            "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            "xls": "application/vnd.ms-excel",
-            "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            "ppt": "application/vnd.ms-powerpoint",
-            "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
-            "txt": "text/plain",
-            "jpg": "image/jpeg",
-            "jpeg": "image/jpeg",
-            "png": "image/png",
-            "gif": "image/gif",
-            "webp": "image/webp",
-        }
-        _content_type = _content_type_map.get(_ext, "application/octet-stream")
-
-        if _ext == "pdf":
-            _folder = "uploads/pdf"
-        elif _ext in {"jpg", "jpeg", "png", "gif", "webp"}:
-            _folder = "uploads/images"
-        else:
-            _folder = "uploads/docs"
+_BLOB_BUSY_DETAIL = "Un archivo idéntico se está eliminando. Intente de nuevo en unos segundos."
 
-        _s3_key = f"{_folder}/{_safe_basename}_{_unique_suffix}.{_ext}"
 
-        try:
-            logger.info(f"Attempting S3 upload: bucket={AWS_S3_BUCKET_NAME}, region={AWS_S3_REGION}, key={_s3_key}")
-            s3_client.put_object(
-                Bucket=AWS_S3_BUCKET_NAME,
-                Key=_s3_key,
-                Body=file_content,
-                ContentType=_content_type,
-                ContentDisposition=f'inline; filename="{original_name}"',
-            )
-            _file_url = f"https://{AWS_S3_BUCKET_NAME}.s3.{AWS_S3_REGION}.amazonaws.com/{_s3_key}"
-            logger.info(f"File uploaded to S3: {_file_url}")
-            return {
-                "filename": original_name,
-                "stored_name": _s3_key,
-                "url": _file_url,
-                "size": file_size,
-                "storage": "s3",
-                "resource_type": "raw"
+async def _store_upload(fileobj, original_name: str, file_size: int, background_compression: bool = False) -> dict:
+    """Store an already validated upload in the default backend and return the file entry
+    (shared by POST /upload and resumable upload sessions)."""
+    _ext = Path(original_name).suffix.lower().lstrip(".")
+    # Only images are materialized, because Pillow needs the whole file to re-encode it.
+    # Everything else is handed to the storage backend as a file object.
+    backend = get_default_backend()
+    source_ext = _ext
+    file_content: Optional[bytes] = None
+    if _ext in IMAGE_EXTENSIONS:
+        fileobj.seek(0)
+        file_content = await run_in_threadpool(fileobj.read)
+        digest = sha256_bytes(file_content)
+    else:
+        digest = await run_in_threadpool(sha256_fileobj, fileobj)
+
+    # Identical content already stored in this backend: take a reference and skip the
+    # write (and, for images, compression and derivatives) entirely.
+    try:
+        blob = await reuse_blob(backend.name, digest, source_ext)
+    except BlobBeingDeleted as e:
+        logger.warning(f"Upload refused: {e}")
+        raise HTTPException(status_code=503, detail=_BLOB_BUSY_DETAIL)
+    if blob is not None:
+        logger.info(f"Upload deduplicated against {blob['stored_name']}")
+        return response_from_blob(blob, original_name)
+
+    compress_later = False
+    if file_content is not None:
+        # Cloudinary objects are immutable here (overwrite=False), so it always compresses inline.
+        compress_later = background_compression and backend.overwritable
+        if not compress_later:
+            try:
+                file_content, original_name = await compress_or_original(
+                    file_content, original_name, raise_if_busy=backend.overwritable
+                )
+            except ImagePoolBusy:
+                # Queue it rather than keep (and deduplicate against) the original for good.
+                logger.warning(f"Image pool busy, queueing compression of {original_name}")
+                compress_later = True
+            _ext = Path(original_name).suffix.lower().lstrip(".")
+        file_size = len(file_content)
+
+    stored_name = backend.content_key(digest, _ext)
+    content_type = _CONTENT_TYPES.get(_ext, "application/octet-stream")
+    disposition = f'inline; filename="{original_name}"'
+    try:
+        file_url = await backend.put_stream(
+            stored_name,
+            file_content if file_content is not None else fileobj,
+            content_type=content_type,
+            content_disposition=disposition,
+        )
+    except Exception as e:
+        logger.error(f"{backend.name} upload failed for key={stored_name}: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=500,
+            detail="Error al subir el archivo. Intente de nuevo más tarde."
+        )
+    logger.info(f"File uploaded to {backend.name}: {stored_name}")
+    response = {
+        "filename": original_name,
+        "stored_name": stored_name,
+        "url": file_url,
+        "size": file_size,
+        "storage": backend.name,
+        "sha256": digest,
+        **backend.metadata(stored_name),
+    }
+
+    if file_content is not None and backend.renders_derivatives:
+        # Cloudinary renders derivatives on demand from transformation URLs, so nothing
+        # extra is stored; only the URLs are recorded.
+        _sizes = derivative_sizes(original_name)
+        if _sizes:
+            response["derivatives"] = {
+                size: {"url": backend.derivative_url(stored_name, None, size, DERIVATIVE_WIDTHS[size])}
+                for size in _sizes
             }
-        except Exception as e:
-            logger.error(f"S3 upload failed for key={_s3_key}: {e}", exc_info=True)
-            raise HTTPException(
-                status_code=500,
-                detail="Error al subir el archivo. Intente de nuevo más tarde."
-            )
-
-    if USE_CLOUDINARY:
-        import cloudinary.uploader
-        import io as _io
-        if _ext in {"jpg", "jpeg", "png", "gif", "webp", "bmp", "svg"}:
-            _resource_type = "image"
-        elif _ext in {"mp4", "avi", "mov", "mkv", "webm"}:
-            _resource_type = "video"
-        else:
-            _resource_type = "raw"
-        _public_id = f"educando/uploads/{_safe_basename}_{_unique_suffix}.{_ext}"
-        result = cloudinary.uploader.upload(
-            _io.BytesIO(file_content),
-            public_id=_public_id,
-            resource_type=_resource_type,
-            overwrite=False,
+    elif file_content is not None:
+        async def _store_original(content: bytes):
+            # The file may have been deleted (e.g. with its course) before background
+            # compression finished; do not bring it back.
+            if await backend.exists(stored_name):
+                await backend.put_stream(stored_name, content, content_type=content_type, content_disposition=disposition)
+
+        async def _store_derivative(name: str, content: bytes):
+            await backend.put_stream(name, content, content_type="image/webp")
+
+        await _finish_image(
+            response, file_content, original_name, stored_name, backend.name, compress_later,
+            _store_original, _store_derivative,
+            lambda name, size: backend.derivative_url(stored_name, name, size, DERIVATIVE_WIDTHS[size]),
         )
-        return {
-            "filename": original_name,
-            "stored_name": result["public_id"],
-            "url": result["secure_url"],
-            "size": file_size,
-            "storage": "cloudinary",
-            "resource_type": _resource_type
-        }
-
-    _file_id = str(uuid.uuid4())
-    _ext_with_dot = Path(original_name).suffix
-    safe_name = f"{_file_id}{_ext_with_dot}"
-    file_path = UPLOAD_DIR / safe_name
-    with open(file_path, "wb") as f:
-        f.write(file_content)
+
+    try:
+        await register_blob(digest, source_ext, response)
+    except BlobBeingDeleted as e:
+        # A deletion of the same content may have removed what was just written.
+        logger.warning(f"Upload refused: {e}")
+        raise HTTPException(status_code=503, detail=_BLOB_BUSY_DETAIL)
+    except Exception as e:
+        # The upload itself succeeded; it just will not be shared with later duplicates.
+        logger.error(f"Failed to register blob {stored_name}: {e}")
+    return response
+
+
+@router.post("/uploads/presign")
+async def presign_upload(data: PresignUploadRequest, user=Depends(get_current_user)):
+    """First step of a direct-to-storage upload.
+
+    Returns a presigned POST (url + form fields) the client sends the file to, and an
+    upload_id for POST /uploads/complete. Storage enforces the size limit and content
+    type, so no file bytes go through the app server. Only available with S3; clients
+    fall back to POST /upload otherwise (the 501 tells them to).
+    """
+    if user["role"] not in ["profesor", "admin", "estudiante"]:
+        raise HTTPException(status_code=403, detail="No autorizado")
+    backend = get_default_backend()
+    if not backend.supports_presigned:
+        raise HTTPException(status_code=501, detail="Las subidas directas no están disponibles; use /upload")
+
+    ext = Path(data.filename).suffix.lower().lstrip(".")
+    if ext not in ALLOWED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Tipo de archivo no permitido: .{ext}")
+    if data.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="El archivo excede el tamaño máximo permitido (10MB)")
+
+    await _consume_upload_quota(user["id"])
+
+    stored_name = backend.new_key(_safe_basename_for(data.filename), ext)
+    content_type = _CONTENT_TYPES.get(ext, "application/octet-stream")
+    now = datetime.now(timezone.utc)
+    expires_at = now + timedelta(seconds=PRESIGNED_UPLOAD_EXPIRES)
+    intent = {
+        "id": str(uuid.uuid4()),
+        "user_id": user["id"],
+        "storage": backend.name,
+        "stored_name": stored_name,
+        "filename": data.filename,
+        "content_type": content_type,
+        "created_at": now,
+        "expires_at": expires_at,
+    }
+    await db.upload_intents.insert_one(intent)
+    presigned = backend.presign_upload(
+        stored_name, content_type, MAX_UPLOAD_SIZE, PRESIGNED_UPLOAD_EXPIRES,
+        content_disposition=f'inline; filename="{_safe_basename_for(data.filename)}.{ext}"',
+    )
+    return {"upload_id": intent["id"], "expires_at": expires_at.isoformat(), **presigned}
+
+
+@router.post("/uploads/complete")
+async def complete_upload(data: CompleteUploadRequest, user=Depends(get_current_user)):
+    """Second step of a direct upload: verify the stored object and register it.
+
+    Checks size and content type with a HEAD and the magic bytes with a ranged GET of
+    the first bytes; an object that fails is deleted. The response has the same shape as
+    POST /upload. Images uploaded this way are stored as sent (no compression or
+    derivatives, since the app never holds the bytes), so previews use the original.
+    """
+    intent = await db.upload_intents.find_one({"id": data.upload_id, "user_id": user["id"]}, {"_id": 0})
+    if not intent:
+        raise HTTPException(status_code=404, detail="Subida no encontrada")
+    backend = get_backend(intent["storage"])
+    if backend is None or not backend.supports_presigned:
+        raise HTTPException(status_code=501, detail="Las subidas directas no están disponibles; use /upload")
+
+    stored_name = intent["stored_name"]
+    ext = Path(stored_name).suffix.lower().lstrip(".")
+    try:
+        meta = await backend.head(stored_name)
+        if meta is None:
+            raise HTTPException(status_code=400, detail="El archivo aún no se ha subido")
+        if meta["size"] > MAX_UPLOAD_SIZE:
+            error = (413, "El archivo excede el tamaño máximo permitido (10MB)")
+        elif meta["content_type"] != intent["content_type"]:
+            error = (400, "El tipo de contenido del archivo no coincide")
+        elif not _validate_file_content(await backend.read_range(stored_name, 0, _HEADER_BYTES), ext):
+            error = (400, f"El contenido del archivo no coincide con la extensión .{ext}")
+        else:
+            error = None
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Verifying direct upload {stored_name} failed: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Error al verificar el archivo. Intente de nuevo más tarde.")
+
+    # Claiming the intent makes completion single-shot even with concurrent requests.
+    claimed = await db.upload_intents.delete_one({"id": intent["id"]})
+    if claimed.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Subida no encontrada")
+    if error:
+        await backend.delete_many([stored_name])
+        raise HTTPException(status_code=error[0], detail=error[1])
+
     return {
-        "filename": original_name,
-        "stored_name": safe_name,
-        "url": f"/api/files/{safe_name}",
-        "size": os.path.getsize(file_path),
-        "storage": "local"
+        "filename": intent["filename"],
+        "stored_name": stored_name,
+        "url": backend.url_for(stored_name),
+        "size": meta["size"],
+        "storage": backend.name,
+        **backend.metadata(stored_name),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Resumable upload sessions
+#
+# create (POST /uploads/sessions) -> PUT each chunk in order -> GET to learn the received
+# offset after a dropped connection -> POST .../finalize. Only creating a session counts
+# against the upload rate limit, so retried chunks are free. Chunks are written into one
+# file per session under UPLOAD_SESSION_DIR; finalize validates it and hands it to the
+# same storage pipeline as POST /upload.
+# ---------------------------------------------------------------------------
+
+def _write_chunk(path: Path, offset: int, data: bytes):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def _session_status(session: dict) -> dict:
+    return {
+        "session_id": session["id"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "chunk_size": session["chunk_size"],
+        "offset": session["received"],
+        "next_chunk": session["received"] // session["chunk_size"],
+        "complete": session["received"] >= session["size"],
+        # Motor returns naive UTC datetimes.
+        "expires_at": session["expires_at"].replace(tzinfo=timezone.utc).isoformat(),
+    }
+
+
+async def _get_session(session_id: str, user: dict) -> dict:
+    session = await db.upload_sessions.find_one(
+        {"id": session_id, "user_id": user["id"], "expires_at": {"$gt": datetime.now(timezone.utc)}}, {"_id": 0}
+    )
+    if not session:
+        raise HTTPException(status_code=404, detail="Sesión de subida no encontrada o expirada")
+    return session
+
+
+@router.post("/uploads/sessions")
+async def create_upload_session(data: UploadSessionCreate, user=Depends(get_current_user)):
+    """Start a resumable upload of `size` bytes, sent as chunk_size chunks."""
+    if user["role"] not in ["profesor", "admin", "estudiante"]:
+        raise HTTPException(status_code=403, detail="No autorizado")
+    ext = Path(data.filename).suffix.lower().lstrip(".")
+    if ext not in ALLOWED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Tipo de archivo no permitido: .{ext}")
+    if data.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="El archivo excede el tamaño máximo permitido (10MB)")
+
+    await _consume_upload_quota(user["id"])
+
+    now = datetime.now(timezone.utc)
+    session = {
+        "id": str(uuid.uuid4()),
+        "user_id": user["id"],
+        "filename": data.filename,
+        "size": data.size,
+        "chunk_size": UPLOAD_SESSION_CHUNK_SIZE,
+        "received": 0,
+        "status": "open",
+        "created_at": now,
+        "expires_at": now + timedelta(hours=UPLOAD_SESSION_TTL_HOURS),
     }
+    await run_in_threadpool(upload_session_path(session["id"]).touch)
+    await db.upload_sessions.insert_one(session)
+    return _session_status(session)
+
+
+@router.get("/uploads/sessions/{session_id}")
+async def get_upload_session(session_id: str, user=Depends(get_current_user)):
+    """Received offset of a session; the client resumes from next_chunk."""
+    return _session_status(await _get_session(session_id, user))
+
+
+@router.put("/uploads/sessions/{session_id}/chunks/{index}")
+async def put_upload_chunk(session_id: str, index: int, request: Request, user=Depends(get_current_user)):
+    """Store chunk `index` (bytes index*chunk_size onwards). Every chunk but the last must
+    be exactly chunk_size bytes. Re-sending an already received chunk is a no-op, and a
+    chunk past the received offset is rejected with 409 so the client can resume."""
+    session = await _get_session(session_id, user)
+    if session["status"] != "open":
+        raise HTTPException(status_code=409, detail="La sesión de subida ya se está finalizando")
+    chunk_size = session["chunk_size"]
+    offset = index * chunk_size
+    if index < 0 or offset >= session["size"]:
+        raise HTTPException(status_code=400, detail="Número de fragmento inválido")
+    expected = min(chunk_size, session["size"] - offset)
+
+    data = bytearray()
+    async for part in request.stream():
+        data.extend(part)
+        if len(data) > expected:
+            raise HTTPException(status_code=413, detail="El fragmento excede el tamaño esperado")
+    if len(data) != expected:
+        raise HTTPException(status_code=400, detail=f"El fragmento debe tener {expected} bytes")
+
+    if offset < session["received"]:
+        return _session_status(session)
+    if offset > session["received"]:
+        raise HTTPException(status_code=409, detail=f"Se esperaba el fragmento {session['received'] // chunk_size}")
+
+    await run_in_threadpool(_write_chunk, upload_session_path(session_id), offset, bytes(data))
+    # Conditional on the offset, so two concurrent retries of a chunk advance it once.
+    updated = await db.upload_sessions.find_one_and_update(
+        {"id": session_id, "received": offset},
+        {"$set": {"received": offset + expected}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    return _session_status(updated or await _get_session(session_id, user))
+
+
+@router.post("/uploads/sessions/{session_id}/finalize")
+async def finalize_upload_session(session_id: str, background_compression: bool = False,
+                                  user=Depends(get_current_user)):
+    """Validate the assembled file and store it; returns the same shape as POST /upload."""
+    session = await _get_session(session_id, user)
+    if session["received"] < session["size"]:
+        raise HTTPException(status_code=409, detail=f"Faltan datos: recibidos {session['received']} de {session['size']} bytes")
+    claimed = await db.upload_sessions.find_one_and_update(
+        {"id": session_id, "status": "open"}, {"$set": {"status": "finalizing"}}
+    )
+    if not claimed:
+        raise HTTPException(status_code=409, detail="La sesión de subida ya se está finalizando")
+
+    ext = Path(session["filename"]).suffix.lower().lstrip(".")
+    try:
+        f = await run_in_threadpool(open, upload_session_path(session_id), "rb")
+        try:
+            if not _validate_file_content(await run_in_threadpool(f.read, _HEADER_BYTES), ext):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"El contenido del archivo no coincide con la extensión .{ext}"
+                )
+            response = await _store_upload(f, session["filename"], session["size"], background_compression)
+        finally:
+            f.close()
+    except HTTPException as e:
+        if e.status_code == 400:
+            await _discard_session(session_id)
+        else:
+            await db.upload_sessions.update_one({"id": session_id}, {"$set": {"status": "open"}})
+        raise
+    except Exception:
+        # Storage failed; let the client retry finalize without re-sending chunks.
+        await db.upload_sessions.update_one({"id": session_id}, {"$set": {"status": "open"}})
+        raise
+    await _discard_session(session_id)
+    return response
+
+
+async def _discard_session(session_id: str):
+    await db.upload_sessions.delete_one({"id": session_id})
+    await run_in_threadpool(upload_session_path(session_id).unlink, missing_ok=True)
+
+
+# Local names are uuid4 or SHA-256 based (plus an optional derivative suffix) and never
+# reused for different content, so such files can be cached for a long time. The one
+# exception is an image whose background compression is still pending: it is about to be
+# overwritten under the same name, so it is served with no-cache until that finishes.
+_IMMUTABLE_NAME_RE = re.compile(
+    r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{64})(__\w+)?\.\w+$'
+)
+CACHE_CONTROL_IMMUTABLE_FILE = "private, max-age=31536000, immutable"
+
+_MIME_MAP = {
+    'pdf': 'application/pdf',
+    'jpg': 'image/jpeg', 'jpeg': 'image/jpeg',
+    'png': 'image/png', 'gif': 'image/gif', 'webp': 'image/webp',
+    'txt': 'text/plain',
+    'doc': 'application/msword',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'xls': 'application/vnd.ms-excel',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'ppt': 'application/vnd.ms-powerpoint',
+    'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+}
+
+
+def file_etag(stat_result: os.stat_result) -> str:
+    """Strong ETag from size and mtime, in the same format nginx uses for static files,
+    so validators stay interchangeable when X-Accel-Redirect mode is on."""
+    return f'"{int(stat_result.st_mtime):x}-{stat_result.st_size:x}"'
 
 
 @router.get("/files/{filename}")
-async def get_file(filename: str, user=Depends(get_current_user)):
+async def get_file(request: Request, filename: str, size: Optional[str] = None, user=Depends(get_current_user)):
+    """Serve a locally stored file. `size` (thumb, 640, webp) selects a preview derivative
+    of an image and falls back to the original when that derivative does not exist.
+
+    Supports Range requests (PDF viewers fetch pages on demand) and If-None-Match.
+    With FILES_ACCEL_REDIRECT_PREFIX set, nginx sends the bytes after this handler has
+    authorized the request.
+    """
     if any(c in filename for c in ('..', '/', '\\', '\x00')):
         raise HTTPException(status_code=400, detail="Nombre de archivo inválido")
     safe_filename = Path(filename).name
@@ -276,28 +659,48 @@ async def get_file(filename: str, user=Depends(get_current_user)):
             raise HTTPException(status_code=400, detail="Nombre de archivo inválido")
     except ValueError:
         raise HTTPException(status_code=400, detail="Nombre de archivo inválido")
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    if size is not None and size not in DERIVATIVE_WIDTHS:
+        raise HTTPException(status_code=400, detail=f"Tamaño no válido: {size}")
+
+    cache_control = CACHE_CONTROL_IMMUTABLE_FILE if _IMMUTABLE_NAME_RE.match(safe_filename) else "private, no-cache"
+    if (cache_control == CACHE_CONTROL_IMMUTABLE_FILE and size is None
+            and derivative_sizes(safe_filename) and await compression_pending("local", safe_filename)):
+        cache_control = "private, no-cache"
+    stat_result = None
+    if size is not None:
+        derivative_path = UPLOAD_DIR / derivative_name(safe_filename, size)
+        try:
+            stat_result = await run_in_threadpool(os.stat, derivative_path)
+            file_path = derivative_path
+            safe_filename = derivative_path.name
+        except FileNotFoundError:
+            # The derivative may still be in progress; serve the original without
+            # letting the browser pin it as the preview.
+            cache_control = "private, no-cache"
+    if stat_result is None:
+        try:
+            stat_result = await run_in_threadpool(os.stat, file_path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Archivo no encontrado")
+        if not stat.S_ISREG(stat_result.st_mode):
+            raise HTTPException(status_code=404, detail="Archivo no encontrado")
+
     ext = safe_filename.rsplit('.', 1)[-1].lower() if '.' in safe_filename else ''
-    mime_map = {
-        'pdf': 'application/pdf',
-        'jpg': 'image/jpeg', 'jpeg': 'image/jpeg',
-        'png': 'image/png', 'gif': 'image/gif', 'webp': 'image/webp',
-        'txt': 'text/plain',
-        'doc': 'application/msword',
-        'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        'xls': 'application/vnd.ms-excel',
-        'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        'ppt': 'application/vnd.ms-powerpoint',
-        'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-    }
-    media_type = mime_map.get(ext, 'application/octet-stream')
+    media_type = _MIME_MAP.get(ext, 'application/octet-stream')
     if ext in ('pdf', 'jpg', 'jpeg', 'png', 'gif', 'webp', 'txt'):
         disposition = f'inline; filename="{safe_filename}"'
     else:
         disposition = f'attachment; filename="{safe_filename}"'
-    return FileResponse(
-        file_path,
-        media_type=media_type,
-        headers={"Content-Disposition": disposition}
-    )
+    etag = file_etag(stat_result)
+    headers = {"Content-Disposition": disposition, "ETag": etag, "Cache-Control": cache_control}
+
+    if etag_matches(request, etag):
+        return not_modified(etag, cache_control)
+    if FILES_ACCEL_REDIRECT_PREFIX:
+        # nginx keeps Content-Type, Content-Disposition and Cache-Control from this
+        # response and handles Range and sendfile itself.
+        return Response(
+            headers={**headers, "X-Accel-Redirect": f"{FILES_ACCEL_REDIRECT_PREFIX}{safe_filename}"},
+            media_type=media_type,
+        )
+    return FileResponse(file_path, media_type=media_type, headers=headers, stat_result=stat_result)
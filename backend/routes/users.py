@@ -4,11 +4,15 @@ import logging
 from datetime import datetime, timezone
 from typing import Optional
 from fastapi import APIRouter, HTTPException, Depends
+from pymongo import ReturnDocument
 
 from database import db
 from utils.security import get_current_user, hash_password
 from utils.audit import log_audit, log_security_event
-from utils.helpers import derive_estado_from_program_statuses
+from utils.helpers import derive_estado_from_program_statuses, student_status_backfilled, with_student_status
+from utils.http_cache import bump_versions
+from utils.counters import count_student_status_change, count_user_created, count_user_deleted
+from utils import enrollments
 from models.schemas import UserCreate, UserUpdate, AdminCreateByEditor, AdminUpdateByEditor
 
 logger = logging.getLogger(__name__)
@@ -37,9 +41,13 @@ async def get_users(
     if role:
         query["role"] = role
     if estado:
-        if estado == 'activo':
+        if estado == 'activo' and not await student_status_backfilled():
+            # Students stored without estado are active until the student_status
+            # migration has written it.
             query["$or"] = [{"estado": "activo"}, {"estado": None}, {"estado": {"$exists": False}}]
         else:
+            # Every student has estado (see with_student_status), so this is an
+            # equality match on users_role_estado.
             query["estado"] = estado
 
     if program_id:
@@ -48,7 +56,7 @@ async def get_users(
             estado_or = query.pop("$or")
             query["$and"] = [{"$or": estado_or}, program_filter]
         else:
-            query["$or"] = [{"program_id": program_id}, {"program_ids": program_id}]
+            query["$or"] = program_filter["$or"]
 
     if search and search.strip():
         # Escape regex metacharacters to prevent ReDoS (CWE-943).
@@ -67,14 +75,17 @@ async def get_users(
     users = await db.users.find(query, {"_id": 0, "password_hash": 0}).sort("name", 1).skip(skip).limit(page_size).to_list(page_size)
 
     if role == "estudiante" and users:
-        user_ids = [u["id"] for u in users]
+        student_courses = await enrollments.course_ids_by_student(u["id"] for u in users)
+        all_course_ids = {cid for ids in student_courses.values() for cid in ids}
         enrolled_courses = await db.courses.find(
-            {"student_ids": {"$in": user_ids}},
-            {"_id": 0, "id": 1, "name": 1, "student_ids": 1, "program_id": 1}
-        ).to_list(1000)
+            {"id": {"$in": list(all_course_ids)}},
+            {"_id": 0, "id": 1, "name": 1, "program_id": 1}
+        ).to_list(1000) if all_course_ids else []
+        course_map = {c["id"]: c for c in enrolled_courses}
         for u in users:
-            u["course_ids"] = [c["id"] for c in enrolled_courses if u["id"] in (c.get("student_ids") or [])]
-            u["enrolled_courses"] = [{"id": c["id"], "name": c["name"], "program_id": c.get("program_id")} for c in enrolled_courses if u["id"] in (c.get("student_ids") or [])]
+            courses_of_user = [course_map[cid] for cid in student_courses[u["id"]] if cid in course_map]
+            u["course_ids"] = [c["id"] for c in courses_of_user]
+            u["enrolled_courses"] = [{"id": c["id"], "name": c["name"], "program_id": c.get("program_id")} for c in courses_of_user]
 
     return {
         "users": users,
@@ -150,7 +161,7 @@ async def create_user(req: UserCreate, user=Depends(get_current_user)):
         elif program_ids:
             program_statuses = {prog_id: "activo" for prog_id in program_ids}
         else:
-            program_statuses = None
+            program_statuses = {}
         if program_statuses and not req.estado:
             estado = derive_estado_from_program_statuses(program_statuses)
     else:
@@ -175,6 +186,9 @@ async def create_user(req: UserCreate, user=Depends(get_current_user)):
     }
     if req.email is not None:
         new_user["email"] = req.email
+    if req.role == "estudiante":
+        # Status filters are equality matches: never store a student without estado.
+        with_student_status(new_user)
     try:
         await db.users.insert_one(new_user)
     except Exception as exc:
@@ -182,6 +196,9 @@ async def create_user(req: UserCreate, user=Depends(get_current_user)):
         raise HTTPException(status_code=500, detail="No se pudo crear el usuario. Inténtelo de nuevo.")
 
     logger.info(f"User created: id={new_user['id']}, role={req.role}, by={user['id']}")
+    await count_user_created(req.role, new_user["estado"])
+    if req.role == "estudiante":
+        await bump_versions("students")
     await log_audit("student_created" if req.role == "estudiante" else "user_created", user["id"], user["role"], {"new_user_id": new_user["id"], "new_user_role": req.role, "new_user_name": req.name})
 
     del new_user["_id"]
@@ -272,14 +289,21 @@ async def update_user(user_id: str, req: UserUpdate, user=Depends(get_current_us
     if update_data.get("program_statuses"):
         update_data["estado"] = derive_estado_from_program_statuses(update_data["program_statuses"])
 
-    result = await db.users.update_one({"id": user_id}, {"$set": update_data})
-    if result.matched_count == 0:
+    before = await db.users.find_one_and_update(
+        {"id": user_id}, {"$set": update_data},
+        projection={"_id": 0, "role": 1, "estado": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if before is None:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    if before.get("role") == "estudiante" and "estado" in update_data:
+        await count_student_status_change(before.get("estado"), update_data["estado"])
 
     if "subject_ids" in update_data:
         logger.info(f"User subject assignment updated: user_id={user_id}, subject_ids={update_data['subject_ids']}, by={user['id']}")
 
     logger.info(f"User updated: id={user_id}, by={user['id']}, fields={list(update_data.keys())}")
+    await bump_versions("students")
 
     updated = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
     await log_audit("user_updated", user["id"], user["role"], {"target_user_id": user_id})
@@ -292,14 +316,13 @@ async def delete_user(user_id: str, user=Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Solo admin puede eliminar usuarios")
     if user_id == user["id"]:
         raise HTTPException(status_code=400, detail="No puedes eliminar tu propia cuenta")
-    target = await db.users.find_one({"id": user_id}, {"_id": 0, "name": 1, "role": 1})
+    target = await db.users.find_one({"id": user_id}, {"_id": 0, "name": 1, "role": 1, "estado": 1})
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
-    await db.courses.update_many(
-        {"student_ids": user_id},
-        {"$pull": {"student_ids": user_id}}
-    )
+    await count_user_deleted((target or {}).get("role"), (target or {}).get("estado"))
+    await enrollments.drop_students([user_id])
+    await bump_versions("courses", "students")
     await db.grades.delete_many({"student_id": user_id})
     await db.submissions.delete_many({"student_id": user_id})
     await db.failed_subjects.delete_many({"student_id": user_id})
@@ -446,6 +469,7 @@ async def promote_student(user_id: str, program_id: Optional[str] = None, user=D
             {"id": user_id},
             {"$set": {"module": current_module + 1}}
         )
+        await bump_versions("students")
         updated = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
         return updated
 
@@ -474,6 +498,8 @@ async def promote_student(user_id: str, program_id: Optional[str] = None, user=D
     set_fields["module"] = program_modules.get(target_programs[0], current_module)
 
     await db.users.update_one({"id": user_id}, {"$set": set_fields})
+    await count_student_status_change(student.get("estado"), new_estado)
+    await bump_versions("students")
     updated = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
     return updated
 
@@ -504,6 +530,8 @@ async def graduate_student(user_id: str, program_id: Optional[str] = None, user=
         if current_module < 2:
             raise HTTPException(status_code=400, detail="El estudiante debe estar en el módulo final para graduarse")
         await db.users.update_one({"id": user_id}, {"$set": {"estado": "egresado"}})
+        await count_student_status_change(student.get("estado"), "egresado")
+        await bump_versions("students")
         updated = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
         return updated
 
@@ -527,5 +555,7 @@ async def graduate_student(user_id: str, program_id: Optional[str] = None, user=
         {"id": user_id},
         {"$set": {"estado": new_estado, "program_statuses": program_statuses}}
     )
+    await count_student_status_change(student.get("estado"), new_estado)
+    await bump_versions("students")
     updated = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
     return updated
@@ -6,6 +6,7 @@ from fastapi import APIRouter, HTTPException, Depends
 from fastapi.responses import JSONResponse
 
 from database import db
+from cache import invalidate_student_dashboard
 from utils.security import get_current_user, safe_object_id
 from models.schemas import ClassVideoCreate, ClassVideoUpdate
 
@@ -100,6 +101,7 @@ async def create_class_video(req: ClassVideoCreate, user=Depends(get_current_use
         await db.class_videos.insert_one(video)
         del video["_id"]
         created_videos.append(video)
+        await invalidate_student_dashboard(cid)
 
     if len(created_videos) == 1:
         return created_videos[0]
@@ -116,11 +118,13 @@ async def delete_class_video_group(group_id: str, user=Depends(get_current_user)
     if user["role"] != "profesor":
         raise HTTPException(status_code=403, detail="Solo profesores")
     videos_in_group = await db.class_videos.find(
-        {"video_group_id": group_id}, {"_id": 0, "id": 1}
+        {"video_group_id": group_id}, {"_id": 0, "id": 1, "course_id": 1}
     ).to_list(500)
     if not videos_in_group:
         raise HTTPException(status_code=404, detail="Grupo de videos no encontrado")
     await db.class_videos.delete_many({"video_group_id": group_id})
+    for v in videos_in_group:
+        await invalidate_student_dashboard(v.get("course_id"))
     return {"message": f"Grupo eliminado: {len(videos_in_group)} videos"}
 
 
@@ -128,8 +132,9 @@ async def delete_class_video_group(group_id: str, user=Depends(get_current_user)
 async def delete_class_video(video_id: str, user=Depends(get_current_user)):
     if user["role"] != "profesor":
         raise HTTPException(status_code=403, detail="Solo profesores")
-    await _verify_video_course_ownership(video_id, user)
+    video = await _verify_video_course_ownership(video_id, user)
     await db.class_videos.delete_one({"id": video_id})
+    await invalidate_student_dashboard(video.get("course_id"))
     return {"message": "Video eliminado"}
 
 
@@ -137,7 +142,7 @@ async def delete_class_video(video_id: str, user=Depends(get_current_user)):
 async def update_class_video(video_id: str, req: ClassVideoUpdate, user=Depends(get_current_user)):
     if user["role"] != "profesor":
         raise HTTPException(status_code=403, detail="Solo profesores")
-    await _verify_video_course_ownership(video_id, user)
+    video = await _verify_video_course_ownership(video_id, user)
     raw = req.model_dump()
     update_data = {k: v for k, v in raw.items() if v is not None}
     if raw.get("available_from") in ("", None) and "available_from" in raw:
@@ -145,5 +150,6 @@ async def update_class_video(video_id: str, req: ClassVideoUpdate, user=Depends(
     result = await db.class_videos.update_one({"id": video_id}, {"$set": update_data})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Video no encontrado")
+    await invalidate_student_dashboard(video.get("course_id"))
     updated = await db.class_videos.find_one({"id": video_id}, {"_id": 0})
     return updated
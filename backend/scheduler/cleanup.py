@@ -36,7 +36,7 @@ async def acquire_scheduler_lock(lock_name: str, ttl_seconds: int = 300) -> bool
             {
                 "$set": {
                     "lock_name": lock_name,
-                    "locked_by": f"worker-{os.environ.get('WORKER_ID', 'unknown')}-{os.getpid()}",
+                    "locked_by": _lock_owner(),
                     "locked_at": now,
                     "expires_at": expires_at
                 }
@@ -49,28 +49,138 @@ async def acquire_scheduler_lock(lock_name: str, ttl_seconds: int = 300) -> bool
         return False
 
 
+def _lock_owner() -> str:
+    return f"worker-{os.environ.get('WORKER_ID', 'unknown')}-{os.getpid()}"
+
+
+async def extend_scheduler_lock(lock_name: str, ttl_seconds: int = 300) -> bool:
+    """Push back the expiry of a lock this process holds, for jobs that run longer than
+    one TTL. Returns False if the lock is no longer ours."""
+    try:
+        result = await db.scheduler_locks.update_one(
+            {"lock_name": lock_name, "locked_by": _lock_owner()},
+            {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)}},
+        )
+        return result.matched_count > 0
+    except Exception as e:
+        logger.error(f"Failed to extend scheduler lock '{lock_name}': {e}")
+        return False
+
+
 async def release_scheduler_lock(lock_name: str):
-    """Release a distributed lock.
+    """Release a distributed lock held by this process.
 
     Args:
         lock_name: The name of the lock to release.
+
+    If the lock expired and another worker took it over, it is left alone.
     """
     try:
-        await db.scheduler_locks.delete_one({"lock_name": lock_name})
+        await db.scheduler_locks.delete_one({"lock_name": lock_name, "locked_by": _lock_owner()})
     except Exception as e:
         logger.error(f"Failed to release scheduler lock '{lock_name}': {e}")
 
 
+async def purge_abandoned_uploads(cutoff: datetime) -> int:
+    """Delete presigned uploads that expired before `cutoff` without being completed,
+    together with any object the client did send. Returns how many were purged."""
+    from utils.storage import delete_file_entries
+    abandoned = await db.upload_intents.find(
+        {"expires_at": {"$lt": cutoff}}, {"_id": 0, "id": 1, "stored_name": 1, "storage": 1}
+    ).to_list(5000)
+    if not abandoned:
+        return 0
+    await delete_file_entries(abandoned)
+    await db.upload_intents.delete_many({"id": {"$in": [a["id"] for a in abandoned]}})
+    return len(abandoned)
+
+
+def upload_session_path(session_id: str):
+    """Partial file of a resumable upload session (see routes/uploads.py)."""
+    from config import UPLOAD_SESSION_DIR
+    return UPLOAD_SESSION_DIR / f"{session_id}.part"
+
+
+async def purge_expired_upload_sessions(cutoff: datetime) -> int:
+    """Delete resumable upload sessions that expired before `cutoff`, with their partial files."""
+    expired = await db.upload_sessions.find(
+        {"expires_at": {"$lt": cutoff}}, {"_id": 0, "id": 1}
+    ).to_list(5000)
+    for session in expired:
+        try:
+            upload_session_path(session["id"]).unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Failed to delete upload session file {session['id']}: {e}")
+    if expired:
+        await db.upload_sessions.delete_many({"id": {"$in": [s["id"] for s in expired]}})
+    return len(expired)
+
+
 async def cleanup_expired_data():
-    """Safety-net cleanup for expired tokens and rate limits."""
+    """Safety-net cleanup for expired tokens, rate limits and abandoned uploads."""
     try:
         if not await acquire_scheduler_lock("cleanup_expired_data", ttl_seconds=600):
             logger.info("cleanup_expired_data: another worker holds the lock, skipping")
             return
+        from config import PRESIGNED_UPLOAD_GRACE
         cutoff = datetime.now(timezone.utc)
         r1 = await db.refresh_tokens.delete_many({"expires_at": {"$lt": cutoff}})
         r2 = await db.rate_limits.delete_many({"expires_at": {"$lt": cutoff}})
         if r1.deleted_count or r2.deleted_count:
             logger.info(f"Cleanup: removed {r1.deleted_count} expired refresh tokens, {r2.deleted_count} expired rate limits")
+        uploads_purged = await purge_abandoned_uploads(cutoff - timedelta(seconds=PRESIGNED_UPLOAD_GRACE))
+        if uploads_purged:
+            logger.info(f"Cleanup: removed {uploads_purged} abandoned direct uploads")
+        sessions_purged = await purge_expired_upload_sessions(cutoff)
+        if sessions_purged:
+            logger.info(f"Cleanup: removed {sessions_purged} expired resumable upload sessions")
     except Exception as e:
         logger.error(f"cleanup_expired_data failed: {e}")
+
+
+async def reconcile_stats_counters(only_if_requested: bool = False):
+    """Recompute the /stats counters document to correct drift from bulk jobs.
+
+    With only_if_requested=True (the frequent scheduler check and the run kicked by
+    request_stats_reconcile) it does nothing unless a recount has been requested.
+    """
+    from utils.counters import RECONCILE_REQUEST_ID, reconcile_counters
+    if only_if_requested and not await db.counters.count_documents(
+        {"_id": RECONCILE_REQUEST_ID}, limit=1
+    ):
+        return
+    if not await acquire_scheduler_lock("reconcile_stats_counters", ttl_seconds=300):
+        # A pending request stays in place for the next scheduler check.
+        logger.info("reconcile_stats_counters: another worker holds the lock, skipping")
+        return
+    try:
+        started_at = datetime.now(timezone.utc)
+        await reconcile_counters()
+        # Requests made after the recount started may not be reflected in it; keep them.
+        await db.counters.delete_one(
+            {"_id": RECONCILE_REQUEST_ID, "requested_at": {"$lte": started_at}}
+        )
+    except Exception as e:
+        logger.error(f"reconcile_stats_counters failed: {e}")
+    finally:
+        await release_scheduler_lock("reconcile_stats_counters")
+
+
+async def request_stats_reconcile():
+    """Ask for a /stats recount after a bulk change without running it in the caller.
+
+    The request is stored in the counters collection and a background run is kicked;
+    if that run cannot take the lock, the scheduler's frequent check serves the request.
+    """
+    from utils.counters import RECONCILE_REQUEST_ID
+    from utils.images import run_in_background
+    try:
+        await db.counters.update_one(
+            {"_id": RECONCILE_REQUEST_ID},
+            {"$set": {"requested_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+    except Exception as e:
+        logger.error(f"Failed to request a stats counters reconcile: {e}")
+        return
+    run_in_background(reconcile_stats_counters(only_if_requested=True))
@@ -0,0 +1,163 @@
+import logging
+from datetime import datetime, timezone
+
+from database import db
+from utils.blobs import release_and_delete
+from utils.counters import incr_counters
+from scheduler.cleanup import acquire_scheduler_lock, extend_scheduler_lock, release_scheduler_lock
+
+logger = logging.getLogger(__name__)
+
+# Course deletion is tombstone-then-sweep: DELETE /courses/{id} moves the course document
+# into `course_deletions` (so every read stops seeing it at once) and this sweeper removes
+# the dependent documents and stored files in bounded batches. Progress is written to the
+# tombstone after every batch, which is what GET /course-deletions shows.
+
+SWEEP_BATCH_SIZE = 500
+LOCK_NAME = "sweep_course_deletions"
+# Extended after every batch, so a crashed sweeper's lock frees up quickly while a live
+# one keeps it for as long as it needs.
+LOCK_TTL_SECONDS = 300
+FILE_DELETE_ATTEMPTS = 3
+# At most this many undeletable file keys are kept on the tombstone for inspection.
+MAX_FAILED_KEYS_RECORDED = 200
+
+# Collections removed by course_id once activities and submissions are gone, with the
+# progress field each one is counted under.
+_COURSE_COLLECTIONS = (
+    ("grades", "grades"),
+    ("failed_subjects", "failed_subjects"),
+    ("recovery_enabled", "recovery_enabled"),
+    ("class_videos", "videos"),
+)
+
+_EMPTY_PROGRESS = {
+    "activities": 0, "submissions": 0, "grades": 0, "failed_subjects": 0,
+    "recovery_enabled": 0, "videos": 0, "files_deleted": 0, "files_failed": 0,
+}
+
+
+async def tombstone_course(course: dict, user: dict) -> dict:
+    """Replace the course document with a pending deletion record and return it."""
+    now = datetime.now(timezone.utc).isoformat()
+    deletion = {
+        "course_id": course["id"],
+        "course_name": course.get("name", ""),
+        "program_id": course.get("program_id", ""),
+        "requested_by": user["id"],
+        "requested_at": now,
+        "updated_at": now,
+        "status": "pending",
+        "progress": dict(_EMPTY_PROGRESS),
+        "failed_keys": [],
+    }
+    await db.course_deletions.replace_one({"course_id": course["id"]}, deletion, upsert=True)
+    await db.courses.delete_one({"id": course["id"]})
+    # Enrollment rows go now rather than in the sweep: conflict and "still enrolled"
+    # checks must stop seeing the group immediately.
+    await db.enrollments.delete_many({"course_id": course["id"]})
+    await incr_counters(courses=-1)
+    deletion.pop("_id", None)
+    return deletion
+
+
+async def _record(course_id: str, inc: dict, failed_keys: list = None):
+    update = {
+        "$inc": {f"progress.{k}": v for k, v in inc.items() if v},
+        "$set": {"status": "running", "updated_at": datetime.now(timezone.utc).isoformat()},
+    }
+    if failed_keys:
+        update["$push"] = {"failed_keys": {"$each": failed_keys[:MAX_FAILED_KEYS_RECORDED], "$slice": MAX_FAILED_KEYS_RECORDED}}
+    if not update["$inc"]:
+        del update["$inc"]
+    await db.course_deletions.update_one({"course_id": course_id}, update)
+
+
+async def _purge_files(course_id: str, file_entries: list):
+    """Release the entries' blob references and delete what is no longer referenced.
+
+    Called only after the documents holding the entries are deleted: a crash in between
+    leaks references (an orphaned file) instead of releasing the same reference twice.
+    """
+    if not file_entries:
+        return
+    result = await release_and_delete(file_entries, attempts=FILE_DELETE_ATTEMPTS)
+    deleted = sum(result["deleted"].values())
+    await _record(course_id, {"files_deleted": deleted, "files_failed": len(result["failed"])}, result["failed"])
+
+
+async def _heartbeat():
+    if not await extend_scheduler_lock(LOCK_NAME, LOCK_TTL_SECONDS):
+        # Another sweeper took over; two sweepers could release the same blob reference twice.
+        raise RuntimeError("sweep lock lost")
+
+
+async def _sweep_activities(course_id: str):
+    while True:
+        await _heartbeat()
+        activities = await db.activities.find(
+            {"course_id": course_id}, {"_id": 0, "id": 1, "files": 1}
+        ).limit(SWEEP_BATCH_SIZE).to_list(SWEEP_BATCH_SIZE)
+        if not activities:
+            return
+        activity_ids = [a["id"] for a in activities]
+        while True:
+            submissions = await db.submissions.find(
+                {"activity_id": {"$in": activity_ids}}, {"_id": 0, "id": 1, "files": 1}
+            ).limit(SWEEP_BATCH_SIZE).to_list(SWEEP_BATCH_SIZE)
+            if not submissions:
+                break
+            await _heartbeat()
+            result = await db.submissions.delete_many({"id": {"$in": [s["id"] for s in submissions]}})
+            await _record(course_id, {"submissions": result.deleted_count})
+            await _purge_files(course_id, [f for s in submissions for f in (s.get("files") or [])])
+        result = await db.activities.delete_many({"id": {"$in": activity_ids}})
+        await incr_counters(activities=-result.deleted_count)
+        await _record(course_id, {"activities": result.deleted_count})
+        await _purge_files(course_id, [f for a in activities for f in (a.get("files") or [])])
+
+
+async def _sweep_collection(course_id: str, collection: str, progress_field: str):
+    while True:
+        await _heartbeat()
+        batch = await db[collection].find({"course_id": course_id}, {"_id": 1}).limit(SWEEP_BATCH_SIZE).to_list(SWEEP_BATCH_SIZE)
+        if not batch:
+            return
+        result = await db[collection].delete_many({"_id": {"$in": [d["_id"] for d in batch]}})
+        await _record(course_id, {progress_field: result.deleted_count})
+
+
+async def sweep_course(course_id: str):
+    """Delete everything that belonged to a tombstoned course. Safe to re-run after a
+    crash: every step only looks for what is still there."""
+    await _sweep_activities(course_id)
+    for collection, progress_field in _COURSE_COLLECTIONS:
+        await _sweep_collection(course_id, collection, progress_field)
+    await db.course_deletions.update_one(
+        {"course_id": course_id},
+        {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc).isoformat()}},
+    )
+
+
+async def sweep_course_deletions():
+    """Scheduler job (and post-DELETE kick): finish every pending course deletion."""
+    if not await acquire_scheduler_lock(LOCK_NAME, ttl_seconds=LOCK_TTL_SECONDS):
+        logger.info("sweep_course_deletions: another worker holds the lock, skipping")
+        return
+    try:
+        pending = await db.course_deletions.find(
+            {"status": {"$in": ["pending", "running", "error"]}}, {"_id": 0, "course_id": 1}
+        ).to_list(100)
+        for deletion in pending:
+            course_id = deletion["course_id"]
+            try:
+                await sweep_course(course_id)
+                logger.info(f"sweep_course_deletions: course {course_id} fully deleted")
+            except Exception as e:
+                logger.error(f"sweep_course_deletions: course {course_id} failed: {e}", exc_info=True)
+                await db.course_deletions.update_one(
+                    {"course_id": course_id},
+                    {"$set": {"status": "error", "error": str(e)[:500], "updated_at": datetime.now(timezone.utc).isoformat()}},
+                )
+    finally:
+        await release_scheduler_lock(LOCK_NAME)
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from database import db
+from utils.blobs import release_and_delete
+from utils.counters import incr_counters
+from scheduler.cleanup import acquire_scheduler_lock, extend_scheduler_lock, release_scheduler_lock
+
+logger = logging.getLogger(__name__)
+
+# Finds documents whose parent course or activity no longer exists and deletes them.
+# Each collection is walked in _id order in small batches; parents are checked with one
+# $in lookup per batch, so nothing ever loads every course or activity id. The position
+# reached is kept in `orphan_collector` (one document per collection), so a run that
+# hits its batch budget or crashes resumes where it stopped, and a completed pass
+# records its totals there (GET /admin/orphan-collector).
+
+LOCK_NAME = "collect_orphans"
+LOCK_TTL_SECONDS = 300
+BATCH_SIZE = 200
+# Rate limiting: at most this many batches per collection per run, with a pause
+# between batches so the collector never competes with request traffic for long.
+MAX_BATCHES_PER_RUN = 50
+BATCH_PAUSE_SECONDS = 0.2
+FILE_DELETE_ATTEMPTS = 3
+
+# (collection, parent field, parent collection). Order matters: activities go before
+# submissions so a pass deletes both levels of an orphaned course.
+_TARGETS = (
+    ("activities", "course_id", "courses"),
+    ("submissions", "activity_id", "activities"),
+    ("grades", "course_id", "courses"),
+    ("class_videos", "course_id", "courses"),
+    ("failed_subjects", "course_id", "courses"),
+    ("recovery_enabled", "course_id", "courses"),
+    ("enrollments", "course_id", "courses"),
+)
+# Collections whose documents hold uploaded files; their blob references are released.
+_WITH_FILES = {"activities", "submissions"}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+async def _heartbeat():
+    if not await extend_scheduler_lock(LOCK_NAME, LOCK_TTL_SECONDS):
+        raise RuntimeError("orphan collector lock lost")
+
+
+async def _courses_being_swept(course_ids: list) -> set:
+    """Courses with an unfinished tombstone: their data is the course sweeper's to delete
+    (it releases file references in a specific order), so the collector leaves it."""
+    if not course_ids:
+        return set()
+    return set(await db.course_deletions.distinct(
+        "course_id", {"course_id": {"$in": course_ids}, "status": {"$ne": "done"}}
+    ))
+
+
+async def _find_orphans(collection: str, parent_field: str, parent_collection: str, batch: list) -> list:
+    parent_ids = list({d[parent_field] for d in batch if d.get(parent_field)})
+    if not parent_ids:
+        return []
+    existing = set(await db[parent_collection].distinct("id", {"id": {"$in": parent_ids}}))
+    orphans = [d for d in batch if d.get(parent_field) and d[parent_field] not in existing]
+    if not orphans:
+        return []
+    course_ids = list({d.get("course_id") for d in orphans if d.get("course_id")})
+    swept = await _courses_being_swept(course_ids)
+    return [d for d in orphans if d.get("course_id") not in swept]
+
+
+async def _delete_orphans(collection: str, orphans: list) -> dict:
+    """Delete a batch of orphans. Documents holding files are removed one by one with
+    find_one_and_delete so each file reference is released only by whoever deleted it."""
+    if collection not in _WITH_FILES:
+        result = await db[collection].delete_many({"_id": {"$in": [d["_id"] for d in orphans]}})
+        return {"deleted": result.deleted_count, "files_deleted": 0}
+    deleted, entries = 0, []
+    for doc in orphans:
+        removed = await db[collection].find_one_and_delete({"_id": doc["_id"]}, projection={"files": 1})
+        if removed:
+            deleted += 1
+            entries.extend(removed.get("files") or [])
+    files_deleted = 0
+    if entries:
+        result = await release_and_delete(entries, attempts=FILE_DELETE_ATTEMPTS)
+        files_deleted = sum(result["deleted"].values())
+        if result["failed"]:
+            logger.warning(f"collect_orphans: could not delete {len(result['failed'])} orphaned file(s) from {collection}")
+    if collection == "activities" and deleted:
+        await incr_counters(activities=-deleted)
+    return {"deleted": deleted, "files_deleted": files_deleted}
+
+
+async def collect_collection(collection: str, parent_field: str, parent_collection: str,
+                             max_batches: int = MAX_BATCHES_PER_RUN) -> dict:
+    """Advance the collector over one collection by up to max_batches batches."""
+    state = await db.orphan_collector.find_one({"_id": collection}) or {}
+    last_id = state.get("last_id")
+    run = {"scanned": 0, "deleted": 0, "files_deleted": 0}
+    pass_done = False
+    for batch_no in range(max_batches):
+        await _heartbeat()
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        projection = {"_id": 1, parent_field: 1, "course_id": 1}
+        batch = await db[collection].find(query, projection).sort("_id", 1).limit(BATCH_SIZE).to_list(BATCH_SIZE)
+        if not batch:
+            pass_done = True
+            break
+        last_id = batch[-1]["_id"]
+        run["scanned"] += len(batch)
+        orphans = await _find_orphans(collection, parent_field, parent_collection, batch)
+        if orphans:
+            result = await _delete_orphans(collection, orphans)
+            run["deleted"] += result["deleted"]
+            run["files_deleted"] += result["files_deleted"]
+        if BATCH_PAUSE_SECONDS and batch_no + 1 < max_batches:
+            await asyncio.sleep(BATCH_PAUSE_SECONDS)
+
+    update = {
+        "$set": {"updated_at": _now(), "last_id": None if pass_done else last_id},
+        "$inc": {"pass_scanned": run["scanned"], "pass_deleted": run["deleted"],
+                 "total_deleted": run["deleted"], "total_files_deleted": run["files_deleted"]},
+    }
+    if pass_done:
+        # Close the pass: keep its totals for the metrics endpoint and start over.
+        update["$set"].update({
+            "last_pass_finished_at": _now(),
+            "last_pass_scanned": state.get("pass_scanned", 0) + run["scanned"],
+            "last_pass_deleted": state.get("pass_deleted", 0) + run["deleted"],
+            "pass_scanned": 0, "pass_deleted": 0,
+        })
+        del update["$inc"]["pass_scanned"], update["$inc"]["pass_deleted"]
+        update["$inc"]["passes"] = 1
+    await db.orphan_collector.update_one({"_id": collection}, update, upsert=True)
+    return {**run, "pass_done": pass_done}
+
+
+async def collect_orphans():
+    """Scheduler job: advance the orphan collector over every target collection."""
+    if not await acquire_scheduler_lock(LOCK_NAME, ttl_seconds=LOCK_TTL_SECONDS):
+        logger.info("collect_orphans: another worker holds the lock, skipping")
+        return
+    try:
+        for collection, parent_field, parent_collection in _TARGETS:
+            try:
+                result = await collect_collection(collection, parent_field, parent_collection)
+            except Exception as e:
+                logger.error(f"collect_orphans: {collection} failed: {e}", exc_info=True)
+                continue
+            if result["deleted"]:
+                logger.info(
+                    f"collect_orphans: deleted {result['deleted']} orphaned {collection} "
+                    f"({result['files_deleted']} file(s)) after scanning {result['scanned']}"
+                )
+    finally:
+        await release_scheduler_lock(LOCK_NAME)
+
+
+async def collector_status() -> list:
+    """Cursor position and totals of every target collection."""
+    states = {s["_id"]: s for s in await db.orphan_collector.find({}).to_list(None)}
+    result = []
+    for collection, parent_field, parent_collection in _TARGETS:
+        state = states.get(collection, {})
+        state.pop("_id", None)
+        last_id = state.pop("last_id", None)
+        result.append({
+            "collection": collection,
+            "parent": f"{parent_collection}.id via {parent_field}",
+            "in_progress": last_id is not None,
+            "passes": state.get("passes", 0),
+            **state,
+        })
+    return result
@@ -0,0 +1,178 @@
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+from pymongo import ReplaceOne
+
+from database import db
+from config import BOGOTA_TZ
+from utils import recovery_state
+from scheduler.cleanup import acquire_scheduler_lock, release_scheduler_lock
+
+logger = logging.getLogger(__name__)
+
+# Grades are on a 0.0–5.0 scale; the histogram uses ten 0.5-wide buckets, the last one
+# closed on both ends so a perfect 5.0 lands in [4.5, 5.0].
+GRADE_BUCKET_WIDTH = 0.5
+GRADE_BUCKETS = 10
+PASSING_GRADE = 3.0
+
+# Recovery counts per snapshot, by failed_subjects state: "approved" is every record the
+# admin approved that is still in recovery (approved or completed_ok), "completed" only
+# completed_ok, "rejected" completed_rejected; expired records are never "pending".
+RECOVERY_FIELDS = ("total", "pending", "approved", "completed", "rejected", "expired", "processed")
+_RECOVERY_FIELDS_BY_STATE = {
+    recovery_state.PENDING: ("pending",),
+    recovery_state.APPROVED: ("approved",),
+    recovery_state.COMPLETED_OK: ("approved", "completed"),
+    recovery_state.COMPLETED_REJECTED: ("rejected",),
+    recovery_state.EXPIRED: ("expired",),
+    recovery_state.PROCESSED: ("processed",),
+}
+
+
+def grade_bucket(value: float) -> int:
+    """Index of the histogram bucket a grade falls in."""
+    return min(max(int(value / GRADE_BUCKET_WIDTH), 0), GRADE_BUCKETS - 1)
+
+
+def _empty_snapshot(date_str: str, program_id: str, module_number: int) -> dict:
+    return {
+        "date": date_str,
+        "program_id": program_id,
+        "module_number": module_number,
+        "students": {"total": 0, "by_estado": {}},
+        "grades": {"count": 0, "sum": 0.0, "passed": 0, "histogram": [0] * GRADE_BUCKETS},
+        "recovery": {field: 0 for field in RECOVERY_FIELDS},
+    }
+
+
+async def build_daily_rollups(date_str: Optional[str] = None) -> list:
+    """Build one snapshot per (program, module) describing the state on `date_str`.
+
+    Each snapshot holds student counts by per-program status, a grade histogram and
+    recovery counts. The documents are small, so trend charts read them directly
+    instead of re-aggregating grades and failed_subjects.
+    """
+    date_str = date_str or datetime.now(BOGOTA_TZ).strftime("%Y-%m-%d")
+    snapshots: dict = {}
+
+    def snap(program_id: str, module_number: int) -> dict:
+        key = (program_id, module_number)
+        if key not in snapshots:
+            snapshots[key] = _empty_snapshot(date_str, program_id, module_number)
+        return snapshots[key]
+
+    # Students: counted in every program they belong to, at that program's current module.
+    # Older accounts only carry program_id/program_ids and a single `module`.
+    async for s in db.users.find(
+        {"role": "estudiante"},
+        {"_id": 0, "estado": 1, "module": 1, "program_id": 1, "program_ids": 1,
+         "program_modules": 1, "program_statuses": 1},
+    ):
+        statuses = s.get("program_statuses") or {}
+        program_modules = s.get("program_modules") or {}
+        program_ids = dict.fromkeys(
+            list(program_modules) + list(s.get("program_ids") or []) + [s.get("program_id")]
+        )
+        for prog_id in program_ids:
+            module_number = program_modules.get(prog_id) or s.get("module")
+            if not prog_id or not module_number:
+                continue
+            estado = statuses.get(prog_id) or s.get("estado") or "activo"
+            bucket = snap(prog_id, int(module_number))["students"]
+            bucket["total"] += 1
+            bucket["by_estado"][estado] = bucket["by_estado"].get(estado, 0) + 1
+
+    # Grades: bucketed in MongoDB, then attributed through course → program and subject → module.
+    courses = await db.courses.find({}, {"_id": 0, "id": 1, "program_id": 1}).to_list(5000)
+    course_program = {c["id"]: c.get("program_id") for c in courses}
+    subjects = await db.subjects.find({}, {"_id": 0, "id": 1, "module_number": 1}).to_list(1000)
+    subject_module = {s["id"]: s.get("module_number") for s in subjects}
+
+    grade_groups = await db.grades.aggregate([
+        {"$match": {"value": {"$type": "number"}}},
+        {"$group": {
+            "_id": {
+                "course_id": "$course_id",
+                "subject_id": "$subject_id",
+                "bucket": {"$min": [{"$floor": {"$divide": ["$value", GRADE_BUCKET_WIDTH]}}, GRADE_BUCKETS - 1]},
+            },
+            "count": {"$sum": 1},
+            "sum": {"$sum": "$value"},
+            "passed": {"$sum": {"$cond": [{"$gte": ["$value", PASSING_GRADE]}, 1, 0]}},
+        }},
+    ]).to_list(None)
+    unattributed = 0
+    for g in grade_groups:
+        prog_id = course_program.get(g["_id"].get("course_id"))
+        module_number = subject_module.get(g["_id"].get("subject_id"))
+        if not prog_id or not module_number:
+            unattributed += g["count"]
+            continue
+        grades = snap(prog_id, int(module_number))["grades"]
+        grades["count"] += g["count"]
+        grades["sum"] += g["sum"]
+        grades["passed"] += g["passed"]
+        grades["histogram"][max(int(g["_id"]["bucket"]), 0)] += g["count"]
+
+    # Records the recovery_states migration has not reached yet are grouped by their flags.
+    state_key = "$state" if await recovery_state.states_backfilled() else recovery_state.STATE_EXPR
+    recovery_groups = await db.failed_subjects.aggregate([
+        {"$group": {
+            "_id": {"program_id": "$program_id", "module_number": "$module_number", "state": state_key},
+            "count": {"$sum": 1},
+        }},
+    ]).to_list(None)
+    for r in recovery_groups:
+        prog_id, module_number = r["_id"].get("program_id"), r["_id"].get("module_number")
+        if not prog_id or not module_number:
+            continue
+        recovery = snap(prog_id, int(module_number))["recovery"]
+        recovery["total"] += r["count"]
+        for field in _RECOVERY_FIELDS_BY_STATE.get(r["_id"].get("state"), ()):
+            recovery[field] += r["count"]
+
+    now_iso = datetime.now(timezone.utc).isoformat()
+    docs = []
+    for doc in snapshots.values():
+        grades = doc["grades"]
+        grades["average"] = round(grades["sum"] / grades["count"], 2) if grades["count"] else None
+        grades["pass_rate"] = round(grades["passed"] / grades["count"], 4) if grades["count"] else None
+        grades["sum"] = round(grades["sum"], 2)
+        doc["created_at"] = now_iso
+        docs.append(doc)
+
+    if unattributed:
+        logger.info(f"build_daily_rollups: {unattributed} grades without a resolvable program/module were skipped")
+    return docs
+
+
+async def rollup_daily_analytics():
+    """Nightly job: write today's per-program/per-module snapshots to analytics_rollups.
+
+    Re-running on the same day replaces that day's documents, so a manual rerun after a
+    data fix is safe: that day's snapshots are deleted first, so a program/module that no
+    longer has any data does not keep a stale one.
+    """
+    if not await acquire_scheduler_lock("rollup_daily_analytics", ttl_seconds=900):
+        logger.info("rollup_daily_analytics: another worker holds the lock, skipping")
+        return
+    try:
+        date_str = datetime.now(BOGOTA_TZ).strftime("%Y-%m-%d")
+        docs = await build_daily_rollups(date_str)
+        await db.analytics_rollups.delete_many({"date": date_str})
+        if docs:
+            await db.analytics_rollups.bulk_write([
+                ReplaceOne(
+                    {"date": d["date"], "program_id": d["program_id"], "module_number": d["module_number"]},
+                    d,
+                    upsert=True,
+                )
+                for d in docs
+            ], ordered=False)
+        logger.info(f"rollup_daily_analytics: wrote {len(docs)} snapshots")
+    except Exception as e:
+        logger.error(f"rollup_daily_analytics failed: {e}")
+    finally:
+        await release_scheduler_lock("rollup_daily_analytics")
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+from utils.storage import delete_file_entries, file_entry_keys, storage_name_for_file
+
+logger = logging.getLogger(__name__)
+
+# Uploads are stored under the SHA-256 of the bytes the client sent, and `file_blobs`
+# holds one document per stored object with a reference count. An identical upload
+# reuses the stored object (and its derivatives) instead of writing it again; the
+# object is only deleted when its last reference is released.
+#
+# A blob is identified by (storage, sha256, ext): the extension is part of the identity
+# because images may be re-encoded (and renamed) by compression, and because the same
+# bytes can legitimately be uploaded as .txt and as something else.
+#
+# Releasing the last reference marks the blob `deleting` and its document is removed
+# only once the stored object is gone. Until then an identical upload waits instead of
+# reusing (or rewriting) an object that is about to be deleted under the same key.
+
+HASH_CHUNK_SIZE = 64 * 1024
+# How long an upload waits for the deletion of identical content to finish.
+RELEASE_WAIT_SECONDS = 10
+_RELEASE_POLL_SECONDS = 0.1
+
+# Fields copied from the stored upload response into the blob, and back into the
+# response of every duplicate upload.
+_BLOB_FIELDS = ("stored_name", "url", "size", "storage", "resource_type", "derivatives")
+
+
+class BlobBeingDeleted(Exception):
+    """Identical content is still being deleted from storage; retry the upload later."""
+
+
+def sha256_fileobj(fileobj) -> str:
+    """SHA-256 of a file object, read in chunks from the start; leaves it rewound."""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def sha256_bytes(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+async def _wait_for_release(query: dict) -> bool:
+    """Wait while the blob matching `query` is being deleted; returns whether it was.
+
+    Raises BlobBeingDeleted if the deletion takes longer than RELEASE_WAIT_SECONDS.
+    """
+    deadline = time.monotonic() + RELEASE_WAIT_SECONDS
+    waited = False
+    while await db.file_blobs.count_documents({**query, "deleting": True}, limit=1):
+        if time.monotonic() >= deadline:
+            raise BlobBeingDeleted(f"{query} is still being deleted")
+        waited = True
+        await asyncio.sleep(_RELEASE_POLL_SECONDS)
+    return waited
+
+
+async def reuse_blob(storage: str, digest: str, ext: str) -> Optional[dict]:
+    """Take a reference on an already stored blob, or return None when the content has
+    not been stored in this backend yet (or has just been deleted)."""
+    query = {"storage": storage, "sha256": digest, "ext": ext}
+    await _wait_for_release(query)
+    return await db.file_blobs.find_one_and_update(
+        {**query, "deleting": {"$ne": True}},
+        {"$inc": {"refcount": 1}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def register_blob(digest: str, ext: str, response: dict):
+    """Record a freshly stored upload with one reference.
+
+    Two identical uploads racing past reuse_blob both write the same object under the
+    same key, and the upsert turns the second registration into a second reference.
+    Raises BlobBeingDeleted when a blob with the same key was released meanwhile: its
+    deletion may have removed the object this upload just wrote.
+    """
+    fields = {k: response[k] for k in _BLOB_FIELDS if k in response}
+    if fields.get("derivatives"):
+        # Background-mode derivatives are recorded as pending; by the time a duplicate
+        # reuses them they exist (or previews fall back to the original anyway).
+        fields["derivatives"] = {
+            size: {k: v for k, v in d.items() if k != "pending"} for size, d in fields["derivatives"].items()
+        }
+    if response.get("compression") == "pending":
+        # Background compression will overwrite the object under the same name; until
+        # it is done the file must not be served as immutable (see compression_finished).
+        fields["compression"] = "pending"
+    query = {"storage": response["storage"], "sha256": digest, "ext": ext}
+    if await _wait_for_release(query):
+        raise BlobBeingDeleted(f"{response['stored_name']} was deleted while being uploaded")
+    try:
+        await db.file_blobs.update_one(
+            {**query, "deleting": {"$ne": True}},
+            {
+                "$inc": {"refcount": 1},
+                "$setOnInsert": {**fields, "created_at": datetime.now(timezone.utc).isoformat()},
+            },
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # The unique (storage, sha256, ext) index: the blob was marked deleting in between.
+        raise BlobBeingDeleted(f"{response['stored_name']} was deleted while being uploaded")
+
+
+async def compression_pending(storage: str, stored_name: str) -> bool:
+    return bool(await db.file_blobs.count_documents(
+        {"storage": storage, "stored_name": stored_name, "compression": "pending"}, limit=1
+    ))
+
+
+async def compression_finished(storage: str, stored_name: str):
+    """Clear the pending flag once background compression has replaced (or kept) the object."""
+    await db.file_blobs.update_one(
+        {"storage": storage, "stored_name": stored_name}, {"$unset": {"compression": ""}}
+    )
+
+
+def response_from_blob(blob: dict, filename: str) -> dict:
+    response = {"filename": filename, **{k: blob[k] for k in _BLOB_FIELDS if k in blob}}
+    response["sha256"] = blob["sha256"]
+    return response
+
+
+async def add_file_references(file_entries: Iterable[dict], count: int):
+    """Add `count` references to each content-addressed file in `file_entries`, for
+    documents that copy an upload's file list (e.g. one activity per course)."""
+    if count <= 0:
+        return
+    for entry in file_entries or []:
+        if not isinstance(entry, dict) or not entry.get("sha256") or not entry.get("stored_name"):
+            continue
+        await db.file_blobs.update_one(
+            {"storage": storage_name_for_file(entry), "stored_name": entry["stored_name"]},
+            {"$inc": {"refcount": count}},
+        )
+
+
+async def release_file_entries(file_entries: Iterable[dict]) -> list:
+    """Drop one reference per file entry and return the entries whose stored objects
+    are no longer referenced and should be deleted. Their blobs are left marked
+    `deleting`; finish_release removes them once the objects are gone.
+
+    Entries without a blob (uploaded before content addressing, or via a presigned
+    upload) are returned as-is, since nothing else tracks them.
+    """
+    unreferenced = []
+    for entry in file_entries:
+        if not isinstance(entry, dict) or not entry.get("stored_name"):
+            continue
+        query = {"storage": storage_name_for_file(entry), "stored_name": entry["stored_name"]}
+        blob = await db.file_blobs.find_one_and_update(
+            query, {"$inc": {"refcount": -1}},
+            projection={"_id": 0, "refcount": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        if blob is None:
+            unreferenced.append(entry)
+        elif blob["refcount"] <= 0:
+            # Conditional: an upload that took a reference in the meantime keeps it.
+            marked = await db.file_blobs.update_one(
+                {**query, "refcount": {"$lte": 0}, "deleting": {"$ne": True}},
+                {"$set": {"deleting": True}},
+            )
+            if marked.modified_count:
+                unreferenced.append(entry)
+    return unreferenced
+
+
+async def finish_release(file_entries: Iterable[dict], failed_keys: Iterable[str]):
+    """Remove the blobs of released entries whose objects were deleted. A blob whose
+    objects could not be deleted is unmarked instead, so its content stays reusable."""
+    failed = set(failed_keys)
+    for entry in file_entries:
+        query = {"storage": storage_name_for_file(entry), "stored_name": entry["stored_name"], "deleting": True}
+        if failed.intersection(file_entry_keys(entry)):
+            await db.file_blobs.update_one(query, {"$unset": {"deleting": ""}})
+        else:
+            await db.file_blobs.delete_one(query)
+
+
+async def release_and_delete(file_entries: Iterable[dict], attempts: int = 1) -> dict:
+    """Release one reference per entry and delete the objects no longer referenced.
+
+    Returns the delete_file_entries result.
+    """
+    unreferenced = await release_file_entries(file_entries)
+    result = await delete_file_entries(unreferenced, attempts=attempts)
+    await finish_release(unreferenced, result["failed"])
+    return result
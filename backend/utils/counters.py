@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Single document in the `counters` collection backing GET /stats. Write paths keep it
+# current with $inc; reconcile_counters() recomputes it from the source collections to
+# correct any drift (bulk jobs, failed increments, manual DB edits). Bulk jobs ask for a
+# recount by writing the RECONCILE_REQUEST_ID document (scheduler.cleanup.request_stats_reconcile).
+COUNTERS_DOC_ID = "stats"
+RECONCILE_REQUEST_ID = "stats_reconcile_request"
+
+STUDENT_STATUSES = ("activo", "pendiente_recuperacion", "egresado", "retirado", "reprobado")
+
+
+def student_status_field(estado: Optional[str]) -> str:
+    """Counter field for a student status; a missing status counts as 'activo'."""
+    return f"students_{estado or 'activo'}"
+
+
+async def incr_counters(**deltas: int):
+    """Apply $inc deltas to the stats counters. Never raises: a failed increment is
+    logged and corrected by the next reconciliation."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    try:
+        await db.counters.update_one({"_id": COUNTERS_DOC_ID}, {"$inc": deltas}, upsert=True)
+    except Exception as e:
+        logger.error(f"Failed to update stats counters {deltas}: {e}")
+
+
+async def count_user_created(role: str, estado: Optional[str] = None):
+    if role == "estudiante":
+        await incr_counters(students=1, **{student_status_field(estado): 1})
+    elif role == "profesor":
+        await incr_counters(teachers=1)
+
+
+async def count_user_deleted(role: Optional[str], estado: Optional[str] = None):
+    if role == "estudiante":
+        await incr_counters(students=-1, **{student_status_field(estado): -1})
+    elif role == "profesor":
+        await incr_counters(teachers=-1)
+
+
+async def count_students_deleted(estados: list):
+    """Decrement the student counters for a batch of deleted students."""
+    deltas: dict = {"students": -len(estados)}
+    for estado in estados:
+        field = student_status_field(estado)
+        deltas[field] = deltas.get(field, 0) - 1
+    await incr_counters(**deltas)
+
+
+async def count_student_status_change(old_estado: Optional[str], new_estado: Optional[str]):
+    old_field, new_field = student_status_field(old_estado), student_status_field(new_estado)
+    if old_field != new_field:
+        await incr_counters(**{old_field: -1, new_field: 1})
+
+
+async def compute_counters() -> dict:
+    """Recompute every stats counter from the source collections."""
+    from utils.helpers import student_status_backfilled
+    if await student_status_backfilled():
+        # Students always carry estado (utils.helpers.with_student_status), so each status
+        # is an equality count answered from the users_role_estado index alone.
+        status_counts = await asyncio.gather(*(
+            db.users.count_documents({"role": "estudiante", "estado": estado}) for estado in STUDENT_STATUSES
+        ))
+        students_by_status = dict(zip(STUDENT_STATUSES, status_counts))
+    else:
+        # Until the student_status migration has run, a missing estado counts as activo.
+        student_status_agg = await db.users.aggregate([
+            {"$match": {"role": "estudiante"}},
+            {"$group": {
+                "_id": {"$ifNull": ["$estado", "activo"]},
+                "count": {"$sum": 1}
+            }}
+        ]).to_list(20)
+        students_by_status = {doc["_id"]: doc["count"] for doc in student_status_agg}
+
+    # Activities of deleted courses are removed by the course sweeper and the orphan
+    # collector, so a plain count matches what /stats should show.
+    students, teachers, programs_count, courses_count, activities = await asyncio.gather(
+        db.users.count_documents({"role": "estudiante"}),
+        db.users.count_documents({"role": "profesor"}),
+        db.programs.count_documents({}),
+        db.courses.count_documents({}),
+        db.activities.count_documents({}),
+    )
+
+    counters = {
+        "students": students,
+        "teachers": teachers,
+        "programs": programs_count,
+        "courses": courses_count,
+        "activities": activities,
+    }
+    for estado in STUDENT_STATUSES:
+        counters[student_status_field(estado)] = students_by_status.get(estado, 0)
+    return counters
+
+
+async def reconcile_counters() -> dict:
+    """Overwrite the counters document with freshly computed values and log any drift.
+
+    An increment that lands between the recount and the write is lost, which is why
+    this also runs on a schedule rather than only after bulk jobs.
+    """
+    fresh = await compute_counters()
+    current = await db.counters.find_one({"_id": COUNTERS_DOC_ID}) or {}
+    drift = {k: current.get(k, 0) - v for k, v in fresh.items() if current.get(k, 0) != v}
+    await db.counters.replace_one(
+        {"_id": COUNTERS_DOC_ID},
+        {**fresh, "reconciled_at": datetime.now(timezone.utc).isoformat()},
+        upsert=True,
+    )
+    if current and drift:
+        logger.warning(f"Stats counters drifted and were reconciled: {drift}")
+    return fresh
+
+
+async def get_counters() -> dict:
+    """Return the counters document, building it on first use."""
+    doc = await db.counters.find_one({"_id": COUNTERS_DOC_ID}, {"_id": 0, "reconciled_at": 0})
+    if doc is None:
+        doc = await reconcile_counters()
+    return doc
@@ -0,0 +1,293 @@
+import logging
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+from pymongo import UpdateOne
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# One document per (course, student) in the `enrollments` collection:
+#   {course_id, student_id, program_id, status, enrolled_at[, removed_at]}
+# It replaces the student_ids / removed_student_ids arrays courses used to carry. A
+# "removed" row is a student taken out of the group for failing recovery; it blocks
+# re-enrollment in that same group. A manual removal by an admin just deletes the row.
+# Course documents only keep student_count.
+#
+# Until the enrollments_collection migration has run (other workers keep serving while
+# it holds the lock, or after it failed), courses may still carry the arrays. Reads then
+# merge them with the rows, a row taking precedence for its student, and writes pull
+# students out of the arrays so a removal is not undone by them.
+ACTIVE = "active"
+REMOVED = "removed"
+# Number of the migration that runs migrate_course_arrays (migrations/versions.py).
+ENROLLMENTS_MIGRATION = 6
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+async def _arrays_pending() -> bool:
+    from migrations.runner import is_applied
+    return not await is_applied(ENROLLMENTS_MIGRATION)
+
+
+async def _array_statuses(query: dict) -> dict:
+    """{(course_id, student_id): status} from the legacy course arrays matching `query`."""
+    statuses = {}
+    async for course in db.courses.find(
+        {**query, "$or": [{"student_ids": {"$exists": True}}, {"removed_student_ids": {"$exists": True}}]},
+        {"_id": 0, "id": 1, "student_ids": 1, "removed_student_ids": 1},
+    ):
+        for sid in course.get("removed_student_ids") or []:
+            statuses[(course["id"], sid)] = REMOVED
+        for sid in course.get("student_ids") or []:
+            statuses[(course["id"], sid)] = ACTIVE  # as in migrate_course_arrays, active wins
+    return statuses
+
+
+async def _statuses(row_query: dict, course_query: Optional[dict] = None,
+                    student_ids: Optional[list] = None) -> dict:
+    """{(course_id, student_id): status} from the rows matching `row_query`, merged with
+    the legacy arrays of the courses matching `course_query` when one is given."""
+    statuses = {}
+    if course_query is not None:
+        statuses = await _array_statuses(course_query)
+        if student_ids is not None:
+            wanted = set(student_ids)
+            statuses = {k: v for k, v in statuses.items() if k[1] in wanted}
+    async for row in db.enrollments.find(row_query, {"_id": 0, "course_id": 1, "student_id": 1, "status": 1}):
+        statuses[(row["course_id"], row["student_id"])] = row["status"]
+    return statuses
+
+
+async def enrolled_ids(course_id: str) -> list:
+    enrolled, _ = await course_roster(course_id)
+    return enrolled
+
+
+async def course_roster(course_id: str) -> tuple:
+    """(enrolled student ids, removed student ids) for one course."""
+    return (await rosters_for([course_id]))[course_id]
+
+
+async def rosters_for(course_ids: Iterable[str]) -> dict:
+    """{course_id: (enrolled ids, removed ids)} for several courses in one query."""
+    course_ids = list(course_ids)
+    result = {cid: ([], []) for cid in course_ids}
+    if not course_ids:
+        return result
+    course_query = {"id": {"$in": course_ids}} if await _arrays_pending() else None
+    statuses = await _statuses({"course_id": {"$in": course_ids}}, course_query)
+    for (course_id, student_id), status in statuses.items():
+        enrolled, removed = result[course_id]
+        (enrolled if status == ACTIVE else removed).append(student_id)
+    return result
+
+
+async def with_roster(course: dict) -> dict:
+    """Add student_ids / removed_student_ids to a single course for API responses; the
+    admin group editor still works with the full id lists of the group it opens."""
+    if course:
+        course["student_ids"], course["removed_student_ids"] = await course_roster(course["id"])
+    return course
+
+
+async def active_enrollment(course_id: str, student_id: str) -> Optional[dict]:
+    row = await db.enrollments.find_one({"course_id": course_id, "student_id": student_id}, {"_id": 0})
+    if row is None and await _arrays_pending():
+        if await db.courses.count_documents({"id": course_id, "student_ids": student_id}, limit=1):
+            return {"course_id": course_id, "student_id": student_id, "status": ACTIVE}
+    return row if row and row["status"] == ACTIVE else None
+
+
+async def is_enrolled(course_id: str, student_id: str) -> bool:
+    return await active_enrollment(course_id, student_id) is not None
+
+
+async def is_enrolled_anywhere(student_id: str) -> bool:
+    if await _arrays_pending():
+        return bool(await course_ids_for_student(student_id))
+    return bool(await db.enrollments.count_documents({"student_id": student_id, "status": ACTIVE}, limit=1))
+
+
+async def _active_course_ids(student_ids: list, program_id: Optional[str] = None) -> dict:
+    """{student_id: [course_id, ...]} of active enrollments of the given students."""
+    row_query = {"student_id": {"$in": student_ids}}
+    course_query = None
+    if await _arrays_pending():
+        # Removed rows are read too: they override the arrays.
+        course_query = {"student_ids": {"$in": student_ids}}
+        if program_id:
+            course_query["program_id"] = program_id
+    else:
+        row_query["status"] = ACTIVE
+    if program_id:
+        row_query["program_id"] = program_id
+    result = {sid: [] for sid in student_ids}
+    statuses = await _statuses(row_query, course_query, student_ids)
+    for (course_id, student_id), status in statuses.items():
+        if status == ACTIVE:
+            result[student_id].append(course_id)
+    return result
+
+
+async def still_enrolled(student_ids: Iterable[str]) -> set:
+    """The subset of student_ids with at least one active enrollment."""
+    student_ids = list(student_ids)
+    if not student_ids:
+        return set()
+    return {sid for sid, course_ids in (await _active_course_ids(student_ids)).items() if course_ids}
+
+
+async def course_ids_for_student(student_id: str, program_id: Optional[str] = None) -> list:
+    return (await _active_course_ids([student_id], program_id))[student_id]
+
+
+async def course_ids_by_student(student_ids: Iterable[str]) -> dict:
+    """{student_id: [course_id, ...]} of active enrollments, in one query."""
+    student_ids = list(student_ids)
+    if not student_ids:
+        return {}
+    return await _active_course_ids(student_ids)
+
+
+async def conflicting_course_ids(program_id: str, student_ids: Iterable[str],
+                                 exclude_course_id: Optional[str] = None) -> list:
+    """Other courses of the program where any of student_ids is already enrolled."""
+    student_ids = list(student_ids)
+    if not await _arrays_pending():
+        query = {"program_id": program_id, "student_id": {"$in": student_ids}, "status": ACTIVE}
+        if exclude_course_id:
+            query["course_id"] = {"$ne": exclude_course_id}
+        return await db.enrollments.distinct("course_id", query)
+    by_student = await _active_course_ids(student_ids, program_id)
+    return list({cid for ids in by_student.values() for cid in ids if cid != exclude_course_id})
+
+
+async def refresh_student_count(course_ids: Iterable[str]):
+    """Recompute courses.student_count from the enrollment rows."""
+    pending = await _arrays_pending()
+    for course_id in set(course_ids):
+        if pending:
+            count = len(await enrolled_ids(course_id))
+        else:
+            count = await db.enrollments.count_documents({"course_id": course_id, "status": ACTIVE})
+        await db.courses.update_one({"id": course_id}, {"$set": {"student_count": count}})
+
+
+async def _pull_from_arrays(course_query: dict, student_ids: list, *fields: str):
+    """Take students out of the legacy course arrays, so they do not override a write."""
+    if await _arrays_pending():
+        await db.courses.update_many(course_query, {"$pull": {f: {"$in": student_ids} for f in fields}})
+
+
+async def enroll(course_id: str, program_id: str, student_ids: Iterable[str]):
+    """Enroll students (re-activating removed rows) and refresh the course's count."""
+    now = _now()
+    ops = [
+        UpdateOne(
+            {"course_id": course_id, "student_id": sid},
+            {
+                "$set": {"status": ACTIVE, "program_id": program_id or ""},
+                "$unset": {"removed_at": ""},
+                "$setOnInsert": {"enrolled_at": now},
+            },
+            upsert=True,
+        )
+        for sid in dict.fromkeys(student_ids)
+    ]
+    if ops:
+        await db.enrollments.bulk_write(ops, ordered=False)
+        await refresh_student_count([course_id])
+
+
+async def mark_removed(course_id: str, student_ids: Iterable[str]):
+    """Take students out of the group, keeping a row that blocks re-enrollment in it."""
+    student_ids = list(student_ids)
+    if not student_ids:
+        return
+    if await _arrays_pending():
+        # A student may be enrolled only through the course array, without a row yet.
+        enrolled = set(await enrolled_ids(course_id))
+        now = _now()
+        ops = [
+            UpdateOne(
+                {"course_id": course_id, "student_id": sid},
+                {"$set": {"status": REMOVED, "removed_at": now}, "$setOnInsert": {"enrolled_at": now}},
+                upsert=True,
+            )
+            for sid in dict.fromkeys(student_ids) if sid in enrolled
+        ]
+        if ops:
+            await db.enrollments.bulk_write(ops, ordered=False)
+    else:
+        await db.enrollments.update_many(
+            {"course_id": course_id, "student_id": {"$in": student_ids}, "status": ACTIVE},
+            {"$set": {"status": REMOVED, "removed_at": _now()}},
+        )
+    await refresh_student_count([course_id])
+
+
+async def unenroll(course_id: str, student_ids: Iterable[str]):
+    """Delete the students' rows in one course, leaving them free to be enrolled again."""
+    student_ids = list(student_ids)
+    if not student_ids:
+        return
+    await db.enrollments.delete_many({"course_id": course_id, "student_id": {"$in": student_ids}})
+    await _pull_from_arrays({"id": course_id}, student_ids, "student_ids", "removed_student_ids")
+    await refresh_student_count([course_id])
+
+
+async def drop_students(student_ids: Iterable[str]):
+    """Delete every enrollment row of the given students (their accounts are gone)."""
+    student_ids = list(student_ids)
+    if not student_ids:
+        return
+    course_ids = await db.enrollments.distinct("course_id", {"student_id": {"$in": student_ids}})
+    if await _arrays_pending():
+        course_ids = set(course_ids) | set(await db.courses.distinct("id", {"$or": [
+            {"student_ids": {"$in": student_ids}}, {"removed_student_ids": {"$in": student_ids}},
+        ]}))
+        await _pull_from_arrays({"id": {"$in": list(course_ids)}}, student_ids, "student_ids", "removed_student_ids")
+    await db.enrollments.delete_many({"student_id": {"$in": student_ids}})
+    await refresh_student_count(course_ids)
+
+
+async def migrate_course_arrays() -> int:
+    """Move courses.student_ids / removed_student_ids into enrollment rows and replace the
+    arrays with student_count. Idempotent: only courses still carrying an array are touched,
+    and each one is unset only after its rows are written."""
+    migrated = 0
+    cursor = db.courses.find(
+        {"$or": [{"student_ids": {"$exists": True}}, {"removed_student_ids": {"$exists": True}}]},
+        {"_id": 0, "id": 1, "program_id": 1, "student_ids": 1, "removed_student_ids": 1, "created_at": 1},
+    )
+    async for course in cursor:
+        enrolled = list(dict.fromkeys(course.get("student_ids") or []))
+        enrolled_set = set(enrolled)
+        # Both arrays could hold the same id (re-enrolled after removal): active wins.
+        removed = [sid for sid in dict.fromkeys(course.get("removed_student_ids") or []) if sid not in enrolled_set]
+        since = course.get("created_at") or _now()
+        program_id = course.get("program_id") or ""
+        ops = [
+            UpdateOne(
+                {"course_id": course["id"], "student_id": sid},
+                {"$setOnInsert": {"program_id": program_id, "status": status, "enrolled_at": since}},
+                upsert=True,
+            )
+            for status, ids in ((ACTIVE, enrolled), (REMOVED, removed))
+            for sid in ids
+        ]
+        if ops:
+            await db.enrollments.bulk_write(ops, ordered=False)
+        await db.courses.update_one(
+            {"id": course["id"]},
+            {"$set": {"student_count": len(enrolled)}, "$unset": {"student_ids": "", "removed_student_ids": ""}},
+        )
+        migrated += 1
+    if migrated:
+        logger.info(f"Migrated enrollment arrays of {migrated} course(s) into the enrollments collection")
+    return migrated
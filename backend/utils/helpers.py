@@ -5,6 +5,9 @@ from pymongo import UpdateOne
 
 from database import db
 from utils.audit import log_audit
+from utils.http_cache import bump_versions
+from utils.counters import count_student_status_change
+from utils import enrollments, recovery_state
 
 logger = logging.getLogger(__name__)
 
@@ -143,16 +146,65 @@ def derive_estado_from_program_statuses(program_statuses: dict) -> str:
     return "retirado"
 
 
+def with_student_status(student: dict) -> dict:
+    """Fill in a student's estado and program_statuses so both are always stored.
+
+    Queries match them with plain equality (the users_role_estado index), so a student
+    document must never be written without them.
+    """
+    program_statuses = student.get("program_statuses")
+    if program_statuses is None:
+        program_ids = student.get("program_ids") or ([student["program_id"]] if student.get("program_id") else [])
+        program_statuses = {pid: student.get("estado") or "activo" for pid in program_ids}
+        student["program_statuses"] = program_statuses
+    if not student.get("estado"):
+        student["estado"] = derive_estado_from_program_statuses(program_statuses)
+    return student
+
+
+# Number of the migration that runs backfill_student_status (migrations/versions.py).
+STUDENT_STATUS_MIGRATION = 4
+
+
+async def student_status_backfilled() -> bool:
+    """True once the student_status migration has run, so every stored student has estado."""
+    from migrations.runner import is_applied
+    return await is_applied(STUDENT_STATUS_MIGRATION)
+
+
+async def backfill_student_status(batch_size: int = 1000) -> int:
+    """Write estado / program_statuses on students stored without them. Idempotent."""
+    missing = {"role": "estudiante", "$or": [
+        {"estado": {"$exists": False}}, {"estado": None},
+        {"program_statuses": {"$exists": False}}, {"program_statuses": None},
+    ]}
+    fixed = 0
+    while True:
+        batch = await db.users.find(
+            missing, {"_id": 1, "estado": 1, "program_statuses": 1, "program_ids": 1, "program_id": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        ops = []
+        for student in batch:
+            filled = with_student_status(dict(student))
+            ops.append(UpdateOne({"_id": student["_id"]}, {"$set": {
+                "estado": filled["estado"], "program_statuses": filled["program_statuses"],
+            }}))
+        await db.users.bulk_write(ops, ordered=False)
+        fixed += len(batch)
+    if fixed:
+        logger.info(f"Backfilled estado/program_statuses on {fixed} student(s)")
+    return fixed
+
+
 async def _get_program_courses_for_student(
     student_id: str, prog_id: str, fallback_course_id: str
 ) -> list:
     """Return all courses for prog_id where student_id is still enrolled."""
     if prog_id:
-        courses = await db.courses.find(
-            {"program_id": prog_id, "student_ids": student_id},
-            {"_id": 0, "id": 1},
-        ).to_list(1000)
-        return courses or [{"id": fallback_course_id}]
+        course_ids = await enrollments.course_ids_for_student(student_id, prog_id)
+        return [{"id": cid} for cid in course_ids] or [{"id": fallback_course_id}]
     return [{"id": fallback_course_id}]
 
 
@@ -160,24 +212,15 @@ async def _unenroll_student_from_course(
     student_id: str, course_id: str
 ) -> list:
     """Unenroll student only from the specified course and clear stale group label."""
-    await db.courses.update_one(
-        {"id": course_id},
-        {
-            "$pull": {"student_ids": student_id},
-            "$addToSet": {"removed_student_ids": student_id}
-        }
-    )
+    await enrollments.mark_removed(course_id, [student_id])
 
-    still_enrolled_anywhere = await db.courses.find_one(
-        {"student_ids": student_id},
-        {"_id": 0, "id": 1}
-    )
-    if not still_enrolled_anywhere:
+    if not await enrollments.is_enrolled_anywhere(student_id):
         await db.users.update_one(
             {"id": student_id, "role": "estudiante"},
             {"$unset": {"grupo": ""}}
         )
 
+    await bump_versions(f"course:{course_id}", "students")
     return [course_id]
 
 
@@ -198,23 +241,16 @@ async def _check_and_update_recovery_completion(student_id: str, course_id: str)
     prog_id = course.get("program_id", "")
 
     all_records = await db.failed_subjects.find(
-        {
-            "student_id": student_id,
-            "course_id": course_id,
-            "recovery_processed": {"$ne": True},
-            "recovery_expired": {"$ne": True},
-        },
+        await recovery_state.in_states(
+            {"student_id": student_id, "course_id": course_id}, recovery_state.OPEN_STATES
+        ),
         {"_id": 0},
     ).to_list(200)
 
     if not all_records:
         return
 
-    all_passed = all(
-        r.get("recovery_approved") is True and
-        r.get("recovery_completed") is True and r.get("teacher_graded_status") == "approved"
-        for r in all_records
-    )
+    all_passed = all(recovery_state.is_passed(r) for r in all_records)
     if not all_passed:
         return
 
@@ -245,6 +281,8 @@ async def _check_and_update_recovery_completion(student_id: str, course_id: str)
         {"id": student_id},
         {"$set": {"estado": new_estado, "program_statuses": program_statuses}},
     )
+    await count_student_status_change(student.get("estado"), new_estado)
+    await bump_versions("students")
     logger.info(
         f"Student {student_id} status updated to {program_statuses.get(prog_id)} "
         f"after all recovery subjects approved in course {course_id}"
@@ -281,13 +319,10 @@ async def _check_and_update_recovery_rejection(student_id: str, course_id: str):
     prog_id = course.get("program_id", "")
 
     approved_records = await db.failed_subjects.find(
-        {
-            "student_id": student_id,
-            "course_id": course_id,
-            "recovery_approved": True,
-            "recovery_processed": {"$ne": True},
-            "recovery_expired": {"$ne": True},
-        },
+        await recovery_state.in_states(
+            {"student_id": student_id, "course_id": course_id, "recovery_approved": True},
+            recovery_state.GRADED_OR_APPROVED_STATES,
+        ),
         {"_id": 0},
     ).to_list(200)
 
@@ -300,13 +335,9 @@ async def _check_and_update_recovery_rejection(student_id: str, course_id: str):
 
     now = datetime.now(timezone.utc)
     bulk_reject_ops = [
-        UpdateOne(
-            {"id": record["id"]},
-            {"$set": {
-                "recovery_rejected": True,
-                "rejected_at": now.isoformat(),
-                "rejected_by": "teacher"
-            }}
+        recovery_state.transition_op(
+            record["id"], recovery_state.COMPLETED_REJECTED,
+            rejected_at=now.isoformat(), rejected_by="teacher",
         )
         for record in approved_records
     ]
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import uuid
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from pymongo import UpdateOne
+from starlette.responses import JSONResponse, Response
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Cache-Control per kind of route. Everything here is per-user authenticated data, so it is
+# "private" (never stored by nginx or shared proxies) and "no-cache" (browser must revalidate
+# with If-None-Match, which is answered with an empty 304 when nothing changed).
+CACHE_CONTROL_CATALOGUE = "private, no-cache"
+CACHE_CONTROL_COURSE = "private, no-cache"
+CACHE_CONTROL_ME = "private, no-cache"
+
+BUMP_ATTEMPTS = 3
+BUMP_RETRY_DELAY = 0.05
+
+
+def compute_etag(payload: Any) -> str:
+    """Strong ETag derived from the canonical JSON form of a response payload."""
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return '"' + hashlib.sha1(body.encode("utf-8")).hexdigest() + '"'
+
+
+def etag_matches(request: Optional[Request], etag: str) -> bool:
+    """True when the request's If-None-Match header already names this ETag."""
+    if request is None:
+        return False
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [c.strip() for c in header.split(",")]
+    # nginx downgrades strong ETags to weak ones when it gzips the body, so accept both forms.
+    return any(c == etag or c == f"W/{etag}" for c in candidates)
+
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    """Empty 304 response carrying the validators the client should keep using."""
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+def json_with_etag(payload: Any, etag: str, cache_control: str) -> JSONResponse:
+    return JSONResponse(content=jsonable_encoder(payload), headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+# ---------------------------------------------------------------------------
+# Version stamps
+#
+# Each stamp is a random token stored in the response_versions collection and replaced on
+# every write that changes the data behind it. Keys are either collection-level
+# ("programs", "subjects", "courses", "students") or document-level ("course:<id>").
+# Random tokens (rather than counters) mean a wiped or recreated collection can never
+# hand out a stamp a client has already cached.
+# ---------------------------------------------------------------------------
+
+def _new_stamp() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+async def get_versions(*keys: str) -> dict:
+    """Return {key: stamp} for the given keys, creating stamps that do not exist yet."""
+    docs = await db.response_versions.find(
+        {"key": {"$in": list(keys)}}, {"_id": 0, "key": 1, "version": 1}
+    ).to_list(len(keys))
+    versions = {d["key"]: d["version"] for d in docs}
+    for key in keys:
+        if key not in versions:
+            doc = await db.response_versions.find_one_and_update(
+                {"key": key},
+                {"$setOnInsert": {"key": key, "version": _new_stamp(),
+                                  "updated_at": datetime.now(timezone.utc).isoformat()}},
+                upsert=True,
+                projection={"_id": 0, "version": 1},
+                return_document=True,
+            )
+            versions[key] = doc["version"]
+    return versions
+
+
+async def bump_versions(*keys: str):
+    """Replace the stamps for the given keys, retrying transient failures.
+
+    A bump that never lands leaves clients revalidating against the old stamp, and they
+    would keep getting 304s for stale data until some later write bumps the same key. So
+    after BUMP_ATTEMPTS the error is raised to the caller instead of being swallowed.
+    """
+    keys = [k for k in dict.fromkeys(keys) if k]
+    if not keys:
+        return
+    for attempt in range(1, BUMP_ATTEMPTS + 1):
+        now = datetime.now(timezone.utc).isoformat()
+        try:
+            await db.response_versions.bulk_write([
+                UpdateOne({"key": k}, {"$set": {"key": k, "version": _new_stamp(), "updated_at": now}}, upsert=True)
+                for k in keys
+            ], ordered=False)
+            return
+        except Exception as e:
+            if attempt == BUMP_ATTEMPTS:
+                logger.error(f"Failed to bump response versions {keys}: {e}")
+                raise
+            logger.warning(f"Retrying response versions bump {keys} (attempt {attempt}): {e}")
+            await asyncio.sleep(BUMP_RETRY_DELAY * attempt)
+
+
+async def versioned_etag(*keys: str, variant: str = "") -> tuple:
+    """Return (etag, versions) for a response built from the given stamps. `variant` folds
+    query parameters that change the payload (e.g. a program filter) into the ETag."""
+    versions = await get_versions(*keys)
+    raw = "|".join(f"{k}={versions[k]}" for k in keys) + f"|{variant}"
+    return '"' + hashlib.sha1(raw.encode("utf-8")).hexdigest() + '"', versions
+
+
+def course_version_keys(course_id: str) -> tuple:
+    return ("courses", f"course:{course_id}")
+
+
+def dashboard_version_keys(course_id: str, student_id: Optional[str]) -> tuple:
+    """Stamps behind a student's course dashboard: one bumped by course-wide writes
+    (activities, videos, course edits), one by writes to that student's grades/recovery."""
+    return (f"dashboard:{course_id}", f"dashboard:{course_id}:{student_id}")
+
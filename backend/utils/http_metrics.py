@@ -0,0 +1,356 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from config import METRICS_DIR, METRICS_FLUSH_SECONDS
+from utils import loop_monitor
+from utils.query_metrics import current_stats
+
+logger = logging.getLogger(__name__)
+
+# Per-route request metrics: latency histogram, status counts, database time and requests
+# in flight, keyed by (method, route template) so /courses/{course_id} is one series.
+# Every gunicorn worker keeps its own totals in memory and writes them to
+# METRICS_DIR/<pid>.json (tmpfs by default) every METRICS_FLUSH_SECONDS; GET /api/metrics
+# merges those files with the live totals of the worker answering. When a worker exits,
+# the master folds its file into archive.json (mark_process_dead) so counters never go
+# backwards across worker restarts.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ARCHIVE_FILE = "archive.json"
+LOCK_FILE = ".lock"
+
+# (method, route) -> {"statuses": {code: n}, "buckets": [n per bucket + overflow],
+#                     "sum": seconds, "db_sum": seconds, "in_progress": n}
+# in_progress is only filled in snapshots, from _in_flight.
+_series: dict = {}
+# id(scope) -> scope of requests being handled by this worker.
+_in_flight: dict = {}
+_flush_task: Optional[asyncio.Task] = None
+_dir_ok: Optional[bool] = None
+
+
+def _empty() -> dict:
+    return {"statuses": {}, "buckets": [0] * (len(BUCKETS) + 1), "sum": 0.0, "db_sum": 0.0, "in_progress": 0}
+
+
+def _entry(key: tuple) -> dict:
+    entry = _series.get(key)
+    if entry is None:
+        entry = _series[key] = _empty()
+    return entry
+
+
+def _bucket_index(seconds: float) -> int:
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(BUCKETS)
+
+
+def _route_path(scope) -> str:
+    return getattr(scope.get("route"), "path", None) or "(unmatched)"
+
+
+def _db_seconds() -> float:
+    stats = current_stats()
+    return stats["duration_ms"] / 1000 if stats else 0.0
+
+
+class HttpMetricsMiddleware:
+    """Pure ASGI middleware recording per-route metrics and adding a Server-Timing header.
+
+    Must sit inside QueryMetricsMiddleware so the request's database time is visible.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                total_ms = (time.perf_counter() - started) * 1000
+                db_ms = _db_seconds() * 1000
+                timing = (f"db;dur={db_ms:.1f}, app;dur={max(total_ms - db_ms, 0):.1f}, "
+                          f"total;dur={total_ms:.1f}").encode("latin-1")
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", timing)]}
+            await send(message)
+
+        _in_flight[id(scope)] = scope
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            del _in_flight[id(scope)]
+            elapsed = time.perf_counter() - started
+            entry = _entry((scope.get("method", ""), _route_path(scope)))
+            entry["statuses"][str(status)] = entry["statuses"].get(str(status), 0) + 1
+            entry["buckets"][_bucket_index(elapsed)] += 1
+            entry["sum"] += elapsed
+            entry["db_sum"] += _db_seconds()
+
+
+def _local_snapshot() -> dict:
+    """This worker's totals, with requests in flight counted under the route they were
+    routed to so far (the router fills in scope["route"] before calling the endpoint)."""
+    series = {}
+    for key, entry in _series.items():
+        series[key] = {**entry, "statuses": dict(entry["statuses"]), "buckets": list(entry["buckets"])}
+    for scope in list(_in_flight.values()):
+        key = (scope.get("method", ""), _route_path(scope))
+        if key not in series:
+            series[key] = _empty()
+        series[key]["in_progress"] += 1
+    return {"pid": os.getpid(), "series": [[m, r, e] for (m, r), e in series.items()],
+            "loop": loop_monitor.summary()}
+
+
+def _usable_dir() -> Optional[str]:
+    global _dir_ok
+    if not METRICS_DIR:
+        return None
+    if _dir_ok is None:
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            _dir_ok = os.access(METRICS_DIR, os.W_OK)
+        except OSError:
+            _dir_ok = False
+        if not _dir_ok:
+            logger.warning(f"Metrics directory {METRICS_DIR} is not writable; /api/metrics reports one worker only")
+    return METRICS_DIR if _dir_ok else None
+
+
+def _write_json(path: str, data: dict):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def flush():
+    """Write this worker's totals to its file in METRICS_DIR."""
+    directory = _usable_dir()
+    if directory:
+        try:
+            _write_json(os.path.join(directory, f"{os.getpid()}.json"), _local_snapshot())
+        except OSError as e:
+            logger.warning(f"Could not write request metrics: {e}")
+
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_SECONDS)
+        flush()
+
+
+def start_flushing():
+    """Called from the app lifespan in every worker."""
+    global _flush_task
+    if _usable_dir() and _flush_task is None:
+        _flush_task = asyncio.get_running_loop().create_task(_flush_loop())
+
+
+def stop_flushing():
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        _flush_task = None
+    flush()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge_into(total: dict, snapshot: dict, with_gauges: bool):
+    for method, route, entry in snapshot.get("series", []):
+        merged = total.setdefault((method, route), _empty())
+        for status, count in entry["statuses"].items():
+            merged["statuses"][status] = merged["statuses"].get(status, 0) + count
+        for i, count in enumerate(entry["buckets"]):
+            merged["buckets"][i] += count
+        merged["sum"] += entry["sum"]
+        merged["db_sum"] += entry["db_sum"]
+        if with_gauges:
+            merged["in_progress"] += entry["in_progress"]
+
+
+def collect() -> dict:
+    """(method, route) -> totals across every worker sharing METRICS_DIR."""
+    return _collect()[0]
+
+
+def _collect() -> tuple:
+    """Route totals plus {pid: event-loop lag summary} of the live workers."""
+    total: dict = {}
+    loops: dict = {}
+    own_pid = os.getpid()
+    local = _local_snapshot()
+    _merge_into(total, local, with_gauges=True)
+    if local["loop"]:
+        loops[own_pid] = local["loop"]
+    directory = _usable_dir()
+    if not directory:
+        return total, loops
+    with open(os.path.join(directory, LOCK_FILE), "a") as lock:
+        # Shared lock: mark_process_dead never moves a file into the archive mid-read.
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        for name in os.listdir(directory):
+            if not name.endswith(".json"):
+                continue
+            if name == ARCHIVE_FILE:
+                snapshot = _read_json(os.path.join(directory, name))
+                if snapshot:
+                    _merge_into(total, snapshot, with_gauges=False)
+                continue
+            try:
+                pid = int(name[:-5])
+            except ValueError:
+                continue
+            if pid == own_pid:
+                continue
+            snapshot = _read_json(os.path.join(directory, name))
+            if snapshot:
+                # Gauges of a worker that died without cleanup are stale.
+                alive = _pid_alive(pid)
+                _merge_into(total, snapshot, with_gauges=alive)
+                if alive and snapshot.get("loop"):
+                    loops[pid] = snapshot["loop"]
+    return total, loops
+
+
+def mark_process_dead(pid: int, directory: Optional[str] = None):
+    """Fold a dead worker's file into the archive. Called by the gunicorn master
+    (child_exit in gunicorn.conf.py)."""
+    directory = directory or METRICS_DIR
+    if not directory:
+        return
+    path = os.path.join(directory, f"{pid}.json")
+    if not os.path.exists(path):
+        return
+    with open(os.path.join(directory, LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        snapshot = _read_json(path)
+        if snapshot:
+            archive_path = os.path.join(directory, ARCHIVE_FILE)
+            total: dict = {}
+            _merge_into(total, _read_json(archive_path) or {}, with_gauges=False)
+            _merge_into(total, snapshot, with_gauges=False)
+            _write_json(archive_path, {"series": [[m, r, e] for (m, r), e in total.items()]})
+        os.remove(path)
+
+
+def clear_directory(directory: Optional[str] = None):
+    """Drop every metrics file; the gunicorn master calls this once at startup."""
+    directory = directory or METRICS_DIR
+    if not directory or not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith(".json") or name.endswith(".tmp"):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_number(value) -> str:
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def render_prometheus() -> str:
+    """Prometheus text exposition (version 0.0.4) of the merged totals."""
+    total, loops = _collect()
+    keys = sorted(total)
+    lines = [
+        "# HELP http_requests_total Requests handled, by route template and status code.",
+        "# TYPE http_requests_total counter",
+    ]
+    for method, route in keys:
+        labels = f'method="{_escape(method)}",route="{_escape(route)}"'
+        for status, count in sorted(total[(method, route)]["statuses"].items()):
+            lines.append(f'http_requests_total{{{labels},status="{status}"}} {count}')
+
+    lines += [
+        "# HELP http_request_duration_seconds Time from request to end of response.",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for method, route in keys:
+        entry = total[(method, route)]
+        labels = f'method="{_escape(method)}",route="{_escape(route)}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS, entry["buckets"]):
+            cumulative += count
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += entry["buckets"][-1]
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f"http_request_duration_seconds_sum{{{labels}}} {_format_number(entry['sum'])}")
+        lines.append(f"http_request_duration_seconds_count{{{labels}}} {cumulative}")
+
+    lines += [
+        "# HELP http_request_db_seconds_total Time spent in MongoDB commands, by route template.",
+        "# TYPE http_request_db_seconds_total counter",
+    ]
+    for method, route in keys:
+        labels = f'method="{_escape(method)}",route="{_escape(route)}"'
+        lines.append(f"http_request_db_seconds_total{{{labels}}} {_format_number(total[(method, route)]['db_sum'])}")
+
+    lines += [
+        "# HELP http_requests_in_progress Requests being handled right now.",
+        "# TYPE http_requests_in_progress gauge",
+    ]
+    for method, route in keys:
+        labels = f'method="{_escape(method)}",route="{_escape(route)}"'
+        lines.append(f"http_requests_in_progress{{{labels}}} {total[(method, route)]['in_progress']}")
+
+    if loops:
+        # Percentiles cannot be merged across workers, so each worker is its own series.
+        lines += [
+            "# HELP event_loop_lag_seconds Event-loop lag over the recent samples (LOOP_MONITOR).",
+            "# TYPE event_loop_lag_seconds summary",
+        ]
+        for pid, loop in sorted(loops.items()):
+            for quantile, key in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"), ("1", "max")):
+                lines.append(f'event_loop_lag_seconds{{pid="{pid}",quantile="{quantile}"}} {_format_number(float(loop[key]))}')
+            lines.append(f'event_loop_lag_seconds_count{{pid="{pid}"}} {loop["samples"]}')
+        lines += [
+            "# HELP event_loop_stalls_total Loop stalls over LOOP_LAG_THRESHOLD_MS since the worker started.",
+            "# TYPE event_loop_stalls_total counter",
+        ]
+        for pid, loop in sorted(loops.items()):
+            lines.append(f'event_loop_stalls_total{{pid="{pid}"}} {loop["stalls"]}')
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    _series.clear()
@@ -0,0 +1,251 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "gif"}
+MAX_IMAGE_DIMENSION = 1920
+JPEG_QUALITY = 80
+
+# Preview derivatives stored next to each uploaded image, keyed by the `size=` value
+# GET /files/{filename} accepts. None means full size (the compressed original, as WebP).
+DERIVATIVE_WIDTHS = {"thumb": 256, "640": 640, "webp": None}
+WEBP_QUALITY = 75
+
+
+def compress_image(file_content: bytes, filename: str, keep_format: bool = False) -> tuple:
+    """Compress and optionally resize an image file.
+
+    By default opaque PNG, WebP and GIF are re-encoded as JPEG. With keep_format=True the
+    original format is preserved (GIF is returned untouched), so the result can replace
+    an object already stored under the original name.
+    """
+    from PIL import Image
+
+    ext = Path(filename).suffix.lower().lstrip(".")
+    if ext not in IMAGE_EXTENSIONS:
+        return file_content, filename
+    if keep_format and ext == "gif":
+        return file_content, filename
+
+    original_size = len(file_content)
+    img = Image.open(io.BytesIO(file_content))
+    w, h = img.size
+    if w > MAX_IMAGE_DIMENSION or h > MAX_IMAGE_DIMENSION:
+        img.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION), Image.LANCZOS)
+
+    output = io.BytesIO()
+    stem = Path(filename).stem
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+
+    if ext == "png" and (has_alpha or keep_format):
+        if img.mode == "P":
+            img = img.convert("RGBA")
+        img.save(output, format="PNG", optimize=True)
+        new_filename = f"{stem}.png"
+    elif ext == "webp" and keep_format:
+        img.save(output, format="WEBP", quality=JPEG_QUALITY)
+        new_filename = f"{stem}.webp"
+    else:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.save(output, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        new_filename = f"{stem}.{ext}" if keep_format else f"{stem}.jpg"
+
+    compressed_bytes = output.getvalue()
+    compressed_size = len(compressed_bytes)
+    savings = round((1 - compressed_size / original_size) * 100, 1) if original_size else 0
+    logger.info(f"Image compressed: {original_size} -> {compressed_size} ({savings}% reduction)")
+    return compressed_bytes, new_filename
+
+
+def derivative_name(stored_name: str, size: str) -> str:
+    """Name of a derivative stored next to `stored_name` (a file name or an S3 key)."""
+    stem = stored_name.rsplit(".", 1)[0] if "." in stored_name.rsplit("/", 1)[-1] else stored_name
+    return f"{stem}__{size}.webp"
+
+
+def derivative_sizes(filename: str) -> list:
+    """Derivative sizes make_derivatives produces for this file name."""
+    ext = Path(filename).suffix.lower().lstrip(".")
+    if ext not in IMAGE_EXTENSIONS or ext == "gif":
+        return []
+    return [size for size, width in DERIVATIVE_WIDTHS.items() if not (width is None and ext == "webp")]
+
+
+def make_derivatives(file_content: bytes, filename: str) -> dict:
+    """Build the WebP preview derivatives for an image: {size: (bytes, width, height)}.
+
+    GIFs are skipped (animation would be lost) and so is the full-size WebP when the
+    original already is one.
+    """
+    from PIL import Image
+
+    sizes = derivative_sizes(filename)
+    if not sizes:
+        return {}
+    source = Image.open(io.BytesIO(file_content))
+    source.load()
+    if source.mode not in ("RGB", "RGBA"):
+        source = source.convert("RGBA" if "transparency" in source.info or source.mode in ("LA", "P") else "RGB")
+
+    derivatives = {}
+    for size in sizes:
+        width = DERIVATIVE_WIDTHS[size]
+        img = source.copy()
+        if width is not None and img.width > width:
+            img.thumbnail((width, width * 4), Image.LANCZOS)
+        output = io.BytesIO()
+        img.save(output, format="WEBP", quality=WEBP_QUALITY, method=4)
+        derivatives[size] = (output.getvalue(), img.width, img.height)
+    return derivatives
+
+
+# ---------------------------------------------------------------------------
+# Process pool
+#
+# Created lazily so each gunicorn worker (the app is preloaded, then forked) owns its own
+# pool. "spawn" keeps the children free of the parent's event loop and Mongo client
+# threads; they only import this module and Pillow, which is why config is imported
+# inside the functions below rather than at module level.
+# ---------------------------------------------------------------------------
+
+class ImagePoolBusy(Exception):
+    """Raised when no queue slot freed up within the allowed wait."""
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+# IMAGE_POOL_MAX_PENDING queue slots; waiters get them in arrival order.
+_slots: Optional[asyncio.Semaphore] = None
+_slots_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_tasks: set = set()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        from config import IMAGE_POOL_WORKERS
+        _pool = ProcessPoolExecutor(
+            max_workers=IMAGE_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+
+def _get_slots() -> asyncio.Semaphore:
+    """The queue bound, created in the running loop (again if the loop changes)."""
+    global _slots, _slots_loop
+    loop = asyncio.get_running_loop()
+    if _slots is None or _slots_loop is not loop:
+        from config import IMAGE_POOL_MAX_PENDING
+        _slots, _slots_loop = asyncio.Semaphore(IMAGE_POOL_MAX_PENDING), loop
+    return _slots
+
+
+async def _wait_for_slot(queue_wait: float) -> asyncio.Semaphore:
+    slots = _get_slots()
+    if not slots.locked():
+        await slots.acquire()  # free and nobody queued ahead: does not block
+        return slots
+    try:
+        await asyncio.wait_for(slots.acquire(), timeout=queue_wait)
+    except asyncio.TimeoutError:
+        raise ImagePoolBusy()
+    return slots
+
+
+async def run_in_pool(fn, *args, queue_wait: Optional[float] = None):
+    """Run an image function in the process pool.
+
+    When IMAGE_POOL_MAX_PENDING jobs are already in flight, waits up to `queue_wait`
+    seconds (default IMAGE_POOL_QUEUE_WAIT) for one to finish, then raises ImagePoolBusy.
+    Raises asyncio.TimeoutError when the job exceeds IMAGE_JOB_TIMEOUT. A timed-out job
+    keeps its queue slot until the child process actually finishes, so the bound stays honest.
+    """
+    global _pool
+    from config import IMAGE_POOL_QUEUE_WAIT, IMAGE_JOB_TIMEOUT
+    slots = await _wait_for_slot(IMAGE_POOL_QUEUE_WAIT if queue_wait is None else queue_wait)
+    loop = asyncio.get_running_loop()
+    try:
+        try:
+            future = loop.run_in_executor(_get_pool(), fn, *args)
+        except BrokenProcessPool:
+            _pool = None
+            future = loop.run_in_executor(_get_pool(), fn, *args)
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _future: slots.release())
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), timeout=IMAGE_JOB_TIMEOUT)
+    except BrokenProcessPool:
+        # A child died (e.g. OOM on a decompression bomb); start a fresh pool next time.
+        _pool = None
+        raise
+
+
+async def compress_in_pool(file_content: bytes, filename: str, keep_format: bool = False,
+                           queue_wait: Optional[float] = None) -> tuple:
+    return await run_in_pool(compress_image, file_content, filename, keep_format, queue_wait=queue_wait)
+
+
+async def compress_or_original(file_content: bytes, filename: str, keep_format: bool = False,
+                               queue_wait: Optional[float] = None, raise_if_busy: bool = False) -> tuple:
+    """Compressed (bytes, filename), or the original when the pool stays busy, the job
+    times out or Pillow fails. Compression is an optimization, never a reason to reject
+    an upload that already passed validation.
+
+    With raise_if_busy=True a full pool raises ImagePoolBusy instead, so the caller can
+    queue the work for background processing rather than keep the original for good.
+    """
+    try:
+        return await compress_in_pool(file_content, filename, keep_format, queue_wait=queue_wait)
+    except ImagePoolBusy:
+        if raise_if_busy:
+            raise
+        logger.warning(f"Image pool busy, storing {filename} uncompressed")
+    except asyncio.TimeoutError:
+        logger.warning(f"Image compression timed out, storing {filename} uncompressed")
+    except Exception as e:
+        logger.error(f"Image compression failed for {filename}: {e}")
+    return file_content, filename
+
+
+async def derivatives_or_empty(file_content: bytes, filename: str, queue_wait: Optional[float] = None,
+                               raise_if_busy: bool = False) -> dict:
+    """make_derivatives in the pool, or {} when it stays busy, is slow or fails. Missing
+    derivatives only mean previews fall back to the original file. raise_if_busy works
+    as in compress_or_original."""
+    try:
+        return await run_in_pool(make_derivatives, file_content, filename, queue_wait=queue_wait)
+    except ImagePoolBusy:
+        if raise_if_busy:
+            raise
+        logger.warning(f"Image pool busy, skipping derivatives for {filename}")
+    except asyncio.TimeoutError:
+        logger.warning(f"Derivative generation timed out for {filename}")
+    except Exception as e:
+        logger.error(f"Derivative generation failed for {filename}: {e}")
+    return {}
+
+
+def run_in_background(coro):
+    """Schedule a coroutine and keep a reference until it finishes (asyncio only keeps
+    weak references to tasks)."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def shutdown_image_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
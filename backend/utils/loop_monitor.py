@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+from config import LOOP_MONITOR_ENABLED, LOOP_MONITOR_INTERVAL_MS, LOOP_LAG_THRESHOLD_MS
+
+logger = logging.getLogger(__name__)
+
+# Event-loop lag watchdog (opt-in with LOOP_MONITOR=true). A task on the loop sleeps
+# LOOP_MONITOR_INTERVAL_MS at a time and records how late it wakes up; that lateness is
+# the time the loop spent running something that did not yield (bcrypt, Pillow, openpyxl,
+# synchronous S3/Cloudinary calls...). A helper thread watches the task's heartbeat and,
+# when the loop has been stuck longer than LOOP_LAG_THRESHOLD_MS, captures the loop
+# thread's stack while it is still blocked, so the log names the offending call.
+# Lag percentiles are exported on GET /api/metrics; recent stalls on GET /admin/loop-monitor.
+
+SAMPLES = 2400          # ~10 minutes of samples at the default 250 ms interval
+STALLS_KEPT = 20
+STACK_FRAMES = 25
+
+_samples: deque = deque(maxlen=SAMPLES)
+_stalls: deque = deque(maxlen=STALLS_KEPT)
+_stall_count = 0
+_last_beat = 0.0
+# Stall captured for the current heartbeat; cleared when the loop ticks again.
+_open_stall: Optional[dict] = None
+_lock = threading.Lock()
+_task: Optional[asyncio.Task] = None
+_watchdog: Optional[threading.Thread] = None
+_stop = threading.Event()
+
+
+def _interval() -> float:
+    return LOOP_MONITOR_INTERVAL_MS / 1000
+
+
+async def _measure():
+    global _last_beat, _open_stall
+    interval = _interval()
+    while True:
+        expected = time.monotonic() + interval
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        lag = max(now - expected, 0.0)
+        with _lock:
+            _samples.append(lag)
+            _last_beat = now
+            if _open_stall is not None:
+                # The loop is free again: record how long the stall really lasted.
+                _open_stall["lag_ms"] = round(lag * 1000)
+                logger.warning(f"Event loop blocked for {lag * 1000:.0f} ms (stack logged above)")
+                _open_stall = None
+
+
+def _watch(loop_thread_id: int):
+    global _stall_count, _open_stall
+    threshold = LOOP_LAG_THRESHOLD_MS / 1000
+    check_every = max(min(threshold / 2, _interval()), 0.01)
+    while not _stop.wait(check_every):
+        with _lock:
+            stalled = time.monotonic() - (_last_beat + _interval())
+            if stalled < threshold or _open_stall is not None:
+                continue
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        stack = "".join(traceback.format_stack(frame, limit=STACK_FRAMES))
+        stall = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "blocked_ms_at_capture": round(stalled * 1000),
+            "lag_ms": None,
+            "stack": stack,
+        }
+        with _lock:
+            _stall_count += 1
+            _stalls.append(stall)
+            _open_stall = stall
+        logger.warning(f"Event loop blocked for {stalled * 1000:.0f} ms so far; loop thread stack:\n{stack}")
+
+
+def start():
+    """Called from the app lifespan in every worker; does nothing unless enabled."""
+    global _task, _watchdog, _last_beat
+    if not LOOP_MONITOR_ENABLED or _task is not None:
+        return
+    _last_beat = time.monotonic()
+    _stop.clear()
+    _task = asyncio.get_running_loop().create_task(_measure())
+    _watchdog = threading.Thread(
+        target=_watch, args=(threading.get_ident(),), name="loop-monitor", daemon=True
+    )
+    _watchdog.start()
+    logger.info(f"Event loop monitor started (interval {LOOP_MONITOR_INTERVAL_MS:.0f} ms, "
+                f"threshold {LOOP_LAG_THRESHOLD_MS:.0f} ms)")
+
+
+def stop():
+    global _task, _watchdog
+    _stop.set()
+    if _task is not None:
+        _task.cancel()
+        _task = None
+    if _watchdog is not None:
+        _watchdog.join(timeout=1)
+        _watchdog = None
+
+
+def _percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def summary() -> Optional[dict]:
+    """Lag percentiles (seconds) over the recent samples, or None when the monitor is off."""
+    if _task is None:
+        return None
+    with _lock:
+        ordered = sorted(_samples)
+        stalls = _stall_count
+    return {
+        "samples": len(ordered),
+        "p50": _percentile(ordered, 0.5),
+        "p90": _percentile(ordered, 0.9),
+        "p99": _percentile(ordered, 0.99),
+        "max": ordered[-1] if ordered else 0.0,
+        "stalls": stalls,
+    }
+
+
+def recent_stalls() -> list:
+    with _lock:
+        return [dict(s) for s in reversed(_stalls)]
+
+
+def status() -> dict:
+    return {
+        "enabled": _task is not None,
+        "pid": os.getpid(),
+        "worker_id": os.environ.get("WORKER_ID"),
+        "interval_ms": LOOP_MONITOR_INTERVAL_MS,
+        "threshold_ms": LOOP_LAG_THRESHOLD_MS,
+        "lag": summary(),
+        "stalls": recent_stalls(),
+    }
+
+
+def reset():
+    global _stall_count, _open_stall
+    with _lock:
+        _samples.clear()
+        _stalls.clear()
+        _stall_count = 0
+        _open_stall = None
@@ -0,0 +1,157 @@
+import contextvars
+import logging
+import os
+import threading
+from typing import Optional
+
+from pymongo import monitoring
+
+from config import SLOW_QUERY_MS
+
+logger = logging.getLogger(__name__)
+
+# MongoDB command instrumentation. QueryMetricsListener is registered on the Motor client
+# (database.py) and sees every command the driver sends. QueryMetricsMiddleware puts a
+# per-request stats dict in a contextvar; Motor copies the context into the executor
+# thread that runs each pymongo call, so the listener adds to the right request's dict.
+# When the request ends its totals are folded into per-route aggregates, served by
+# GET /admin/query-metrics. Everything is per worker process.
+
+BACKGROUND_ROUTE = "(background)"
+
+_request_stats: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("query_stats", default=None)
+
+# Commands of one request may run in several executor threads at once (asyncio.gather).
+_lock = threading.Lock()
+_routes: dict = {}
+# (connection_id, request_id) -> collection name while a command runs, for the slow log.
+_in_flight: dict = {}
+
+
+def _new_stats(path: str = "") -> dict:
+    return {"path": path, "commands": 0, "duration_ms": 0.0, "docs": 0, "by_command": {}}
+
+
+def current_stats() -> Optional[dict]:
+    """Stats of the request being handled, or None outside a request."""
+    return _request_stats.get()
+
+
+def _docs_returned(reply) -> int:
+    cursor = reply.get("cursor") if isinstance(reply, dict) else None
+    if not isinstance(cursor, dict):
+        return 0
+    batch = cursor.get("firstBatch", cursor.get("nextBatch"))
+    return len(batch) if isinstance(batch, list) else 0
+
+
+def _aggregate(route: str, commands: int, duration_ms: float, docs: int, by_command: dict,
+               requests: int = 0):
+    entry = _routes.get(route)
+    if entry is None:
+        entry = _routes[route] = {
+            "requests": 0, "commands": 0, "duration_ms": 0.0, "docs": 0,
+            "max_commands_per_request": 0, "by_command": {},
+        }
+    entry["requests"] += requests
+    entry["commands"] += commands
+    entry["duration_ms"] += duration_ms
+    entry["docs"] += docs
+    if requests:
+        entry["max_commands_per_request"] = max(entry["max_commands_per_request"], commands)
+    for name, count in by_command.items():
+        entry["by_command"][name] = entry["by_command"].get(name, 0) + count
+
+
+class QueryMetricsListener(monitoring.CommandListener):
+    """pymongo listener; runs synchronously in the driver's thread, so it stays cheap."""
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if isinstance(collection, str):
+            with _lock:
+                _in_flight[(event.connection_id, event.request_id)] = collection
+
+    def _finished(self, event, docs: int):
+        duration_ms = event.duration_micros / 1000
+        name = event.command_name
+        stats = _request_stats.get()
+        with _lock:
+            collection = _in_flight.pop((event.connection_id, event.request_id), None)
+            if stats is not None:
+                stats["commands"] += 1
+                stats["duration_ms"] += duration_ms
+                stats["docs"] += docs
+                stats["by_command"][name] = stats["by_command"].get(name, 0) + 1
+            else:
+                _aggregate(BACKGROUND_ROUTE, 1, duration_ms, docs, {name: 1})
+        if duration_ms >= SLOW_QUERY_MS:
+            logger.warning(
+                f"Slow MongoDB command: {name} on {collection or '?'} took {duration_ms:.0f} ms "
+                f"({stats['path'] if stats else BACKGROUND_ROUTE}, {docs} docs)"
+            )
+
+    def succeeded(self, event):
+        self._finished(event, _docs_returned(event.reply))
+
+    def failed(self, event):
+        self._finished(event, 0)
+
+
+def _route_template(scope) -> str:
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    return f"{scope.get('method', '')} {path}" if path else f"{scope.get('method', '')} (unmatched)"
+
+
+class QueryMetricsMiddleware:
+    """Pure ASGI middleware giving each HTTP request its own stats dict."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = _new_stats(f"{scope.get('method', '')} {scope.get('path', '')}")
+        token = _request_stats.set(stats)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_stats.reset(token)
+            # The router has filled in scope["route"] by now.
+            with _lock:
+                _aggregate(_route_template(scope), stats["commands"], stats["duration_ms"], stats["docs"],
+                           stats["by_command"], requests=1)
+
+
+def snapshot(top: int = 50) -> dict:
+    """Per-route totals of this worker, routes with the most database time first."""
+    with _lock:
+        routes = [
+            {
+                "route": route, **entry,
+                "duration_ms": round(entry["duration_ms"], 1),
+                "by_command": dict(entry["by_command"]),
+                "avg_commands_per_request": round(entry["commands"] / entry["requests"], 2) if entry["requests"] else None,
+            }
+            for route, entry in _routes.items()
+        ]
+    routes.sort(key=lambda r: r["duration_ms"], reverse=True)
+    return {
+        "pid": os.getpid(),
+        "worker_id": os.environ.get("WORKER_ID"),
+        "slow_query_ms": SLOW_QUERY_MS,
+        "totals": {
+            "commands": sum(r["commands"] for r in routes),
+            "duration_ms": round(sum(r["duration_ms"] for r in routes), 1),
+            "docs": sum(r["docs"] for r in routes),
+        },
+        "routes": routes[:top],
+    }
+
+
+def reset():
+    with _lock:
+        _routes.clear()
@@ -0,0 +1,224 @@
+import logging
+
+from pymongo import UpdateOne
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Lifecycle of a failed_subjects record, stored as one indexed `state` field. The legacy
+# recovery_* booleans are still written (by the helpers below, never directly) because
+# responses and the frontend read them, but queries filter on `state`.
+#
+#   pending ──approve──> approved ──teacher ok──> completed_ok
+#      │                   │  ▲                       │
+#      └──reject──> completed_rejected <──teacher/admin reject
+#   any open state ──recovery_close──> processed;  legacy data may also be `expired`.
+#
+# Records written before `state` existed get it from the recovery_states migration. Until
+# that has run (other workers serve while it holds the lock, or after it failed), queries
+# built with in_states() also match records without `state` by their legacy flags.
+PENDING = "pending"
+APPROVED = "approved"
+COMPLETED_OK = "completed_ok"
+COMPLETED_REJECTED = "completed_rejected"
+EXPIRED = "expired"
+PROCESSED = "processed"
+
+# Waiting for recovery_close; the partial indexes in create_indexes.py cover these.
+OPEN_STATES = [PENDING, APPROVED, COMPLETED_OK, COMPLETED_REJECTED]
+UNPROCESSED_STATES = OPEN_STATES + [EXPIRED]
+# Admin-approved and not rejected: the student may submit and the teacher may grade.
+IN_RECOVERY_STATES = [APPROVED, COMPLETED_OK]
+# Past admin approval, whatever the teacher decided. completed_rejected also holds admin
+# rejections, so queries pair this with recovery_approved=True.
+GRADED_OR_APPROVED_STATES = [APPROVED, COMPLETED_OK, COMPLETED_REJECTED]
+UNREJECTED_STATES = [PENDING, APPROVED, COMPLETED_OK, EXPIRED]
+
+# Number of the migration that runs backfill_states (migrations/versions.py).
+STATES_MIGRATION = 7
+
+# target state -> states it may be entered from
+_ALLOWED_FROM = {
+    PENDING: {APPROVED},
+    APPROVED: {PENDING, APPROVED, COMPLETED_REJECTED},
+    COMPLETED_OK: {APPROVED, COMPLETED_OK},
+    COMPLETED_REJECTED: {PENDING, APPROVED, COMPLETED_OK, COMPLETED_REJECTED},
+    EXPIRED: {PENDING, APPROVED},
+    PROCESSED: set(UNPROCESSED_STATES),
+}
+
+# Legacy flags each transition writes alongside `state`.
+_FLAGS = {
+    PENDING: {"recovery_approved": False},
+    APPROVED: {"recovery_approved": True, "recovery_rejected": False, "recovery_completed": False},
+    COMPLETED_OK: {"recovery_completed": True, "teacher_graded_status": "approved"},
+    COMPLETED_REJECTED: {"recovery_rejected": True},
+    EXPIRED: {"recovery_expired": True},
+    PROCESSED: {"recovery_processed": True},
+}
+
+
+class InvalidRecoveryTransition(Exception):
+    """Raised when a record is not in a state the requested transition starts from."""
+
+
+def derive_state(record: dict) -> str:
+    """State implied by a record's legacy flags (used for new records and the backfill)."""
+    if record.get("recovery_processed"):
+        return PROCESSED
+    if record.get("recovery_expired"):
+        return EXPIRED
+    if record.get("recovery_rejected"):
+        return COMPLETED_REJECTED
+    if record.get("recovery_completed"):
+        return COMPLETED_OK if record.get("teacher_graded_status") == "approved" else COMPLETED_REJECTED
+    if record.get("recovery_approved"):
+        return APPROVED
+    return PENDING
+
+
+_NOT_SET = {"$ne": True}
+
+# Query on the legacy flags equivalent to derive_state() == state.
+_LEGACY_CONDITIONS = {
+    PROCESSED: {"recovery_processed": True},
+    EXPIRED: {"recovery_processed": _NOT_SET, "recovery_expired": True},
+    COMPLETED_REJECTED: {
+        "recovery_processed": _NOT_SET, "recovery_expired": _NOT_SET,
+        "$or": [{"recovery_rejected": True},
+                {"recovery_completed": True, "teacher_graded_status": {"$ne": "approved"}}],
+    },
+    COMPLETED_OK: {
+        "recovery_processed": _NOT_SET, "recovery_expired": _NOT_SET, "recovery_rejected": _NOT_SET,
+        "recovery_completed": True, "teacher_graded_status": "approved",
+    },
+    APPROVED: {
+        "recovery_processed": _NOT_SET, "recovery_expired": _NOT_SET, "recovery_rejected": _NOT_SET,
+        "recovery_completed": _NOT_SET, "recovery_approved": True,
+    },
+    PENDING: {
+        "recovery_processed": _NOT_SET, "recovery_expired": _NOT_SET, "recovery_rejected": _NOT_SET,
+        "recovery_completed": _NOT_SET, "recovery_approved": _NOT_SET,
+    },
+}
+
+# Aggregation expression for a record's state, deriving it from the flags when missing.
+STATE_EXPR = {"$ifNull": ["$state", {"$switch": {
+    "branches": [
+        {"case": {"$eq": ["$recovery_processed", True]}, "then": PROCESSED},
+        {"case": {"$eq": ["$recovery_expired", True]}, "then": EXPIRED},
+        {"case": {"$eq": ["$recovery_rejected", True]}, "then": COMPLETED_REJECTED},
+        {"case": {"$eq": ["$recovery_completed", True]}, "then": {"$cond": [
+            {"$eq": ["$teacher_graded_status", "approved"]}, COMPLETED_OK, COMPLETED_REJECTED,
+        ]}},
+        {"case": {"$eq": ["$recovery_approved", True]}, "then": APPROVED},
+    ],
+    "default": PENDING,
+}}]}
+
+
+async def states_backfilled() -> bool:
+    """True once the recovery_states migration has run, so every record has `state`."""
+    from migrations.runner import is_applied
+    return await is_applied(STATES_MIGRATION)
+
+
+def _state_condition(states: list, legacy: bool) -> dict:
+    condition = {"state": {"$in": states}}
+    if not legacy:
+        return condition
+    return {"$or": [condition] + [{"state": {"$exists": False}, **_LEGACY_CONDITIONS[s]} for s in states]}
+
+
+async def in_states(query: dict, states) -> dict:
+    """`query` restricted to records in `states` (one state or a list). Until the
+    recovery_states migration has run, records without `state` match on their flags."""
+    states = [states] if isinstance(states, str) else list(states)
+    if await states_backfilled():
+        return {**query, "state": {"$in": states}}
+    return {"$and": [query, _state_condition(states, legacy=True)]}
+
+
+def new_record(record: dict) -> dict:
+    """Stamp `state` on a record about to be inserted."""
+    record["state"] = derive_state(record)
+    return record
+
+
+def state_of(record: dict) -> str:
+    return record.get("state") or derive_state(record)
+
+
+def is_passed(record: dict) -> bool:
+    """Approved by the admin and graded as passed by the teacher."""
+    return state_of(record) == COMPLETED_OK
+
+
+def transition_update(target: str, **fields) -> dict:
+    return {"$set": {"state": target, **_FLAGS[target], **fields}}
+
+
+def transition_filter(query: dict, target: str, legacy: bool = False) -> dict:
+    """`query` restricted to records the transition to `target` may start from. A state
+    condition already in `query` (a single state or an $in list) narrows it further.
+    With legacy=True, records without `state` are matched on their flags."""
+    allowed = _ALLOWED_FROM[target]
+    query = dict(query)
+    wanted = query.pop("state", None)
+    if isinstance(wanted, str):
+        allowed = allowed & {wanted}
+    elif isinstance(wanted, dict) and "$in" in wanted:
+        allowed = allowed & set(wanted["$in"])
+    if legacy:
+        return {"$and": [query, _state_condition(sorted(allowed), legacy=True)]}
+    return {**query, "state": {"$in": sorted(allowed)}}
+
+
+def transition_op(record_id: str, target: str, **fields) -> UpdateOne:
+    """Bulk-write form of transition(); records in other states are left untouched.
+
+    Always accepts records without `state`: the filter is on the unique id, so the
+    extra legacy branch costs nothing once the migration has run.
+    """
+    return UpdateOne(
+        transition_filter({"id": record_id}, target, legacy=True), transition_update(target, **fields)
+    )
+
+
+async def transition(query: dict, target: str, many: bool = False, **fields) -> int:
+    """Move the records matching `query` to `target`, writing the legacy flags too.
+
+    The source-state check is part of the update filter, so concurrent transitions cannot
+    both win. With many=False, raises InvalidRecoveryTransition if nothing matched.
+    """
+    update = transition_update(target, **fields)
+    flt = transition_filter(query, target, legacy=not await states_backfilled())
+    if many:
+        result = await db.failed_subjects.update_many(flt, update)
+        return result.modified_count
+    result = await db.failed_subjects.update_one(flt, update)
+    if result.matched_count == 0:
+        raise InvalidRecoveryTransition(f"no failed_subjects record matching {query} can move to {target}")
+    return result.modified_count
+
+
+async def backfill_states(batch_size: int = 1000) -> int:
+    """Set `state` on records written before it existed. Idempotent."""
+    updated = 0
+    while True:
+        batch = await db.failed_subjects.find(
+            {"state": {"$exists": False}},
+            {"_id": 1, "recovery_processed": 1, "recovery_expired": 1, "recovery_rejected": 1,
+             "recovery_completed": 1, "recovery_approved": 1, "teacher_graded_status": 1},
+        ).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        result = await db.failed_subjects.bulk_write(
+            [UpdateOne({"_id": r["_id"]}, {"$set": {"state": derive_state(r)}}) for r in batch],
+            ordered=False,
+        )
+        updated += result.modified_count
+    if updated:
+        logger.info(f"Backfilled recovery state on {updated} failed_subjects record(s)")
+    return updated
@@ -0,0 +1,555 @@
+import asyncio
+import functools
+import logging
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Iterable, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+Body = Union[bytes, BinaryIO]
+
+
+class StorageError(Exception):
+    """A storage backend call failed."""
+
+
+class StorageBackend:
+    """Async interface over one place uploaded files live.
+
+    Every SDK or disk call runs on the backend's own bounded thread pool, so slow storage
+    can neither block the event loop nor exhaust the default executor shared with the
+    rest of the app.
+    """
+
+    name = "base"
+    # Backends that render image variants themselves (Cloudinary) return derivative URLs
+    # instead of storing derivative objects.
+    renders_derivatives = False
+    # Whether put_stream may replace an existing object (background compression relies on it).
+    overwritable = True
+    # Whether clients can upload straight to the backend (presign_upload / head / read_range).
+    supports_presigned = False
+
+    def __init__(self, max_workers: int = 8):
+        self._max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def _run(self, fn, *args, **kwargs):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._max_workers, thread_name_prefix=f"storage-{self.name}"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def new_key(self, basename: str, ext: str) -> str:
+        """Fresh storage key for an upload named `basename`.`ext`."""
+        return f"{basename}_{uuid.uuid4().hex[:8]}.{ext}"
+
+    def content_key(self, digest: str, ext: str) -> str:
+        """Content-addressed key for an upload whose SHA-256 is `digest` (see utils/blobs.py)."""
+        return f"{digest}.{ext}"
+
+    def url_for(self, key: str) -> str:
+        raise NotImplementedError
+
+    def derivative_url(self, key: str, derivative_key: str, size: str, width: Optional[int]) -> str:
+        return self.url_for(derivative_key)
+
+    def metadata(self, key: str) -> dict:
+        """Extra fields recorded on the file entry next to stored_name/url/storage."""
+        return {}
+
+    async def put_stream(self, key: str, body: Body, content_type: Optional[str] = None,
+                         content_disposition: Optional[str] = None) -> str:
+        """Store `body` under `key` and return its URL."""
+        raise NotImplementedError
+
+    async def get_stream(self, key: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        raise NotImplementedError
+        yield b""  # pragma: no cover
+
+    async def delete_many(self, keys: Iterable[str]) -> int:
+        """Delete the given keys, ignoring ones that do not exist. Returns how many were
+        deleted (or requested, where the backend does not report it)."""
+        raise NotImplementedError
+
+    async def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def _read_body(body: Body) -> bytes:
+    if isinstance(body, (bytes, bytearray)):
+        return bytes(body)
+    body.seek(0)
+    return body.read()
+
+
+# ---------------------------------------------------------------------------
+# Local disk
+# ---------------------------------------------------------------------------
+
+class LocalStorage(StorageBackend):
+    name = "local"
+
+    def __init__(self, root: Path, max_workers: int = 8):
+        super().__init__(max_workers)
+        self.root = Path(root)
+
+    def _path(self, key: str) -> Path:
+        if not isinstance(key, str) or not key or any(c in key for c in ("..", "/", "\\", "\x00")):
+            raise StorageError(f"Invalid local storage key: {key!r}")
+        return self.root / key
+
+    def new_key(self, basename: str, ext: str) -> str:
+        return f"{uuid.uuid4()}.{ext}"
+
+    def url_for(self, key: str) -> str:
+        return f"/api/files/{key}"
+
+    def derivative_url(self, key: str, derivative_key: str, size: str, width: Optional[int]) -> str:
+        return f"/api/files/{key}?size={size}"
+
+    @staticmethod
+    def _write(path: Path, body: Body):
+        # Written through a .part file so a failed copy never leaves a truncated file
+        # under the final name, and readers never see a partial one.
+        tmp_path = path.with_name(path.name + ".part")
+        try:
+            with open(tmp_path, "wb") as out:
+                if isinstance(body, (bytes, bytearray)):
+                    out.write(body)
+                else:
+                    body.seek(0)
+                    shutil.copyfileobj(body, out, CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    async def put_stream(self, key, body, content_type=None, content_disposition=None) -> str:
+        await self._run(self._write, self._path(key), body)
+        return self.url_for(key)
+
+    async def get_stream(self, key, chunk_size=CHUNK_SIZE):
+        f = await self._run(open, self._path(key), "rb")
+        try:
+            while True:
+                chunk = await self._run(f.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            await self._run(f.close)
+
+    @staticmethod
+    def _unlink_all(paths: list) -> int:
+        deleted = 0
+        for path in paths:
+            try:
+                path.unlink()
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Failed to delete file {path.name}: {e}")
+        return deleted
+
+    async def delete_many(self, keys) -> int:
+        paths = []
+        for key in keys:
+            try:
+                paths.append(self._path(key))
+            except StorageError:
+                logger.warning(f"Skipping invalid local storage key {key!r}")
+        return await self._run(self._unlink_all, paths)
+
+    async def exists(self, key) -> bool:
+        return await self._run(self._path(key).exists)
+
+
+# ---------------------------------------------------------------------------
+# In-memory stand-in (tests, benchmarks)
+# ---------------------------------------------------------------------------
+
+class MemoryStorage(StorageBackend):
+    """Dict-backed backend with the same contract as the real ones. It still goes through
+    the bounded thread pool, so benchmarks measure the same scheduling overhead."""
+
+    name = "memory"
+
+    def __init__(self, max_workers: int = 8):
+        super().__init__(max_workers)
+        self.objects: dict = {}
+        self.delete_calls: list = []
+
+    def url_for(self, key: str) -> str:
+        return f"memory://{key}"
+
+    async def put_stream(self, key, body, content_type=None, content_disposition=None) -> str:
+        self.objects[key] = await self._run(_read_body, body)
+        return self.url_for(key)
+
+    async def get_stream(self, key, chunk_size=CHUNK_SIZE):
+        data = self.objects[key]
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    async def delete_many(self, keys) -> int:
+        keys = [k for k in keys if k]
+        self.delete_calls.append(keys)
+        return sum(1 for k in keys if self.objects.pop(k, None) is not None)
+
+    async def exists(self, key) -> bool:
+        return key in self.objects
+
+
+# ---------------------------------------------------------------------------
+# S3
+# ---------------------------------------------------------------------------
+
+S3_DELETE_BATCH = 1000  # delete_objects accepts at most 1000 keys per request
+
+
+def s3_folder_for(ext: str) -> str:
+    if ext == "pdf":
+        return "uploads/pdf"
+    if ext in {"jpg", "jpeg", "png", "gif", "webp"}:
+        return "uploads/images"
+    return "uploads/docs"
+
+
+class S3Storage(StorageBackend):
+    name = "s3"
+
+    supports_presigned = True
+
+    def __init__(self, client, bucket: str, region: str, max_workers: int = 8,
+                 endpoint_url: Optional[str] = None):
+        super().__init__(max_workers)
+        # A single boto3 client is thread-safe and pools its HTTP connections
+        # (max_pool_connections is sized to STORAGE_POOL_WORKERS in config.py).
+        self.client = client
+        self.bucket = bucket
+        self.region = region
+        self.endpoint_url = endpoint_url.rstrip("/") if endpoint_url else None
+        self._transfer_config = None
+
+    def new_key(self, basename: str, ext: str) -> str:
+        return f"{s3_folder_for(ext)}/{super().new_key(basename, ext)}"
+
+    def content_key(self, digest: str, ext: str) -> str:
+        return f"{s3_folder_for(ext)}/{super().content_key(digest, ext)}"
+
+    def url_for(self, key: str) -> str:
+        if self.endpoint_url:
+            # S3-compatible stand-ins (MinIO, LocalStack) use path-style URLs.
+            return f"{self.endpoint_url}/{self.bucket}/{key}"
+        return f"https://{self.bucket}.s3.{self.region}.amazonaws.com/{key}"
+
+    def metadata(self, key: str) -> dict:
+        return {"resource_type": "raw"}
+
+    def _get_transfer_config(self):
+        if self._transfer_config is None:
+            from boto3.s3.transfer import TransferConfig
+            # 5MB is the smallest part S3 accepts; a 10MB upload goes up as two parts.
+            self._transfer_config = TransferConfig(
+                multipart_threshold=5 * 1024 * 1024,
+                multipart_chunksize=5 * 1024 * 1024,
+                max_concurrency=2,
+            )
+        return self._transfer_config
+
+    async def put_stream(self, key, body, content_type=None, content_disposition=None) -> str:
+        extra = {}
+        if content_type:
+            extra["ContentType"] = content_type
+        if content_disposition:
+            extra["ContentDisposition"] = content_disposition
+        if isinstance(body, (bytes, bytearray)):
+            await self._run(self.client.put_object, Bucket=self.bucket, Key=key, Body=bytes(body), **extra)
+        else:
+            body.seek(0)
+            # upload_fileobj switches to a multipart upload above the threshold and
+            # reads the file part by part.
+            await self._run(
+                self.client.upload_fileobj, body, self.bucket, key,
+                ExtraArgs=extra, Config=self._get_transfer_config(),
+            )
+        return self.url_for(key)
+
+    async def get_stream(self, key, chunk_size=CHUNK_SIZE):
+        obj = await self._run(self.client.get_object, Bucket=self.bucket, Key=key)
+        stream = obj["Body"]
+        try:
+            while True:
+                chunk = await self._run(stream.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            stream.close()
+
+    async def delete_many(self, keys) -> int:
+        keys = list(dict.fromkeys(k for k in keys if k))
+        deleted = 0
+        for i in range(0, len(keys), S3_DELETE_BATCH):
+            batch = keys[i:i + S3_DELETE_BATCH]
+            result = await self._run(
+                self.client.delete_objects,
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True},
+            )
+            errors = result.get("Errors") or []
+            for err in errors:
+                logger.warning(f"S3 delete failed for {err.get('Key')}: {err.get('Code')} {err.get('Message')}")
+            deleted += len(batch) - len(errors)
+        return deleted
+
+    async def exists(self, key) -> bool:
+        return await self.head(key) is not None
+
+    async def head(self, key: str) -> Optional[dict]:
+        """{"size", "content_type"} of an object, or None when it does not exist."""
+        from botocore.exceptions import ClientError
+        try:
+            meta = await self._run(self.client.head_object, Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return {"size": meta.get("ContentLength", 0), "content_type": meta.get("ContentType")}
+
+    async def read_range(self, key: str, start: int, length: int) -> bytes:
+        obj = await self._run(
+            self.client.get_object, Bucket=self.bucket, Key=key, Range=f"bytes={start}-{start + length - 1}"
+        )
+        try:
+            return await self._run(obj["Body"].read)
+        finally:
+            obj["Body"].close()
+
+    def presign_upload(self, key: str, content_type: str, max_size: int, expires_in: int,
+                       content_disposition: Optional[str] = None) -> dict:
+        """Presigned POST the browser sends the file to directly. S3 itself enforces the
+        size range and the content type, so an oversized or relabelled body is rejected
+        before it is stored."""
+        fields = {"Content-Type": content_type}
+        conditions = [{"Content-Type": content_type}, ["content-length-range", 1, max_size]]
+        if content_disposition:
+            fields["Content-Disposition"] = content_disposition
+            conditions.append({"Content-Disposition": content_disposition})
+        # Signing is local (no request to S3), so it does not need the thread pool.
+        post = self.client.generate_presigned_post(
+            Bucket=self.bucket, Key=key, Fields=fields, Conditions=conditions, ExpiresIn=expires_in,
+        )
+        return {"method": "POST", "url": post["url"], "fields": post["fields"]}
+
+
+# ---------------------------------------------------------------------------
+# Cloudinary
+# ---------------------------------------------------------------------------
+
+CLOUDINARY_DELETE_BATCH = 100  # Admin API delete_resources limit
+
+
+def cloudinary_resource_type(key: str) -> str:
+    ext = Path(key).suffix.lower().lstrip(".")
+    if ext in {"jpg", "jpeg", "png", "gif", "webp", "bmp", "svg"}:
+        return "image"
+    if ext in {"mp4", "avi", "mov", "mkv", "webm"}:
+        return "video"
+    return "raw"
+
+
+class CloudinaryStorage(StorageBackend):
+    name = "cloudinary"
+    renders_derivatives = True
+    overwritable = False
+
+    def new_key(self, basename: str, ext: str) -> str:
+        return f"educando/uploads/{super().new_key(basename, ext)}"
+
+    def content_key(self, digest: str, ext: str) -> str:
+        return f"educando/uploads/{super().content_key(digest, ext)}"
+
+    def url_for(self, key: str) -> str:
+        from cloudinary.utils import cloudinary_url
+        return cloudinary_url(key, resource_type=cloudinary_resource_type(key), secure=True)[0]
+
+    def derivative_url(self, key: str, derivative_key: str, size: str, width: Optional[int]) -> str:
+        import cloudinary
+        options = {"secure": True, "format": "webp", "quality": "auto"}
+        if width:
+            options.update(width=width, crop="limit")
+        return cloudinary.CloudinaryImage(key).build_url(**options)
+
+    def metadata(self, key: str) -> dict:
+        return {"resource_type": cloudinary_resource_type(key)}
+
+    async def put_stream(self, key, body, content_type=None, content_disposition=None) -> str:
+        import io
+        import cloudinary.uploader
+        if isinstance(body, (bytes, bytearray)):
+            body = io.BytesIO(body)
+        else:
+            body.seek(0)
+        result = await self._run(
+            cloudinary.uploader.upload, body,
+            public_id=key, resource_type=cloudinary_resource_type(key), overwrite=False,
+        )
+        return result["secure_url"]
+
+    async def get_stream(self, key, chunk_size=CHUNK_SIZE):
+        import urllib.request
+        response = await self._run(urllib.request.urlopen, self.url_for(key), timeout=30)
+        try:
+            while True:
+                chunk = await self._run(response.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            response.close()
+
+    async def delete_many(self, keys) -> int:
+        import cloudinary.api
+        by_type: dict = {}
+        for key in dict.fromkeys(k for k in keys if k):
+            by_type.setdefault(cloudinary_resource_type(key), []).append(key)
+        deleted = 0
+        for resource_type, type_keys in by_type.items():
+            for i in range(0, len(type_keys), CLOUDINARY_DELETE_BATCH):
+                batch = type_keys[i:i + CLOUDINARY_DELETE_BATCH]
+                result = await self._run(cloudinary.api.delete_resources, batch, resource_type=resource_type)
+                deleted += sum(1 for v in (result.get("deleted") or {}).values() if v == "deleted")
+        return deleted
+
+    async def exists(self, key) -> bool:
+        import cloudinary.api
+        from cloudinary.exceptions import NotFound
+        try:
+            await self._run(cloudinary.api.resource, key, resource_type=cloudinary_resource_type(key))
+            return True
+        except NotFound:
+            return False
+
+
+# ---------------------------------------------------------------------------
+# Registry
+# ---------------------------------------------------------------------------
+
+_backends: dict = {}
+
+
+def get_backend(name: str) -> Optional[StorageBackend]:
+    """Backend for a file entry's `storage` value, or None when it is not configured
+    in this deployment (e.g. an S3 file after S3 credentials were removed)."""
+    if name not in _backends:
+        from config import (
+            USE_S3, USE_CLOUDINARY, UPLOAD_DIR, STORAGE_POOL_WORKERS,
+            AWS_S3_BUCKET_NAME, AWS_S3_REGION, AWS_S3_ENDPOINT_URL, s3_client,
+        )
+        if name == "local":
+            _backends[name] = LocalStorage(UPLOAD_DIR, STORAGE_POOL_WORKERS)
+        elif name == "s3" and USE_S3:
+            _backends[name] = S3Storage(
+                s3_client, AWS_S3_BUCKET_NAME, AWS_S3_REGION, STORAGE_POOL_WORKERS, AWS_S3_ENDPOINT_URL
+            )
+        elif name == "cloudinary" and USE_CLOUDINARY:
+            _backends[name] = CloudinaryStorage(STORAGE_POOL_WORKERS)
+        else:
+            return None
+    return _backends[name]
+
+
+def set_backend(name: str, backend: Optional[StorageBackend]):
+    """Replace (or with None, reset) a registered backend; used by tests and benchmarks."""
+    if backend is None:
+        _backends.pop(name, None)
+    else:
+        _backends[name] = backend
+
+
+def default_backend_name() -> str:
+    """Where new uploads go: S3 first, then Cloudinary, then local disk."""
+    from config import USE_S3, USE_CLOUDINARY
+    if USE_S3:
+        return "s3"
+    if USE_CLOUDINARY:
+        return "cloudinary"
+    return "local"
+
+
+def get_default_backend() -> StorageBackend:
+    return get_backend(default_backend_name())
+
+
+def storage_name_for_file(file_entry: dict) -> str:
+    """Backend name for a stored file entry. Old Cloudinary entries carry no `storage`
+    field but always have an educando/ public_id."""
+    storage = file_entry.get("storage")
+    if storage:
+        return storage
+    stored_name = file_entry.get("stored_name") or ""
+    return "cloudinary" if stored_name.startswith("educando/") else "local"
+
+
+def file_entry_keys(file_entry: dict) -> list:
+    """The stored_name of a file entry plus those of its stored derivatives."""
+    keys = [file_entry.get("stored_name")]
+    for d in (file_entry.get("derivatives") or {}).values():
+        if isinstance(d, dict):
+            keys.append(d.get("stored_name"))
+    return [k for k in keys if k]
+
+
+async def delete_file_entries(file_entries: Iterable[dict], attempts: int = 1) -> dict:
+    """Delete every stored object referenced by the given file entries, grouped per
+    backend and issued as batched deletes, retrying a failed batch up to `attempts`
+    times with exponential backoff.
+
+    Returns {"deleted": {backend_name: count}, "failed": [keys not deleted]}.
+    """
+    keys_by_backend: dict = {}
+    for entry in file_entries:
+        if not isinstance(entry, dict):
+            continue
+        keys_by_backend.setdefault(storage_name_for_file(entry), []).extend(file_entry_keys(entry))
+    deleted: dict = {}
+    failed: list = []
+    for name, keys in keys_by_backend.items():
+        backend = get_backend(name)
+        if backend is None:
+            logger.warning(f"Storage backend '{name}' is not configured; {len(keys)} objects not deleted")
+            failed.extend(keys)
+            continue
+        for attempt in range(attempts):
+            try:
+                deleted[name] = await backend.delete_many(keys)
+                break
+            except Exception as e:
+                logger.warning(f"Failed to delete {len(keys)} objects from {name} (attempt {attempt + 1}/{attempts}): {e}")
+                if attempt + 1 < attempts:
+                    await asyncio.sleep(2 ** attempt)
+        else:
+            failed.extend(keys)
+    return {"deleted": deleted, "failed": failed}
+
+
+def close_backends():
+    for backend in _backends.values():
+        backend.close()
+    _backends.clear()
@@ -0,0 +1,80 @@
+import zipfile
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+# Output is handed to the response once this much compressed data has accumulated.
+FLUSH_SIZE = 256 * 1024
+
+# Formats that are already compressed (PDF, images, OOXML which is itself a ZIP) are
+# stored as-is; deflating them costs CPU for nothing.
+_DEFLATE_EXTENSIONS = {"txt", "csv", "doc", "xls", "ppt"}
+
+
+class _Sink:
+    """Write-only file object collecting ZIP output. It has no seek/tell, so zipfile
+    writes local headers with data descriptors and never goes back to patch them."""
+
+    def __init__(self):
+        self._chunks: list = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+def compress_type_for(name: str) -> int:
+    ext = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    return zipfile.ZIP_DEFLATED if ext in _DEFLATE_EXTENSIONS else zipfile.ZIP_STORED
+
+
+class ZipStreamWriter:
+    """Build a ZIP archive incrementally; every method returns or yields the bytes that
+    are ready to send, so only the entry being written is ever held in memory."""
+
+    def __init__(self):
+        self._sink = _Sink()
+        self._zip = zipfile.ZipFile(self._sink, "w")
+
+    def _info(self, name: str, date_time: Optional[datetime]) -> zipfile.ZipInfo:
+        dt = date_time or datetime.now()
+        info = zipfile.ZipInfo(name, (max(dt.year, 1980), dt.month, dt.day, dt.hour, dt.minute, dt.second))
+        info.compress_type = compress_type_for(name)
+        info.external_attr = 0o644 << 16
+        return info
+
+    async def add_stream(self, name: str, chunks: AsyncIterator[bytes],
+                         date_time: Optional[datetime] = None) -> AsyncIterator[bytes]:
+        """Add an entry from an async byte source. If the source fails the entry is
+        closed where it stopped (so the archive stays valid) and the error propagates."""
+        dest = self._zip.open(self._info(name, date_time), "w")
+        try:
+            async for chunk in chunks:
+                # Deflate runs off the event loop.
+                await run_in_threadpool(dest.write, chunk)
+                if self._sink.size >= FLUSH_SIZE:
+                    yield self._sink.drain()
+        finally:
+            dest.close()
+        yield self._sink.drain()
+
+    def add_bytes(self, name: str, data: bytes, date_time: Optional[datetime] = None) -> bytes:
+        self._zip.writestr(self._info(name, date_time), data)
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        """Write the central directory and return the final bytes."""
+        self._zip.close()
+        return self._sink.drain()
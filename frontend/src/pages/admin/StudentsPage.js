@@ -178,7 +178,7 @@ export default function StudentsPage() {
 
   const loadFullCourses = async () => {
     try {
-      const res = await api.get('/courses');
+      const res = await api.get('/courses?fields=summary&limit=500');
       setFullCourses(res.data);
     } catch (err) {
       toast.error('Error cargando grupos');
@@ -356,23 +356,22 @@ export default function StudentsPage() {
       // Update course enrollments — handle failures independently so a created student
       // is never silently lost if a particular enrollment request fails.
       const enrollmentErrors = [];
+      const currentCourseIds = editing ? (editing.course_ids || []) : [];
       for (const course of fullCourses) {
-        const isEnrolled = (course.student_ids || []).includes(studentId);
+        const isEnrolled = currentCourseIds.includes(course.id);
         const shouldBeEnrolled = (form.course_ids || []).includes(course.id);
 
         if (isEnrolled && !shouldBeEnrolled) {
           // Remove from course
-          const newIds = (course.student_ids || []).filter(id => id !== studentId);
           try {
-            await api.put(`/courses/${course.id}`, { student_ids: newIds });
+            await api.put(`/courses/${course.id}`, { remove_student_ids: [studentId] });
           } catch (enrollErr) {
             enrollmentErrors.push(`Error al desinscribir del grupo "${course.name}": ${enrollErr.response?.data?.detail || enrollErr.message}`);
           }
         } else if (!isEnrolled && shouldBeEnrolled) {
           // Add to course
-          const newIds = [...(course.student_ids || []), studentId];
           try {
-            await api.put(`/courses/${course.id}`, { student_ids: newIds });
+            await api.put(`/courses/${course.id}`, { add_student_ids: [studentId] });
           } catch (enrollErr) {
             enrollmentErrors.push(`Inscripción en grupo "${course.name}" fallida: ${enrollErr.response?.data?.detail || enrollErr.message}`);
           }
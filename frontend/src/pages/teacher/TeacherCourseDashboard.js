@@ -39,7 +39,7 @@ export default function TeacherCourseDashboard() {
   if (loading) return <DashboardLayout courseId={courseId}><div className="flex justify-center py-20"><Loader2 className="h-8 w-8 animate-spin text-primary" /></div></DashboardLayout>;
 
   const stats = [
-    { label: 'Estudiantes', value: course?.student_ids?.length || 0, icon: Users, color: 'text-primary' },
+    { label: 'Estudiantes', value: course?.student_count || 0, icon: Users, color: 'text-primary' },
     { label: 'Actividades', value: activities.length, icon: FileText, color: 'text-success' },
     { label: 'Videos', value: videos.length, icon: Video, color: 'text-warning' },
   ];
@@ -235,7 +235,7 @@ export default function TeacherCourseSelector() {
                       <div className="flex gap-2 flex-wrap">
                         <Badge variant="secondary">
                           <Users className="h-3 w-3 mr-1" />
-                          {course.student_ids?.length || 0} estudiantes
+                          {course.student_count || 0} estudiantes
                         </Badge>
                         <Badge variant="outline">{course.year}</Badge>
                       </div>
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Benchmark del middleware de cabeceras de seguridad.
+
+Compara, llamando a la aplicación ASGI directamente (sin red ni cliente HTTP), entre:
+  - "base_http": la versión anterior basada en BaseHTTPMiddleware (copiada abajo);
+  - "asgi": SecurityHeadersMiddleware de app.py, ASGI puro con cabeceras precalculadas.
+
+Mide peticiones por segundo contra un /api/health sin base de datos y, para una
+exportación grande con StreamingResponse, el tiempo hasta el primer byte y el total.
+
+Uso:
+    python scripts/bench_middleware.py [--requests 20000] [--export-mb 50]
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.responses import StreamingResponse  # noqa: E402
+from starlette.middleware.base import BaseHTTPMiddleware  # noqa: E402
+
+from app import SecurityHeadersMiddleware  # noqa: E402
+
+EXPORT_CHUNK = 64 * 1024
+
+
+class BaseHTTPSecurityHeadersMiddleware(BaseHTTPMiddleware):
+    """La implementación anterior, tal como estaba en app.py."""
+
+    async def dispatch(self, request, call_next):
+        response = await call_next(request)
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        response.headers["X-Frame-Options"] = "DENY"
+        response.headers["X-XSS-Protection"] = "1; mode=block"
+        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+        response.headers["Permissions-Policy"] = "camera=(), microphone=(), geolocation=()"
+        content_type = response.headers.get("content-type", "")
+        if "text/html" in content_type:
+            csp_directives = [
+                "default-src 'self'",
+                "script-src 'self'",
+                "style-src 'self' 'unsafe-inline'",
+                "img-src 'self' data: blob: https://*.amazonaws.com",
+                "font-src 'self' data:",
+                "connect-src 'self' https://*.onrender.com",
+                "frame-ancestors 'none'",
+                "base-uri 'self'",
+                "form-action 'self'",
+            ]
+            response.headers["Content-Security-Policy"] = "; ".join(csp_directives)
+        if request.url.scheme == "https":
+            response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
+        if request.url.path.startswith("/api/auth/") and "cache-control" not in response.headers:
+            response.headers["Cache-Control"] = "no-store"
+        return response
+
+
+def build_app(middleware, export_size: int) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(middleware)
+
+    @app.get("/api/health")
+    async def health():
+        return {"status": "healthy"}
+
+    @app.get("/export")
+    async def export():
+        block = b"x" * EXPORT_CHUNK
+
+        async def chunks():
+            sent = 0
+            while sent < export_size:
+                yield block
+                sent += len(block)
+        return StreamingResponse(chunks(), media_type="text/csv")
+
+    return app
+
+
+def scope_for(path: str) -> dict:
+    return {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "",
+            "query_string": b"", "headers": [(b"host", b"bench")], "server": ("bench", 80),
+            "client": ("127.0.0.1", 1)}
+
+
+def make_receive():
+    """Entrega el cuerpo vacío una vez y luego espera, como un servidor sin desconexión."""
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.Event().wait()
+
+    return receive
+
+
+async def bench_health(app, requests: int) -> float:
+    scope = scope_for("/api/health")
+
+    async def send(message):
+        pass
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), make_receive(), send)
+    return requests / (time.perf_counter() - started)
+
+
+async def bench_export(app) -> tuple:
+    started = time.perf_counter()
+    first_byte = None
+
+    async def send(message):
+        nonlocal first_byte
+        if message["type"] == "http.response.body" and message.get("body") and first_byte is None:
+            first_byte = time.perf_counter() - started
+
+    await app(scope_for("/export"), make_receive(), send)
+    return first_byte, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--export-mb", type=float, default=50)
+    args = parser.parse_args()
+    export_size = int(args.export_mb * 1024 * 1024)
+
+    print(f"/api/health x {args.requests} peticiones; exportación de {args.export_mb}MB en bloques de 64KB")
+    for name, middleware in (("base_http", BaseHTTPSecurityHeadersMiddleware), ("asgi", SecurityHeadersMiddleware)):
+        app = build_app(middleware, export_size)
+        rps = asyncio.run(bench_health(app, args.requests))
+        first_byte, total = asyncio.run(bench_export(app))
+        print(f"  {name:<10} health={rps:9.0f} req/s  export: primer byte={first_byte * 1000:7.2f} ms "
+              f"total={total:6.2f} s ({args.export_mb / total:7.1f} MB/s)")
+
+
+if __name__ == "__main__":
+    main()
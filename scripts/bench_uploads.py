@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark de memoria para la subida de archivos.
+
+Compara el pico de memoria de Python (tracemalloc) con N subidas concurrentes de
+un archivo no-imagen de M MB entre:
+  - "buffered": el pipeline anterior (lee en bloques de 64KB, acumula en una lista y
+    hace b"".join antes de guardar);
+  - "streaming": el pipeline actual de routes/uploads.py (valida la cabecera y entrega
+    el archivo temporal de Starlette a LocalStorage.put_stream, que lo copia por bloques).
+
+Uso:
+    python scripts/bench_uploads.py [--uploads 50] [--size-mb 10]
+"""
+
+import argparse
+import asyncio
+import functools
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from starlette.datastructures import UploadFile  # noqa: E402
+
+from routes.uploads import _HEADER_BYTES, _validate_file_content  # noqa: E402
+from utils.storage import CHUNK_SIZE as _CHUNK_SIZE, LocalStorage  # noqa: E402
+
+# Mismo umbral que usa Starlette al parsear multipart: hasta 1MB en memoria, luego disco.
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+def make_upload(size: int) -> UploadFile:
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    block = b"%PDF" + os.urandom(_CHUNK_SIZE - 4)
+    written = 0
+    while written < size:
+        spool.write(block[: min(len(block), size - written)])
+        written += min(len(block), size - written)
+    spool.seek(0)
+    return UploadFile(file=spool, size=size, filename="bench.pdf")
+
+
+async def buffered(upload: UploadFile, dest: Path) -> int:
+    chunks = []
+    while True:
+        chunk = await upload.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    content = b"".join(chunks)
+    assert _validate_file_content(content, "pdf")
+    dest.write_bytes(content)
+    return len(content)
+
+
+@functools.lru_cache(maxsize=None)
+def _local_storage(root: Path) -> LocalStorage:
+    return LocalStorage(root)
+
+
+async def streaming(upload: UploadFile, dest: Path) -> int:
+    header = await upload.read(_HEADER_BYTES)
+    await upload.seek(0)
+    assert _validate_file_content(header, "pdf")
+    await _local_storage(dest.parent).put_stream(dest.name, upload.file)
+    return upload.size
+
+
+async def run(mode, uploads: int, size: int, out_dir: Path):
+    files = [make_upload(size) for _ in range(uploads)]
+    tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(mode(f, out_dir / f"{mode.__name__}_{i}.pdf") for i, f in enumerate(files)))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for f in files:
+        f.file.close()
+    for p in out_dir.iterdir():
+        p.unlink()
+    return peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=50)
+    parser.add_argument("--size-mb", type=float, default=10)
+    args = parser.parse_args()
+    size = int(args.size_mb * 1024 * 1024)
+
+    print(f"{args.uploads} subidas concurrentes de {args.size_mb}MB")
+    with tempfile.TemporaryDirectory() as tmp:
+        out_dir = Path(tmp)
+        for mode in (buffered, streaming):
+            peak, elapsed = asyncio.run(run(mode, args.uploads, size, out_dir))
+            print(f"  {mode.__name__:<10} pico={peak / 1024 / 1024:8.1f} MB  tiempo={elapsed:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,12 @@ Tests for backend functionality: password hashing, data validation,
 user creation, login, and recovery endpoints.
 """
 import hashlib
+import json
+import logging
 import os
 import re
 import sys
+import types
 
 import pytest
 
@@ -1038,6 +1041,352 @@ def client(test_app):
     return AsyncClient(transport=transport, base_url="http://test")
 
 
+# ---------------------------------------------------------------------------
+# In-memory stand-in for the Motor database, shared by the unit tests below
+# ---------------------------------------------------------------------------
+
+_MISSING = object()
+
+
+def _get_path(doc, path):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+class _FakeResult:
+    def __init__(self, matched=0, modified=None, deleted=0, upserted_id=None, upserted=0, inserted_id=None):
+        self.matched_count = matched
+        self.modified_count = matched if modified is None else modified
+        self.deleted_count = deleted
+        self.upserted_id = upserted_id
+        self.upserted_count = upserted
+        self.inserted_id = inserted_id
+
+
+class FakeCursor:
+    """find()/aggregate()/list_indexes() cursor: sort, skip, limit, to_list, async for."""
+
+    def __init__(self, docs, collection=None):
+        self._docs = docs
+        self._collection = collection
+        self._sort = []
+        self._skip = 0
+        self._limit = None
+
+    def sort(self, key, direction=1):
+        self._sort = list(key) if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        if self._collection is not None:
+            self._collection.find_limits.append(n)
+        return self
+
+    def _results(self):
+        docs = list(self._docs)
+        for key, direction in reversed(self._sort):
+            docs.sort(key=lambda d: (_get_path(d, key) is _MISSING, _get_path(d, key)), reverse=direction < 0)
+        docs = docs[self._skip:]
+        return docs[:self._limit] if self._limit else docs
+
+    async def to_list(self, length=None):
+        docs = self._results()
+        return docs[:length] if length else docs
+
+    def __aiter__(self):
+        async def _gen():
+            for doc in self._results():
+                yield doc
+        return _gen()
+
+
+class FakeCollection:
+    """Enough of a Motor collection for the helpers under test: query operators
+    ($in, $nin, $ne, $exists, $gt/$gte/$lt/$lte, $or, $and, dotted paths), the
+    $inc/$set/$max/$setOnInsert/$unset/$push update operators, upserts, bulk_write,
+    find_one_and_*, distinct and index calls. Projections are ignored; _id is the only
+    unique key enforced."""
+
+    def __init__(self, docs=None):
+        self.docs = []
+        self._next_id = 0
+        self.find_limits = []
+        self.aggregate_result = []
+        self.indexes = {}
+        self.calls = []
+        for doc in docs or []:
+            self._insert(doc)
+
+    def _insert(self, doc):
+        from pymongo.errors import DuplicateKeyError
+        doc = dict(doc)
+        if "_id" not in doc:
+            doc["_id"] = self._next_id
+            self._next_id += 1
+        elif any(d["_id"] == doc["_id"] for d in self.docs):
+            raise DuplicateKeyError(f"duplicate _id {doc['_id']!r}")
+        self.docs.append(doc)
+        return doc
+
+    @classmethod
+    def _match_value(cls, value, cond):
+        if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+            present = value is not _MISSING
+            for op, arg in cond.items():
+                if op == "$exists":
+                    if present != bool(arg):
+                        return False
+                elif op == "$in":
+                    if isinstance(value, list):
+                        if not any(v in arg for v in value):
+                            return False
+                    elif (value if present else None) not in arg:
+                        return False
+                elif op == "$nin":
+                    if (value if present else None) in arg:
+                        return False
+                elif op == "$ne":
+                    if (value if present else None) == arg:
+                        return False
+                elif op in ("$gt", "$gte", "$lt", "$lte"):
+                    if not present or value is None:
+                        return False
+                    if op == "$gt" and not value > arg or op == "$gte" and not value >= arg:
+                        return False
+                    if op == "$lt" and not value < arg or op == "$lte" and not value <= arg:
+                        return False
+                else:
+                    raise NotImplementedError(op)
+            return True
+        if isinstance(value, list) and not isinstance(cond, list):
+            return cond in value  # an array field matches any of its elements
+        return (value if value is not _MISSING else None) == cond
+
+    @classmethod
+    def _match(cls, doc, query):
+        for k, v in (query or {}).items():
+            if k == "$or":
+                if not any(cls._match(doc, q) for q in v):
+                    return False
+            elif k == "$and":
+                if not all(cls._match(doc, q) for q in v):
+                    return False
+            elif not cls._match_value(_get_path(doc, k), v):
+                return False
+        return True
+
+    @staticmethod
+    def _target(doc, path):
+        parent, _, key = path.rpartition(".")
+        target = doc
+        for part in parent.split(".") if parent else []:
+            target = target.setdefault(part, {})
+        return target, key
+
+    def _apply(self, doc, update, inserting=False):
+        if not any(k.startswith("$") for k in update):
+            _id = doc.get("_id")
+            doc.clear()
+            doc.update(update, _id=_id)
+            return
+        if inserting:
+            for path, v in update.get("$setOnInsert", {}).items():
+                target, key = self._target(doc, path)
+                target[key] = v
+        for path, v in update.get("$set", {}).items():
+            target, key = self._target(doc, path)
+            target[key] = v
+        for path, v in update.get("$inc", {}).items():
+            target, key = self._target(doc, path)
+            target[key] = target.get(key, 0) + v
+        for path, v in update.get("$max", {}).items():
+            target, key = self._target(doc, path)
+            target[key] = max(target.get(key, v), v)
+        for path in update.get("$unset", {}):
+            target, key = self._target(doc, path)
+            target.pop(key, None)
+        for path, v in update.get("$push", {}).items():
+            target, key = self._target(doc, path)
+            target.setdefault(key, []).extend(v["$each"] if isinstance(v, dict) and "$each" in v else [v])
+        for path, v in update.get("$pull", {}).items():
+            target, key = self._target(doc, path)
+            if key in target:
+                target[key] = [x for x in target[key] if not self._match_value(x, v)]
+
+    def _upsert(self, query, update):
+        seed = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+        doc = self._insert(seed)
+        self._apply(doc, update, inserting=True)
+        return doc
+
+    def _matching(self, query):
+        return [d for d in self.docs if self._match(d, query)]
+
+    def find(self, query=None, projection=None):
+        return FakeCursor([dict(d) for d in self._matching(query)], self)
+
+    async def find_one(self, query=None, projection=None, sort=None):
+        found = await self.find(query).sort(sort or []).to_list(1) if sort else self._matching(query)[:1]
+        return dict(found[0]) if found else None
+
+    async def count_documents(self, query, limit=None):
+        count = len(self._matching(query))
+        return min(count, limit) if limit else count
+
+    async def distinct(self, field, query=None):
+        values = []
+        for doc in self._matching(query):
+            value = _get_path(doc, field)
+            for v in value if isinstance(value, list) else [value]:
+                if v is not _MISSING and v not in values:
+                    values.append(v)
+        return values
+
+    async def insert_one(self, doc):
+        return _FakeResult(inserted_id=self._insert(doc)["_id"])
+
+    async def insert_many(self, docs, ordered=True):
+        for doc in docs:
+            self._insert(doc)
+
+    async def update_one(self, query, update, upsert=False):
+        found = self._matching(query)[:1]
+        if found:
+            self._apply(found[0], update)
+            return _FakeResult(1)
+        if upsert:
+            return _FakeResult(0, upserted_id=self._upsert(query, update)["_id"], upserted=1)
+        return _FakeResult(0)
+
+    async def update_many(self, query, update, upsert=False):
+        found = self._matching(query)
+        for doc in found:
+            self._apply(doc, update)
+        if not found and upsert:
+            return _FakeResult(0, upserted_id=self._upsert(query, update)["_id"], upserted=1)
+        return _FakeResult(len(found))
+
+    async def replace_one(self, query, replacement, upsert=False):
+        return await self.update_one(query, dict(replacement), upsert=upsert)
+
+    async def delete_one(self, query):
+        found = self._matching(query)[:1]
+        for doc in found:
+            self.docs.remove(doc)
+        return _FakeResult(deleted=len(found))
+
+    async def delete_many(self, query):
+        found = self._matching(query)
+        self.docs = [d for d in self.docs if d not in found]
+        return _FakeResult(deleted=len(found))
+
+    async def find_one_and_update(self, query, update, upsert=False, projection=None,
+                                  return_document=False, sort=None):
+        found = self._matching(query)[:1]
+        if found:
+            before = dict(found[0])
+            self._apply(found[0], update)
+            return dict(found[0]) if return_document else before
+        if upsert:
+            doc = self._upsert(query, update)
+            return dict(doc) if return_document else None
+        return None
+
+    async def find_one_and_delete(self, query, projection=None, sort=None):
+        found = self._matching(query)[:1]
+        if not found:
+            return None
+        self.docs.remove(found[0])
+        return dict(found[0])
+
+    async def bulk_write(self, ops, ordered=True):
+        matched = upserted = 0
+        for op in ops:
+            name = type(op).__name__
+            if name == "InsertOne":
+                self._insert(op._doc)
+                continue
+            if name in ("DeleteOne", "DeleteMany"):
+                await (self.delete_one if name == "DeleteOne" else self.delete_many)(op._filter)
+                continue
+            method = self.update_many if name == "UpdateMany" else self.update_one
+            result = await method(op._filter, op._doc, upsert=bool(op._upsert))
+            matched += result.matched_count
+            upserted += result.upserted_count
+        return _FakeResult(matched, upserted=upserted)
+
+    def aggregate(self, pipeline):
+        return FakeCursor(list(self.aggregate_result))
+
+    def list_indexes(self):
+        return FakeCursor([dict(ix) for ix in self.indexes.values()])
+
+    async def create_indexes(self, models):
+        self.calls.append(("create_indexes", [m.document["name"] for m in models]))
+        for m in models:
+            self.indexes[m.document["name"]] = dict(m.document)
+
+    async def create_index(self, keys, **options):
+        self.calls.append(("create_index", options["name"]))
+        self.indexes[options["name"]] = {"key": dict(keys), **options}
+
+    async def drop_index(self, name):
+        self.calls.append(("drop_index", name))
+        self.indexes.pop(name, None)
+
+
+class FakeDB:
+    """Database of FakeCollections created on first access (db.name or db["name"])."""
+
+    def __init__(self, monkeypatch=None):
+        self._collections = {}
+        self._monkeypatch = monkeypatch
+
+    def install(self, *modules, **collections):
+        """Load the given collections and point each module's `db` at this database."""
+        for name, docs in collections.items():
+            self._collections[name] = FakeCollection(docs)
+        for module in modules:
+            self._monkeypatch.setattr(module, "db", self)
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection()
+        return self._collections[name]
+
+    async def command(self, *args, **kwargs):
+        return {"ok": 1}
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """A fresh FakeDB; `fake_db.install(module, ..., name=[docs])` wires it in."""
+    return FakeDB(monkeypatch)
+
+
+@pytest.fixture(autouse=True)
+def migrations_applied(monkeypatch):
+    """Code that checks migrations.runner.is_applied sees every migration as applied;
+    tests of the pre-migration fallbacks reset runner._applied_seen themselves."""
+    import migrations.runner as runner
+    monkeypatch.setattr(runner, "_applied_seen", {m.number for m in runner.MIGRATIONS})
+
+
 class TestHealthEndpoint:
     """Test the health check endpoint."""
 
@@ -1257,46 +1606,22 @@ class TestCreateSeedUsersEnvVar:
 
 
 # ---------------------------------------------------------------------------
-# Unit tests for GET /users estado filter — treat null/missing as 'activo'
+# Unit tests for GET /users estado filter — students always carry estado, so the
+# filter is a plain equality match; legacy null/missing values are backfilled.
 # ---------------------------------------------------------------------------
 
 class TestGetUsersEstadoFilter:
     """Tests for the estado filter logic in get_users endpoint."""
 
     def _build_estado_query(self, estado):
-        """Mirror the estado filter logic from server.py get_users."""
+        """Mirror the estado filter logic from routes/users.py get_users."""
         query = {}
         if estado:
-            if estado == 'activo':
-                query["$or"] = [
-                    {"estado": "activo"},
-                    {"estado": None},
-                    {"estado": {"$exists": False}}
-                ]
-            else:
-                query["estado"] = estado
+            query["estado"] = estado
         return query
 
-    def _matches_activo_query(self, user_estado):
-        """Simulate MongoDB $or matching for activo query."""
-        return user_estado in ("activo", None) or user_estado == "__missing__"
-
-    def test_activo_filter_matches_activo(self):
-        assert self._matches_activo_query("activo") is True
-
-    def test_activo_filter_matches_null_estado(self):
-        """Users with null estado should appear in activo filter."""
-        assert self._matches_activo_query(None) is True
-
-    def test_activo_filter_matches_missing_estado(self):
-        """Users without estado field should appear in activo filter."""
-        assert self._matches_activo_query("__missing__") is True
-
-    def test_activo_filter_does_not_match_retirado(self):
-        assert self._matches_activo_query("retirado") is False
-
-    def test_activo_filter_does_not_match_egresado(self):
-        assert self._matches_activo_query("egresado") is False
+    def test_activo_filter_is_equality(self):
+        assert self._build_estado_query("activo") == {"estado": "activo"}
 
     def test_retirado_filter_builds_simple_query(self):
         query = self._build_estado_query("retirado")
@@ -1307,6 +1632,60 @@ class TestGetUsersEstadoFilter:
         query = self._build_estado_query(None)
         assert query == {}
 
+    def test_missing_estado_becomes_activo(self):
+        from utils.helpers import with_student_status
+        student = with_student_status({"id": "s1", "program_ids": ["p1"]})
+        assert student["estado"] == "activo"
+        assert student["program_statuses"] == {"p1": "activo"}
+
+    def test_null_estado_becomes_activo_without_programs(self):
+        from utils.helpers import with_student_status
+        student = with_student_status({"id": "s1", "estado": None, "program_statuses": None})
+        assert student["estado"] == "activo"
+        assert student["program_statuses"] == {}
+
+    def test_existing_values_are_kept(self):
+        from utils.helpers import with_student_status
+        student = with_student_status({"id": "s1", "program_id": "p1", "estado": "egresado"})
+        assert student["program_statuses"] == {"p1": "egresado"}
+        student = with_student_status({"id": "s2", "estado": "activo", "program_statuses": {"p1": "retirado"}})
+        assert student["estado"] == "activo" and student["program_statuses"] == {"p1": "retirado"}
+
+    @pytest.mark.asyncio
+    async def test_backfill_writes_missing_fields(self, fake_db):
+        import utils.helpers as helpers
+        fake_db.install(helpers, users=[
+            {"id": "s1", "role": "estudiante", "program_ids": ["p1"]},
+            {"id": "s2", "role": "estudiante", "estado": "retirado", "program_statuses": {"p1": "retirado"}},
+            {"id": "s3", "role": "estudiante", "estado": None, "program_statuses": {"p1": "egresado"}},
+            {"id": "t1", "role": "profesor"},
+        ])
+        assert await helpers.backfill_student_status(batch_size=1) == 2
+        by_id = {u["id"]: u for u in fake_db.users.docs}
+        assert by_id["s1"]["estado"] == "activo" and by_id["s1"]["program_statuses"] == {"p1": "activo"}
+        assert by_id["s3"]["estado"] == "egresado"
+        assert "estado" not in by_id["t1"]
+        assert await helpers.backfill_student_status() == 0
+
+    @pytest.mark.asyncio
+    async def test_activo_keeps_missing_estado_until_migration_applied(self, fake_db, monkeypatch):
+        import migrations.runner as runner
+        import routes.users as users_routes
+        monkeypatch.setattr(runner, "_applied_seen", set())
+        fake_db.install(runner, users_routes, users=[
+            {"id": "s1", "name": "A", "role": "estudiante", "estado": "activo", "program_id": "p1"},
+            {"id": "s2", "name": "B", "role": "estudiante", "program_id": "p1"},
+            {"id": "s3", "name": "C", "role": "estudiante", "estado": "retirado", "program_id": "p1"},
+        ])
+        admin = {"id": "a1", "role": "admin"}
+
+        result = await users_routes.get_users(estado="activo", program_id="p1", user=admin)
+        assert [u["id"] for u in result["users"]] == ["s1", "s2"]
+
+        fake_db.schema_migrations.docs.append({"_id": 4, "name": "student_status"})
+        result = await users_routes.get_users(estado="activo", program_id="p1", user=admin)
+        assert [u["id"] for u in result["users"]] == ["s1"]
+
 
 # ---------------------------------------------------------------------------
 # Unit tests for CoursesPage date validation logic (mirrors frontend JS)
@@ -4317,3 +4696,1947 @@ class TestCompressImage:
             out_bytes, out_name = compress_image(content, fname)
             assert out_bytes == content
             assert out_name == fname
+
+
+# ---------------------------------------------------------------------------
+# Unit tests for the columnar gradebook (format=matrix)
+# ---------------------------------------------------------------------------
+
+class TestGradesMatrix:
+    """Tests for _build_grades_matrix pivoting grades into parallel arrays."""
+
+    @staticmethod
+    async def _cursor(docs):
+        for d in docs:
+            yield d
+
+    @pytest.mark.asyncio
+    async def test_dense_matrix_with_nulls(self):
+        from routes.dashboard import _build_grades_matrix
+        students = [{"id": "s1", "name": "Ana"}, {"id": "s2", "name": "Luis"}]
+        activities = [{"id": "a1", "title": "Taller 1"}, {"id": "a2", "title": "Taller 2"}]
+        grades = [
+            {"student_id": "s1", "activity_id": "a2", "value": 4.5},
+            {"student_id": "s2", "activity_id": "a1", "value": 2.0},
+        ]
+        matrix = await _build_grades_matrix(students, activities, self._cursor(grades))
+        assert matrix["student_ids"] == ["s1", "s2"]
+        assert matrix["student_names"] == ["Ana", "Luis"]
+        assert matrix["activity_titles"] == ["Taller 1", "Taller 2"]
+        assert matrix["values"] == [[None, 4.5], [2.0, None]]
+        assert matrix["recovery_status"] == []
+
+    @pytest.mark.asyncio
+    async def test_unknown_student_or_activity_ignored(self):
+        from routes.dashboard import _build_grades_matrix
+        grades = [
+            {"student_id": "ghost", "activity_id": "a1", "value": 5.0},
+            {"student_id": "s1", "activity_id": "deleted", "value": 5.0},
+        ]
+        matrix = await _build_grades_matrix(
+            [{"id": "s1", "name": "Ana"}], [{"id": "a1", "title": "T"}], self._cursor(grades)
+        )
+        assert matrix["values"] == [[None]]
+
+    @pytest.mark.asyncio
+    async def test_recovery_status_is_sparse(self):
+        from routes.dashboard import _build_grades_matrix
+        grades = [{"student_id": "s1", "activity_id": "a1", "value": None, "recovery_status": "rejected"}]
+        matrix = await _build_grades_matrix(
+            [{"id": "s1", "name": "Ana"}], [{"id": "a1", "title": "Rec"}], self._cursor(grades)
+        )
+        assert matrix["values"] == [[None]]
+        assert matrix["recovery_status"] == [[0, 0, "rejected"]]
+
+
+# ---------------------------------------------------------------------------
+# Unit tests for the per-student dashboard cache and ETag helpers
+# ---------------------------------------------------------------------------
+
+class TestStudentDashboardCache:
+    """Tests for dashboard cache invalidation, release splitting and ETags."""
+
+    def test_bounded_cache_evicts_expired_then_least_recently_used(self, monkeypatch):
+        import cache
+        now = [1000.0]
+        monkeypatch.setattr(cache.time, "time", lambda: now[0])
+        c = cache.TTLCache(ttl_seconds=10, max_entries=3)
+        c.set("old", 0)
+        now[0] += 20
+        c.set("a", 1)
+        c.set("b", 2)
+        c.set("c", 3)  # overflow: the expired entry goes first
+        assert list(c._cache) == ["a", "b", "c"]
+        assert c.get("a") == 1
+        c.set("d", 4)  # nothing expired: the least recently used ("b") goes
+        assert list(c._cache) == ["c", "a", "d"]
+
+    @pytest.mark.asyncio
+    async def test_invalidate_whole_course(self, fake_db):
+        import utils.http_cache as http_cache
+        from cache import student_dashboard_cache, invalidate_student_dashboard
+        fake_db.install(http_cache)
+        before = await http_cache.get_versions("dashboard:c1", "dashboard:c2")
+        student_dashboard_cache.set("c1:s1:", {"v": 1})
+        student_dashboard_cache.set("c1:s2:subj", {"v": 2})
+        student_dashboard_cache.set("c2:s1:", {"v": 3})
+        await invalidate_student_dashboard("c1")
+        after = await http_cache.get_versions("dashboard:c1", "dashboard:c2")
+        assert after["dashboard:c1"] != before["dashboard:c1"]
+        assert after["dashboard:c2"] == before["dashboard:c2"]
+        assert student_dashboard_cache.get("c1:s1:") is None
+        assert student_dashboard_cache.get("c1:s2:subj") is None
+        assert student_dashboard_cache.get("c2:s1:") == {"v": 3}
+        student_dashboard_cache.invalidate()
+
+    @pytest.mark.asyncio
+    async def test_invalidate_single_student(self, fake_db):
+        import utils.http_cache as http_cache
+        from cache import student_dashboard_cache, invalidate_student_dashboard
+        fake_db.install(http_cache)
+        keys = ("dashboard:c1", "dashboard:c1:s1", "dashboard:c1:s2")
+        before = await http_cache.get_versions(*keys)
+        student_dashboard_cache.set("c1:s1:", {"v": 1})
+        student_dashboard_cache.set("c1:s1:subj", {"v": 1})
+        student_dashboard_cache.set("c1:s2:", {"v": 2})
+        await invalidate_student_dashboard("c1", "s1")
+        after = await http_cache.get_versions(*keys)
+        assert [after[k] == before[k] for k in keys] == [True, False, True]
+        assert student_dashboard_cache.get("c1:s1:") is None
+        assert student_dashboard_cache.get("c1:s1:subj") is None
+        assert student_dashboard_cache.get("c1:s2:") == {"v": 2}
+        student_dashboard_cache.invalidate()
+
+    @pytest.mark.asyncio
+    async def test_write_in_another_worker_is_seen(self, fake_db):
+        import routes.dashboard as dashboard
+        import utils.enrollments as enrollments
+        import utils.http_cache as http_cache
+        from cache import student_dashboard_cache
+        fake_db.install(
+            dashboard, enrollments, http_cache,
+            courses=[{"id": "c1", "name": "Grupo A"}],
+            enrollments=[{"course_id": "c1", "student_id": "s1", "status": "active"}],
+            activities=[{"id": "a1", "course_id": "c1", "title": "Taller"}],
+        )
+        student = {"id": "s1", "role": "estudiante"}
+        first = await dashboard.get_student_dashboard("c1", None, None, student)
+
+        # Another worker adds an activity and bumps the shared stamp; its local
+        # invalidation never reaches this process's cache.
+        fake_db.activities.docs.append({"id": "a2", "course_id": "c1", "title": "Quiz"})
+        await http_cache.bump_versions("dashboard:c1")
+
+        second = await dashboard.get_student_dashboard("c1", None, None, student)
+        assert second.headers["etag"] != first.headers["etag"]
+        assert [a["id"] for a in json.loads(second.body)["activities"]] == ["a1", "a2"]
+        student_dashboard_cache.invalidate()
+
+    def test_split_by_release(self):
+        from routes.dashboard import _split_by_release
+        now = "2026-05-10T12:00:00+00:00"
+        docs = [
+            {"id": "a", "start_date": None},
+            {"id": "b", "start_date": ""},
+            {"id": "c", "start_date": "2026-05-01T00:00:00+00:00"},
+            {"id": "d", "start_date": "2026-06-01T00:00:00+00:00"},
+            {"id": "e", "start_date": "2026-05-20T00:00:00+00:00"},
+            {"id": "f"},
+        ]
+        visible, next_release = _split_by_release(docs, "start_date", now)
+        assert [d["id"] for d in visible] == ["a", "b", "c", "f"]
+        assert next_release == "2026-05-20T00:00:00+00:00"
+
+    def test_etag_is_stable_and_content_sensitive(self):
+        from utils.http_cache import compute_etag
+        a = compute_etag({"x": 1, "y": [1, 2]})
+        b = compute_etag({"y": [1, 2], "x": 1})
+        c = compute_etag({"x": 2, "y": [1, 2]})
+        assert a == b
+        assert a != c
+        assert a.startswith('"') and a.endswith('"')
+
+    def test_etag_matches_if_none_match(self):
+        from starlette.requests import Request as _Request
+        from utils.http_cache import etag_matches
+
+        def _req(value):
+            headers = [(b"if-none-match", value.encode())] if value is not None else []
+            return _Request({"type": "http", "headers": headers})
+
+        assert etag_matches(_req('"abc"'), '"abc"') is True
+        assert etag_matches(_req('"zzz", W/"abc"'), '"abc"') is True
+        assert etag_matches(_req('*'), '"abc"') is True
+        assert etag_matches(_req('"zzz"'), '"abc"') is False
+        assert etag_matches(_req(None), '"abc"') is False
+
+
+# ==================== VERSION-STAMPED ETAG TESTS ====================
+
+class TestVersionedEtag:
+    """ETags derived from response_versions stamps change only when a stamp is bumped."""
+
+    @pytest.fixture
+    def versions(self, fake_db):
+        import utils.http_cache as http_cache
+        return fake_db.install(http_cache).response_versions
+
+    @pytest.mark.asyncio
+    async def test_etag_stable_until_bump(self, versions):
+        from utils.http_cache import versioned_etag, bump_versions
+        first, v1 = await versioned_etag("programs")
+        second, _ = await versioned_etag("programs")
+        assert first == second
+        await bump_versions("programs")
+        third, v3 = await versioned_etag("programs")
+        assert third != first
+        assert v3["programs"] != v1["programs"]
+
+    @pytest.mark.asyncio
+    async def test_unrelated_bump_keeps_etag(self, versions):
+        from utils.http_cache import versioned_etag, bump_versions, course_version_keys
+        before, _ = await versioned_etag(*course_version_keys("c1"))
+        await bump_versions("course:c2")
+        after, _ = await versioned_etag(*course_version_keys("c1"))
+        assert before == after
+        await bump_versions("courses")
+        assert (await versioned_etag(*course_version_keys("c1")))[0] != before
+
+    @pytest.mark.asyncio
+    async def test_bump_retries_then_raises(self, versions, monkeypatch):
+        import utils.http_cache as http_cache
+        monkeypatch.setattr(http_cache, "BUMP_RETRY_DELAY", 0)
+        real_bulk_write = versions.bulk_write
+        failures = []
+
+        async def _flaky(ops, **kwargs):
+            if len(failures) < 2:
+                failures.append(1)
+                raise ConnectionError("primary stepped down")
+            return await real_bulk_write(ops, **kwargs)
+
+        monkeypatch.setattr(versions, "bulk_write", _flaky)
+        before, _ = await http_cache.versioned_etag("programs")
+        await http_cache.bump_versions("programs")
+        assert (await http_cache.versioned_etag("programs"))[0] != before
+
+        failures.clear()
+        monkeypatch.setattr(http_cache, "BUMP_ATTEMPTS", 2)
+        with pytest.raises(ConnectionError):
+            await http_cache.bump_versions("programs")
+
+    def test_deleted_course_is_404_despite_matching_etag(self, versions, fake_db):
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        import routes.courses as courses
+        import utils.enrollments as enrollments
+        fake_db.install(courses, enrollments, courses=[{"id": "c1", "name": "Grupo A"}])
+        app = FastAPI()
+        app.include_router(courses.router)
+        app.dependency_overrides[courses.get_current_user] = lambda: {"id": "a1", "role": "admin"}
+        client = TestClient(app)
+        etags = {path: client.get(path).headers["etag"] for path in ("/courses/c1", "/courses/c1/students")}
+        for path, etag in etags.items():
+            assert client.get(path, headers={"If-None-Match": etag}).status_code == 304
+        fake_db.courses.docs.clear()  # deleted without a version bump reaching this worker
+        for path, etag in etags.items():
+            assert client.get(path, headers={"If-None-Match": etag}).status_code == 404
+
+    @pytest.mark.asyncio
+    async def test_variant_changes_etag(self, versions):
+        from utils.http_cache import versioned_etag
+        all_subjects, _ = await versioned_etag("subjects")
+        one_program, _ = await versioned_etag("subjects", variant="prog-1")
+        assert all_subjects != one_program
+
+
+# ==================== STATS COUNTERS TESTS ====================
+
+class TestStatsCounters:
+    """$inc bookkeeping for the /stats counters document."""
+
+    @pytest.fixture
+    def counters(self, fake_db):
+        import utils.counters as counters_mod
+        fake_db.install(counters_mod)
+
+        def stats_doc():
+            """The counters document without its _id."""
+            doc = next((d for d in fake_db.counters.docs if d["_id"] == counters_mod.COUNTERS_DOC_ID), {})
+            return {k: v for k, v in doc.items() if k != "_id"}
+        return stats_doc
+
+    def test_missing_status_counts_as_activo(self):
+        from utils.counters import student_status_field
+        assert student_status_field(None) == "students_activo"
+        assert student_status_field("egresado") == "students_egresado"
+
+    @pytest.mark.asyncio
+    async def test_create_delete_and_status_change(self, counters):
+        from utils.counters import count_user_created, count_user_deleted, count_student_status_change
+        await count_user_created("estudiante", "activo")
+        await count_user_created("estudiante", None)
+        await count_user_created("profesor")
+        await count_user_created("admin")
+        await count_student_status_change("activo", "egresado")
+        await count_user_deleted("estudiante", "activo")
+        assert counters() == {"students": 1, "students_activo": 0, "students_egresado": 1, "teachers": 1}
+
+    @pytest.mark.asyncio
+    async def test_unchanged_status_is_noop(self, counters):
+        from utils.counters import count_student_status_change
+        await count_student_status_change(None, "activo")
+        assert counters() == {}
+
+    @pytest.mark.asyncio
+    async def test_batch_delete(self, counters):
+        from utils.counters import count_students_deleted
+        await count_students_deleted(["activo", "activo", "reprobado"])
+        assert counters() == {"students": -3, "students_activo": -2, "students_reprobado": -1}
+
+    @pytest.mark.asyncio
+    async def test_requested_recount_runs_in_background_and_survives_a_held_lock(
+        self, counters, fake_db, monkeypatch
+    ):
+        import asyncio
+        import scheduler.cleanup as cleanup
+        import utils.counters as counters_mod
+        import utils.images as images
+        import migrations.runner as runner
+        monkeypatch.setattr(runner, "_applied_seen", set())
+        fake_db.install(
+            cleanup, runner,
+            schema_migrations=[{"_id": 4, "name": "student_status"}],
+            users=[{"id": "s1", "role": "estudiante", "estado": "activo"}],
+            activities=[{"id": "a1", "course_id": "gone"}],
+        )
+        request = {"_id": counters_mod.RECONCILE_REQUEST_ID}
+        lock_free = False
+
+        async def _acquire(*args, **kwargs):
+            return lock_free
+
+        monkeypatch.setattr(cleanup, "acquire_scheduler_lock", _acquire)
+        await cleanup.request_stats_reconcile()
+        await asyncio.gather(*images._background_tasks)
+        assert counters() == {} and await fake_db.counters.find_one(request) is not None
+
+        lock_free = True
+        await cleanup.reconcile_stats_counters(only_if_requested=True)
+        assert counters()["students_activo"] == 1 and counters()["activities"] == 1
+        assert await fake_db.counters.find_one(request) is None
+
+
+# ==================== ANALYTICS ROLLUP TESTS ====================
+
+class TestDailyRollups:
+    """Per-program/per-module snapshots built by the nightly rollup job."""
+
+    def test_grade_bucket_edges(self):
+        from scheduler.rollups import grade_bucket
+        assert grade_bucket(0.0) == 0
+        assert grade_bucket(2.99) == 5
+        assert grade_bucket(3.0) == 6
+        assert grade_bucket(5.0) == 9
+
+    @pytest.mark.asyncio
+    async def test_build_snapshots(self, fake_db):
+        import scheduler.rollups as rollups
+        fake_db.install(
+            rollups,
+            users=[
+                {"role": "estudiante", "estado": "activo", "program_modules": {"p1": 1},
+                 "program_statuses": {"p1": "activo"}},
+                {"role": "estudiante", "estado": "activo", "program_modules": {"p1": 1, "p2": 2},
+                 "program_statuses": {"p2": "reprobado"}},
+                {"role": "estudiante", "estado": "egresado", "program_id": "p2", "module": 2},
+            ],
+            courses=[{"id": "c1", "program_id": "p1"}],
+            subjects=[{"id": "s1", "module_number": 1}],
+        )
+        fake_db.grades.aggregate_result = [
+            {"_id": {"course_id": "c1", "subject_id": "s1", "bucket": 8}, "count": 2, "sum": 8.4, "passed": 2},
+            {"_id": {"course_id": "c1", "subject_id": "s1", "bucket": 2}, "count": 2, "sum": 2.0, "passed": 0},
+            {"_id": {"course_id": "gone", "subject_id": "s1", "bucket": 9}, "count": 5, "sum": 25.0, "passed": 5},
+        ]
+        fake_db.failed_subjects.aggregate_result = [
+            {"_id": {"program_id": "p1", "module_number": 1, "state": "pending"}, "count": 1},
+            {"_id": {"program_id": "p1", "module_number": 1, "state": "approved"}, "count": 1},
+            {"_id": {"program_id": "p1", "module_number": 1, "state": "completed_ok"}, "count": 1},
+            {"_id": {"program_id": "p1", "module_number": 1, "state": "expired"}, "count": 2},
+        ]
+
+        docs = {(d["program_id"], d["module_number"]): d for d in await rollups.build_daily_rollups("2026-06-30")}
+        p1 = docs[("p1", 1)]
+        assert p1["date"] == "2026-06-30"
+        assert p1["students"] == {"total": 2, "by_estado": {"activo": 2}}
+        assert p1["grades"]["count"] == 4
+        assert p1["grades"]["histogram"][8] == 2 and p1["grades"]["histogram"][2] == 2
+        assert p1["grades"]["pass_rate"] == 0.5
+        assert p1["grades"]["average"] == 2.6
+        assert p1["recovery"] == {"total": 5, "pending": 1, "approved": 2, "completed": 1,
+                                  "rejected": 0, "expired": 2, "processed": 0}
+        assert docs[("p2", 2)]["students"]["by_estado"] == {"reprobado": 1, "egresado": 1}
+
+    @pytest.mark.asyncio
+    async def test_rerun_replaces_the_days_snapshots(self, fake_db, monkeypatch):
+        import scheduler.rollups as rollups
+
+        async def _noop(*args, **kwargs):
+            return True
+
+        monkeypatch.setattr(rollups, "acquire_scheduler_lock", _noop)
+        monkeypatch.setattr(rollups, "release_scheduler_lock", _noop)
+        fake_db.install(rollups, users=[{"role": "estudiante", "estado": "activo", "program_modules": {"p1": 1}}])
+        fake_db.grades.aggregate_result = []
+        fake_db.failed_subjects.aggregate_result = []
+        await rollups.rollup_daily_analytics()
+        today = fake_db.analytics_rollups.docs[0]["date"]
+        fake_db.analytics_rollups.docs.append({"date": "2020-01-01", "program_id": "p1", "module_number": 1})
+
+        fake_db.users.docs[0]["program_modules"] = {"p1": 2}
+        await rollups.rollup_daily_analytics()
+        assert sorted((d["date"], d["module_number"]) for d in fake_db.analytics_rollups.docs) == [
+            ("2020-01-01", 1), (today, 2),
+        ]
+
+
+# ==================== STREAMING UPLOAD TESTS ====================
+
+class TestStreamingUpload:
+    """Non-image uploads are copied from the spool file in chunks, never joined in memory."""
+
+    def _spool(self, data: bytes):
+        import tempfile
+        spool = tempfile.SpooledTemporaryFile(max_size=1024)
+        spool.write(data)
+        spool.seek(0)
+        return spool
+
+    def test_spooled_size_rewinds(self):
+        from routes.uploads import _spooled_size
+        spool = self._spool(b"x" * 5000)
+        assert _spooled_size(spool) == 5000
+        assert spool.tell() == 0
+
+    @pytest.mark.asyncio
+    async def test_local_put_stream_writes_full_file(self, tmp_path):
+        from utils.storage import LocalStorage
+        data = b"%PDF" + bytes(range(256)) * 1000
+        spool = self._spool(data)
+        spool.read(10)  # the copy must rewind even after the header was read
+        await LocalStorage(tmp_path).put_stream("out.pdf", spool)
+        assert (tmp_path / "out.pdf").read_bytes() == data
+        assert not (tmp_path / "out.pdf.part").exists()
+
+    def test_header_only_validation(self):
+        from routes.uploads import _validate_file_content, _HEADER_BYTES
+        webp = b"RIFF\x00\x00\x00\x00WEBPVP8 " + b"\x00" * 100
+        assert _validate_file_content(webp[:_HEADER_BYTES], "webp") is True
+        assert _validate_file_content(b"%PDF-1.7"[:_HEADER_BYTES], "docx") is False
+
+
+# ==================== IMAGE PROCESS POOL TESTS ====================
+
+class TestImagePool:
+    """compress_image runs in a bounded process pool and degrades to the original."""
+
+    def test_keep_format_preserves_extension(self):
+        from utils.images import compress_image
+        data, name = compress_image(_make_png_bytes(300, 300), "shot.png", keep_format=True)
+        assert name == "shot.png"
+        assert _PILImage.open(_io.BytesIO(data)).format == "PNG"
+        data, name = compress_image(_make_webp_bytes(300, 300), "shot.webp", keep_format=True)
+        assert name == "shot.webp"
+        assert _PILImage.open(_io.BytesIO(data)).format == "WEBP"
+
+    def test_default_still_converts_opaque_png_to_jpeg(self):
+        from utils.images import compress_image
+        _, name = compress_image(_make_png_bytes(300, 300), "shot.png")
+        assert name == "shot.jpg"
+
+    @pytest.mark.asyncio
+    async def test_busy_pool_returns_original(self, monkeypatch):
+        import config
+        from utils.images import compress_or_original
+        monkeypatch.setattr(config, "IMAGE_POOL_MAX_PENDING", 0)
+        original = _make_jpeg_bytes(200, 200)
+        data, name = await compress_or_original(original, "a.jpg", queue_wait=0)
+        assert data == original and name == "a.jpg"
+
+    @pytest.mark.asyncio
+    async def test_waits_for_a_free_slot(self, monkeypatch):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        import config
+        import utils.images as images
+        monkeypatch.setattr(config, "IMAGE_POOL_MAX_PENDING", 1)
+        monkeypatch.setattr(images, "_get_pool", lambda: ThreadPoolExecutor(max_workers=1))
+        slots = images._get_slots()
+        await slots.acquire()  # a running job holds the only slot
+        asyncio.get_running_loop().call_later(0.1, slots.release)
+        assert await images.run_in_pool(len, b"abc", queue_wait=2) == 3
+        await slots.acquire()
+        with pytest.raises(images.ImagePoolBusy):
+            await images.run_in_pool(len, b"abc", queue_wait=0.1)
+        slots.release()
+
+    @pytest.mark.asyncio
+    async def test_waiters_get_slots_in_arrival_order(self, monkeypatch):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        import config
+        import utils.images as images
+        monkeypatch.setattr(config, "IMAGE_POOL_MAX_PENDING", 1)
+        monkeypatch.setattr(images, "_get_pool", lambda: ThreadPoolExecutor(max_workers=4))
+        slots = images._get_slots()
+        await slots.acquire()
+        order = []
+        waiters = []
+        for i in range(4):
+            waiters.append(asyncio.create_task(images.run_in_pool(order.append, i, queue_wait=5)))
+            await asyncio.sleep(0)
+        slots.release()
+        await asyncio.gather(*waiters)
+        assert order == [0, 1, 2, 3]
+        assert not slots.locked()
+
+    @pytest.mark.asyncio
+    async def test_full_pool_queues_compression_instead_of_skipping_it(self, monkeypatch, fake_db):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        import config
+        import routes.uploads as uploads
+        import utils.blobs as blobs
+        import utils.images as images
+        import utils.storage as storage
+        backend = storage.MemoryStorage()
+        fake_db.install(uploads, blobs)
+        monkeypatch.setattr(storage, "default_backend_name", lambda: "memory")
+        monkeypatch.setattr(config, "IMAGE_POOL_MAX_PENDING", 1)
+        monkeypatch.setattr(config, "IMAGE_POOL_QUEUE_WAIT", 0)
+        monkeypatch.setattr(images, "_get_pool", lambda: ThreadPoolExecutor(max_workers=1))
+        slots = images._get_slots()
+        await slots.acquire()  # the pool is full
+        storage.set_backend("memory", backend)
+        original = _make_jpeg_bytes(2400, 1200)
+        try:
+            response = await uploads._store_upload(_io.BytesIO(original), "foto.jpg", len(original))
+            assert response["compression"] == "pending"
+            assert backend.objects[response["stored_name"]] == original
+            assert fake_db.file_blobs.docs[0]["compression"] == "pending"
+
+            slots.release()
+            await asyncio.gather(*images._background_tasks)
+        finally:
+            storage.set_backend("memory", None)
+
+        assert len(backend.objects[response["stored_name"]]) < len(original)
+        assert "compression" not in fake_db.file_blobs.docs[0]
+        assert {size for size, d in response["derivatives"].items() if d["pending"]} == {"thumb", "640", "webp"}
+        assert all(d["stored_name"] in backend.objects for d in response["derivatives"].values())
+
+    @pytest.mark.asyncio
+    async def test_compresses_in_child_process(self):
+        import utils.images as images
+        try:
+            data, name = await images.compress_in_pool(_make_jpeg_bytes(2400, 1200), "big.jpg")
+            assert name == "big.jpg"
+            assert max(_PILImage.open(_io.BytesIO(data)).size) == images.MAX_IMAGE_DIMENSION
+            assert not images._get_slots().locked()
+        finally:
+            images.shutdown_image_pool()
+
+
+# ==================== IMAGE DERIVATIVE TESTS ====================
+
+class TestImageDerivatives:
+    """Uploads of images get thumb / 640 / webp derivatives served via ?size=."""
+
+    def test_derivative_name_keeps_folder(self):
+        from utils.images import derivative_name
+        assert derivative_name("abc.jpg", "thumb") == "abc__thumb.webp"
+        assert derivative_name("uploads/images/a_b.c_1.png", "640") == "uploads/images/a_b.c_1__640.webp"
+
+    def test_make_derivatives_sizes(self):
+        from utils.images import make_derivatives
+        out = make_derivatives(_make_jpeg_bytes(1600, 800), "p.jpg")
+        assert set(out) == {"thumb", "640", "webp"}
+        assert out["thumb"][1] == 256 and out["640"][1] == 640 and out["webp"][1] == 1600
+        assert _PILImage.open(_io.BytesIO(out["thumb"][0])).format == "WEBP"
+        assert set(make_derivatives(_make_webp_bytes(300, 300), "p.webp")) == {"thumb", "640"}
+        assert make_derivatives(b"GIF89a", "p.gif") == {}
+
+    def test_upload_and_serve_local_derivative(self, tmp_path, monkeypatch, fake_db):
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        import routes.uploads as uploads
+        import utils.blobs as blobs
+        import utils.images as images
+        import utils.storage as storage
+
+        monkeypatch.setattr(uploads, "UPLOAD_DIR", tmp_path)
+        monkeypatch.setattr(storage, "default_backend_name", lambda: "local")
+        storage.set_backend("local", storage.LocalStorage(tmp_path))
+        fake_db.install(uploads, blobs)
+        app = FastAPI()
+        app.include_router(uploads.router)
+        app.dependency_overrides[uploads.get_current_user] = lambda: {"id": "u1", "role": "profesor"}
+        try:
+            with TestClient(app) as client:
+                res = client.post("/upload", files={"file": ("foto.jpg", _make_jpeg_bytes(1200, 900), "image/jpeg")})
+                assert res.status_code == 200
+                body = res.json()
+                assert set(body["derivatives"]) == {"thumb", "640", "webp"}
+                assert body["derivatives"]["thumb"]["url"].endswith("?size=thumb")
+                thumb = client.get(f"/files/{body['stored_name']}", params={"size": "thumb"})
+                assert thumb.headers["content-type"] == "image/webp"
+                assert _PILImage.open(_io.BytesIO(thumb.content)).size[0] == 256
+                assert client.get(f"/files/{body['stored_name']}", params={"size": "huge"}).status_code == 400
+        finally:
+            images.shutdown_image_pool()
+            storage.set_backend("local", None)
+
+
+# ==================== STORAGE BACKEND TESTS ====================
+
+class _FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+        self.content_types = {}
+        self.delete_batches = []
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, **extra):
+        self.objects[Key] = Body
+        self.content_types[Key] = ContentType
+
+    def head_object(self, Bucket, Key):
+        from botocore.exceptions import ClientError
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ContentLength": len(self.objects[Key]), "ContentType": self.content_types.get(Key)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.objects[Key]
+        if Range:
+            start, end = Range.removeprefix("bytes=").split("-")
+            data = data[int(start):int(end) + 1]
+        return {"Body": _io.BytesIO(data)}
+
+    def generate_presigned_post(self, **kwargs):
+        import boto3
+        real = boto3.client("s3", region_name="us-east-1", aws_access_key_id="x", aws_secret_access_key="y")
+        return real.generate_presigned_post(**kwargs)
+
+    def delete_objects(self, Bucket, Delete):
+        keys = [o["Key"] for o in Delete["Objects"]]
+        assert Delete["Quiet"] is True
+        self.delete_batches.append(len(keys))
+        for k in keys:
+            self.objects.pop(k, None)
+        return {}
+
+
+class TestStorageBackends:
+    """StorageBackend implementations share one async contract."""
+
+    @pytest.mark.asyncio
+    async def test_memory_and_local_roundtrip(self, tmp_path):
+        from utils.storage import LocalStorage, MemoryStorage
+        data = bytes(range(256)) * 700
+        for backend in (MemoryStorage(), LocalStorage(tmp_path)):
+            url = await backend.put_stream("a.bin", data)
+            assert url == backend.url_for("a.bin")
+            assert await backend.exists("a.bin")
+            chunks = [c async for c in backend.get_stream("a.bin", chunk_size=65536)]
+            assert b"".join(chunks) == data and len(chunks) == 3
+            assert await backend.delete_many(["a.bin", "missing.bin"]) == 1
+            assert not await backend.exists("a.bin")
+            backend.close()
+
+    @pytest.mark.asyncio
+    async def test_local_rejects_path_keys(self, tmp_path):
+        from utils.storage import LocalStorage, StorageError
+        backend = LocalStorage(tmp_path)
+        with pytest.raises(StorageError):
+            await backend.put_stream("../escape.txt", b"x")
+        assert await backend.delete_many(["../escape.txt"]) == 0
+
+    @pytest.mark.asyncio
+    async def test_s3_delete_many_batches_1000_keys(self):
+        from utils.storage import S3Storage
+        client = _FakeS3Client()
+        backend = S3Storage(client, "bucket", "us-east-1")
+        keys = [f"uploads/docs/f{i}.pdf" for i in range(2500)]
+        for k in keys:
+            await backend.put_stream(k, b"%PDF")
+        assert await backend.delete_many(keys + keys[:10]) == 2500
+        assert client.delete_batches == [1000, 1000, 500]
+        assert client.objects == {}
+        backend.close()
+
+    @pytest.mark.asyncio
+    async def test_delete_file_entries_groups_by_backend(self):
+        import utils.storage as storage
+        local, cloud = storage.MemoryStorage(), storage.MemoryStorage()
+        storage.set_backend("local", local)
+        storage.set_backend("cloudinary", cloud)
+        try:
+            entries = [
+                {"stored_name": "a.jpg", "storage": "local",
+                 "derivatives": {"thumb": {"stored_name": "a__thumb.webp"}}},
+                {"stored_name": "educando/uploads/b.pdf"},
+                {"stored_name": "c.pdf"},
+                "not-a-dict",
+            ]
+            await storage.delete_file_entries(entries)
+            assert local.delete_calls == [["a.jpg", "a__thumb.webp", "c.pdf"]]
+            assert cloud.delete_calls == [["educando/uploads/b.pdf"]]
+        finally:
+            storage.set_backend("local", None)
+            storage.set_backend("cloudinary", None)
+
+
+# ==================== PRESIGNED UPLOAD TESTS ====================
+
+class TestPresignedUploads:
+    """Direct-to-S3 uploads: presign, client PUTs/POSTs to storage, then complete."""
+
+    def _client(self, monkeypatch, fake_db, s3_client):
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        import routes.uploads as uploads
+        import utils.storage as storage
+
+        intents = fake_db.install(uploads).upload_intents
+        backend = storage.S3Storage(s3_client, "bucket", "us-east-1", endpoint_url="http://localhost:9000")
+        monkeypatch.setattr(storage, "default_backend_name", lambda: "s3")
+        storage.set_backend("s3", backend)
+        app = FastAPI()
+        app.include_router(uploads.router)
+        app.dependency_overrides[uploads.get_current_user] = lambda: {"id": "u1", "role": "estudiante"}
+        return TestClient(app), intents
+
+    def teardown_method(self):
+        import utils.storage as storage
+        storage.set_backend("s3", None)
+
+    def test_presign_then_complete(self, monkeypatch, fake_db):
+        s3 = _FakeS3Client()
+        client, intents = self._client(monkeypatch, fake_db, s3)
+        res = client.post("/uploads/presign", json={"filename": "Tarea 1.pdf", "size": 2048})
+        assert res.status_code == 200
+        body = res.json()
+        assert body["method"] == "POST" and body["url"].endswith("bucket.s3.amazonaws.com/")
+        assert body["fields"]["Content-Type"] == "application/pdf"
+        key = body["fields"]["key"]
+        assert key.startswith("uploads/pdf/Tarea_1_") and "policy" in body["fields"]
+
+        # The client sends the file straight to storage.
+        s3.put_object(Bucket="bucket", Key=key, Body=b"%PDF-1.7" + b"\0" * 2040, ContentType="application/pdf")
+        res = client.post("/uploads/complete", json={"upload_id": body["upload_id"]})
+        assert res.status_code == 200
+        done = res.json()
+        assert done["stored_name"] == key and done["size"] == 2048 and done["storage"] == "s3"
+        assert done["url"] == f"http://localhost:9000/bucket/{key}"
+        assert intents.docs == []
+        assert client.post("/uploads/complete", json={"upload_id": body["upload_id"]}).status_code == 404
+
+    def test_complete_rejects_and_deletes_mismatched_content(self, monkeypatch, fake_db):
+        s3 = _FakeS3Client()
+        client, _ = self._client(monkeypatch, fake_db, s3)
+        body = client.post("/uploads/presign", json={"filename": "doc.pdf", "size": 100}).json()
+        assert client.post("/uploads/complete", json={"upload_id": body["upload_id"]}).status_code == 400
+        key = body["fields"]["key"]
+        s3.put_object(Bucket="bucket", Key=key, Body=b"MZ\x90\x00 not a pdf", ContentType="application/pdf")
+        res = client.post("/uploads/complete", json={"upload_id": body["upload_id"]})
+        assert res.status_code == 400
+        assert key not in s3.objects
+
+    def test_presign_limits(self, monkeypatch, fake_db):
+        import routes.uploads as uploads
+        import utils.storage as storage
+        client, _ = self._client(monkeypatch, fake_db, _FakeS3Client())
+        assert client.post("/uploads/presign", json={"filename": "a.exe", "size": 10}).status_code == 400
+        assert client.post("/uploads/presign", json={"filename": "a.pdf", "size": 11 * 1024 * 1024}).status_code == 413
+        # Backends without direct uploads tell the client to use POST /upload.
+        monkeypatch.setattr(uploads, "get_default_backend", lambda: storage.MemoryStorage())
+        assert client.post("/uploads/presign", json={"filename": "a.pdf", "size": 10}).status_code == 501
+
+
+# ==================== UPLOAD DEDUPLICATION TESTS ====================
+
+class TestUploadDeduplication:
+    """Uploads are stored by SHA-256 and shared through reference-counted file_blobs."""
+
+    def _client(self, monkeypatch, fake_db):
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        import routes.uploads as uploads
+        import utils.blobs as blobs
+        import utils.storage as storage
+
+        fake_blobs = fake_db.install(uploads, blobs).file_blobs
+        monkeypatch.setattr(storage, "default_backend_name", lambda: "local")
+        backend = storage.MemoryStorage()
+        storage.set_backend("local", backend)
+        app = FastAPI()
+        app.include_router(uploads.router)
+        app.dependency_overrides[uploads.get_current_user] = lambda: {"id": "u1", "role": "profesor"}
+        return TestClient(app), backend, fake_blobs
+
+    def teardown_method(self):
+        import utils.storage as storage
+        storage.set_backend("local", None)
+
+    def test_duplicate_upload_skips_storage_write(self, monkeypatch, fake_db):
+        import hashlib
+        client, backend, fake_blobs = self._client(monkeypatch, fake_db)
+        pdf = b"%PDF-1.7 syllabus" + b"\0" * 5000
+        first = client.post("/upload", files={"file": ("silabo.pdf", pdf, "application/pdf")}).json()
+        assert first["stored_name"] == f"{hashlib.sha256(pdf).hexdigest()}.pdf"
+        assert first["sha256"] == hashlib.sha256(pdf).hexdigest()
+        backend.objects.clear()  # a second write would show up here
+        second = client.post("/upload", files={"file": ("copia.pdf", pdf, "application/pdf")}).json()
+        assert backend.objects == {}
+        assert second["stored_name"] == first["stored_name"] and second["filename"] == "copia.pdf"
+        assert fake_blobs.docs[0]["refcount"] == 2
+
+    @pytest.mark.asyncio
+    async def test_release_only_deletes_last_reference(self, fake_db):
+        import utils.blobs as blobs
+        fake_blobs = fake_db.install(blobs).file_blobs
+        entry = {"stored_name": "abc.pdf", "storage": "local", "sha256": "abc"}
+        await blobs.register_blob("abc", "pdf", {**entry, "url": "/api/files/abc.pdf", "size": 10})
+        await blobs.add_file_references([entry], 2)  # activity copied to two more courses
+        legacy = {"stored_name": "old-uuid.pdf", "storage": "local"}
+        assert await blobs.release_file_entries([entry, legacy]) == [legacy]
+        assert await blobs.release_file_entries([entry]) == []
+        assert await blobs.release_file_entries([entry]) == [entry]
+        assert fake_blobs.docs[0]["deleting"] is True
+        await blobs.finish_release([entry], failed_keys=[])
+        assert fake_blobs.docs == []
+
+    @pytest.mark.asyncio
+    async def test_reupload_waits_for_release_of_same_content(self, monkeypatch, fake_db):
+        import asyncio
+        import utils.blobs as blobs
+        import utils.storage as storage
+        fake_blobs = fake_db.install(blobs).file_blobs
+        monkeypatch.setattr(blobs, "_RELEASE_POLL_SECONDS", 0.01)
+        backend = storage.MemoryStorage()
+        backend.objects["abc.pdf"] = b"old"
+        storage.set_backend("local", backend)
+        entry = {"stored_name": "abc.pdf", "storage": "local", "sha256": "abc"}
+        await blobs.register_blob("abc", "pdf", {**entry, "url": "/api/files/abc.pdf", "size": 3})
+
+        deleting, delete_done = asyncio.Event(), asyncio.Event()
+        delete_many = backend.delete_many
+
+        async def slow_delete(keys):
+            deleting.set()
+            await asyncio.sleep(0.05)
+            deleted = await delete_many(keys)
+            delete_done.set()
+            return deleted
+
+        monkeypatch.setattr(backend, "delete_many", slow_delete)
+
+        async def reupload():
+            await deleting.wait()
+            assert await blobs.reuse_blob("local", "abc", "pdf") is None
+            # Only now may the upload write the object, after the old one is gone.
+            assert delete_done.is_set()
+            await backend.put_stream("abc.pdf", b"new")
+            await blobs.register_blob("abc", "pdf", {**entry, "url": "/api/files/abc.pdf", "size": 3})
+
+        try:
+            result, _ = await asyncio.gather(blobs.release_and_delete([entry]), reupload())
+        finally:
+            storage.set_backend("local", None)
+        assert result["deleted"] == {"local": 1}
+        assert backend.objects == {"abc.pdf": b"new"}
+        assert len(fake_blobs.docs) == 1 and fake_blobs.docs[0]["refcount"] == 1
+        assert "deleting" not in fake_blobs.docs[0]
+
+
+# ==================== LOCAL FILE SERVING TESTS ====================
+
+class TestLocalFileServing:
+    """GET /files supports ranges, validators, long-lived caching and nginx offload."""
+
+    NAME = "0123abcd-0000-4000-8000-0123456789ab.pdf"
+
+    def _client(self, tmp_path, monkeypatch):
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        import routes.uploads as uploads
+
+        (tmp_path / self.NAME).write_bytes(b"%PDF-" + bytes(range(256)) * 4)
+        (tmp_path / "notes.txt").write_bytes(b"hello")
+        monkeypatch.setattr(uploads, "UPLOAD_DIR", tmp_path)
+        app = FastAPI()
+        app.include_router(uploads.router)
+        app.dependency_overrides[uploads.get_current_user] = lambda: {"id": "u1", "role": "estudiante"}
+        return TestClient(app), uploads
+
+    def test_range_and_validators(self, tmp_path, monkeypatch):
+        client, _ = self._client(tmp_path, monkeypatch)
+        full = client.get(f"/files/{self.NAME}")
+        assert full.status_code == 200 and full.headers["accept-ranges"] == "bytes"
+        assert full.headers["cache-control"] == "private, max-age=31536000, immutable"
+        etag = full.headers["etag"]
+        part = client.get(f"/files/{self.NAME}", headers={"Range": "bytes=5-9"})
+        assert part.status_code == 206
+        assert part.content == bytes(range(5))
+        assert part.headers["content-range"] == f"bytes 5-9/{len(full.content)}"
+        cached = client.get(f"/files/{self.NAME}", headers={"If-None-Match": etag})
+        assert cached.status_code == 304 and cached.content == b""
+        assert client.get("/files/notes.txt").headers["cache-control"] == "private, no-cache"
+
+    def test_missing_derivative_is_not_cached_as_immutable(self, tmp_path, monkeypatch):
+        client, _ = self._client(tmp_path, monkeypatch)
+        name = "0123abcd-0000-4000-8000-0123456789ab.jpg"
+        (tmp_path / name).write_bytes(_make_jpeg_bytes(50, 50))
+        res = client.get(f"/files/{name}", params={"size": "thumb"})
+        assert res.status_code == 200 and res.headers["cache-control"] == "private, no-cache"
+
+    def test_image_pending_compression_is_not_cached_as_immutable(self, tmp_path, monkeypatch, fake_db):
+        import asyncio
+        import utils.blobs as blobs
+        client, _ = self._client(tmp_path, monkeypatch)
+        fake_db.install(blobs)
+        name = "ab" * 32 + ".jpg"
+        (tmp_path / name).write_bytes(_make_jpeg_bytes(50, 50))
+        asyncio.run(blobs.register_blob("ab" * 32, "jpg", {
+            "stored_name": name, "storage": "local", "size": 10, "compression": "pending",
+        }))
+        assert client.get(f"/files/{name}").headers["cache-control"] == "private, no-cache"
+
+        asyncio.run(blobs.compression_finished("local", name))
+        assert client.get(f"/files/{name}").headers["cache-control"] == "private, max-age=31536000, immutable"
+
+    def test_accel_redirect_mode(self, tmp_path, monkeypatch):
+        client, uploads = self._client(tmp_path, monkeypatch)
+        monkeypatch.setattr(uploads, "FILES_ACCEL_REDIRECT_PREFIX", "/_protected_uploads/")
+        res = client.get(f"/files/{self.NAME}")
+        assert res.headers["x-accel-redirect"] == f"/_protected_uploads/{self.NAME}"
+        assert res.headers["content-type"].startswith("application/pdf")
+        assert res.content == b""
+        assert client.get("/files/missing.pdf").status_code == 404
+
+
+# ==================== RESUMABLE UPLOAD TESTS ====================
+
+class TestResumableUploads:
+    """Chunked upload sessions: create, PUT chunks, resume from the offset, finalize."""
+
+    def _client(self, tmp_path, monkeypatch, fake_db):
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        import config
+        import routes.uploads as uploads
+        import utils.blobs as blobs
+        import utils.storage as storage
+
+        monkeypatch.setattr(config, "UPLOAD_SESSION_DIR", tmp_path)
+        monkeypatch.setattr(uploads, "UPLOAD_SESSION_CHUNK_SIZE", 1000)
+        rate_limits = fake_db.install(uploads, blobs).rate_limits
+        monkeypatch.setattr(storage, "default_backend_name", lambda: "local")
+        backend = storage.MemoryStorage()
+        storage.set_backend("local", backend)
+        app = FastAPI()
+        app.include_router(uploads.router)
+        app.dependency_overrides[uploads.get_current_user] = lambda: {"id": "u1", "role": "estudiante"}
+        return TestClient(app), backend, rate_limits
+
+    def teardown_method(self):
+        import utils.storage as storage
+        storage.set_backend("local", None)
+
+    def test_resume_and_finalize(self, tmp_path, monkeypatch, fake_db):
+        client, backend, rate_limits = self._client(tmp_path, monkeypatch, fake_db)
+        pdf = b"%PDF-1.7" + bytes(range(256)) * 10  # 2568 bytes -> 3 chunks
+        session = client.post("/uploads/sessions", json={"filename": "tarea.pdf", "size": len(pdf)}).json()
+        sid = session["session_id"]
+        assert session["chunk_size"] == 1000 and session["offset"] == 0
+
+        assert client.put(f"/uploads/sessions/{sid}/chunks/0", content=pdf[:1000]).json()["offset"] == 1000
+        # Out of order: rejected so the client asks where to resume.
+        assert client.put(f"/uploads/sessions/{sid}/chunks/2", content=pdf[2000:]).status_code == 409
+        assert client.get(f"/uploads/sessions/{sid}").json()["next_chunk"] == 1
+        # A retried chunk that already arrived is accepted without changing the offset.
+        assert client.put(f"/uploads/sessions/{sid}/chunks/0", content=pdf[:1000]).json()["offset"] == 1000
+        assert client.put(f"/uploads/sessions/{sid}/chunks/1", content=pdf[1000:1500]).status_code == 400
+        assert client.post(f"/uploads/sessions/{sid}/finalize").status_code == 409
+        client.put(f"/uploads/sessions/{sid}/chunks/1", content=pdf[1000:2000])
+        assert client.put(f"/uploads/sessions/{sid}/chunks/2", content=pdf[2000:]).json()["complete"] is True
+
+        res = client.post(f"/uploads/sessions/{sid}/finalize")
+        assert res.status_code == 200
+        body = res.json()
+        assert body["filename"] == "tarea.pdf" and body["size"] == len(pdf)
+        assert backend.objects[body["stored_name"]] == pdf
+        assert len(rate_limits.docs) == 1
+        assert not (tmp_path / f"{sid}.part").exists()
+        assert client.get(f"/uploads/sessions/{sid}").status_code == 404
+
+    def test_finalize_rejects_mismatched_content(self, tmp_path, monkeypatch, fake_db):
+        client, backend, _ = self._client(tmp_path, monkeypatch, fake_db)
+        sid = client.post("/uploads/sessions", json={"filename": "a.pdf", "size": 10}).json()["session_id"]
+        client.put(f"/uploads/sessions/{sid}/chunks/0", content=b"MZ" + b"\0" * 8)
+        assert client.post(f"/uploads/sessions/{sid}/finalize").status_code == 400
+        assert backend.objects == {}
+        assert not (tmp_path / f"{sid}.part").exists()
+
+
+# ==================== SUBMISSIONS ZIP EXPORT TESTS ====================
+
+class TestSubmissionsZipExport:
+    """GET /activities/{id}/submissions.zip streams every submission file plus a manifest."""
+
+    def test_zip_contains_files_per_student_and_manifest(self, monkeypatch, fake_db):
+        import zipfile
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        import routes.activities as activities
+        import utils.storage as storage
+
+        backend = storage.MemoryStorage()
+        backend.objects["a.pdf"] = b"%PDF" + bytes(range(256)) * 2000
+        backend.objects["b.txt"] = b"respuesta " * 1000
+        submissions = [
+            {"student_id": "s1", "submitted_at": "2026-03-01T15:00:00+00:00", "edited": False,
+             "files": [{"filename": "Tarea.pdf", "stored_name": "a.pdf", "storage": "local"},
+                       {"filename": "Tarea.pdf", "stored_name": "b.txt", "storage": "local"}]},
+            {"student_id": "s2", "submitted_at": "2026-03-02T15:00:00+00:00", "edited": True,
+             "files": [{"filename": "perdido.pdf", "stored_name": "gone.pdf", "storage": "local"}]},
+            {"student_id": "s3", "submitted_at": "2026-03-02T16:00:00+00:00", "files": []},
+        ]
+        users = [{"id": "s1", "name": "Ana Pérez", "cedula": "123"}, {"id": "s2", "name": "Luis/Gómez"}]
+
+        async def _audit(*args, **kwargs):
+            return None
+
+        fake_db.install(
+            activities,
+            activities=[{"id": "act1", "course_id": "c1", "activity_number": 2, "title": "Ensayo Łódź"}],
+            submissions=[dict(sub, activity_id="act1") for sub in submissions],
+            users=users,
+        )
+        monkeypatch.setattr(activities, "log_audit", _audit)
+        storage.set_backend("local", backend)
+        app = FastAPI()
+        app.include_router(activities.router)
+        app.dependency_overrides[activities.get_current_user] = lambda: {"id": "adm", "role": "admin"}
+        try:
+            with TestClient(app) as client:
+                res = client.get("/activities/act1/submissions.zip")
+        finally:
+            storage.set_backend("local", None)
+        assert res.status_code == 200 and res.headers["content-type"] == "application/zip"
+        # "Ł" is outside latin-1: ASCII fallback plus the RFC 5987 UTF-8 name.
+        disposition = res.headers["content-disposition"]
+        assert 'filename="actividad_2_Ensayo _odz_entregas.zip"' in disposition
+        assert "filename*=UTF-8''actividad_2_Ensayo%20%C5%81%C3%B3d%C5%BA_entregas.zip" in disposition
+
+        zf = zipfile.ZipFile(_io.BytesIO(res.content))
+        names = zf.namelist()
+        assert "Ana Pérez_123/Tarea.pdf" in names and "Ana Pérez_123/Tarea_2.pdf" in names
+        assert zf.read("Ana Pérez_123/Tarea.pdf") == backend.objects["a.pdf"]
+        assert zf.getinfo("Ana Pérez_123/Tarea.pdf").compress_type == zipfile.ZIP_STORED
+        manifest = zf.read("manifest.csv").decode("utf-8-sig").splitlines()
+        assert manifest[0].startswith("estudiante,cedula")
+        assert any("Luis/Gómez" in line and "archivo no encontrado" in line for line in manifest)
+        assert not any(n.startswith("Luis") for n in names)
+        assert any(line.endswith("sin archivos") for line in manifest)
+        assert zf.testzip() is None
+
+
+# ==================== COURSE DELETION SWEEP TESTS ====================
+
+class TestCourseDeletionSweep:
+    """DELETE /courses/{id} tombstones the course; the sweeper removes its data in batches."""
+
+    def _setup(self, monkeypatch, fake_db, backend):
+        import scheduler.course_sweeper as sweeper
+        import utils.blobs as blobs
+        import utils.storage as storage
+
+        activities = [
+            {"id": f"a{i}", "course_id": "c1", "files": [{"stored_name": f"act{i}.pdf", "storage": "local"}]}
+            for i in range(3)
+        ] + [{"id": "other", "course_id": "c2", "files": []}]
+        shared = {"stored_name": "shared.pdf", "storage": "local", "sha256": "s"}
+        submissions = [
+            {"id": f"s{i}", "activity_id": f"a{i % 3}", "files": [shared] if i == 0 else []} for i in range(5)
+        ]
+        fake_db.install(
+            sweeper, blobs,
+            courses=[{"id": "c1", "name": "Grupo A", "program_id": "p1"}],
+            enrollments=[
+                {"course_id": "c1", "student_id": "s1", "status": "active"},
+                {"course_id": "c2", "student_id": "s1", "status": "active"},
+            ],
+            activities=activities,
+            submissions=submissions,
+            grades=[{"course_id": "c1"}] * 3 + [{"course_id": "c2"}],
+            recovery_enabled=[{"course_id": "c1"}],
+            file_blobs=[{"storage": "local", "stored_name": "shared.pdf", "refcount": 2}],
+        )
+
+        async def _noop(*args, **kwargs):
+            return True
+
+        monkeypatch.setattr(sweeper, "SWEEP_BATCH_SIZE", 2)
+        monkeypatch.setattr(sweeper, "incr_counters", _noop)
+        monkeypatch.setattr(sweeper, "acquire_scheduler_lock", _noop)
+        monkeypatch.setattr(sweeper, "extend_scheduler_lock", _noop)
+        monkeypatch.setattr(sweeper, "release_scheduler_lock", _noop)
+        storage.set_backend("local", backend)
+        return sweeper, fake_db.file_blobs
+
+    @pytest.mark.asyncio
+    async def test_tombstone_then_sweep_in_batches(self, monkeypatch, fake_db):
+        import utils.storage as storage
+        backend = storage.MemoryStorage()
+        backend.objects.update({f"act{i}.pdf": b"%PDF" for i in range(3)})
+        sweeper, fake_blobs = self._setup(monkeypatch, fake_db, backend)
+        try:
+            deletion = await sweeper.tombstone_course(
+                {"id": "c1", "name": "Grupo A", "program_id": "p1"}, {"id": "admin1"}
+            )
+            assert deletion["status"] == "pending"
+            assert fake_db.courses.docs == []
+            assert [r["course_id"] for r in fake_db.enrollments.docs] == ["c2"]
+
+            await sweeper.sweep_course_deletions()
+        finally:
+            storage.set_backend("local", None)
+
+        record = fake_db.course_deletions.docs[0]
+        assert record["status"] == "done" and record["finished_at"]
+        assert record["progress"]["activities"] == 3
+        assert record["progress"]["submissions"] == 5
+        assert record["progress"]["grades"] == 3
+        assert record["progress"]["recovery_enabled"] == 1
+        assert record["progress"]["files_deleted"] == 3
+        assert [a["id"] for a in fake_db.activities.docs] == ["other"]
+        assert fake_db.submissions.docs == []
+        assert len(fake_db.grades.docs) == 1
+        assert set(fake_db.activities.find_limits) == {2}
+        # The shared file is still referenced elsewhere: one reference released, object kept.
+        assert fake_blobs.docs[0]["refcount"] == 1
+        deleted_keys = [k for call in backend.delete_calls for k in call]
+        assert "shared.pdf" not in deleted_keys
+        assert {"act0.pdf", "act1.pdf", "act2.pdf"} <= set(deleted_keys)
+
+    @pytest.mark.asyncio
+    async def test_failed_file_deletes_are_recorded(self, monkeypatch, fake_db):
+        import utils.storage as storage
+
+        class _FailingStorage(storage.MemoryStorage):
+            async def delete_many(self, keys):
+                raise OSError("storage down")
+
+        async def _no_sleep(seconds):
+            return None
+
+        sweeper, _ = self._setup(monkeypatch, fake_db, _FailingStorage())
+        monkeypatch.setattr(storage.asyncio, "sleep", _no_sleep)
+        try:
+            await sweeper.tombstone_course({"id": "c1", "name": "Grupo A"}, {"id": "admin1"})
+            await sweeper.sweep_course_deletions()
+        finally:
+            storage.set_backend("local", None)
+
+        record = fake_db.course_deletions.docs[0]
+        assert record["status"] == "done"
+        assert record["progress"]["files_failed"] == 3
+        assert {"act0.pdf", "act1.pdf", "act2.pdf"} <= set(record["failed_keys"])
+
+    @pytest.mark.asyncio
+    async def test_lost_lock_stops_the_sweep(self, monkeypatch, fake_db):
+        import utils.storage as storage
+        sweeper, _ = self._setup(monkeypatch, fake_db, storage.MemoryStorage())
+
+        async def _lost(*args, **kwargs):
+            return False
+
+        monkeypatch.setattr(sweeper, "extend_scheduler_lock", _lost)
+        try:
+            await sweeper.tombstone_course({"id": "c1", "name": "Grupo A"}, {"id": "admin1"})
+            await sweeper.sweep_course_deletions()
+        finally:
+            storage.set_backend("local", None)
+
+        record = fake_db.course_deletions.docs[0]
+        assert record["status"] == "error"
+        assert len(fake_db.activities.docs) == 4
+
+    @pytest.mark.asyncio
+    async def test_release_leaves_a_lock_taken_over_by_another_worker(self, fake_db):
+        import scheduler.cleanup as cleanup
+        locks = fake_db.install(cleanup).scheduler_locks
+
+        assert await cleanup.acquire_scheduler_lock("course_sweeper", ttl_seconds=300)
+        await cleanup.release_scheduler_lock("course_sweeper")
+        assert locks.docs == []
+
+        locks.docs.append({"lock_name": "course_sweeper", "locked_by": "worker-3-999"})
+        await cleanup.release_scheduler_lock("course_sweeper")
+        assert [lock["locked_by"] for lock in locks.docs] == ["worker-3-999"]
+
+
+# ==================== ENROLLMENTS TESTS ====================
+
+class TestEnrollments:
+    """Course membership lives in `enrollments` rows; courses only keep student_count."""
+
+    def _db(self, fake_db, courses=None, rows=None):
+        import utils.enrollments as enrollments
+        fake_db.install(enrollments, courses=courses, enrollments=rows)
+        return enrollments
+
+    @pytest.mark.asyncio
+    async def test_migration_moves_arrays_into_rows(self, fake_db):
+        enrollments = self._db(fake_db, courses=[
+            {"id": "c1", "program_id": "p1", "created_at": "2025-01-01",
+             "student_ids": ["s1", "s2"], "removed_student_ids": ["s2", "s3"]},
+            {"id": "c2", "program_id": "p1", "student_count": 0},
+        ])
+        assert await enrollments.migrate_course_arrays() == 1
+        course = fake_db.courses.docs[0]
+        assert "student_ids" not in course and "removed_student_ids" not in course
+        assert course["student_count"] == 2
+        rows = {r["student_id"]: r for r in fake_db.enrollments.docs}
+        # s2 is in both arrays (re-enrolled after removal): the active row wins.
+        assert rows["s2"]["status"] == "active" and rows["s3"]["status"] == "removed"
+        assert rows["s1"]["program_id"] == "p1" and rows["s1"]["enrolled_at"] == "2025-01-01"
+        assert await enrollments.course_roster("c1") == (["s1", "s2"], ["s3"])
+        assert await enrollments.migrate_course_arrays() == 0
+
+    @pytest.mark.asyncio
+    async def test_course_arrays_are_read_until_migration_applied(self, fake_db, monkeypatch):
+        import migrations.runner as runner
+        monkeypatch.setattr(runner, "_applied_seen", set())
+        enrollments = self._db(fake_db, courses=[
+            {"id": "c1", "program_id": "p1", "student_ids": ["s1", "s2"], "removed_student_ids": ["s3"]},
+            {"id": "c2", "program_id": "p1", "student_count": 0},
+        ])
+        fake_db.install(runner)
+        assert await enrollments.course_roster("c1") == (["s1", "s2"], ["s3"])
+        assert await enrollments.is_enrolled("c1", "s1")
+        assert await enrollments.course_ids_for_student("s2", "p1") == ["c1"]
+        assert await enrollments.conflicting_course_ids("p1", ["s1"], exclude_course_id="c2") == ["c1"]
+
+        await enrollments.enroll("c2", "p1", ["s4"])
+        await enrollments.mark_removed("c1", ["s1"])
+        await enrollments.unenroll("c1", ["s2"])
+        assert await enrollments.course_roster("c1") == ([], ["s3", "s1"])
+        assert await enrollments.still_enrolled(["s1", "s2", "s4"]) == {"s4"}
+        # s1's removed row overrides the array; s2's manual removal pulled it from the array.
+        assert fake_db.courses.docs[0]["student_ids"] == ["s1"] and fake_db.courses.docs[0]["student_count"] == 0
+
+        # The migration keeps the rows written in the meantime.
+        await enrollments.migrate_course_arrays()
+        enrolled, removed = await enrollments.course_roster("c1")
+        assert enrolled == [] and sorted(removed) == ["s1", "s3"]
+
+    @pytest.mark.asyncio
+    async def test_enroll_remove_and_count(self, fake_db):
+        enrollments = self._db(fake_db, courses=[{"id": "c1"}, {"id": "c2"}])
+        await enrollments.enroll("c1", "p1", ["s1", "s2", "s1"])
+        await enrollments.enroll("c2", "p2", ["s2"])
+        assert fake_db.courses.docs[0]["student_count"] == 2
+        assert await enrollments.is_enrolled("c1", "s2")
+
+        await enrollments.mark_removed("c1", ["s2"])
+        assert fake_db.courses.docs[0]["student_count"] == 1
+        assert not await enrollments.is_enrolled("c1", "s2")
+        assert await enrollments.course_roster("c1") == (["s1"], ["s2"])
+        assert await enrollments.still_enrolled(["s1", "s2", "s9"]) == {"s1", "s2"}
+        assert await enrollments.course_ids_by_student(["s1", "s2"]) == {"s1": ["c1"], "s2": ["c2"]}
+        assert await enrollments.conflicting_course_ids("p1", ["s1"], exclude_course_id="c9") == ["c1"]
+        assert await enrollments.conflicting_course_ids("p1", ["s1"], exclude_course_id="c1") == []
+
+        await enrollments.drop_students(["s2"])
+        assert fake_db.courses.docs[1]["student_count"] == 0
+        assert await enrollments.course_roster("c1") == (["s1"], [])
+
+    @pytest.mark.asyncio
+    async def test_manual_removal_does_not_block_re_enrollment(self, fake_db):
+        import routes.courses as courses
+        import utils.enrollments as enrollments
+        import utils.http_cache as http_cache
+        from models.schemas import CourseUpdate
+        fake_db.install(
+            courses, enrollments, http_cache,
+            courses=[{"id": "c1", "name": "Grupo A", "program_id": "p1", "module_dates": {}}],
+            users=[{"id": sid, "role": "estudiante", "program_modules": {"p1": 1}} for sid in ("s1", "s2")],
+        )
+        admin = {"id": "admin1", "role": "admin"}
+        await enrollments.enroll("c1", "p1", ["s1", "s2"])
+
+        updated = await courses.update_course("c1", CourseUpdate(student_ids=["s1"]), admin)
+        assert updated["student_ids"] == ["s1"] and updated["removed_student_ids"] == []
+
+        updated = await courses.update_course("c1", CourseUpdate(student_ids=["s1", "s2"]), admin)
+        assert sorted(updated["student_ids"]) == ["s1", "s2"]
+        assert fake_db.courses.docs[0]["student_count"] == 2
+
+
+# ==================== RECOVERY STATE TESTS ====================
+
+class TestRecoveryState:
+    """failed_subjects records carry one `state`; transitions go through utils/recovery_state."""
+
+    def _db(self, fake_db, records=None):
+        import utils.recovery_state as recovery_state
+        fake_db.install(recovery_state, failed_subjects=records)
+        return recovery_state
+
+    def test_derive_state_from_legacy_flags(self):
+        from utils import recovery_state as rs
+        assert rs.derive_state({"recovery_approved": False}) == rs.PENDING
+        assert rs.derive_state({"recovery_approved": True}) == rs.APPROVED
+        assert rs.derive_state({"recovery_approved": True, "recovery_completed": True,
+                                "teacher_graded_status": "approved"}) == rs.COMPLETED_OK
+        assert rs.derive_state({"recovery_approved": True, "recovery_completed": True,
+                                "teacher_graded_status": "rejected"}) == rs.COMPLETED_REJECTED
+        assert rs.derive_state({"recovery_rejected": True}) == rs.COMPLETED_REJECTED
+        assert rs.derive_state({"recovery_rejected": True, "recovery_processed": True}) == rs.PROCESSED
+        assert rs.is_passed({"state": rs.COMPLETED_OK})
+        assert not rs.is_passed({"recovery_approved": True, "recovery_completed": True})
+
+    @pytest.mark.asyncio
+    async def test_transitions_write_state_and_flags(self, fake_db):
+        rs = self._db(fake_db, [{"id": "r1", "state": "pending", "recovery_approved": False}])
+        await rs.transition({"id": "r1"}, rs.APPROVED, approved_by="admin")
+        doc = fake_db.failed_subjects.docs[0]
+        assert doc["state"] == rs.APPROVED and doc["recovery_approved"] is True
+        assert doc["approved_by"] == "admin"
+
+        await rs.transition({"id": "r1"}, rs.COMPLETED_OK)
+        assert doc["state"] == rs.COMPLETED_OK and doc["teacher_graded_status"] == "approved"
+        assert rs.derive_state(doc) == rs.COMPLETED_OK
+
+        await rs.transition({"id": "r1"}, rs.PROCESSED)
+        assert doc["state"] == rs.PROCESSED and doc["recovery_processed"] is True
+        # Processed records are final.
+        with pytest.raises(rs.InvalidRecoveryTransition):
+            await rs.transition({"id": "r1"}, rs.APPROVED)
+
+    def test_transition_filter_narrows_existing_state_condition(self):
+        from utils import recovery_state as rs
+        flt = rs.transition_filter({"id": "r1", "state": {"$in": rs.IN_RECOVERY_STATES}}, rs.COMPLETED_REJECTED)
+        assert flt == {"id": "r1", "state": {"$in": [rs.APPROVED, rs.COMPLETED_OK]}}
+        assert rs.transition_filter({"state": rs.PENDING}, rs.COMPLETED_OK)["state"] == {"$in": []}
+
+    @pytest.mark.asyncio
+    async def test_records_without_state_match_on_flags_until_migration_applied(self, fake_db, monkeypatch):
+        import itertools
+        import migrations.runner as runner
+        monkeypatch.setattr(runner, "_applied_seen", set())
+        flags = ["recovery_processed", "recovery_expired", "recovery_rejected", "recovery_completed", "recovery_approved"]
+        records = [
+            {"id": f"r{i}", **dict(zip(flags, values)), "teacher_graded_status": graded}
+            for i, (values, graded) in enumerate(itertools.product(
+                itertools.product([True, False], repeat=len(flags)), ["approved", "rejected"]
+            ))
+        ]
+        rs = self._db(fake_db, records)
+        fake_db.install(runner)
+        for state in rs.UNPROCESSED_STATES + [rs.PROCESSED]:
+            matched = await fake_db.failed_subjects.find(await rs.in_states({}, state)).to_list(None)
+            assert {r["id"] for r in matched} == {r["id"] for r in records if rs.derive_state(r) == state}
+
+        # Transitions accept them too, and write `state`.
+        pending_id = next(r["id"] for r in records if rs.derive_state(r) == rs.PENDING)
+        await rs.transition({"id": pending_id}, rs.APPROVED)
+        assert (await fake_db.failed_subjects.find_one({"id": pending_id}))["state"] == rs.APPROVED
+
+        fake_db.schema_migrations.docs.append({"_id": rs.STATES_MIGRATION, "name": "recovery_states"})
+        assert await rs.in_states({"course_id": "c1"}, rs.OPEN_STATES) == {
+            "course_id": "c1", "state": {"$in": rs.OPEN_STATES},
+        }
+
+    @pytest.mark.asyncio
+    async def test_backfill_sets_state_once(self, fake_db):
+        rs = self._db(fake_db, [
+            {"id": "a", "recovery_approved": False},
+            {"id": "b", "recovery_approved": True, "recovery_completed": True, "teacher_graded_status": "approved"},
+            {"id": "c", "recovery_processed": True},
+            {"id": "d", "state": "approved", "recovery_approved": True},
+        ])
+        assert await rs.backfill_states(batch_size=2) == 3
+        assert [d["state"] for d in fake_db.failed_subjects.docs] == [
+            rs.PENDING, rs.COMPLETED_OK, rs.PROCESSED, rs.APPROVED,
+        ]
+        assert await rs.backfill_states() == 0
+
+
+# ==================== SCHEMA MIGRATION TESTS ====================
+
+class TestSchemaMigrations:
+    """Numbered data migrations run once, under a lock, and are recorded in schema_migrations."""
+
+    def _setup(self, monkeypatch, fake_db, migrations, lock_free=True):
+        import migrations.runner as runner
+        import utils.http_cache as http_cache
+        fake_db.install(runner)
+        calls = {"acquire": 0}
+
+        async def acquire(name, ttl_seconds=300):
+            calls["acquire"] += 1
+            return lock_free
+
+        async def extend(name, ttl_seconds=300):
+            return True
+
+        async def release(name):
+            pass
+
+        async def bump(*keys):
+            pass
+
+        monkeypatch.setattr(runner, "MIGRATIONS", migrations)
+        monkeypatch.setattr(runner, "acquire_scheduler_lock", acquire)
+        monkeypatch.setattr(runner, "extend_scheduler_lock", extend)
+        monkeypatch.setattr(runner, "release_scheduler_lock", release)
+        monkeypatch.setattr(http_cache, "bump_versions", bump)
+        return runner, calls
+
+    def _migrations(self, ran, fail_on=None):
+        from migrations.versions import Migration
+
+        def step(number):
+            async def run():
+                if number == fail_on:
+                    raise ValueError("boom")
+                ran.append(number)
+            return Migration(number, f"step_{number}", run)
+
+        return [step(1), step(2), step(3)]
+
+    @pytest.mark.asyncio
+    async def test_applies_pending_in_order_once(self, monkeypatch, fake_db):
+        ran = []
+        runner, calls = self._setup(monkeypatch, fake_db, self._migrations(ran))
+        await runner.ensure_migrated()
+        assert ran == [1, 2, 3]
+        assert await runner.current_version() == 3
+        assert set(await runner.applied_migrations()) == {1, 2, 3}
+
+        # Current schema: startup reads the head document and takes no lock.
+        await runner.ensure_migrated()
+        assert ran == [1, 2, 3] and calls["acquire"] == 1
+
+    @pytest.mark.asyncio
+    async def test_failure_leaves_migration_pending(self, monkeypatch, fake_db):
+        ran = []
+        runner, _ = self._setup(monkeypatch, fake_db, self._migrations(ran, fail_on=2))
+        await runner.ensure_migrated()
+        assert ran == [1]
+        assert await runner.current_version() == 0
+        assert [m.number for m in await runner.pending_migrations()] == [2, 3]
+
+    @pytest.mark.asyncio
+    async def test_skips_when_another_process_holds_the_lock(self, monkeypatch, fake_db):
+        ran = []
+        runner, _ = self._setup(monkeypatch, fake_db, self._migrations(ran), lock_free=False)
+        assert await runner.run_pending() is None
+        assert ran == []
+
+    def test_registry_numbers_are_unique_and_ordered(self):
+        from migrations.versions import MIGRATIONS
+        numbers = [m.number for m in MIGRATIONS]
+        assert numbers == sorted(numbers) and len(numbers) == len(set(numbers))
+
+
+# ==================== INDEX BOOTSTRAP TESTS ====================
+
+class TestIndexBootstrap:
+    """Startup index work is skipped when the stored fingerprint matches INDEXES."""
+
+    def _db(self, monkeypatch, fake_db, existing=None):
+        import create_indexes as ci
+        monkeypatch.setattr(ci, "INDEXES", [
+            ("users", [("role", 1), ("estado", 1)], {"name": "users_role_estado"}),
+            ("users", [("name", 1)], {"name": "users_name"}),
+            ("rate_limits", [("expires_at", 1)], {"expireAfterSeconds": 0, "name": "rate_limits_ttl"}),
+        ])
+        fake_db.users.indexes = {ix["name"]: ix for ix in existing or []}
+        return ci, fake_db
+
+    @pytest.mark.asyncio
+    async def test_creates_only_missing_then_skips(self, monkeypatch, fake_db):
+        ci, db = self._db(monkeypatch, fake_db, existing=[
+            {"name": "users_role_estado", "key": {"role": 1, "estado": 1}},
+        ])
+        report = await ci.create_indexes(db)
+        assert report["skipped"] is False
+        assert sorted(report["created"]) == ["rate_limits_ttl", "users_name"]
+        assert report["existing"] == 1 and report["errors"] == []
+        # One batched create_indexes call per collection.
+        assert db.users.calls == [("create_indexes", ["users_name"])]
+
+        again = await ci.create_indexes(db)
+        assert again["skipped"] is True
+        assert db.users.calls == [("create_indexes", ["users_name"])]
+
+    @pytest.mark.asyncio
+    async def test_changed_definition_is_recreated_and_fingerprint_refreshed(self, monkeypatch, fake_db):
+        ci, db = self._db(monkeypatch, fake_db, existing=[
+            {"name": "users_role_estado", "key": {"role": 1, "estado": -1}},
+        ])
+        report = await ci.create_indexes(db)
+        assert report["recreated"] == ["users_role_estado"]
+        assert ("drop_index", "users_role_estado") in db.users.calls
+
+        monkeypatch.setattr(ci, "INDEXES", ci.INDEXES + [
+            ("users", [("cedula", 1)], {"sparse": True, "name": "users_cedula"}),
+        ])
+        report = await ci.create_indexes(db)
+        assert report["skipped"] is False and report["created"] == ["users_cedula"]
+
+    @pytest.mark.asyncio
+    async def test_other_workers_skip_while_one_syncs(self, monkeypatch, fake_db):
+        from datetime import datetime, timedelta, timezone
+        ci, db = self._db(monkeypatch, fake_db)
+        db.index_state.docs.append({
+            "_id": ci.LOCK_DOC_ID, "locked_by": "worker-1-123",
+            "expires_at": datetime.now(timezone.utc) + timedelta(minutes=5),
+        })
+        report = await ci.create_indexes(db)
+        assert report["skipped"] is True and report["locked"] is True
+        assert db.users.calls == []
+
+        db.index_state.docs[0]["expires_at"] = datetime.now(timezone.utc) - timedelta(seconds=1)
+        report = await ci.create_indexes(db)
+        assert sorted(report["created"]) == ["rate_limits_ttl", "users_name", "users_role_estado"]
+        assert [d["_id"] for d in db.index_state.docs] == [ci.FINGERPRINT_DOC_ID]
+
+    def test_every_index_is_named_once(self):
+        import create_indexes as ci
+        names = [options.get("name") for _, _, options in ci.INDEXES]
+        assert None not in names and len(names) == len(set(names))
+
+
+# ==================== ORPHAN COLLECTOR TESTS ====================
+
+class TestOrphanCollector:
+    """The orphan collector walks collections in _id order with a resumable cursor."""
+
+    def _setup(self, monkeypatch, fake_db, backend):
+        import scheduler.orphan_collector as collector
+        import utils.blobs as blobs
+        import utils.storage as storage
+
+        fake_db.install(
+            collector, blobs,
+            courses=[{"id": "c1"}],
+            course_deletions=[{"course_id": "c3", "status": "running"}],
+            activities=[
+                {"id": "a1", "course_id": "c1", "files": []},
+                {"id": "a2", "course_id": "gone", "files": [{"stored_name": "old.pdf", "storage": "local"}]},
+                {"id": "a3", "course_id": "c3", "files": []},
+            ],
+            submissions=[
+                {"id": "s1", "activity_id": "a1", "course_id": "c1"},
+                {"id": "s2", "activity_id": "a2", "course_id": "gone"},
+                {"id": "s3", "activity_id": "a9", "course_id": "c1"},
+            ],
+            grades=[{"course_id": "c1"}, {"course_id": "gone"}, {"course_id": None}, {"course_id": "gone"}],
+            enrollments=[{"course_id": "gone", "student_id": "x"}],
+        )
+
+        async def _noop(*args, **kwargs):
+            return True
+
+        monkeypatch.setattr(collector, "BATCH_SIZE", 2)
+        monkeypatch.setattr(collector, "BATCH_PAUSE_SECONDS", 0)
+        monkeypatch.setattr(collector, "incr_counters", _noop)
+        monkeypatch.setattr(collector, "acquire_scheduler_lock", _noop)
+        monkeypatch.setattr(collector, "extend_scheduler_lock", _noop)
+        monkeypatch.setattr(collector, "release_scheduler_lock", _noop)
+        storage.set_backend("local", backend)
+        return collector
+
+    @pytest.mark.asyncio
+    async def test_full_run_deletes_orphans_only(self, monkeypatch, fake_db):
+        import utils.storage as storage
+        backend = storage.MemoryStorage()
+        backend.objects["old.pdf"] = b"%PDF"
+        collector = self._setup(monkeypatch, fake_db, backend)
+        try:
+            await collector.collect_orphans()
+        finally:
+            storage.set_backend("local", None)
+
+        # a3 belongs to a course the sweeper is still deleting; it is left to the sweeper.
+        assert [a["id"] for a in fake_db.activities.docs] == ["a1", "a3"]
+        assert [s["id"] for s in fake_db.submissions.docs] == ["s1"]
+        assert [g["course_id"] for g in fake_db.grades.docs] == ["c1", None]
+        assert fake_db.enrollments.docs == []
+        assert "old.pdf" not in backend.objects
+
+        state = {s["_id"]: s for s in fake_db.orphan_collector.docs}
+        assert state["grades"]["last_pass_deleted"] == 2 and state["grades"]["passes"] == 1
+        assert state["grades"]["last_id"] is None
+
+    @pytest.mark.asyncio
+    async def test_cursor_resumes_after_batch_budget(self, monkeypatch, fake_db):
+        import utils.storage as storage
+        collector = self._setup(monkeypatch, fake_db, storage.MemoryStorage())
+        try:
+            first = await collector.collect_collection("grades", "course_id", "courses", max_batches=1)
+            assert first == {"scanned": 2, "deleted": 1, "files_deleted": 0, "pass_done": False}
+            assert fake_db.orphan_collector.docs[0]["last_id"] == 1
+
+            second = await collector.collect_collection("grades", "course_id", "courses", max_batches=5)
+            assert second["pass_done"] and second["scanned"] == 2 and second["deleted"] == 1
+            status = {s["collection"]: s for s in await collector.collector_status()}
+            assert status["grades"]["last_pass_scanned"] == 4
+            assert status["grades"]["in_progress"] is False
+        finally:
+            storage.set_backend("local", None)
+
+
+# ==================== QUERY METRICS TESTS ====================
+
+class TestQueryMetrics:
+    """Driver command events are attributed to the request (route template) that issued them."""
+
+    def _event(self, name, collection="users", micros=1500, reply=None, request_id=1):
+        command = {name: collection}
+        return types.SimpleNamespace(
+            command_name=name, command=command, connection_id=("localhost", 27017),
+            request_id=request_id, duration_micros=micros, reply=reply or {"ok": 1},
+        )
+
+    def _emit(self, listener, event):
+        """Fire started/succeeded from an executor thread with the caller's context, as Motor does."""
+        import contextvars
+        import concurrent.futures
+        ctx = contextvars.copy_context()
+
+        def run():
+            listener.started(event)
+            listener.succeeded(event)
+
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            pool.submit(ctx.run, run).result()
+
+    def test_commands_are_aggregated_per_route(self):
+        from fastapi import FastAPI
+        from fastapi.testclient import TestClient
+        from utils import query_metrics
+
+        query_metrics.reset()
+        listener = query_metrics.QueryMetricsListener()
+        app = FastAPI()
+        app.add_middleware(query_metrics.QueryMetricsMiddleware)
+
+        @app.get("/items/{item_id}")
+        async def get_item(item_id: str):
+            self._emit(listener, self._event("find", reply={"cursor": {"firstBatch": [{}, {}, {}]}}))
+            self._emit(listener, self._event("find", request_id=2))
+            self._emit(listener, self._event("count", request_id=3))
+            return {"commands": query_metrics.current_stats()["commands"]}
+
+        client = TestClient(app)
+        assert client.get("/items/a").json() == {"commands": 3}
+        client.get("/items/b")
+        self._emit(listener, self._event("delete", micros=500))
+
+        snap = query_metrics.snapshot()
+        routes = {r["route"]: r for r in snap["routes"]}
+        item = routes["GET /items/{item_id}"]
+        assert item["requests"] == 2 and item["commands"] == 6 and item["docs"] == 6
+        assert item["by_command"] == {"find": 4, "count": 2}
+        assert item["max_commands_per_request"] == 3 and item["avg_commands_per_request"] == 3
+        assert routes[query_metrics.BACKGROUND_ROUTE]["commands"] == 1
+        query_metrics.reset()
+
+    def test_slow_commands_are_logged(self, monkeypatch, caplog):
+        from utils import query_metrics
+        monkeypatch.setattr(query_metrics, "SLOW_QUERY_MS", 100)
+        listener = query_metrics.QueryMetricsListener()
+        with caplog.at_level(logging.WARNING, logger="utils.query_metrics"):
+            self._emit(listener, self._event("aggregate", collection="grades", micros=250_000))
+            self._emit(listener, self._event("find", micros=5_000, request_id=2))
+        slow = [r.getMessage() for r in caplog.records if "Slow MongoDB command" in r.getMessage()]
+        assert len(slow) == 1 and "aggregate on grades" in slow[0]
+        query_metrics.reset()
+
+
+# ==================== HTTP METRICS TESTS ====================
+
+class TestHttpMetrics:
+    """Per-route latency metrics, Server-Timing and the multi-worker metrics store."""
+
+    @pytest.fixture(autouse=True)
+    def _metrics_dir(self, tmp_path, monkeypatch):
+        from utils import http_metrics
+        monkeypatch.setattr(http_metrics, "METRICS_DIR", str(tmp_path))
+        monkeypatch.setattr(http_metrics, "_dir_ok", None)
+        http_metrics.reset()
+        yield tmp_path
+        http_metrics.reset()
+
+    def _client(self):
+        from fastapi import FastAPI, HTTPException
+        from fastapi.testclient import TestClient
+        from utils import query_metrics
+        from utils.http_metrics import HttpMetricsMiddleware
+
+        app = FastAPI()
+        app.add_middleware(HttpMetricsMiddleware)
+        app.add_middleware(query_metrics.QueryMetricsMiddleware)
+
+        @app.get("/items/{item_id}")
+        async def get_item(item_id: str):
+            if item_id == "missing":
+                raise HTTPException(status_code=404, detail="No encontrado")
+            query_metrics.current_stats()["duration_ms"] += 4.0
+            return {"id": item_id}
+
+        return TestClient(app)
+
+    def test_requests_are_recorded_per_route_template(self):
+        from utils import http_metrics
+        client = self._client()
+        response = client.get("/items/a")
+        client.get("/items/b")
+        client.get("/items/missing")
+        client.get("/nope")
+
+        timing = response.headers["server-timing"]
+        assert timing.startswith("db;dur=4.0, app;dur=") and "total;dur=" in timing
+
+        total = http_metrics.collect()
+        item = total[("GET", "/items/{item_id}")]
+        assert item["statuses"] == {"200": 2, "404": 1}
+        assert sum(item["buckets"]) == 3
+        assert item["db_sum"] == pytest.approx(0.008)
+        assert item["in_progress"] == 0
+        assert total[("GET", "(unmatched)")]["statuses"] == {"404": 1}
+
+    def test_prometheus_output_merges_worker_files(self, _metrics_dir):
+        from utils import http_metrics
+        self._client().get("/items/a")
+        other = {"pid": os.getpid() + 100000, "series": [["GET", "/items/{item_id}", {
+            "statuses": {"200": 5}, "buckets": [5] + [0] * len(http_metrics.BUCKETS),
+            "sum": 0.01, "db_sum": 0.0, "in_progress": 2,
+        }]]}
+        http_metrics._write_json(str(_metrics_dir / f"{other['pid']}.json"), other)
+
+        text = http_metrics.render_prometheus()
+        labels = 'method="GET",route="/items/{item_id}"'
+        assert f'http_requests_total{{{labels},status="200"}} 6' in text
+        assert f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 6' in text
+        assert f"http_request_duration_seconds_count{{{labels}}} 6" in text
+        # The other pid is not running, so its in-flight gauge is ignored.
+        assert f"http_requests_in_progress{{{labels}}} 0" in text
+        assert "# TYPE http_request_duration_seconds histogram" in text
+
+    def test_dead_worker_counts_move_to_archive(self, _metrics_dir):
+        from utils import http_metrics
+        self._client().get("/items/a")
+        http_metrics.flush()
+        pid = os.getpid()
+        assert (_metrics_dir / f"{pid}.json").exists()
+
+        http_metrics.mark_process_dead(pid, str(_metrics_dir))
+        assert not (_metrics_dir / f"{pid}.json").exists()
+        http_metrics.reset()
+        assert http_metrics.collect()[("GET", "/items/{item_id}")]["statuses"] == {"200": 1}
+
+        http_metrics.clear_directory(str(_metrics_dir))
+        assert http_metrics.collect() == {}
+
+    def test_metrics_endpoint_token(self, monkeypatch):
+        import config
+        from fastapi.testclient import TestClient
+        from app import app
+        monkeypatch.setattr(config, "METRICS_TOKEN", "s3cret")
+        client = TestClient(app)
+        assert client.get("/api/metrics").status_code == 401
+        response = client.get("/api/metrics", headers={"Authorization": "Bearer s3cret"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+
+    def test_metrics_endpoint_without_token_requires_admin(self, monkeypatch):
+        import config
+        from fastapi.testclient import TestClient
+        from utils import security
+        from app import app
+        monkeypatch.setattr(config, "METRICS_TOKEN", None)
+        users = {"Bearer admin": {"id": "a1", "role": "admin"}, "Bearer prof": {"id": "p1", "role": "profesor"}}
+
+        async def fake_current_user(authorization=None):
+            if authorization not in users:
+                raise security.HTTPException(status_code=401, detail="No autorizado")
+            return users[authorization]
+
+        monkeypatch.setattr(security, "get_current_user", fake_current_user)
+        client = TestClient(app)
+        assert client.get("/api/metrics").status_code == 401
+        assert client.get("/api/metrics", headers={"Authorization": "Bearer prof"}).status_code == 403
+        assert client.get("/api/metrics", headers={"Authorization": "Bearer admin"}).status_code == 200
+
+
+
+# ==================== SECURITY HEADERS TESTS ====================
+
+class TestSecurityHeadersMiddleware:
+    """The pure ASGI security headers middleware keeps the BaseHTTPMiddleware behaviour."""
+
+    def _app(self):
+        from fastapi import FastAPI
+        from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+        from app import SecurityHeadersMiddleware
+
+        app = FastAPI()
+        app.add_middleware(SecurityHeadersMiddleware)
+
+        @app.get("/api/data")
+        async def data():
+            return JSONResponse({"ok": True}, headers={"X-Frame-Options": "SAMEORIGIN"})
+
+        @app.get("/page")
+        async def page():
+            return HTMLResponse("<p>hola</p>")
+
+        @app.get("/api/auth/token")
+        async def token():
+            return {"ok": True}
+
+        @app.get("/api/auth/me")
+        async def me():
+            return JSONResponse({"ok": True}, headers={"Cache-Control": "private, no-cache"})
+
+        @app.get("/export")
+        async def export():
+            async def chunks():
+                for i in range(3):
+                    yield f"fila {i}\n".encode()
+            return StreamingResponse(chunks(), media_type="text/csv")
+
+        return app
+
+    def test_headers_added_and_replaced(self):
+        from fastapi.testclient import TestClient
+        client = TestClient(self._app())
+        response = client.get("/api/data")
+        assert response.headers["x-content-type-options"] == "nosniff"
+        assert response.headers.get_list("x-frame-options") == ["DENY"]
+        assert response.headers["permissions-policy"] == "camera=(), microphone=(), geolocation=()"
+        assert "content-security-policy" not in response.headers
+        assert "strict-transport-security" not in response.headers
+        assert "cache-control" not in response.headers
+
+    def test_csp_only_on_html_and_hsts_only_on_https(self):
+        from fastapi.testclient import TestClient
+        page = TestClient(self._app(), base_url="https://testserver").get("/page")
+        assert page.headers["content-security-policy"].startswith("default-src 'self'; script-src 'self'")
+        assert page.headers["strict-transport-security"] == "max-age=31536000; includeSubDomains"
+
+    def test_auth_routes_default_to_no_store(self):
+        from fastapi.testclient import TestClient
+        client = TestClient(self._app())
+        assert client.get("/api/auth/token").headers["cache-control"] == "no-store"
+        assert client.get("/api/auth/me").headers.get_list("cache-control") == ["private, no-cache"]
+
+    def test_streaming_body_passes_through_chunk_by_chunk(self):
+        import asyncio
+        messages = []
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/export", "raw_path": b"/export",
+                 "root_path": "", "scheme": "http", "query_string": b"", "headers": [],
+                 "http_version": "1.1", "server": ("testserver", 80), "client": ("test", 1)}
+        asyncio.run(self._app()(scope, receive, send))
+        bodies = [m["body"] for m in messages if m["type"] == "http.response.body" and m.get("body")]
+        assert bodies == [b"fila 0\n", b"fila 1\n", b"fila 2\n"]
+        start = next(m for m in messages if m["type"] == "http.response.start")
+        assert (b"x-frame-options", b"DENY") in start["headers"]
+
+
+# ==================== LOOP MONITOR TESTS ====================
+
+class TestLoopMonitor:
+    """The loop-lag watchdog records lag samples and captures the stack of a blocking call."""
+
+    @pytest.fixture(autouse=True)
+    def _monitor(self, monkeypatch):
+        from utils import loop_monitor
+        monkeypatch.setattr(loop_monitor, "LOOP_MONITOR_ENABLED", True)
+        monkeypatch.setattr(loop_monitor, "LOOP_MONITOR_INTERVAL_MS", 20)
+        monkeypatch.setattr(loop_monitor, "LOOP_LAG_THRESHOLD_MS", 100)
+        loop_monitor.reset()
+        yield loop_monitor
+        loop_monitor.stop()
+        loop_monitor.reset()
+
+    def test_blocking_call_is_captured(self, _monitor):
+        import asyncio
+        import time as _time
+
+        def blocking_report_export():
+            _time.sleep(0.4)
+
+        async def main():
+            _monitor.start()
+            await asyncio.sleep(0.1)
+            blocking_report_export()
+            await asyncio.sleep(0.1)
+            summary = _monitor.summary()
+            _monitor.stop()
+            return summary
+
+        summary = asyncio.run(main())
+        assert summary["samples"] >= 3
+        assert summary["stalls"] == 1
+        assert summary["max"] >= 0.3
+        assert summary["p50"] < 0.1
+        stall = _monitor.recent_stalls()[0]
+        assert "blocking_report_export" in stall["stack"]
+        assert stall["blocked_ms_at_capture"] >= 100
+        assert stall["lag_ms"] >= 300
+
+    def test_disabled_monitor_reports_nothing(self, _monitor, monkeypatch):
+        import asyncio
+        monkeypatch.setattr(_monitor, "LOOP_MONITOR_ENABLED", False)
+
+        async def main():
+            _monitor.start()
+            return _monitor.summary()
+
+        assert asyncio.run(main()) is None
+        assert _monitor.status()["enabled"] is False
+
+    def test_lag_percentiles_on_metrics_endpoint(self, _monitor, tmp_path, monkeypatch):
+        import asyncio
+        from utils import http_metrics
+        monkeypatch.setattr(http_metrics, "METRICS_DIR", str(tmp_path))
+        monkeypatch.setattr(http_metrics, "_dir_ok", None)
+
+        async def main():
+            _monitor.start()
+            await asyncio.sleep(0.1)
+            text = http_metrics.render_prometheus()
+            _monitor.stop()
+            return text
+
+        text = asyncio.run(main())
+        pid = os.getpid()
+        assert "# TYPE event_loop_lag_seconds summary" in text
+        assert f'event_loop_lag_seconds{{pid="{pid}",quantile="0.99"}}' in text
+        assert f'event_loop_stalls_total{{pid="{pid}"}} 0' in text